@@ -0,0 +1,316 @@
+"""
+Teste de carga de ponta a ponta: inicia um cluster e um servidor no loopback e os
+exercita com clientes sintéticos (mygeo.Client, um por thread) executando uma mistura
+de UPLOAD, LIST, DOWNLOAD e DELETE, em cada nível de concorrência pedido.
+
+Para cada nível são medidos a vazão (operações/s e MB/s), a latência p50/p95/p99 por
+operação, as falhas e o tempo de CPU do servidor, do cluster e dos clientes por MB
+transferido. O resultado é gravado em JSON; com --comparar, cada nível é comparado com
+o de uma execução anterior, e as regressões acima de --tolerancia são apontadas (o
+código de saída passa a ser 1), para que mudanças nos caminhos de transferência
+apareçam de uma execução para a outra.
+
+Os tamanhos das imagens seguem os das cenas amazonia*.tif de imagensSatelite/ (o
+conteúdo delas é o enviado); sem as cenas, são rasters sintéticos com tamanhos numa
+distribuição log-normal em torno de --tamanho-mediano-mb. Os downloads leem um acervo
+inicial de --acervo imagens; cada cliente só remove imagens que ele mesmo enviou, então
+uma falha é sempre um erro real.
+
+Uso:
+    python benchmarks/bench_carga.py [--concorrencia 1 4 16] [--duracao 20]
+        [--mistura upload=20,list=10,download=60,delete=10] [--cenas arquivos...]
+        [--args-servidor="--conexoes-cluster 16"] [--saida carga.json] [--comparar anterior.json]
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+from comum import protocolo
+from mygeo import Client, ServerError
+from bench_compressao import raster_sintetico
+from bench_conexoes import aguardar_porta, percentil, porta_livre
+
+OPERACOES = ["upload", "list", "download", "delete"]
+TICKS_POR_SEGUNDO = os.sysconf("SC_CLK_TCK")
+
+
+def ler_mistura(texto):
+    """Converte "upload=20,download=80" em pesos por operação."""
+    pesos = dict.fromkeys(OPERACOES, 0)
+    for item in texto.split(","):
+        operacao, _, peso = item.partition("=")
+        if operacao.strip() not in pesos:
+            raise argparse.ArgumentTypeError(f"Operação desconhecida: {operacao}")
+        pesos[operacao.strip()] = float(peso)
+    if not any(pesos.values()):
+        raise argparse.ArgumentTypeError("A mistura precisa de ao menos uma operação com peso")
+    return pesos
+
+
+def tempo_cpu(pid):
+    """Segundos de CPU (usuário + sistema, incluindo filhos aguardados) de um processo (Linux)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # O nome do processo, entre parênteses, pode conter espaços
+            campos = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return 0.0
+    return sum(int(valor) for valor in campos[11:15]) / TICKS_POR_SEGUNDO
+
+
+class Carga:
+    """Gera o conteúdo das imagens: as cenas reais, ou recortes de um raster sintético."""
+
+    def __init__(self, cenas, mediana_mb, maximo_mb, semente):
+        self.gerador = random.Random(semente)
+        self.cenas = []
+        for caminho in cenas:
+            with open(caminho, "rb") as f:
+                self.cenas.append(f.read())
+        self.mediana = mediana_mb * 1024 * 1024
+        self.maximo = maximo_mb * 1024 * 1024
+        self.raster = None if self.cenas else memoryview(raster_sintetico(maximo_mb))
+
+    def descricao(self):
+        if self.cenas:
+            return {"origem": "cenas", "tamanhos": [len(cena) for cena in self.cenas]}
+        return {"origem": "sintetico", "mediana_bytes": self.mediana, "maximo_bytes": self.maximo}
+
+    def imagem(self, gerador):
+        if self.cenas:
+            return gerador.choice(self.cenas)
+        tamanho = int(min(self.maximo, max(64 * 1024, gerador.lognormvariate(0, 0.6) * self.mediana)))
+        return self.raster[:tamanho]
+
+
+class ClienteSintetico(threading.Thread):
+    """Um cliente que sorteia operações pela mistura até o fim do nível, anotando cada uma."""
+
+    def __init__(self, indice, porta, carga, acervo, mistura, fim, semente):
+        super().__init__(daemon=True)
+        self.indice = indice
+        self.porta = porta
+        self.carga = carga
+        self.acervo = acervo
+        self.operacoes, self.pesos = zip(*mistura.items())
+        self.fim = fim
+        self.gerador = random.Random(semente)
+        self.enviadas = []  # Imagens deste cliente que ainda podem ser removidas
+        self.contador = itertools.count()
+        self.registros = []  # (operação, segundos, bytes, erro ou None)
+
+    def run(self):
+        with Client(port=self.porta, pool_size=1) as cliente:
+            while time.perf_counter() < self.fim:
+                operacao = self.gerador.choices(self.operacoes, self.pesos)[0]
+                if operacao == "delete" and not self.enviadas:
+                    operacao = "upload"
+                inicio = time.perf_counter()
+                try:
+                    transferidos = getattr(self, operacao)(cliente)
+                    erro = None
+                except (ServerError, protocolo.ErroProtocolo, OSError) as e:
+                    transferidos, erro = 0, f"{type(e).__name__}: {e}"
+                self.registros.append((operacao, time.perf_counter() - inicio, transferidos, erro))
+
+    def upload(self, cliente):
+        nome = f"carga_{self.indice}_{next(self.contador)}.tif"
+        dados = self.carga.imagem(self.gerador)
+        cliente.upload(nome, dados)
+        self.enviadas.append(nome)
+        return len(dados)
+
+    def list(self, cliente):
+        list(itertools.islice(cliente.list(), protocolo.LIMITE_LISTAGEM))  # Só a primeira página
+        return 0
+
+    def download(self, cliente):
+        return len(cliente.download(self.gerador.choice(self.acervo)))
+
+    def delete(self, cliente):
+        cliente.delete(self.enviadas.pop(self.gerador.randrange(len(self.enviadas))))
+        return 0
+
+
+def resumir(registros, duracao):
+    """Vazão, latência e falhas por operação (e no total) de um nível."""
+    resumo = {}
+    for operacao in OPERACOES + ["total"]:
+        selecionados = [r for r in registros if operacao in ("total", r[0])]
+        if not selecionados:
+            continue
+        latencias = [r[1] for r in selecionados if r[3] is None]
+        transferidos = sum(r[2] for r in selecionados)
+        erros = [r[3] for r in selecionados if r[3] is not None]
+        resumo[operacao] = {
+            "quantidade": len(selecionados),
+            "falhas": len(erros),
+            "exemplos_falha": sorted(set(erros))[:3],
+            "ops_por_s": len(latencias) / duracao,
+            "mb_por_s": transferidos / duracao / (1024 * 1024),
+            "latencia_ms": {f"p{p}": (percentil(latencias, p) or 0) * 1000 for p in (50, 95, 99)},
+        }
+    return resumo
+
+
+def rodar_nivel(porta, carga, acervo, mistura, concorrencia, duracao, semente, processos):
+    cpu_antes = {nome: tempo_cpu(pid) for nome, pid in processos.items()}
+    cpu_cliente = sum(os.times()[:2])
+    fim = time.perf_counter() + duracao
+    clientes = [ClienteSintetico(i, porta, carga, acervo, mistura, fim, semente * 1000 + i)
+                for i in range(concorrencia)]
+    inicio = time.perf_counter()
+    for cliente in clientes:
+        cliente.start()
+    for cliente in clientes:
+        cliente.join()
+    decorrido = time.perf_counter() - inicio
+
+    registros = [registro for cliente in clientes for registro in cliente.registros]
+    megabytes = sum(r[2] for r in registros) / (1024 * 1024)
+    cpu = {nome: tempo_cpu(pid) - cpu_antes[nome] for nome, pid in processos.items()}
+    cpu["clientes"] = sum(os.times()[:2]) - cpu_cliente
+    # Remove o que sobrou dos uploads para o próximo nível partir do mesmo acervo
+    with Client(port=porta) as cliente:
+        cliente.delete_many([nome for c in clientes for nome in c.enviadas])
+        estatisticas = cliente.stats()
+    return {
+        "concorrencia": concorrencia,
+        "duracao_s": decorrido,
+        "megabytes": megabytes,
+        "operacoes": resumir(registros, decorrido),
+        "cpu_s": cpu,
+        "cpu_ms_por_mb": {nome: segundos * 1000 / megabytes if megabytes else None
+                          for nome, segundos in cpu.items()},
+        "servidor": estatisticas,
+    }
+
+
+def exibir_nivel(nivel):
+    print(f"\nconcorrência {nivel['concorrencia']}: {nivel['megabytes']:.1f} MB em {nivel['duracao_s']:.1f} s, "
+          "CPU ms/MB " + ", ".join(f"{nome} {valor:.1f}" for nome, valor in nivel["cpu_ms_por_mb"].items()
+                                   if valor is not None))
+    print(f"  {'operação':9} {'qtd':>6} {'falhas':>7} {'ops/s':>8} {'MB/s':>8} {'p50(ms)':>9} "
+          f"{'p95(ms)':>9} {'p99(ms)':>9}")
+    for operacao, r in nivel["operacoes"].items():
+        latencia = r["latencia_ms"]
+        print(f"  {operacao:9} {r['quantidade']:>6} {r['falhas']:>7} {r['ops_por_s']:>8.1f} {r['mb_por_s']:>8.1f} "
+              f"{latencia['p50']:>9.1f} {latencia['p95']:>9.1f} {latencia['p99']:>9.1f}")
+
+
+def comparar(anterior, atual, tolerancia):
+    """Compara vazão e p95 de cada operação com a execução anterior. Retorna o número de regressões."""
+    niveis_anteriores = {nivel["concorrencia"]: nivel for nivel in anterior["niveis"]}
+    regressoes = 0
+    print(f"\nComparação com {anterior['inicio']} (tolerância {tolerancia:.0%}):")
+    for nivel in atual["niveis"]:
+        base = niveis_anteriores.get(nivel["concorrencia"])
+        if base is None:
+            continue
+        for operacao, r in nivel["operacoes"].items():
+            b = base["operacoes"].get(operacao)
+            if not b or not b["ops_por_s"] or not b["latencia_ms"]["p95"]:
+                continue
+            vazao = r["ops_por_s"] / b["ops_por_s"] - 1
+            p95 = r["latencia_ms"]["p95"] / b["latencia_ms"]["p95"] - 1
+            regressao = vazao < -tolerancia or p95 > tolerancia
+            regressoes += regressao
+            print(f"  concorrência {nivel['concorrencia']:>4} {operacao:9} ops/s {vazao:>+7.1%}  p95 {p95:>+7.1%}"
+                  f"{'  REGRESSÃO' if regressao else ''}")
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concorrencia", type=int, nargs="+", default=[1, 4, 16], help="Clientes simultâneos")
+    parser.add_argument("--duracao", type=float, default=20, help="Segundos de carga em cada nível")
+    parser.add_argument("--mistura", type=ler_mistura, default="upload=20,list=10,download=60,delete=10",
+                        help="Peso de cada operação")
+    parser.add_argument("--cenas", nargs="*", help="Arquivos enviados (padrão: imagensSatelite/amazonia*.tif)")
+    parser.add_argument("--tamanho-mediano-mb", type=float, default=8, help="Mediana das imagens sintéticas")
+    parser.add_argument("--tamanho-maximo-mb", type=int, default=64, help="Maior imagem sintética")
+    parser.add_argument("--acervo", type=int, default=20, help="Imagens enviadas antes da carga, lidas nos downloads")
+    parser.add_argument("--semente", type=int, default=1)
+    parser.add_argument("--args-servidor", default="",
+                        help="Argumentos extras do servidor (ex.: --args-servidor=\"--conexoes-cluster 16\")")
+    parser.add_argument("--args-cluster", default="",
+                        help="Argumentos extras do cluster (ex.: --args-cluster=\"--deduplicar\")")
+    parser.add_argument("--saida", help="Arquivo JSON do resultado (padrão: carga_<data>.json)")
+    parser.add_argument("--comparar", help="JSON de uma execução anterior")
+    parser.add_argument("--tolerancia", type=float, default=0.10, help="Piora tolerada na comparação (fração)")
+    args = parser.parse_args()
+
+    cenas = args.cenas if args.cenas is not None else sorted(glob.glob(os.path.join(RAIZ, "imagensSatelite",
+                                                                                    "amazonia*.tif")))
+    carga = Carga(cenas, args.tamanho_mediano_mb, args.tamanho_maximo_mb, args.semente)
+    inicio = datetime.now()
+    resultado = {
+        "inicio": inicio.isoformat(timespec="seconds"),
+        "ambiente": {"python": platform.python_version(), "plataforma": platform.platform(),
+                     "cpus": os.cpu_count(), "commit": subprocess.run(
+                         ["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True,
+                         text=True).stdout.strip() or None},
+        "parametros": {"mistura": args.mistura, "duracao_s": args.duracao, "acervo": args.acervo,
+                       "semente": args.semente, "args_servidor": args.args_servidor,
+                       "args_cluster": args.args_cluster, "imagens": carga.descricao()},
+        "niveis": [],
+    }
+
+    with tempfile.TemporaryDirectory() as diretorio:
+        porta_cluster, porta = porta_livre(), porta_livre()
+        cluster = subprocess.Popen([sys.executable, os.path.join(RAIZ, "cluster", "cluster.py"),
+                                    "--porta", str(porta_cluster), "--diretorio", diretorio,
+                                    *shlex.split(args.args_cluster)],
+                                   cwd=diretorio, stdout=subprocess.DEVNULL)
+        servidor = subprocess.Popen([sys.executable, os.path.join(RAIZ, "servidor", "servidor.py"),
+                                     "--porta", str(porta), "--cluster-porta", str(porta_cluster),
+                                     *shlex.split(args.args_servidor)],
+                                    stdout=subprocess.DEVNULL)
+        try:
+            aguardar_porta(porta_cluster)
+            aguardar_porta(porta)
+            gerador = random.Random(args.semente)
+            acervo = [f"acervo_{i}.tif" for i in range(args.acervo)]
+            with Client(port=porta) as cliente:
+                for nome in acervo:
+                    cliente.upload(nome, carga.imagem(gerador))
+            processos = {"servidor": servidor.pid, "cluster": cluster.pid}
+            for concorrencia in args.concorrencia:
+                nivel = rodar_nivel(porta, carga, acervo, args.mistura, concorrencia, args.duracao,
+                                    args.semente, processos)
+                exibir_nivel(nivel)
+                resultado["niveis"].append(nivel)
+        finally:
+            servidor.kill()
+            cluster.kill()
+            servidor.wait()
+            cluster.wait()
+
+    saida = args.saida or f"carga_{inicio:%Y%m%d_%H%M%S}.json"
+    with open(saida, "w") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"\nResultado gravado em {saida}")
+
+    if args.comparar:
+        with open(args.comparar) as f:
+            regressoes = comparar(json.load(f), resultado, args.tolerancia)
+        if regressoes:
+            print(f"{regressoes} regressão(ões) acima da tolerância")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark dos codecs da compressão em trechos (comum/compressao.py): para cada
+arquivo e codec disponível, mede a taxa de compressão e a vazão de compressão e
+de descompressão, em MB/s de dados originais.
+
+A última coluna estima a vazão efetiva de um UPLOAD num enlace de --enlace-mbps:
+o arquivo é comprimido antes do envio, então o tempo total é o da compressão
+mais o da transmissão dos bytes comprimidos. A linha "nenhum" é a transferência
+crua, para comparação.
+
+Por padrão usa as cenas amazonia*.tif de imagensSatelite/ (os arquivos não
+acompanham o repositório; veja imagensSatelite/link.txt). Sem elas, passe os
+caminhos dos arquivos ou use --sintetico para gerar um raster de teste.
+
+Uso:
+    python benchmarks/bench_compressao.py [arquivos...] [--sintetico 64] [--enlace-mbps 100]
+"""
+import argparse
+import glob
+import io
+import os
+import random
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+from comum import compressao
+
+
+def raster_sintetico(tamanho_mb):
+    """Bytes de um raster de 8 bits com um gradiente suave e ruído por pixel, parecido com uma banda de satélite."""
+    gerador = random.Random(0)
+    largura = 4096
+    linhas = []
+    for linha in range(tamanho_mb * 1024 * 1024 // largura):
+        # Ruído de 3 bits somado ao nível da linha, aplicado com translate (sem laço por pixel)
+        nivel = 60 + linha // 64 % 120
+        tabela = bytes((nivel + b % 8) % 256 for b in range(256))
+        linhas.append(gerador.randbytes(largura).translate(tabela))
+    return b"".join(linhas)
+
+
+def medir(dados, codec):
+    """Comprime e descomprime `dados` em trechos. Retorna (tamanho comprimido, s compressão, s descompressão)."""
+    comprimido = io.BytesIO()
+    inicio = time.perf_counter()
+    compressao.comprimir(io.BytesIO(dados), comprimido, codec)
+    t_comprimir = time.perf_counter() - inicio
+
+    visao = memoryview(comprimido.getvalue())
+    posicao = 0
+    inicio = time.perf_counter()
+    while posicao < len(visao):
+        codec_trecho, original, tamanho = compressao.TRECHO_COMPRIMIDO.unpack_from(visao, posicao)
+        posicao += compressao.TRECHO_COMPRIMIDO.size
+        compressao.DESCOMPRESSORES[codec_trecho](bytes(visao[posicao:posicao + tamanho]), original)
+        posicao += tamanho
+    t_descomprimir = time.perf_counter() - inicio
+    return len(visao), t_comprimir, t_descomprimir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("arquivos", nargs="*", help="Arquivos de teste (padrão: imagensSatelite/amazonia*.tif)")
+    parser.add_argument("--sintetico", type=int, metavar="MB", help="Usa um raster sintético deste tamanho")
+    parser.add_argument("--enlace-mbps", type=float, default=100, help="Banda do enlace para a vazão efetiva")
+    args = parser.parse_args()
+
+    entradas = []
+    if args.sintetico:
+        entradas.append((f"sintético ({args.sintetico} MB)", raster_sintetico(args.sintetico)))
+    arquivos = args.arquivos or ([] if args.sintetico else
+                                 sorted(glob.glob(os.path.join(RAIZ, "imagensSatelite", "amazonia*.tif"))))
+    for caminho in arquivos:
+        with open(caminho, "rb") as f:
+            entradas.append((os.path.basename(caminho), f.read()))
+    if not entradas:
+        parser.error("nenhuma cena encontrada em imagensSatelite/ (veja link.txt); "
+                     "passe os arquivos ou use --sintetico")
+
+    enlace = args.enlace_mbps / 8  # MB/s
+    print(f"Codecs disponíveis: {', '.join(compressao.nome_codec(c) for c in compressao.CODECS_DISPONIVEIS)}; "
+          f"enlace de {args.enlace_mbps:g} Mbit/s")
+    print(f"{'arquivo':24} {'codec':7} {'MB':>8} {'taxa':>6} {'compr. MB/s':>12} {'descompr. MB/s':>15} "
+          f"{'efetiva MB/s':>13}")
+    for rotulo, dados in entradas:
+        mb = len(dados) / (1024 * 1024)
+        print(f"{rotulo:24} {'nenhum':7} {mb:>8.1f} {1:>6.2f} {'-':>12} {'-':>15} {enlace:>13.1f}")
+        for codec in compressao.CODECS_DISPONIVEIS:
+            tamanho, t_comprimir, t_descomprimir = medir(dados, codec)
+            taxa = len(dados) / tamanho
+            efetiva = mb / (t_comprimir + tamanho / (1024 * 1024) / enlace)
+            print(f"{rotulo:24} {compressao.nome_codec(codec):7} {mb:>8.1f} {taxa:>6.2f} "
+                  f"{mb / t_comprimir:>12.1f} {mb / t_descomprimir:>15.1f} {efetiva:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Benchmark de carga do front end do servidor: compara o modo com uma thread por
+cliente (threads) com o modo asyncio (async) a 100, 1.000 e 10.000 conexões
+simultâneas.
+
+Cada conexão simulada abre um socket, envia uma requisição LIST e aguarda a
+resposta. São medidos o tempo total, a vazão de requisições, a latência
+(p50/p99), as falhas, as recusas (respostas OCUPADO do controle de admissão) e a
+memória/threads do processo do servidor. Só as respostas OK entram na vazão e na
+latência. O modo threads roda sem limite de conexões (--max-clientes 0), mas as
+requisições ainda passam pela fila do escalonador.
+
+Uso:
+    python benchmarks/bench_conexoes.py [--conexoes 100 1000 10000] [--modos threads async]
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+TEMPO_LIMITE = 60  # Segundos que cada conexão aguarda pela resposta antes de contar como falha
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+from comum import protocolo
+from comum import protocolo_async
+
+
+def porta_livre():
+    """Obtém uma porta TCP livre no loopback."""
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def aguardar_porta(porta, tempo_limite=10):
+    """Aguarda até que um processo esteja aceitando conexões na porta."""
+    limite = time.time() + tempo_limite
+    while time.time() < limite:
+        try:
+            socket.create_connection(("localhost", porta)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nada ouvindo em localhost:{porta}")
+
+
+def ler_status_processo(pid):
+    """Lê a memória residente (MB) e o número de threads de um processo (Linux)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            campos = dict(linha.split(":", 1) for linha in f if ":" in linha)
+        return int(campos["VmRSS"].split()[0]) / 1024, int(campos["Threads"])
+    except (OSError, KeyError):
+        return None, None
+
+
+def percentil(valores, p):
+    """Percentil simples (vizinho mais próximo) de uma lista de valores."""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p / 100))]
+
+
+async def sessao_cliente(porta, latencias, falhas, recusas, pico):
+    """Uma conexão simulada: LIST e resposta, mantendo o socket aberto até o pico de conexões."""
+    inicio = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection("localhost", porta)
+    except OSError:
+        falhas.append("conexao")
+        return
+    try:
+        await protocolo_async.enviar_quadro(writer, protocolo.LIST)
+        cab = await asyncio.wait_for(protocolo_async.receber_cabecalho(reader), TEMPO_LIMITE)
+        if cab is None:
+            raise ConnectionError("Conexão encerrada antes da resposta")
+        await protocolo_async.receber_payload(reader, cab)
+        if cab.opcode == protocolo.OCUPADO:
+            recusas.append(time.perf_counter() - inicio)
+            return
+        if cab.opcode != protocolo.OK:
+            falhas.append("erro")
+            return
+        latencias.append(time.perf_counter() - inicio)
+        await pico  # Mantém a conexão aberta até todas terem sido atendidas
+    except (OSError, asyncio.TimeoutError, protocolo.ErroProtocolo):
+        falhas.append("requisicao")
+    finally:
+        writer.close()
+
+
+async def rodar_carga(porta, conexoes, pid_servidor):
+    """Dispara `conexoes` sessões simultâneas e coleta as métricas."""
+    latencias, falhas, recusas = [], [], []
+    pico = asyncio.get_running_loop().create_future()
+    inicio = time.perf_counter()
+    tarefas = [asyncio.create_task(sessao_cliente(porta, latencias, falhas, recusas, pico)) for _ in range(conexoes)]
+    # Aguarda todas as respostas (ou falhas) antes de liberar as conexões
+    while len(latencias) + len(falhas) + len(recusas) < conexoes:
+        await asyncio.sleep(0.01)
+    duracao = time.perf_counter() - inicio
+    memoria, threads = ler_status_processo(pid_servidor)
+    pico.set_result(None)
+    await asyncio.gather(*tarefas, return_exceptions=True)
+    return {
+        "conexoes": conexoes,
+        "duracao_s": duracao,
+        "req_por_s": len(latencias) / duracao if duracao else 0,
+        "p50_ms": (percentil(latencias, 50) or 0) * 1000,
+        "p99_ms": (percentil(latencias, 99) or 0) * 1000,
+        "falhas": len(falhas),
+        "recusas": len(recusas),
+        "memoria_mb": memoria,
+        "threads": threads,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conexoes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--modos", nargs="+", choices=["threads", "async"], default=["threads", "async"])
+    args = parser.parse_args()
+
+    # Milhares de conexões simultâneas exigem um limite de descritores maior (herdado pelos filhos)
+    _, maximo = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (maximo, maximo))
+
+    print(f"{'modo':8} {'conexões':>9} {'tempo(s)':>9} {'req/s':>9} {'p50(ms)':>9} {'p99(ms)':>9} "
+          f"{'falhas':>7} {'recusas':>8} {'RSS(MB)':>8} {'threads':>8}")
+    with tempfile.TemporaryDirectory() as diretorio:
+        porta_cluster = porta_livre()
+        cluster = subprocess.Popen([sys.executable, os.path.join(RAIZ, "cluster", "cluster.py"),
+                                    "--porta", str(porta_cluster)],
+                                   cwd=diretorio, stdout=subprocess.DEVNULL)
+        try:
+            aguardar_porta(porta_cluster)
+            for modo in args.modos:
+                for conexoes in args.conexoes:
+                    porta = porta_livre()
+                    comando = [sys.executable, os.path.join(RAIZ, "servidor", "servidor.py"), "--modo", modo,
+                               "--porta", str(porta), "--cluster-porta", str(porta_cluster),
+                               "--backlog", str(max(conexoes, 128))]
+                    if modo == "threads":
+                        comando += ["--max-clientes", "0"]  # Sem OCUPADO na conexão: o teste é o front end
+                    servidor = subprocess.Popen(comando, stdout=subprocess.DEVNULL)
+                    try:
+                        aguardar_porta(porta)
+                        r = asyncio.run(rodar_carga(porta, conexoes, servidor.pid))
+                        print(f"{modo:8} {r['conexoes']:>9} {r['duracao_s']:>9.2f} {r['req_por_s']:>9.0f} "
+                              f"{r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} {r['falhas']:>7} {r['recusas']:>8} "
+                              f"{r['memoria_mb'] or 0:>8.1f} {r['threads'] or 0:>8}")
+                    finally:
+                        servidor.kill()
+                        servidor.wait()
+        finally:
+            cluster.kill()
+            cluster.wait()
+
+
+if __name__ == "__main__":
+    main()
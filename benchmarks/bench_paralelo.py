@@ -0,0 +1,92 @@
+"""
+Benchmark das transferências em pedaços: compara o upload/download em um único
+stream (UPLOAD/DOWNLOAD) com o modo paralelo (UPLOAD_PEDACO/DOWNLOAD_INTERVALO)
+usando 1, 2, 4 e 8 conexões.
+
+Um cluster e um servidor são iniciados em diretórios temporários; cada arquivo
+baixado é comparado com o original. No loopback um único stream (sendfile/splice)
+já fica limitado pela cópia de memória, então o paralelismo não acelera; o ganho
+aparece em enlaces com latência alta ou perdas, onde cada conexão extra acrescenta
+a sua própria janela TCP. Para simular isso, use `tc qdisc ... netem delay` no lo.
+
+Uso:
+    python benchmarks/bench_paralelo.py [--tamanho-mb 256] [--conexoes 1 2 4 8] [--pedaco-mb 8]
+"""
+import argparse
+import filecmp
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+from mygeo import Client
+from bench_conexoes import aguardar_porta, porta_livre
+
+
+def cronometrar(funcao, *args, **kwargs):
+    """Executa a função e retorna a duração em segundos."""
+    inicio = time.perf_counter()
+    funcao(*args, **kwargs)
+    return time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tamanho-mb", type=int, default=256, help="Tamanho do arquivo de teste")
+    parser.add_argument("--conexoes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--pedaco-mb", type=int, default=8, help="Tamanho de cada pedaço")
+    args = parser.parse_args()
+    tamanho_pedaco = args.pedaco_mb * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as diretorio:
+        diretorio_cluster = os.path.join(diretorio, "cluster")
+        diretorio_cliente = os.path.join(diretorio, "cliente")
+        os.makedirs(diretorio_cluster)
+        os.makedirs(diretorio_cliente)
+        original = os.path.join(diretorio, "cena.tif")
+        with open(original, "wb") as f:
+            for _ in range(args.tamanho_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        porta_cluster, porta = porta_livre(), porta_livre()
+        cluster = subprocess.Popen([sys.executable, os.path.join(RAIZ, "cluster", "cluster.py"),
+                                    "--porta", str(porta_cluster)],
+                                   cwd=diretorio_cluster, stdout=subprocess.DEVNULL)
+        servidor = subprocess.Popen([sys.executable, os.path.join(RAIZ, "servidor", "servidor.py"),
+                                     "--porta", str(porta), "--cluster-porta", str(porta_cluster)],
+                                    stdout=subprocess.DEVNULL)
+        try:
+            aguardar_porta(porta_cluster)
+            aguardar_porta(porta)
+            os.chdir(diretorio_cliente)
+            # Sem compressão: o arquivo de teste é aleatório, e o stream único mede só a transferência
+            cliente = Client(port=porta, pool_size=max(args.conexoes), compression=False)
+
+            print(f"Arquivo de {args.tamanho_mb} MB, pedaços de {args.pedaco_mb} MB")
+            print(f"{'modo':16} {'upload(s)':>10} {'MB/s':>8} {'download(s)':>12} {'MB/s':>8} {'íntegro':>8}")
+            casos = [("stream único", None)] + [(f"{n} conexão(ões)", n) for n in args.conexoes]
+            for rotulo, conexoes in casos:
+                if conexoes is None:
+                    t_upload = cronometrar(cliente.upload_file, original)
+                    t_download = cronometrar(cliente.download_to, "cena.tif", "cena.tif")
+                else:
+                    t_upload = cronometrar(cliente.upload_parallel, original, None, conexoes, tamanho_pedaco)
+                    t_download = cronometrar(cliente.download_parallel, "cena.tif", "cena.tif", conexoes,
+                                             tamanho_pedaco)
+                integro = filecmp.cmp(original, "cena.tif", shallow=False)
+                os.remove("cena.tif")
+                print(f"{rotulo:16} {t_upload:>10.2f} {args.tamanho_mb / t_upload:>8.0f} "
+                      f"{t_download:>12.2f} {args.tamanho_mb / t_download:>8.0f} {'sim' if integro else 'NÃO':>8}")
+            cliente.close()
+        finally:
+            servidor.kill()
+            cluster.kill()
+            servidor.wait()
+            cluster.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,133 +1,159 @@
-import socket
+"""
+Menu interativo do MyGeo Eye: cada opção chama um método de mygeo.Client e exibe o
+resultado. Scripts e tarefas em lote usam a biblioteca diretamente ou a linha de
+comando (python -m mygeo).
+"""
 import os
-
-class Client:
-    def __init__(self, host='localhost', port=6000):
-        """
-        Inicializa o cliente conectando-se ao servidor no endereço e porta especificados.
-        Cria um socket para comunicação e realiza a conexão.
-        """
-        self.host = host
-        self.port = port
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Cria o socket TCP
-        self.client_socket.connect((self.host, self.port))  # Conecta ao servidor
-        print("[DEBUG] Conectado ao servidor")
-
-    def upload_image(self, file_path):
-        """
-        Faz o upload de uma imagem para o servidor.
-        O caminho do arquivo deve ser especificado. Envia o nome e o conteúdo do arquivo em blocos.
-        """
-        if os.path.exists(file_path):  # Verifica se o arquivo existe
-            file_name = os.path.basename(file_path)  # Obtém apenas o nome do arquivo (sem o caminho)
-            self.client_socket.send(f"UPLOAD {file_name}".encode())  # Envia o comando UPLOAD e o nome do arquivo
-            print(f"[DEBUG] Enviando arquivo: {file_name}")
-
-            # Abre o arquivo em modo binário e envia seu conteúdo em blocos de 4096 bytes
-            with open(file_path, 'rb') as f:
-                while True:
-                    dados = f.read(4096)
-                    if not dados:
-                        break
-                    self.client_socket.send(dados)  # Envia os dados do arquivo
-            self.client_socket.send(b"FIM")  # Marca o fim da transmissão com o marcador "FIM"
-            print(self.client_socket.recv(1024).decode())  # Exibe a resposta do servidor
-        else:
-            print("Arquivo não encontrado. Tente novamente.")
-
-    def list_images(self):
-        """
-        Solicita ao servidor a lista de imagens armazenadas e as exibe.
-        """
-        print("[DEBUG] Solicitando lista de imagens...")
-        self.client_socket.send("LIST".encode())  # Envia o comando LIST para o servidor
-        images = self.client_socket.recv(1024).decode()  # Recebe a lista de imagens
-        print(f"Imagens: {images}")
-
-    def download_image(self, file_name):
-        """
-        Solicita ao servidor o download de uma imagem específica.
-        Recebe e armazena a imagem no diretório local.
-        """
-        print(f"[DEBUG] Solicitando download da imagem: {file_name}")
-        self.client_socket.send(f"DOWNLOAD {file_name}".encode())  # Envia o comando DOWNLOAD e o nome do arquivo
-
-        # Recebe a primeira resposta do servidor
-        response = self.client_socket.recv(1024)
-        if response == b"Arquivo nao encontrado":
-            print("[DEBUG] O arquivo solicitado não foi encontrado no servidor.")
-            print("Erro: Arquivo não encontrado.")
+import sys
+from datetime import datetime
+
+# Permite importar os pacotes "comum" e "mygeo", compartilhados entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import protocolo
+from mygeo import Client, ServerError, expand_paths
+
+OPCOES = [
+    "Upload um arquivo de imagem de satélite",
+    "Listar as imagens inseridas",
+    "Baixar uma imagem inserida",
+    "Deletar uma imagem",
+    "Upload paralelo (em pedaços)",
+    "Download paralelo (em pedaços)",
+    "Upload retomável",
+    "Download retomável",
+    "Upload deduplicado",
+    "Estatísticas do servidor",
+    "Miniatura de uma imagem",
+    "Ladrilho de uma imagem",
+    "Upload em lote (diretório ou padrão glob)",
+    "Download em lote",
+    "Deletar em lote",
+    "Sair",
+]
+
+
+def ler_nomes():
+    return [nome.strip() for nome in input("Digite os nomes das imagens, separados por vírgula: ").split(",")
+            if nome.strip()]
+
+
+def ler_arquivo():
+    """Pede o caminho de um arquivo; None se ele não existir."""
+    caminho = input("Digite o caminho do arquivo de imagem: ")
+    if not os.path.isfile(caminho):
+        print("Arquivo não encontrado. Tente novamente.")
+        return None
+    return caminho
+
+
+def exibir_lote(resultados, acao):
+    """Exibe as falhas de um comando em lote e o total de arquivos atendidos."""
+    for resultado in resultados:
+        if not resultado.sucesso:
+            print(f"  {resultado.nome}: {resultado.mensagem}")
+    print(f"{sum(resultado.sucesso for resultado in resultados)} de {len(resultados)} arquivo(s) {acao}.")
+
+
+def listar(cliente):
+    total = 0
+    for imagem in cliente.list():
+        if total == 0:
+            print("Imagens:")
+        enviada_em = datetime.fromtimestamp(imagem.enviado_em).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"  {imagem.nome} ({imagem.tamanho} bytes, enviada em {enviada_em})")
+        total += 1
+    if total == 0:
+        print("Nenhuma imagem encontrada.")
+
+
+def baixar(cliente, transferir):
+    """Baixa uma imagem para o diretório atual com `transferir(nome, caminho)`."""
+    nome = input("Digite o nome da imagem a ser baixada: ")
+    tamanho = transferir(nome, os.path.basename(nome))
+    print(f"Imagem {nome} baixada com sucesso ({tamanho} bytes).")
+
+
+def exibir_estatisticas(cliente):
+    cache = cliente.stats().get("cache")
+    if cache is None:
+        print("Cache desativado no servidor.")
+        return
+    print(f"Cache: {cache['acertos']} acertos, {cache['falhas']} falhas "
+          f"(taxa de acerto {cache['taxa_acerto']:.1%}), {cache['bytes_economizados']} bytes economizados")
+    print(f"  memória: {cache['imagens_memoria']} imagem(ns), {cache['bytes_memoria']} bytes; "
+          f"disco: {cache['imagens_disco']} imagem(ns), {cache['bytes_disco']} bytes; "
+          f"{cache['despejos']} despejo(s), {cache['invalidacoes']} invalidação(ões)")
+
+
+def gravar_previa(nome, png, saida):
+    with open(saida, 'wb') as f:
+        f.write(png)
+    print(f"Prévia de {nome} gravada em {saida} ({len(png)} bytes).")
+
+
+def executar(cliente, escolha):
+    """Executa a opção escolhida no menu. Retorna False para sair."""
+    if escolha in ('1', '5', '7', '9'):
+        caminho = ler_arquivo()
+        if caminho is not None:
+            enviar = {'1': cliente.upload_file, '5': cliente.upload_parallel, '7': cliente.upload_resumable,
+                      '9': cliente.upload_dedup}[escolha]
+            print(enviar(caminho))
+    elif escolha == '2':
+        listar(cliente)
+    elif escolha == '3':
+        baixar(cliente, cliente.download_to)
+    elif escolha == '4':
+        print(cliente.delete(input("Digite o nome da imagem a ser deletada: ")))
+    elif escolha == '6':
+        baixar(cliente, cliente.download_parallel)
+    elif escolha == '8':
+        baixar(cliente, cliente.download_resumable)
+    elif escolha == '10':
+        exibir_estatisticas(cliente)
+    elif escolha == '11':
+        nome = input("Digite o nome da imagem: ")
+        lado = int(input("Digite o maior lado da miniatura, em pixels: ") or 256)
+        gravar_previa(nome, cliente.thumbnail(nome, lado), f"{os.path.splitext(nome)[0]}_miniatura_{lado}.png")
+    elif escolha == '12':
+        nome = input("Digite o nome da imagem: ")
+        z, x, y = (int(valor) for valor in input("Digite o nível, a coluna e a linha (z x y): ").split())
+        gravar_previa(nome, cliente.tile(nome, z, x, y), f"{os.path.splitext(nome)[0]}_{z}_{x}_{y}.png")
+    elif escolha == '13':
+        arquivos = expand_paths([input("Digite o diretório ou o padrão glob dos arquivos: ")])
+        if not arquivos:
+            print("Nenhum arquivo encontrado.")
         else:
-            print("[DEBUG] Iniciando o download da imagem...")
-
-            # Se a imagem existir, cria um novo arquivo localmente para salvar a imagem recebida
-            with open(file_name, 'wb') as f:
-                while True:
-                    dados = self.client_socket.recv(4096)  # Recebe os dados da imagem em blocos de 4096 bytes
-                    if dados.endswith(b"FIM"):  # Verifica se o marcador de fim "FIM" foi recebido
-                        f.write(dados[:-3])  # Remove o "FIM" do final dos dados recebidos
-                        break
-                    f.write(dados)  # Escreve os dados no arquivo
-            
-            print(f"Imagem {file_name} baixada com sucesso.")
-
-    def delete_image(self, file_name):
-        """
-        Solicita ao servidor que delete uma imagem específica.
-        Exibe a resposta do servidor (confirmação ou erro).
-        """
-        print(f"[DEBUG] Solicitando deleção da imagem: {file_name}")
-        self.client_socket.send(f"DELETE {file_name}".encode())  # Envia o comando DELETE e o nome do arquivo
-        print(self.client_socket.recv(1024).decode())  # Exibe a resposta do servidor
-
-    def close(self):
-        """
-        Fecha a conexão do socket com o servidor.
-        """
-        print("[DEBUG] Fechando conexão com o servidor")
-        self.client_socket.close()  # Fecha o socket de comunicação
-
-    def run(self):
-        """
-        Executa o loop principal do cliente, que permite ao usuário escolher entre
-        as opções de upload, listagem, download, deleção de imagens ou sair.
-        """
+            exibir_lote(cliente.upload_many(arquivos), "enviado(s)")
+    elif escolha == '14':
+        exibir_lote(cliente.download_many(ler_nomes()), "baixado(s)")
+    elif escolha == '15':
+        exibir_lote(cliente.delete_many(ler_nomes()), "deletado(s)")
+    elif escolha == str(len(OPCOES)):
+        return False
+    else:
+        print("Escolha inválida. Tente novamente.")
+    return True
+
+
+def main(host='localhost', porta=6000):
+    """
+    Executa o loop principal do cliente, que permite ao usuário escolher entre
+    as opções de upload, listagem, download, deleção de imagens ou sair.
+    """
+    with Client(host, porta) as cliente:
         while True:
-            # Menu de opções para o usuário
             print("\nEscolha uma opção:")
-            print("1. Upload um arquivo de imagem de satélite")
-            print("2. Listar as imagens inseridas")
-            print("3. Baixar uma imagem inserida")
-            print("4. Deletar uma imagem")
-            print("5. Sair")
-
-            choice = input("Digite sua escolha (1-5): ")
-
-            # Dependendo da escolha, chama o método correspondente
-            if choice == '1':
-                file_path = input("Digite o caminho do arquivo de imagem: ")
-                self.upload_image(file_path)
-
-            elif choice == '2':
-                self.list_images()
-
-            elif choice == '3':
-                file_name = input("Digite o nome da imagem a ser baixada: ")
-                self.download_image(file_name)
-
-            elif choice == '4':
-                file_name = input("Digite o nome da imagem a ser deletada: ")
-                self.delete_image(file_name)
-
-            elif choice == '5':
-                print("Saindo...")
-                self.close()  # Fecha a conexão com o servidor e encerra o cliente
-                break
+            for numero, opcao in enumerate(OPCOES, 1):
+                print(f"{numero}. {opcao}")
+            try:
+                if not executar(cliente, input(f"Digite sua escolha (1-{len(OPCOES)}): ").strip()):
+                    print("Saindo...")
+                    return
+            except (OSError, ServerError, protocolo.ErroProtocolo, ValueError) as e:
+                print(f"Erro: {e}")
 
-            else:
-                print("Escolha inválida. Tente novamente.")
 
 # Inicializa o cliente e inicia o loop de interação
 if __name__ == "__main__":
-    client = Client()  # Cria uma instância do cliente
-    client.run()  # Inicia o loop de interação com o usuário
\ No newline at end of file
+    main()
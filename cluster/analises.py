@@ -0,0 +1,213 @@
+"""
+Análises das cenas feitas no próprio cluster (comando CALCULO), para que um cliente
+que só quer alguns números não precise baixar a cena inteira: estatísticas por banda
+(mínimo, máximo, média, desvio padrão e histograma), NDVI e fração de nuvens.
+
+Os cálculos rodam num pool de processos: a janela pedida é dividida em faixas de
+linhas, cada uma calculada por um processo sobre a imagem mapeada em memória, e os
+resultados parciais (tabelas de frequência e somas) são combinados no cluster. Os
+laços por pixel ficam no código em C do Python: as linhas são decodificadas com
+array, as bandas separadas por fatiamento estendido, as tabelas de frequência
+montadas por Counter e as contas do NDVI encadeadas com map e itertools.
+"""
+import io
+import itertools
+import math
+import mmap
+import operator
+import os
+import sys
+from array import array
+from collections import Counter
+from contextlib import ExitStack
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import geotiff, protocolo
+from armazenamento import LeitorBlocos
+
+PIXELS_POR_PARTE = 4 * 1024 * 1024  # Pixels da janela calculados por tarefa do pool
+ORDEM_NATIVA = "<" if sys.byteorder == "little" else ">"
+
+
+def abrir_trechos(pilha, trechos):
+    """
+    Abre a imagem a partir dos seus trechos em disco (armazem.trechos): mapeada em memória
+    quando é um arquivo só, ou lida bloco a bloco quando está deduplicada.
+    """
+    if len(trechos) == 1 and trechos[0][1] == 0:
+        caminho, _, comprimento = trechos[0]
+        f = pilha.enter_context(open(caminho, 'rb'))
+        return pilha.enter_context(mmap.mmap(f.fileno(), comprimento, access=mmap.ACCESS_READ))
+    return pilha.enter_context(io.BufferedReader(LeitorBlocos([caminho for caminho, _, _ in trechos],
+                                                              [comprimento for _, _, comprimento in trechos])))
+
+
+def preparar(raster, calculo):
+    """Confere as bandas e a janela do cálculo. Retorna (bandas usadas, base 0; janela). ValueError se inválidas."""
+    if calculo.operacao == protocolo.CALCULO_ESTATISTICAS:
+        bandas = list(range(raster.bandas))
+    elif calculo.operacao == protocolo.CALCULO_NDVI:
+        bandas = [calculo.banda_a - 1, calculo.banda_b - 1]
+    else:
+        bandas = [calculo.banda_a - 1]
+    if not all(0 <= banda < raster.bandas for banda in bandas):
+        raise ValueError(f"a cena tem {raster.bandas} banda(s)")
+    if calculo.x >= raster.largura or calculo.y >= raster.altura:
+        raise ValueError("janela fora da imagem")
+    largura = min(calculo.largura or raster.largura, raster.largura - calculo.x)
+    altura = min(calculo.altura or raster.altura, raster.altura - calculo.y)
+    return bandas, (calculo.x, calculo.y, largura, altura)
+
+
+def ler_bandas(raster, janela, bandas):
+    """Gera, para cada linha da janela, a lista das amostras (array) de cada uma das `bandas`."""
+    x, y, largura, altura = janela
+    tipo = "B" if raster.bytes_amostra == 1 else "H"
+    inverter = raster.bytes_amostra == 2 and raster.ordem != ORDEM_NATIVA
+    planos = sorted({banda if raster.planar else 0 for banda in bandas})
+    for linha in range(y, y + altura):
+        lidos = {}
+        for plano in planos:
+            amostras = array(tipo, raster.ler_linha(plano, linha, x, x + largura))
+            if inverter:
+                amostras.byteswap()
+            lidos[plano] = amostras
+        if raster.planar:
+            yield [lidos[banda] for banda in bandas]
+        elif raster.bandas == 1:
+            yield [lidos[0]]
+        else:
+            # Pixels intercalados: as amostras de uma banda estão a cada `bandas` posições
+            yield [lidos[0][banda::raster.bandas] for banda in bandas]
+
+
+def frequencias(raster, janela, bandas):
+    """Tabela de frequência (Counter valor -> pixels) de cada banda na janela."""
+    tabelas = [Counter() for _ in bandas]
+    for amostras in ler_bandas(raster, janela, bandas):
+        for tabela, valores in zip(tabelas, amostras):
+            tabela.update(valores)
+    return tabelas
+
+
+def somas_ndvi(raster, janela, bandas, classes):
+    """
+    Somas parciais do NDVI = (infravermelho - vermelho) / (infravermelho + vermelho) na janela:
+    (pixels, soma, soma dos quadrados, mínimo, máximo, Counter classe -> pixels). Pixels com as
+    duas bandas zeradas (sem dado) ficam de fora.
+    """
+    pixels, soma, quadrados, minimo, maximo = 0, 0.0, 0.0, math.inf, -math.inf
+    histograma = Counter()
+    escala = classes / 2
+    for vermelho, infravermelho in ler_bandas(raster, janela, bandas):
+        denominadores = list(map(operator.add, infravermelho, vermelho))
+        # compress e filter(None) descartam as mesmas posições: as de denominador zero
+        valores = list(map(operator.truediv, itertools.compress(map(operator.sub, infravermelho, vermelho),
+                                                                denominadores),
+                           filter(None, denominadores)))
+        if not valores:
+            continue
+        pixels += len(valores)
+        soma += math.fsum(valores)
+        quadrados += math.fsum(map(operator.mul, valores, valores))
+        minimo = min(minimo, min(valores))
+        maximo = max(maximo, max(valores))
+        # Classe de cada valor em [-1, 1]; o 1 exato cai numa classe extra, somada à última no fim
+        histograma.update(map(int, map(operator.mul, map(operator.add, valores, itertools.repeat(1.0)),
+                                       itertools.repeat(escala))))
+    return pixels, soma, quadrados, minimo, maximo, histograma
+
+
+def calcular_parte(trechos, calculo, bandas, janela):
+    """Resultado parcial de uma faixa da janela. Executada nos processos do pool."""
+    with ExitStack() as pilha:
+        raster = geotiff.Raster(abrir_trechos(pilha, trechos))
+        if calculo.operacao == protocolo.CALCULO_NDVI:
+            return somas_ndvi(raster, janela, bandas, calculo.classes)
+        return frequencias(raster, janela, bandas)
+
+
+def dividir(janela, pixels_por_parte=PIXELS_POR_PARTE):
+    """Divide a janela em faixas de linhas com cerca de `pixels_por_parte` pixels cada."""
+    x, y, largura, altura = janela
+    linhas = max(1, pixels_por_parte // largura)
+    return [(x, inicio, largura, min(linhas, y + altura - inicio)) for inicio in range(y, y + altura, linhas)]
+
+
+def combinar(calculo, partes):
+    """Junta os resultados parciais das faixas, na mesma forma de um resultado parcial."""
+    if calculo.operacao == protocolo.CALCULO_NDVI:
+        histograma = Counter()
+        for parte in partes:
+            histograma.update(parte[5])
+        return (sum(parte[0] for parte in partes), math.fsum(parte[1] for parte in partes),
+                math.fsum(parte[2] for parte in partes), min(parte[3] for parte in partes),
+                max(parte[4] for parte in partes), histograma)
+    tabelas = partes[0]
+    for parte in partes[1:]:
+        for tabela, outra in zip(tabelas, parte):
+            tabela.update(outra)
+    return tabelas
+
+
+def resumir_banda(tabela, bits, classes):
+    """Estatísticas de uma banda a partir da sua tabela de frequência."""
+    pixels = sum(tabela.values())
+    if not pixels:
+        return {"pixels": 0}
+    soma = sum(valor * quantidade for valor, quantidade in tabela.items())
+    quadrados = sum(valor * valor * quantidade for valor, quantidade in tabela.items())
+    media = soma / pixels
+    histograma = [0] * classes
+    largura_classe = (1 << bits) / classes
+    for valor, quantidade in tabela.items():
+        histograma[min(classes - 1, int(valor / largura_classe))] += quantidade
+    return {"pixels": pixels, "minimo": min(tabela), "maximo": max(tabela), "media": media,
+            "desvio": math.sqrt(max(0.0, quadrados / pixels - media * media)),
+            "histograma": histograma, "limites": [0, 1 << bits]}
+
+
+def concluir(calculo, bits, bandas, janela, combinado):
+    """Resultado final (dicionário, enviado em JSON) a partir dos parciais combinados."""
+    resultado = {"operacao": next(nome for nome, codigo in protocolo.OPERACOES_CALCULO.items()
+                                  if codigo == calculo.operacao),
+                 "janela": list(janela)}
+    if calculo.operacao == protocolo.CALCULO_ESTATISTICAS:
+        resultado["bandas"] = [resumir_banda(tabela, bits, calculo.classes) for tabela in combinado]
+    elif calculo.operacao == protocolo.CALCULO_NDVI:
+        pixels, soma, quadrados, minimo, maximo, contagens = combinado
+        resultado.update(bandas=[banda + 1 for banda in bandas], pixels=pixels)
+        if pixels:
+            histograma = [contagens.get(classe, 0) for classe in range(calculo.classes)]
+            histograma[-1] += contagens.get(calculo.classes, 0)
+            media = soma / pixels
+            resultado.update(minimo=minimo, maximo=maximo, media=media,
+                             desvio=math.sqrt(max(0.0, quadrados / pixels - media * media)),
+                             histograma=histograma, limites=[-1.0, 1.0])
+    else:
+        tabela, = combinado
+        pixels = sum(tabela.values())
+        nuvens = sum(quantidade for valor, quantidade in tabela.items() if valor >= calculo.limiar)
+        resultado.update(banda=bandas[0] + 1, limiar=calculo.limiar, pixels=pixels, nuvens=nuvens,
+                         fracao=nuvens / pixels if pixels else 0.0)
+    return resultado
+
+
+def calcular(executor, trechos, calculo):
+    """
+    Executa o cálculo sobre a imagem formada pelos `trechos`, dividindo a janela entre os
+    processos do `executor`. Retorna o resultado (dicionário); ValueError se a cena não
+    puder ser lida ou os parâmetros não servirem para ela.
+    """
+    with ExitStack() as pilha:
+        raster = geotiff.Raster(abrir_trechos(pilha, trechos))
+        bandas, janela = preparar(raster, calculo)
+        bits = raster.bits
+    futuros = [executor.submit(calcular_parte, trechos, calculo, bandas, parte) for parte in dividir(janela)]
+    try:
+        partes = [futuro.result() for futuro in futuros]
+    finally:
+        for futuro in futuros:
+            futuro.cancel()  # Uma parte falhou: as que ainda não começaram não são mais necessárias
+    return concluir(calculo, bits, bandas, janela, combinar(calculo, partes))
@@ -0,0 +1,359 @@
+import bisect
+import io
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import protocolo
+from durabilidade import GrupoSincronizacao
+
+log = logging.getLogger("cluster.armazenamento")
+
+
+def limitar_intervalo(tamanho, deslocamento, comprimento):
+    """Limita um intervalo (deslocamento, comprimento) ao fim de um arquivo de `tamanho` bytes."""
+    if comprimento is None:
+        comprimento = tamanho - deslocamento
+    return max(0, min(comprimento, tamanho - deslocamento))
+
+
+class ArmazemArquivos:
+    """
+    Armazenamento simples: cada imagem é um arquivo com o seu nome no diretório de imagens.
+    """
+    deduplica = False
+
+    def __init__(self, diretorio, sincronizacao=None):
+        self.diretorio = diretorio
+        # Sincroniza com o disco os arquivos e diretórios alterados (em lotes, entre uploads)
+        self.sincronizacao = sincronizacao or GrupoSincronizacao()
+
+    def caminho(self, nome):
+        return os.path.join(self.diretorio, nome)
+
+    def importar(self, temporario):
+        """Prepara um arquivo recebido por inteiro para ser publicado: aqui, só o leva ao disco."""
+        self.sincronizacao.confirmar(arquivos=[temporario])
+        return temporario
+
+    def publicar(self, nome, importado):
+        """Torna a imagem visível com o nome definitivo, substituindo a anterior de forma atômica."""
+        os.replace(importado, self.caminho(nome))
+
+    def tornar_duravel(self, nome):
+        """Leva ao disco a publicação de uma imagem (a entrada renomeada no diretório)."""
+        self.sincronizacao.confirmar(diretorios=[self.diretorio])
+
+    def tamanho(self, nome):
+        """Tamanho da imagem; FileNotFoundError se ela não existir."""
+        return os.path.getsize(self.caminho(nome))
+
+    def trechos(self, nome, deslocamento=0, comprimento=None):
+        """
+        Lista de (caminho, deslocamento, comprimento) dos arquivos em disco que compõem o
+        intervalo pedido da imagem, limitado ao seu fim.
+        """
+        comprimento = limitar_intervalo(self.tamanho(nome), deslocamento, comprimento)
+        return [(self.caminho(nome), deslocamento, comprimento)]
+
+    def abrir(self, nome):
+        """Abre a imagem para leitura binária (com seek); FileNotFoundError se ela não existir."""
+        return open(self.caminho(nome), 'rb')
+
+    def listar(self):
+        # Entradas ocultas, como os uploads parciais, ficam de fora
+        return [nome for nome in os.listdir(self.diretorio) if not nome.startswith(".")]
+
+    def remover(self, nome):
+        """Remove a imagem. Retorna False se ela não existir."""
+        try:
+            os.remove(self.caminho(nome))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+class LeitorBlocos(io.RawIOBase):
+    """Leitura de uma imagem armazenada em blocos como se fosse um único arquivo."""
+
+    def __init__(self, caminhos, tamanhos):
+        super().__init__()
+        self.caminhos = caminhos
+        # Posição de início de cada bloco na imagem, mais o tamanho total no fim
+        self.inicios = [0] + list(itertools.accumulate(tamanhos))
+        self.posicao = 0
+        self.aberto = None  # (índice, arquivo) do último bloco lido
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.posicao
+
+    def seek(self, deslocamento, de=io.SEEK_SET):
+        if de == io.SEEK_CUR:
+            deslocamento += self.posicao
+        elif de == io.SEEK_END:
+            deslocamento += self.inicios[-1]
+        self.posicao = max(0, deslocamento)
+        return self.posicao
+
+    def readinto(self, destino):
+        if self.posicao >= self.inicios[-1]:
+            return 0
+        indice = bisect.bisect_right(self.inicios, self.posicao) - 1
+        if self.aberto is None or self.aberto[0] != indice:
+            if self.aberto is not None:
+                self.aberto[1].close()
+            self.aberto = (indice, open(self.caminhos[indice], 'rb'))
+        f = self.aberto[1]
+        f.seek(self.posicao - self.inicios[indice])
+        n = f.readinto(memoryview(destino)[:self.inicios[indice + 1] - self.posicao])
+        self.posicao += n
+        return n
+
+    def close(self):
+        if self.aberto is not None:
+            self.aberto[1].close()
+            self.aberto = None
+        super().close()
+
+
+class ArmazemConteudo:
+    """
+    Armazenamento endereçado por conteúdo. As imagens são divididas em blocos identificados
+    pelo resumo BLAKE2b do seu conteúdo e guardados uma única vez em `.blocos/`; cada imagem
+    é um manifesto em `.manifestos/` com a sequência de (resumo, comprimento) dos seus blocos.
+    Blocos repetidos entre imagens ocupam disco e são gravados uma só vez.
+    """
+    deduplica = True
+
+    def __init__(self, diretorio, tamanho_bloco=protocolo.TAMANHO_BLOCO_DEDUP, sincronizacao=None):
+        self.diretorio = diretorio
+        self.sincronizacao = sincronizacao or GrupoSincronizacao()
+        self.diretorio_blocos = os.path.join(diretorio, ".blocos")
+        self.diretorio_manifestos = os.path.join(diretorio, ".manifestos")
+        self.tamanho_bloco = tamanho_bloco
+        os.makedirs(self.diretorio_blocos, exist_ok=True)
+        os.makedirs(self.diretorio_manifestos, exist_ok=True)
+
+        # Protege as contagens de referência e a criação/remoção dos arquivos de blocos
+        self.trava = threading.Lock()
+        # Resumo (hex) -> número de usos do bloco em manifestos e em uploads ainda pendentes
+        self.referencias = Counter()
+        # Uploads com troca de resumos ainda não concluídos: nome -> blocos reservados
+        self.pendentes = {}
+
+        for nome in os.listdir(self.diretorio_manifestos):
+            self.referencias.update(resumo for resumo, _ in self.ler_manifesto(nome)["blocos"])
+        # Blocos sem referência (de uploads interrompidos) e temporários são removidos
+        for raiz, _, arquivos in os.walk(self.diretorio_blocos):
+            for arquivo in arquivos:
+                if arquivo not in self.referencias:
+                    os.remove(os.path.join(raiz, arquivo))
+        # Imagens gravadas por inteiro no diretório (armazenamento simples) são importadas
+        for nome in os.listdir(diretorio):
+            caminho = os.path.join(diretorio, nome)
+            if not nome.startswith(".") and os.path.isfile(caminho):
+                self.publicar(nome, self.importar(caminho))
+                self.tornar_duravel(nome)
+                log.info("Imagem %s importada para o armazenamento por conteúdo", nome)
+
+    def caminho_bloco(self, resumo):
+        # Um nível de subdiretórios evita um diretório único com milhares de arquivos
+        return os.path.join(self.diretorio_blocos, resumo[:2], resumo)
+
+    def caminho_manifesto(self, nome):
+        return os.path.join(self.diretorio_manifestos, nome)
+
+    def ler_manifesto(self, nome):
+        """Manifesto de uma imagem; FileNotFoundError se ela não existir."""
+        with open(self.caminho_manifesto(nome)) as f:
+            return json.load(f)
+
+    def _referenciar(self, resumos):
+        """Conta um novo uso de cada bloco. Retorna os resumos cujos arquivos ainda não existem."""
+        faltando = []
+        with self.trava:
+            for resumo in resumos:
+                self.referencias[resumo] += 1
+                if not os.path.exists(self.caminho_bloco(resumo)):
+                    faltando.append(resumo)
+        return faltando
+
+    def _liberar(self, resumos):
+        """Desconta um uso de cada bloco, apagando os que não são mais usados."""
+        with self.trava:
+            for resumo in resumos:
+                self.referencias[resumo] -= 1
+                if self.referencias[resumo] <= 0:
+                    del self.referencias[resumo]
+                    try:
+                        os.remove(self.caminho_bloco(resumo))
+                    except FileNotFoundError:
+                        pass
+
+    def novo_temporario(self):
+        """Cria um arquivo temporário no mesmo sistema de arquivos dos blocos. Retorna (fd, caminho)."""
+        return tempfile.mkstemp(suffix=".tmp", dir=self.diretorio_blocos)
+
+    def adicionar_bloco(self, resumo, temporario):
+        """
+        Move um bloco recebido e verificado para o seu lugar. Se outro upload já o tiver
+        gravado, o temporário é descartado. Retorna False se o bloco não foi reservado.
+        """
+        return self.adicionar_blocos([(resumo, temporario)])[0]
+
+    def adicionar_blocos(self, novos):
+        """
+        Versão em lote de adicionar_bloco, para a lista de (resumo, temporário): os dados dos
+        blocos e depois os diretórios em que foram colocados são sincronizados de uma vez.
+        Retorna, para cada bloco, se ele estava reservado.
+        """
+        self.sincronizacao.confirmar(arquivos=[temporario for _, temporario in novos])
+        reservados = []
+        movidos = set()  # Diretórios que receberam blocos
+        for resumo, temporario in novos:
+            with self.trava:
+                reservado = self.referencias[resumo] > 0
+                caminho = self.caminho_bloco(resumo)
+                if reservado and not os.path.exists(caminho):
+                    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+                    os.replace(temporario, caminho)
+                    movidos.add(os.path.dirname(caminho))
+                    reservados.append(True)
+                    continue
+            os.remove(temporario)
+            reservados.append(reservado)
+        self.sincronizacao.confirmar(diretorios=sorted(movidos))
+        return reservados
+
+    def tem_bloco(self, resumo):
+        return os.path.exists(self.caminho_bloco(resumo))
+
+    def importar(self, temporario):
+        """
+        Divide um arquivo recebido por inteiro em blocos, gravando apenas os que ainda não
+        existem, e remove o arquivo. Retorna a lista de (resumo, comprimento) para publicar.
+        """
+        blocos = []
+        novos = []  # (resumo, temporário) dos blocos ainda inexistentes, movidos todos juntos no fim
+        try:
+            with open(temporario, 'rb') as f:
+                while True:
+                    dados = f.read(self.tamanho_bloco)
+                    if not dados:
+                        break
+                    resumo = protocolo.novo_resumo(dados).hexdigest()
+                    faltando = self._referenciar([resumo])
+                    blocos.append((resumo, len(dados)))
+                    if faltando:
+                        fd, caminho = self.novo_temporario()
+                        novos.append((resumo, caminho))
+                        with os.fdopen(fd, 'wb') as destino:
+                            destino.write(dados)
+            self.adicionar_blocos(novos)
+        except BaseException:
+            for _, caminho in novos:
+                try:
+                    os.remove(caminho)
+                except FileNotFoundError:
+                    pass
+            self._liberar(resumo for resumo, _ in blocos)
+            raise
+        os.remove(temporario)
+        return blocos
+
+    def publicar(self, nome, blocos):
+        """Grava o manifesto da imagem de forma atômica e libera os blocos da versão anterior."""
+        try:
+            antigos = [resumo for resumo, _ in self.ler_manifesto(nome)["blocos"]]
+        except FileNotFoundError:
+            antigos = []
+        caminho = self.caminho_manifesto(nome)
+        with open(caminho + ".novo", 'w') as f:
+            json.dump({"tamanho": sum(c for _, c in blocos), "blocos": blocos}, f)
+        self.sincronizacao.confirmar(arquivos=[caminho + ".novo"])
+        os.replace(caminho + ".novo", caminho)
+        self._liberar(antigos)
+
+    def tornar_duravel(self, nome):
+        """Leva ao disco a publicação de uma imagem (a entrada do manifesto renomeado)."""
+        self.sincronizacao.confirmar(diretorios=[self.diretorio_manifestos])
+
+    def reservar(self, nome, blocos):
+        """
+        Registra um upload com troca de resumos: os blocos anunciados ficam reservados até a
+        conclusão. Retorna os índices dos blocos que o cliente ainda precisa enviar.
+        """
+        faltando = set(self._referenciar(resumo for resumo, _ in blocos))
+        with self.trava:
+            anterior = self.pendentes.get(nome)
+            self.pendentes[nome] = blocos
+        if anterior:
+            # Um upload anterior da mesma imagem foi abandonado: desfaz a sua reserva
+            self._liberar(resumo for resumo, _ in anterior)
+        return [i for i, (resumo, _) in enumerate(blocos) if resumo in faltando]
+
+    def concluir(self, nome):
+        """
+        Retira o upload pendente de uma imagem, se houver. Retorna (blocos, faltando), em que
+        `faltando` conta os blocos que não chegaram (nesse caso a reserva é desfeita).
+        """
+        with self.trava:
+            blocos = self.pendentes.pop(nome, None)
+        if blocos is None:
+            return None, 0
+        faltando = sum(1 for resumo, _ in blocos if not self.tem_bloco(resumo))
+        if faltando:
+            self._liberar(resumo for resumo, _ in blocos)
+        return blocos, faltando
+
+    def tamanho(self, nome):
+        return self.ler_manifesto(nome)["tamanho"]
+
+    def trechos(self, nome, deslocamento=0, comprimento=None):
+        """Lista de (caminho, deslocamento, comprimento) dos blocos que cobrem o intervalo pedido."""
+        manifesto = self.ler_manifesto(nome)
+        restante = limitar_intervalo(manifesto["tamanho"], deslocamento, comprimento)
+        trechos = []
+        inicio = 0  # Posição do bloco atual na imagem
+        for resumo, tamanho in manifesto["blocos"]:
+            if restante == 0:
+                break
+            if deslocamento < inicio + tamanho:
+                interno = deslocamento - inicio
+                n = min(tamanho - interno, restante)
+                trechos.append((self.caminho_bloco(resumo), interno, n))
+                deslocamento += n
+                restante -= n
+            inicio += tamanho
+        return trechos
+
+    def abrir(self, nome):
+        """Abre a imagem para leitura binária (com seek), lendo os seus blocos em sequência."""
+        blocos = self.ler_manifesto(nome)["blocos"]
+        return io.BufferedReader(LeitorBlocos([self.caminho_bloco(resumo) for resumo, _ in blocos],
+                                              [tamanho for _, tamanho in blocos]))
+
+    def listar(self):
+        return [nome for nome in os.listdir(self.diretorio_manifestos) if not nome.endswith(".novo")]
+
+    def remover(self, nome):
+        try:
+            manifesto = self.ler_manifesto(nome)
+        except FileNotFoundError:
+            return False
+        os.remove(self.caminho_manifesto(nome))
+        self._liberar(resumo for resumo, _ in manifesto["blocos"])
+        return True
@@ -1,137 +1,854 @@
-import socket
+import argparse
+import json
+import logging
+import multiprocessing
 import os
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import compressao, delta, geotiff, metricas, protocolo
+import analises
+from armazenamento import ArmazemArquivos, ArmazemConteudo
+from derivados import CacheDerivados
+from durabilidade import GrupoSincronizacao, prealocar
+from espacial import IndiceEspacial
+from indice import IndiceImagens
+from previas import gerar_ladrilho, gerar_miniatura
+from travas import TravasArquivos
+
+log = logging.getLogger("cluster")
+
+REQUISICOES = metricas.REGISTRO.contador("mygeo_cluster_requisicoes_total",
+                                         "Requisições atendidas, por comando", ["comando"])
+FALHAS = metricas.REGISTRO.contador("mygeo_cluster_falhas_total",
+                                    "Requisições interrompidas por um erro (conexão perdida, disco)", ["comando"])
+LATENCIA = metricas.REGISTRO.histograma("mygeo_cluster_latencia_segundos",
+                                        "Duração das requisições, por comando", ["comando"])
+BYTES = metricas.REGISTRO.contador("mygeo_cluster_bytes_total",
+                                   "Bytes recebidos nas escritas (entrada) e de imagens enviados (saida)", ["direcao"])
+CONEXOES = metricas.REGISTRO.contador("mygeo_cluster_conexoes_total", "Conexões de servidores aceitas")
+CONEXOES_ATIVAS = metricas.REGISTRO.medidor("mygeo_cluster_conexoes_ativas", "Conexões de servidores em atendimento")
+CALCULOS = metricas.REGISTRO.contador("mygeo_cluster_calculos_total",
+                                      "Cálculos (CALCULO) atendidos, por resultado do cache de análises", ["cache"])
+REAPROVEITADOS = metricas.REGISTRO.contador("mygeo_cluster_delta_reaproveitados_bytes_total",
+                                            "Bytes dos UPLOAD_DELTA copiados da versão armazenada, sem transmissão")
 
 class Cluster:
     DIRETORIO_IMAGENS = "imagens"  # Diretório onde as imagens serão armazenadas
 
-    def __init__(self, host='localhost', porta=7000):
-        # Se o diretório de imagens não existir, ele será criado
-        if not os.path.exists(self.DIRETORIO_IMAGENS):
-            os.makedirs(self.DIRETORIO_IMAGENS)
+    def __init__(self, host='localhost', porta=7000, max_conexoes=32, diretorio=DIRETORIO_IMAGENS,
+                 deduplicar=False, limite_previas=512 * 1024 * 1024, limite_comprimidas=1024 * 1024 * 1024,
+                 duravel=True, processos=None, limite_analises=64 * 1024 * 1024,
+                 limite_assinaturas=256 * 1024 * 1024):
+        # Permite rodar vários nós na mesma máquina, cada um com o seu diretório
+        self.DIRETORIO_IMAGENS = diretorio
+        # Uploads ainda incompletos (ocultos na listagem): só são movidos para o diretório de
+        # imagens depois de recebidos por inteiro e verificados
+        self.diretorio_parciais = os.path.join(self.DIRETORIO_IMAGENS, ".parciais")
+        # Se os diretórios de imagens não existirem, eles serão criados
+        os.makedirs(self.diretorio_parciais, exist_ok=True)
+        # Temporários de UPLOADs simples interrompidos não podem ser retomados: são removidos
+        for nome in os.listdir(self.diretorio_parciais):
+            if nome.endswith(".tmp"):
+                os.remove(os.path.join(self.diretorio_parciais, nome))
+        # Protege a leitura e a atualização das marcas de progresso dos uploads retomáveis
+        self.trava_marcas = threading.Lock()
+        # Uma imagem só é confirmada ao servidor depois de estar no disco; os fsyncs de uploads
+        # simultâneos são feitos em lotes
+        sincronizacao = GrupoSincronizacao(duravel)
+        # Onde as imagens completas ficam: um arquivo por imagem ou blocos deduplicados por conteúdo
+        if deduplicar:
+            self.armazem = ArmazemConteudo(self.DIRETORIO_IMAGENS, sincronizacao=sincronizacao)
+        else:
+            self.armazem = ArmazemArquivos(self.DIRETORIO_IMAGENS, sincronizacao)
+        # Índice persistente de metadados: o LIST consulta o índice em vez de percorrer o diretório
+        self.indice = IndiceImagens(os.path.join(self.DIRETORIO_IMAGENS, ".indice.sqlite3"))
+        # Grade em memória das extensões das cenas, para a BUSCA: montada do índice na primeira busca
+        self.espacial = IndiceEspacial(self.indice.pegadas)
+        # Miniaturas e ladrilhos já gerados, para que pedidos repetidos não decodifiquem a cena de novo
+        self.previas = CacheDerivados(os.path.join(self.DIRETORIO_IMAGENS, ".previas"), limite_previas, ".png")
+        # Cópias comprimidas das imagens (as recebidas comprimidas e as geradas para DOWNLOADs com
+        # compressão): repetir o download não comprime a imagem de novo
+        self.comprimidas = CacheDerivados(os.path.join(self.DIRETORIO_IMAGENS, ".comprimidas"), limite_comprimidas)
+        # Resultados dos cálculos, pela versão (checksum) da imagem: repetir a consulta não recalcula
+        self.analises = CacheDerivados(os.path.join(self.DIRETORIO_IMAGENS, ".analises"), limite_analises, ".json")
+        # Assinaturas dos blocos de cada imagem para a transferência delta, calculadas ao publicá-la
+        self.assinaturas = CacheDerivados(os.path.join(self.DIRETORIO_IMAGENS, ".assinaturas"), limite_assinaturas,
+                                          ".sig")
+        # Processos que executam os cálculos (um por núcleo, por padrão). O forkserver cria os processos
+        # a partir de um processo limpo, sem as threads e travas do cluster
+        self.processos = ProcessPoolExecutor(max_workers=processos,
+                                             mp_context=multiprocessing.get_context("forkserver"))
+        self.sincronizar_indice()
 
         # Cria o socket do cluster (TCP/IP) e associa-o ao endereço e porta
         self.cluster_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Permite reabrir a porta logo após um reinício, sem esperar o TIME_WAIT das conexões antigas
+        self.cluster_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.cluster_socket.bind((host, porta))
         self.cluster_socket.listen(5)  # Coloca o socket em modo de escuta, aceitando até 5 conexões pendentes
-        print(f"[DEBUG] Cluster ouvindo em {host}:{porta}")
+        log.info("Cluster ouvindo em %s:%d", host, porta)
+
+        # Pool limitado de threads: cada conexão de servidor é atendida por um trabalhador;
+        # conexões além do limite aguardam na fila até que um trabalhador fique livre
+        self.trabalhadores = metricas.ExecutorMedido(max_workers=max_conexoes, thread_name_prefix="cluster")
+        metricas.REGISTRO.medidor("mygeo_cluster_conexoes_na_fila", "Conexões aceitas à espera de um trabalhador",
+                                  funcao=lambda: self.trabalhadores.pendentes)
+        # Travas por arquivo: UPLOAD e DELETE são exclusivos, DOWNLOADs podem ocorrer em paralelo
+        self.travas = TravasArquivos()
+
+    def sincronizar_indice(self):
+        """
+        Alinha o índice com as imagens armazenadas, ao iniciar: indexa as que faltam (por
+        exemplo, copiadas para o diretório com o cluster parado) e remove as que sumiram.
+        """
+        armazenadas = set(self.armazem.listar())
+        indexadas = self.indice.nomes()
+        for nome in indexadas - armazenadas:
+            self.indice.remover(nome)
+            self.espacial.remover(nome)
+        for nome in armazenadas - indexadas:
+            with self.armazem.abrir(nome) as f:
+                checksum = protocolo.calcular_checksum(f)
+            self.indexar(nome, checksum)
+        if armazenadas ^ indexadas:
+            log.info("Índice sincronizado: %d imagem(ns) indexada(s), %d removida(s)",
+                     len(armazenadas - indexadas), len(indexadas - armazenadas))
+
+    def indexar(self, nome_arquivo, checksum):
+        """
+        Registra no índice uma imagem recém-publicada, com os campos do cabeçalho GeoTIFF,
+        descarta as prévias e cópias comprimidas da versão anterior e calcula as assinaturas
+        da nova. Chamado com a trava de escrita da imagem (ou ao iniciar).
+        """
+        self.previas.invalidar(nome_arquivo)
+        self.comprimidas.invalidar(nome_arquivo)
+        self.analises.invalidar(nome_arquivo)
+        self.assinaturas.invalidar(nome_arquivo)
+        with self.armazem.abrir(nome_arquivo) as f:
+            metadados = geotiff.ler_metadados(f)
+        enviado_em = self.indice.registrar(nome_arquivo, self.armazem.tamanho(nome_arquivo), checksum, metadados)
+        self.espacial.atualizar(nome_arquivo, metadados, enviado_em)
+        self.assinaturas_imagem(nome_arquivo, checksum)
+
+    def assinaturas_imagem(self, nome_arquivo, checksum):
+        """
+        Assinaturas dos blocos da imagem, empacotadas como na resposta ao ASSINATURAS: lidas
+        do cache ou calculadas e guardadas nele. Chamado com uma trava da imagem.
+        """
+        caminho = self.assinaturas.caminho(nome_arquivo, "assinaturas", checksum or 0)
+        guardadas = self.assinaturas.abrir(caminho)
+        if guardadas is not None:
+            with guardadas:
+                return guardadas.read()
+        with self.armazem.abrir(nome_arquivo) as f:
+            empacotadas = delta.empacotar_assinaturas(delta.assinar(f))
+        self.assinaturas.guardar(caminho, empacotadas)
+        return empacotadas
 
     def tratar_requisicao(self, server_socket):
         """
         Recebe e trata as requisições enviadas pelo servidor. Este método é executado
         em loop até que o cliente se desconecte ou ocorra um erro.
         """
+        # Buffer pré-alocado, reutilizado em todos os uploads desta conexão
+        buffer = protocolo.novo_buffer()
+        CONEXOES.inc()
+        CONEXOES_ATIVAS.inc()
+        cab = None  # Requisição em andamento
         try:
             while True:
-                # Recebe a requisição do servidor (com até 1024 bytes)
-                requisicao = server_socket.recv(1024)
-                if not requisicao:
-                    print("[DEBUG] Cliente desconectado")
+                # Recebe o cabeçalho do próximo quadro enviado pelo servidor
+                cab = protocolo.receber_cabecalho(server_socket)
+                if cab is None:
+                    log.debug("Servidor desconectado")
                     break
-                requisicao = requisicao.decode()  # Decodifica a mensagem recebida
-                print(f"[DEBUG] Requisição recebida: {requisicao}")
-                self.processar_comando(requisicao, server_socket)  # Processa a requisição
+                if cab.opcode == protocolo.PING:
+                    self.processar_comando(cab, server_socket, buffer)
+                    cab = None
+                    continue
+                # O id de rastreio vem do servidor: o mesmo id aparece no log das duas pontas
+                comando = protocolo.nome_opcode(cab.opcode)
+                log.debug("[%016x] Requisição recebida: %s %s", cab.rastreio, comando, cab.nome)
+                inicio = time.perf_counter()
+                self.processar_comando(cab, server_socket, buffer)  # Processa a requisição
+                LATENCIA.observar(time.perf_counter() - inicio, comando=comando)
+                REQUISICOES.inc(comando=comando)
+                if cab.opcode in protocolo.OPCODES_ESCRITA:
+                    BYTES.inc(cab.tamanho, direcao="entrada")
+                cab = None
         except Exception as e:
-            print(f"[DEBUG] Erro ao tratar cliente: {e}")
+            if cab is not None:
+                FALHAS.inc(comando=protocolo.nome_opcode(cab.opcode))
+            log.warning("[%016x] Erro ao tratar requisição: %s", cab.rastreio if cab is not None else 0, e)
         finally:
             # Fecha a conexão do socket ao final
+            CONEXOES_ATIVAS.dec()
             server_socket.close()
 
-    def processar_comando(self, requisicao, server_socket):
+    def processar_comando(self, cab, server_socket, buffer):
         """
         Processa os comandos enviados pelo servidor, como upload, listagem, download e delete.
         """
-        comando, *args = requisicao.split()
-
         # Dependendo do comando recebido, chama o método apropriado
-        if comando == "UPLOAD":
-            self.upload_imagem(server_socket, args)
-        elif comando == "LIST":
-            self.listar_imagens(server_socket)
-        elif comando == "DOWNLOAD":
-            self.download_imagem(server_socket, args)
-        elif comando == "DELETE":
-            self.deletar_imagem(server_socket, args)
+        if cab.opcode == protocolo.UPLOAD:
+            self.upload_imagem(server_socket, cab, buffer)
+            return
+        if cab.opcode == protocolo.UPLOAD_PEDACO:
+            self.receber_pedaco(server_socket, cab, buffer)
+            return
+        if cab.opcode == protocolo.BLOCO:
+            self.receber_bloco(server_socket, cab, buffer)
+            return
+        if cab.opcode == protocolo.UPLOAD_DELTA:
+            self.upload_delta(server_socket, cab, buffer)
+            return
+        # Os demais comandos carregam no máximo alguns parâmetros, lidos inteiros em memória
+        if cab.tamanho > protocolo.TAMANHO_MAXIMO_PARAMETROS:
+            protocolo.descartar(server_socket, cab.tamanho)
+            protocolo.enviar_quadro(server_socket, protocolo.ERRO, payload="Parâmetros muito grandes",
+                                    id_requisicao=cab.id_requisicao)
+            return
+        parametros = protocolo.receber_payload(server_socket, cab)
+        if cab.opcode == protocolo.PING:
+            protocolo.enviar_quadro(server_socket, protocolo.OK, id_requisicao=cab.id_requisicao)
+        elif cab.opcode == protocolo.LIST:
+            self.listar_imagens(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.BUSCA:
+            self.buscar_imagens(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.DOWNLOAD:
+            self.download_imagem(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.DELETE:
+            self.deletar_imagem(server_socket, cab)
+        elif cab.opcode == protocolo.UPLOAD_INICIO:
+            self.iniciar_upload_pedacos(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.UPLOAD_RETOMAR:
+            self.retomar_upload(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.BLOCOS_CONSULTAR:
+            self.consultar_blocos(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.UPLOAD_FIM:
+            self.finalizar_upload_pedacos(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.DOWNLOAD_INTERVALO:
+            self.download_intervalo(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.TAMANHO:
+            self.informar_tamanho(server_socket, cab)
+        elif cab.opcode in (protocolo.MINIATURA, protocolo.LADRILHO):
+            self.enviar_previa(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.CALCULO:
+            self.calcular(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.ASSINATURAS:
+            self.enviar_assinaturas(server_socket, cab, parametros)
+        elif cab.opcode == protocolo.ESTATISTICAS:
+            # Métricas deste nó, incluídas pelo servidor na resposta ao comando ESTATISTICAS do cliente
+            protocolo.enviar_quadro(server_socket, protocolo.OK, id_requisicao=cab.id_requisicao,
+                                    payload=json.dumps({"metricas": metricas.REGISTRO.json()}))
+        elif cab.opcode == protocolo.CAPACIDADES:
+            # Codecs oferecidos pelo servidor que este nó também sabe descomprimir
+            protocolo.enviar_quadro(server_socket, protocolo.OK, payload=bytes(compressao.escolher(parametros)),
+                                    id_requisicao=cab.id_requisicao)
         else:
-            print("[DEBUG] Comando inválido.")
+            log.warning("[%016x] Comando inválido: %s", cab.rastreio, protocolo.nome_opcode(cab.opcode))
+            protocolo.enviar_quadro(server_socket, protocolo.ERRO, payload="Comando inválido",
+                                    id_requisicao=cab.id_requisicao)
 
-    def upload_imagem(self, server_socket, args):
+    def upload_imagem(self, server_socket, cab, buffer):
         """
         Recebe um arquivo de imagem do servidor e o armazena no diretório especificado.
+        O conteúdo é gravado num arquivo temporário (com o espaço já reservado) e só
+        substitui a imagem depois de recebido por inteiro, verificado e sincronizado com o
+        disco; nem uma conexão interrompida nem uma queda do sistema deixam um arquivo
+        truncado com o nome definitivo. Um payload comprimido é descomprimido à medida que
+        chega, e os trechos recebidos são guardados como cópia comprimida.
         """
-        nome_arquivo = args[0]  # Nome do arquivo a ser salvo
-        caminho_arquivo = os.path.join(self.DIRETORIO_IMAGENS, nome_arquivo)
+        nome_arquivo = cab.nome  # Nome do arquivo a ser salvo
 
-        # Abre um arquivo binário para escrita
-        with open(caminho_arquivo, 'wb') as f:
-            while True:
-                try:
-                    # Recebe os dados da imagem em blocos de 4096 bytes
-                    dados = server_socket.recv(4096)
-                    if not dados:
-                        break
-                    # Verifica se o marcador 'FIM' foi recebido (indicando o final da transmissão)
-                    if dados.endswith(b"FIM"):
-                        print(f"[DEBUG] Recebido marcador 'FIM' do cluster. Transmissão concluída.")
-                        break
-                    f.write(dados)  # Escreve os dados recebidos no arquivo
-                except Exception as e:
-                    print(f"[DEBUG] Erro ao receber dados: {e}")
-                    break
-        print(f"[DEBUG] Imagem {nome_arquivo} recebida no cluster.")
+        fd, temporario = tempfile.mkstemp(prefix=nome_arquivo + ".", suffix=".tmp", dir=self.diretorio_parciais)
+        comprimido = cab.flags & protocolo.FLAG_COMPRIMIDO
+        copia = None
+        try:
+            # Grava exatamente os bytes anunciados no cabeçalho
+            with os.fdopen(fd, 'wb') as f:
+                if comprimido:
+                    fd_copia, copia = self.comprimidas.temporario(nome_arquivo)
+                    with os.fdopen(fd_copia, 'wb') as f_copia:
+                        tamanho, checksum, codec = compressao.receber_descomprimindo(server_socket, cab, f, f_copia)
+                else:
+                    prealocar(fd, cab.tamanho)
+                    tamanho = protocolo.receber_para_arquivo(server_socket, cab, f, buffer)
+        except protocolo.ErroProtocolo as e:
+            # Checksum inválido ou trecho comprimido corrompido: descarta o arquivo e informa o servidor
+            log.warning("[%016x] Erro ao receber %s: %s", cab.rastreio, nome_arquivo, e)
+            os.remove(temporario)
+            if copia is not None:
+                self.comprimidas.descartar(copia)
+            protocolo.enviar_quadro(server_socket, protocolo.ERRO, payload=str(e),
+                                    id_requisicao=cab.id_requisicao)
+            return
+        except BaseException:
+            os.remove(temporario)
+            if copia is not None:
+                self.comprimidas.descartar(copia)
+            raise
+        # Num upload comprimido, o checksum dos bytes originais já foi calculado na recepção
+        if not comprimido:
+            if cab.flags & protocolo.FLAG_CHECKSUM:
+                checksum = cab.checksum  # Já conferido durante a recepção
+            else:
+                checksum = protocolo.calcular_checksum_arquivo(temporario)
+        importado = self.armazem.importar(temporario)
+        # A troca é atômica: downloads simultâneos veem a versão antiga ou a nova, inteira
+        with self.travas.escrita(nome_arquivo):
+            self.armazem.publicar(nome_arquivo, importado)
+            self.indexar(nome_arquivo, checksum)
+            if copia is not None and codec not in (None, compressao.NENHUM):
+                self.comprimidas.adotar(self.comprimidas.caminho(nome_arquivo, compressao.nome_codec(codec), checksum),
+                                        copia)
+                copia = None
+        if copia is not None:
+            self.comprimidas.descartar(copia)
+        self.armazem.tornar_duravel(nome_arquivo)
+        log.debug("[%016x] Imagem %s recebida no cluster (%d bytes, %d transmitidos)", cab.rastreio, nome_arquivo,
+                  tamanho, cab.tamanho)
+        protocolo.enviar_quadro(server_socket, protocolo.OK, payload="Upload bem-sucedido",
+                                id_requisicao=cab.id_requisicao)
+
+    def upload_delta(self, server_socket, cab, buffer):
+        """
+        Recebe uma nova versão de uma imagem como delta (comum/delta.py) da versão armazenada:
+        as instruções são gravadas num temporário e aplicadas sobre a versão atual, com a
+        trava de leitura, num segundo temporário. A imagem montada é conferida contra o
+        tamanho e o CRC32 do preâmbulo e publicada como num UPLOAD. O delta é recusado se a
+        versão armazenada não for mais aquela de que ele partiu; o cliente então envia a
+        imagem inteira.
+        """
+        nome_arquivo = cab.nome
+        fd, recebido = tempfile.mkstemp(prefix=nome_arquivo + ".", suffix=".tmp", dir=self.diretorio_parciais)
+        fd_montado, montado = tempfile.mkstemp(prefix=nome_arquivo + ".", suffix=".tmp", dir=self.diretorio_parciais)
+        try:
+            with os.fdopen(fd, 'w+b') as entrada, os.fdopen(fd_montado, 'wb') as saida:
+                protocolo.receber_para_arquivo(server_socket, cab, entrada, buffer)
+                entrada.seek(0)
+                preambulo = entrada.read(protocolo.PREAMBULO_DELTA.size)
+                if len(preambulo) != protocolo.PREAMBULO_DELTA.size:
+                    raise protocolo.ErroProtocolo("Preâmbulo delta incompleto")
+                resumo_base, tamanho, checksum = protocolo.PREAMBULO_DELTA.unpack(preambulo)
+                prealocar(fd_montado, tamanho)
+                with self.travas.leitura(nome_arquivo):
+                    registro = self.indice.consultar(nome_arquivo)
+                    if registro is None:
+                        raise FileNotFoundError(nome_arquivo)
+                    tamanho_base, tamanho_bloco, resumo = protocolo.CABECALHO_ASSINATURAS.unpack_from(
+                        self.assinaturas_imagem(nome_arquivo, registro["checksum"]))
+                    if resumo != resumo_base:
+                        raise protocolo.ErroProtocolo("A versão armazenada mudou desde o cálculo do delta")
+                    with self.armazem.abrir(nome_arquivo) as base:
+                        montados = delta.aplicar(entrada, base, saida, tamanho_base, tamanho_bloco)
+                if montados != (tamanho, checksum):
+                    raise protocolo.ErroProtocolo("Tamanho ou checksum da imagem montada não confere")
+        except (protocolo.ErroProtocolo, FileNotFoundError) as e:
+            os.remove(montado)
+            mensagem = "Arquivo nao encontrado" if isinstance(e, FileNotFoundError) else str(e)
+            log.warning("[%016x] Delta de %s recusado: %s", cab.rastreio, nome_arquivo, mensagem)
+            self.responder(server_socket, cab, False, mensagem)
+            return
+        except BaseException:
+            os.remove(montado)
+            raise
+        finally:
+            os.remove(recebido)
+        importado = self.armazem.importar(montado)
+        with self.travas.escrita(nome_arquivo):
+            self.armazem.publicar(nome_arquivo, importado)
+            self.indexar(nome_arquivo, checksum)
+        self.armazem.tornar_duravel(nome_arquivo)
+        REAPROVEITADOS.inc(max(0, tamanho - cab.tamanho))
+        log.debug("[%016x] Imagem %s montada a partir do delta (%d bytes, %d transmitidos)", cab.rastreio,
+                  nome_arquivo, tamanho, cab.tamanho)
+        self.responder(server_socket, cab, True, "Upload bem-sucedido")
+
+    def caminho_parcial(self, nome_arquivo):
+        """Caminho do arquivo temporário de um upload em pedaços ou retomável."""
+        return os.path.join(self.diretorio_parciais, nome_arquivo + ".parcial")
+
+    def ler_marca(self, nome_arquivo):
+        """
+        Marca de progresso de um upload: quantos bytes iniciais do arquivo parcial já
+        foram recebidos e gravados em disco (0 se não houver marca).
+        """
+        try:
+            with open(os.path.join(self.diretorio_parciais, nome_arquivo + ".marca")) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def gravar_marca(self, nome_arquivo, recebidos):
+        """Persiste a marca de progresso de forma atômica (arquivo temporário + rename)."""
+        caminho = os.path.join(self.diretorio_parciais, nome_arquivo + ".marca")
+        with open(caminho + ".novo", 'w') as f:
+            f.write(str(recebidos))
+        os.replace(caminho + ".novo", caminho)
+
+    def remover_parcial(self, nome_arquivo):
+        """Remove a marca de progresso (e o arquivo parcial, se ainda existir) de um upload."""
+        for caminho in (self.caminho_parcial(nome_arquivo),
+                        os.path.join(self.diretorio_parciais, nome_arquivo + ".marca")):
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
+    def responder(self, server_socket, cab, sucesso, mensagem):
+        """Envia uma resposta textual (OK ou ERRO) à requisição."""
+        protocolo.enviar_quadro(server_socket, protocolo.OK if sucesso else protocolo.ERRO,
+                                payload=mensagem, id_requisicao=cab.id_requisicao)
+
+    def iniciar_upload_pedacos(self, server_socket, cab, parametros):
+        """
+        Prepara um upload em pedaços: cria o arquivo temporário já com o tamanho final,
+        para que os pedaços possam ser gravados em qualquer ordem, por várias conexões.
+        """
+        tamanho, = protocolo.DESLOCAMENTO.unpack(parametros)
+        with self.trava_marcas:
+            with open(self.caminho_parcial(cab.nome), 'wb') as f:
+                prealocar(f.fileno(), tamanho)
+            self.gravar_marca(cab.nome, 0)
+        log.debug("[%016x] Upload em pedaços de %s iniciado (%d bytes)", cab.rastreio, cab.nome, tamanho)
+        self.responder(server_socket, cab, True, "Upload iniciado")
+
+    def retomar_upload(self, server_socket, cab, parametros):
+        """
+        Inicia ou retoma um upload: se já existir um arquivo parcial do mesmo tamanho,
+        responde com a marca de progresso persistida para que o cliente continue dali;
+        caso contrário, começa um novo arquivo parcial e responde 0.
+        """
+        tamanho, = protocolo.DESLOCAMENTO.unpack(parametros)
+        caminho = self.caminho_parcial(cab.nome)
+        with self.trava_marcas:
+            if os.path.exists(caminho) and os.path.getsize(caminho) == tamanho:
+                recebidos = self.ler_marca(cab.nome)
+            else:
+                with open(caminho, 'wb') as f:
+                    prealocar(f.fileno(), tamanho)
+                self.gravar_marca(cab.nome, 0)
+                recebidos = 0
+        log.debug("[%016x] Upload de %s retomado a partir do byte %d de %d", cab.rastreio, cab.nome, recebidos,
+                  tamanho)
+        protocolo.enviar_quadro(server_socket, protocolo.OK, cab.nome, protocolo.DESLOCAMENTO.pack(recebidos),
+                                id_requisicao=cab.id_requisicao)
+
+    def receber_pedaco(self, server_socket, cab, buffer):
+        """
+        Grava um pedaço do upload na sua posição do arquivo temporário (os.pwrite).
+        Quando o pedaço continua o trecho já recebido, os dados vão para o disco e a
+        marca de progresso avança; um pedaço interrompido no meio não avança a marca.
+        """
+        if cab.tamanho < protocolo.DESLOCAMENTO.size:
+            protocolo.descartar(server_socket, cab.tamanho)
+            self.responder(server_socket, cab, False, "Pedaço sem o deslocamento")
+            return
+        prefixo = protocolo.receber_exato(server_socket, protocolo.DESLOCAMENTO.size)
+        deslocamento, = protocolo.DESLOCAMENTO.unpack(prefixo)
+        comprimento = cab.tamanho - protocolo.DESLOCAMENTO.size
+        caminho = self.caminho_parcial(cab.nome)
+        try:
+            fd = os.open(caminho, os.O_WRONLY)
+        except FileNotFoundError:
+            protocolo.descartar(server_socket, comprimento)
+            self.responder(server_socket, cab, False, f"Upload de {cab.nome} não foi iniciado")
+            return
+        try:
+            if deslocamento + comprimento > os.fstat(fd).st_size:
+                protocolo.descartar(server_socket, comprimento)
+                self.responder(server_socket, cab, False, "Pedaço fora do tamanho anunciado")
+                return
+            checksum = protocolo.receber_em_posicao(server_socket, fd, deslocamento, comprimento, buffer,
+                                                    zlib.crc32(prefixo))
+            try:
+                protocolo.verificar_checksum(cab, checksum)
+            except protocolo.ErroProtocolo as e:
+                self.responder(server_socket, cab, False, str(e))
+                return
+            with self.trava_marcas:
+                if deslocamento <= self.ler_marca(cab.nome) < deslocamento + comprimento:
+                    os.fdatasync(fd)  # A marca só pode apontar para dados já persistidos
+                    self.gravar_marca(cab.nome, deslocamento + comprimento)
+        finally:
+            os.close(fd)
+        self.responder(server_socket, cab, True, "Pedaço recebido")
 
-    def listar_imagens(self, server_socket):
+    def consultar_blocos(self, server_socket, cab, parametros):
         """
-        Envia ao servidor a lista de todas as imagens armazenadas no cluster.
+        Primeira etapa de um upload deduplicado: recebe a lista de (resumo, comprimento) dos
+        blocos da imagem e responde com os índices dos que ainda não estão armazenados.
         """
-        imagens = os.listdir(self.DIRETORIO_IMAGENS)  # Lista todas as imagens no diretório
-        if not imagens:
-            print("[DEBUG] Nenhuma imagem encontrada no cluster.")
-            server_socket.send("Nenhuma imagem encontrada.".encode())  # Informa que não há imagens
+        if not self.armazem.deduplica:
+            self.responder(server_socket, cab, False, "Deduplicação desativada neste nó")
+            return
+        blocos = [(resumo.hex(), comprimento) for resumo, comprimento in protocolo.BLOCO_INFO.iter_unpack(parametros)]
+        faltando = self.armazem.reservar(cab.nome, blocos)
+        log.debug("[%016x] Upload deduplicado de %s: %d de %d blocos a receber", cab.rastreio, cab.nome,
+                  len(faltando), len(blocos))
+        protocolo.enviar_quadro(server_socket, protocolo.OK, cab.nome, protocolo.empacotar_indices(faltando),
+                                id_requisicao=cab.id_requisicao)
+
+    def receber_bloco(self, server_socket, cab, buffer):
+        """
+        Recebe um bloco de um upload deduplicado, confere o resumo BLAKE2b e o guarda no
+        armazenamento. Blocos que já existem são descartados sem gravar em disco.
+        """
+        if cab.tamanho < protocolo.TAMANHO_RESUMO:
+            protocolo.descartar(server_socket, cab.tamanho)
+            self.responder(server_socket, cab, False, "Bloco sem o resumo")
+            return
+        resumo = bytes(protocolo.receber_exato(server_socket, protocolo.TAMANHO_RESUMO))
+        comprimento = cab.tamanho - protocolo.TAMANHO_RESUMO
+        if not self.armazem.deduplica:
+            protocolo.descartar(server_socket, comprimento)
+            self.responder(server_socket, cab, False, "Deduplicação desativada neste nó")
+            return
+        if self.armazem.tem_bloco(resumo.hex()):
+            # Outro upload gravou o mesmo bloco depois da consulta
+            protocolo.descartar(server_socket, comprimento)
+            self.responder(server_socket, cab, True, "Bloco já armazenado")
+            return
+        fd, temporario = self.armazem.novo_temporario()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                recebido = protocolo.receber_com_resumo(server_socket, f, comprimento, buffer)
+        except BaseException:
+            os.remove(temporario)
+            raise
+        if recebido != resumo:
+            os.remove(temporario)
+            self.responder(server_socket, cab, False, "Resumo do bloco não confere")
+        elif not self.armazem.adicionar_bloco(resumo.hex(), temporario):
+            self.responder(server_socket, cab, False, "Bloco não anunciado no BLOCOS_CONSULTAR")
         else:
-            imagens_str = ", ".join(imagens)  # Concatena os nomes das imagens em uma string
-            print(f"[DEBUG] Enviando lista de imagens: {imagens_str}")
-            server_socket.send(imagens_str.encode())  # Envia a lista de imagens ao servidor
-
-    def download_imagem(self, server_socket, args):
-        """
-        Envia um arquivo de imagem específico solicitado pelo servidor.
-        """
-        nome_arquivo = args[0]
-        caminho_arquivo = os.path.join(self.DIRETORIO_IMAGENS, nome_arquivo)
-
-        # Verifica se o arquivo solicitado existe no diretório
-        if os.path.exists(caminho_arquivo):
-            # Abre o arquivo em modo binário para leitura
-            with open(caminho_arquivo, 'rb') as f:
-                while True:
-                    # Lê os dados em blocos de 4096 bytes
-                    dados = f.read(4096)
-                    if not dados:
-                        break
-                    # Verifica se o marcador 'FIM' foi atingido
-                    if dados.endswith(b"FIM"):
-                        server_socket.send(dados[:-3])
-                        break
-                    server_socket.send(dados)  # Envia os dados para o servidor
-            # Envia o marcador 'FIM' ao servidor para indicar que a transmissão acabou
-            server_socket.send(b"FIM")
-            print(f"[DEBUG] Imagem {nome_arquivo} enviada para o servidor.")
+            self.responder(server_socket, cab, True, "Bloco recebido")
+
+    def finalizar_upload_pedacos(self, server_socket, cab, parametros):
+        """
+        Verifica o arquivo temporário completo contra o CRC32 enviado pelo cliente e o move
+        para o diretório de imagens, de forma atômica. O CRC32 é obrigatório: o temporário já
+        nasce com o tamanho final, e só ele revela pedaços que não chegaram. Num upload
+        deduplicado, publica o manifesto se todos os blocos anunciados estiverem armazenados
+        (conferidos pelos resumos; o CRC32, opcional, vai para o índice).
+        """
+        if parametros and len(parametros) != protocolo.CHECKSUM.size:
+            self.responder(server_socket, cab, False, "Parâmetros de UPLOAD_FIM inválidos")
+            return
+        enviado = protocolo.CHECKSUM.unpack(parametros)[0] if parametros else None
+        if self.armazem.deduplica:
+            blocos, faltando = self.armazem.concluir(cab.nome)
+            if faltando:
+                self.responder(server_socket, cab, False, f"{faltando} bloco(s) de {cab.nome} não foram recebidos")
+                return
+            if blocos is not None:
+                with self.travas.escrita(cab.nome):
+                    self.armazem.publicar(cab.nome, blocos)
+                    self.indexar(cab.nome, enviado)
+                self.armazem.tornar_duravel(cab.nome)
+                log.debug("[%016x] Imagem %s publicada a partir de %d blocos", cab.rastreio, cab.nome, len(blocos))
+                self.responder(server_socket, cab, True, "Upload bem-sucedido")
+                return
+        caminho = self.caminho_parcial(cab.nome)
+        if not os.path.exists(caminho):
+            self.responder(server_socket, cab, False, f"Upload de {cab.nome} não foi iniciado")
+            return
+        if enviado is None:
+            # O temporário continua: o cliente pode repetir o UPLOAD_FIM com o CRC32
+            self.responder(server_socket, cab, False, "UPLOAD_FIM sem o CRC32 do arquivo montado")
+            return
+        checksum = protocolo.calcular_checksum_arquivo(caminho)
+        if checksum != enviado:
+            # O conteúdo montado está corrompido: o upload precisa recomeçar do zero
+            self.remover_parcial(cab.nome)
+            self.responder(server_socket, cab, False, "Checksum do arquivo montado não confere")
+            return
+        importado = self.armazem.importar(caminho)
+        with self.travas.escrita(cab.nome):
+            self.armazem.publicar(cab.nome, importado)
+            self.indexar(cab.nome, checksum)
+        self.armazem.tornar_duravel(cab.nome)
+        self.remover_parcial(cab.nome)
+        log.debug("[%016x] Imagem %s montada a partir dos pedaços", cab.rastreio, cab.nome)
+        self.responder(server_socket, cab, True, "Upload bem-sucedido")
+
+    def enviar_trechos(self, server_socket, cab, trechos):
+        """
+        Envia como payload de um quadro OK os trechos (caminho, deslocamento, comprimento)
+        que compõem uma imagem ou um intervalo dela, cada um com sendfile.
+        """
+        tamanho = sum(comprimento for _, _, comprimento in trechos)
+        server_socket.sendall(protocolo.montar_cabecalho(protocolo.OK, cab.nome, tamanho, cab.id_requisicao))
+        for caminho, deslocamento, comprimento in trechos:
+            with open(caminho, 'rb') as f:
+                protocolo.enviar_trecho(server_socket, f, deslocamento, comprimento)
+        BYTES.inc(tamanho, direcao="saida")
+
+    def download_intervalo(self, server_socket, cab, parametros):
+        """Envia apenas um intervalo (deslocamento, comprimento) de uma imagem, com sendfile."""
+        try:
+            deslocamento, comprimento = protocolo.INTERVALO.unpack(parametros)
+        except struct.error:
+            self.responder(server_socket, cab, False, "Parâmetros de DOWNLOAD_INTERVALO inválidos")
+            return
+        with self.travas.leitura(cab.nome):
+            try:
+                # O intervalo é limitado ao fim do arquivo
+                trechos = self.armazem.trechos(cab.nome, deslocamento, comprimento)
+            except FileNotFoundError:
+                self.responder(server_socket, cab, False, "Arquivo nao encontrado")
+                return
+            self.enviar_trechos(server_socket, cab, trechos)
+
+    def informar_tamanho(self, server_socket, cab):
+        """Responde com o tamanho de uma imagem (usado antes de um download em pedaços)."""
+        try:
+            tamanho = self.armazem.tamanho(cab.nome)
+        except FileNotFoundError:
+            self.responder(server_socket, cab, False, "Arquivo nao encontrado")
+            return
+        protocolo.enviar_quadro(server_socket, protocolo.OK, cab.nome, protocolo.DESLOCAMENTO.pack(tamanho),
+                                id_requisicao=cab.id_requisicao)
+
+    def enviar_previa(self, server_socket, cab, parametros):
+        """
+        Responde a uma MINIATURA ou a um LADRILHO com um PNG reduzido a partir da imagem,
+        lendo apenas as linhas necessárias. A prévia gerada fica em cache em disco, de onde
+        os pedidos repetidos (por exemplo, de um visualizador de mapas) são enviados com sendfile.
+        """
+        try:
+            if cab.opcode == protocolo.MINIATURA:
+                lado, = protocolo.LADO_MINIATURA.unpack(parametros)
+                if not 1 <= lado <= protocolo.LADO_MAXIMO_MINIATURA:
+                    raise ValueError(f"o lado deve estar entre 1 e {protocolo.LADO_MAXIMO_MINIATURA}")
+                descricao = f"miniatura-{lado}"
+            else:
+                z, x, y = protocolo.POSICAO_LADRILHO.unpack(parametros)
+                descricao = f"ladrilho-{z}-{x}-{y}"
+        except (struct.error, ValueError) as e:
+            self.responder(server_socket, cab, False, f"Parâmetros de prévia inválidos: {e}")
+            return
+        with self.travas.leitura(cab.nome):
+            registro = self.indice.consultar(cab.nome)
+            if registro is None:
+                self.responder(server_socket, cab, False, "Arquivo nao encontrado")
+                return
+            caminho = self.previas.caminho(cab.nome, descricao, registro["checksum"] or 0)
+            guardada = self.previas.abrir(caminho)
+            if guardada is not None:
+                with guardada:
+                    tamanho = os.fstat(guardada.fileno()).st_size
+                    server_socket.sendall(protocolo.montar_cabecalho(protocolo.OK, cab.nome, tamanho,
+                                                                     cab.id_requisicao))
+                    protocolo.enviar_trecho(server_socket, guardada, 0, tamanho)
+                BYTES.inc(tamanho, direcao="saida")
+                return
+            try:
+                with self.armazem.abrir(cab.nome) as f:
+                    if cab.opcode == protocolo.MINIATURA:
+                        png = gerar_miniatura(f, lado)
+                    else:
+                        png = gerar_ladrilho(f, z, x, y)
+            except ValueError as e:
+                self.responder(server_socket, cab, False, f"Prévia indisponível: {e}")
+                return
+            self.previas.guardar(caminho, png)
+        log.debug("[%016x] Prévia %s de %s gerada (%d bytes)", cab.rastreio, descricao, cab.nome, len(png))
+        protocolo.enviar_quadro(server_socket, protocolo.OK, cab.nome, png, id_requisicao=cab.id_requisicao)
+        BYTES.inc(len(png), direcao="saida")
+
+    def calcular(self, server_socket, cab, parametros):
+        """
+        Responde a um CALCULO com o resultado em JSON, calculado pelo pool de processos sobre
+        a imagem em disco. O resultado fica em cache pela versão da imagem e pelos parâmetros,
+        de onde as consultas repetidas são respondidas sem ler a cena.
+        """
+        try:
+            calculo = protocolo.desempacotar_calculo(parametros)
+        except (protocolo.ErroProtocolo, struct.error) as e:
+            self.responder(server_socket, cab, False, f"Parâmetros de cálculo inválidos: {e}")
+            return
+        with self.travas.leitura(cab.nome):
+            registro = self.indice.consultar(cab.nome)
+            if registro is None:
+                self.responder(server_socket, cab, False, "Arquivo nao encontrado")
+                return
+            caminho = self.analises.caminho(cab.nome, f"calculo-{parametros.hex()}", registro["checksum"] or 0)
+            guardado = self.analises.abrir(caminho)
+            if guardado is not None:
+                with guardado:
+                    resultado = guardado.read()
+                CALCULOS.inc(cache="acerto")
+            else:
+                try:
+                    # Os processos abrem a imagem pelos seus trechos em disco, que a trava de leitura mantém
+                    resultado = json.dumps(analises.calcular(self.processos, self.armazem.trechos(cab.nome),
+                                                             calculo)).encode()
+                except ValueError as e:
+                    self.responder(server_socket, cab, False, f"Cálculo indisponível: {e}")
+                    return
+                self.analises.guardar(caminho, resultado)
+                CALCULOS.inc(cache="falta")
+        log.debug("[%016x] Cálculo sobre %s respondido (%d bytes)", cab.rastreio, cab.nome, len(resultado))
+        protocolo.enviar_quadro(server_socket, protocolo.OK, cab.nome, resultado, id_requisicao=cab.id_requisicao)
+
+    def enviar_assinaturas(self, server_socket, cab, parametros):
+        """
+        Responde a um ASSINATURAS com as assinaturas dos blocos da imagem, do cache. Se o
+        payload trouxer o resumo da cópia do cliente e ele for o mesmo da imagem, só o
+        cabeçalho é enviado: a cópia está atualizada e não há o que transferir.
+        """
+        with self.travas.leitura(cab.nome):
+            registro = self.indice.consultar(cab.nome)
+            if registro is None:
+                self.responder(server_socket, cab, False, "Arquivo nao encontrado")
+                return
+            empacotadas = self.assinaturas_imagem(cab.nome, registro["checksum"])
+        _, _, resumo = protocolo.CABECALHO_ASSINATURAS.unpack_from(empacotadas)
+        if parametros == resumo:
+            empacotadas = empacotadas[:protocolo.CABECALHO_ASSINATURAS.size]
+        protocolo.enviar_quadro(server_socket, protocolo.OK, cab.nome, empacotadas, id_requisicao=cab.id_requisicao)
+
+    def listar_imagens(self, server_socket, cab, parametros):
+        """
+        Envia ao servidor uma página da lista de imagens armazenadas no cluster, consultada
+        no índice: o nome da requisição é o prefixo e o payload traz a ordenação e o cursor.
+        """
+        try:
+            listagem = protocolo.desempacotar_listagem(parametros)
+        except (protocolo.ErroProtocolo, struct.error, UnicodeDecodeError) as e:
+            self.responder(server_socket, cab, False, f"Parâmetros de LIST inválidos: {e}")
+            return
+        registros = self.indice.listar(cab.nome, listagem)
+        log.debug("[%016x] Enviando página com %d imagem(ns)", cab.rastreio, len(registros))
+        # Cada imagem é um registro com o tamanho do nome, então a página pode ser percorrida sem separadores
+        protocolo.enviar_quadro(server_socket, protocolo.OK, payload=protocolo.empacotar_registros(registros),
+                                id_requisicao=cab.id_requisicao)
+
+    def buscar_imagens(self, server_socket, cab, parametros):
+        """
+        Envia ao servidor uma página das cenas cuja extensão intersecta a caixa pedida,
+        consultada no índice espacial: o nome da requisição é o cursor e o payload traz a
+        caixa, o intervalo de datas, o EPSG e o limite.
+        """
+        try:
+            busca = protocolo.desempacotar_busca(parametros)
+        except (protocolo.ErroProtocolo, struct.error) as e:
+            self.responder(server_socket, cab, False, f"Parâmetros de BUSCA inválidos: {e}")
+            return
+        pegadas = self.espacial.buscar(busca[:4], busca.inicio, busca.fim, busca.epsg, cab.nome, busca.limite)
+        resumos = self.indice.resumos(nome for nome, *_ in pegadas)
+        # Uma cena removida entre a busca e a consulta dos resumos fica de fora
+        cenas = [protocolo.CenaEncontrada(nome, *resumos[nome], *pegada) for nome, *pegada in pegadas
+                 if nome in resumos]
+        log.debug("[%016x] Enviando página com %d cena(s)", cab.rastreio, len(cenas))
+        protocolo.enviar_quadro(server_socket, protocolo.OK, payload=protocolo.empacotar_cenas(cenas),
+                                id_requisicao=cab.id_requisicao)
+
+    def download_imagem(self, server_socket, cab, parametros=b""):
+        """
+        Envia um arquivo de imagem específico solicitado pelo servidor. Se a requisição
+        listar codecs aceitos, a imagem pode seguir comprimida (ver enviar_comprimida).
+        """
+        nome_arquivo = cab.nome
+        codecs = compressao.escolher(parametros)
+
+        # A trava de leitura impede que um UPLOAD ou DELETE do mesmo arquivo se intercale com o envio
+        with self.travas.leitura(nome_arquivo):
+            if codecs and self.enviar_comprimida(server_socket, cab, codecs):
+                return
+            try:
+                trechos = self.armazem.trechos(nome_arquivo)
+            except FileNotFoundError:
+                # Se o arquivo não for encontrado, envia uma mensagem de erro
+                protocolo.enviar_quadro(server_socket, protocolo.ERRO, payload="Arquivo nao encontrado",
+                                        id_requisicao=cab.id_requisicao)
+                return
+            # Envia o arquivo como payload de um quadro OK: o tamanho segue no cabeçalho e o
+            # conteúdo é entregue ao kernel com sendfile, sem leituras em blocos no Python
+            self.enviar_trechos(server_socket, cab, trechos)
+            log.debug("[%016x] Imagem %s enviada para o servidor", cab.rastreio, nome_arquivo)
+
+    def enviar_comprimida(self, server_socket, cab, codecs):
+        """
+        Envia a imagem comprimida com um dos `codecs` (chamado com a trava de leitura). Usa a
+        cópia comprimida guardada, se houver, ou comprime a imagem e guarda a cópia. Retorna
+        False se a imagem não existir ou não diminuir com a compressão: ela segue crua.
+        """
+        registro = self.indice.consultar(cab.nome)
+        if registro is None:
+            return False
+        checksum = registro["checksum"] or 0
+        # A cópia com o codec NENHUM é o marcador (vazio) de uma imagem incompressível
+        for codec in codecs + [compressao.NENHUM]:
+            comprimida = self.comprimidas.abrir(self.comprimidas.caminho(cab.nome, compressao.nome_codec(codec),
+                                                                         checksum))
+            if comprimida is not None:
+                break
         else:
-            # Se o arquivo não for encontrado, envia uma mensagem de erro
-            server_socket.send(b"Arquivo nao encontrado")
+            codec, comprimida = self.comprimir_imagem(cab.nome, checksum, codecs[0])
+        with comprimida:
+            tamanho = os.fstat(comprimida.fileno()).st_size
+            if codec == compressao.NENHUM or tamanho >= registro["tamanho"]:
+                return False
+            server_socket.sendall(protocolo.montar_cabecalho(protocolo.OK, cab.nome, tamanho, cab.id_requisicao,
+                                                             flags=protocolo.FLAG_COMPRIMIDO))
+            protocolo.enviar_trecho(server_socket, comprimida, 0, tamanho)
+        BYTES.inc(tamanho, direcao="saida")
+        log.debug("[%016x] Imagem %s enviada comprimida (%d -> %d bytes)", cab.rastreio, cab.nome,
+                  registro["tamanho"], tamanho)
+        return True
 
-    def deletar_imagem(self, server_socket, args):
+    def comprimir_imagem(self, nome_arquivo, checksum, codec):
+        """
+        Comprime a imagem e guarda a cópia no cache (chamado com a trava de leitura).
+        Retorna (codec efetivo, cópia aberta), que continua legível mesmo que não caiba no cache.
+        """
+        fd, temporario = self.comprimidas.temporario(nome_arquivo)
+        comprimida = os.fdopen(fd, 'w+b')
+        try:
+            with self.armazem.abrir(nome_arquivo) as f:
+                codec, _ = compressao.comprimir(f, comprimida, codec)
+            if codec == compressao.NENHUM:
+                comprimida.truncate(0)  # Só o marcador: nada a ganhar comprimindo esta imagem
+            comprimida.flush()
+            self.comprimidas.adotar(self.comprimidas.caminho(nome_arquivo, compressao.nome_codec(codec), checksum),
+                                    temporario)
+        except BaseException:
+            comprimida.close()
+            self.comprimidas.descartar(temporario)
+            raise
+        return codec, comprimida
+
+    def deletar_imagem(self, server_socket, cab):
         """
         Deleta um arquivo de imagem especificado pelo servidor.
         """
-        nome_arquivo = args[0]
-        caminho_arquivo = os.path.join(self.DIRETORIO_IMAGENS, nome_arquivo)
-        # Verifica se o arquivo existe
-        if os.path.exists(caminho_arquivo):
-            os.remove(caminho_arquivo)  # Remove o arquivo
-            server_socket.send(f"Imagem {nome_arquivo} deletada".encode())  # Confirma a remoção
-        else:
-            server_socket.send(f"Imagem {nome_arquivo} não encontrada".encode())  # Informa que o arquivo não foi encontrado
+        nome_arquivo = cab.nome
+        with self.travas.escrita(nome_arquivo):
+            # Remove a imagem, se ela existir
+            if self.armazem.remover(nome_arquivo):
+                self.indice.remover(nome_arquivo)
+                self.espacial.remover(nome_arquivo)
+                self.previas.invalidar(nome_arquivo)
+                self.comprimidas.invalidar(nome_arquivo)
+                self.analises.invalidar(nome_arquivo)
+                self.assinaturas.invalidar(nome_arquivo)
+                protocolo.enviar_quadro(server_socket, protocolo.OK, payload=f"Imagem {nome_arquivo} deletada",
+                                        id_requisicao=cab.id_requisicao)  # Confirma a remoção
+            else:
+                protocolo.enviar_quadro(server_socket, protocolo.ERRO, payload=f"Imagem {nome_arquivo} não encontrada",
+                                        id_requisicao=cab.id_requisicao)  # Informa que o arquivo não foi encontrado
 
     def iniciar(self):
         """
@@ -140,10 +857,45 @@ class Cluster:
         while True:
             # Aceita uma nova conexão do servidor
             server_socket, endereco = self.cluster_socket.accept()
-            print(f"[DEBUG] Conexão recebida de {endereco}")
-            self.tratar_requisicao(server_socket)  # Processa as requisições recebidas
+            log.debug("Conexão recebida de %s", endereco)
+            protocolo.desativar_nagle(server_socket)
+            # Processa as requisições da conexão em um trabalhador do pool, liberando o laço de accept
+            self.trabalhadores.submit(self.tratar_requisicao, server_socket)
 
 # Inicializa o cluster ao executar o script
 if __name__ == "__main__":
-    cluster = Cluster()  # Instancia o objeto Cluster
-    cluster.iniciar()  # Inicia o loop de espera por conexões
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Cluster de armazenamento do MyGeo Eye")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--porta", type=int, default=7000)
+    parser.add_argument("--max-conexoes", type=int, default=32,
+                        help="Número máximo de conexões de servidores atendidas simultaneamente")
+    parser.add_argument("--diretorio", default=Cluster.DIRETORIO_IMAGENS,
+                        help="Diretório onde as imagens deste nó são armazenadas")
+    parser.add_argument("--deduplicar", action="store_true",
+                        help="Armazena as imagens em blocos endereçados por conteúdo, guardando blocos repetidos uma vez")
+    parser.add_argument("--cache-previas", type=int, default=512,
+                        help="Espaço em disco (MB) para as miniaturas e ladrilhos gerados")
+    parser.add_argument("--cache-comprimidas", type=int, default=1024,
+                        help="Espaço em disco (MB) para as cópias comprimidas das imagens (0 desativa)")
+    parser.add_argument("--processos", type=int,
+                        help="Processos que executam os cálculos (CALCULO); por padrão, um por núcleo")
+    parser.add_argument("--cache-analises", type=int, default=64,
+                        help="Espaço em disco (MB) para os resultados dos cálculos")
+    parser.add_argument("--cache-assinaturas", type=int, default=256,
+                        help="Espaço em disco (MB) para as assinaturas dos blocos, usadas na transferência delta")
+    parser.add_argument("--sem-fsync", action="store_true",
+                        help="Confirma os uploads sem sincronizar com o disco (mais rápido, mas uma queda do "
+                             "sistema pode perder imagens já confirmadas)")
+    parser.add_argument("--log", choices=metricas.NIVEIS_LOG, default="info",
+                        help="Nível do log (debug mostra cada requisição, com o id de rastreio do servidor)")
+    parser.add_argument("--metricas-porta", type=int,
+                        help="Porta do endpoint HTTP /metrics, no formato do Prometheus (desativado se omitida)")
+    args = parser.parse_args()
+    metricas.configurar_log(args.log)
+    if args.metricas_porta is not None:
+        metricas.servir_http(args.host, args.metricas_porta)
+    cluster = Cluster(args.host, args.porta, args.max_conexoes, args.diretorio, args.deduplicar,
+                      args.cache_previas * 1024 * 1024, args.cache_comprimidas * 1024 * 1024,
+                      not args.sem_fsync, args.processos, args.cache_analises * 1024 * 1024,
+                      args.cache_assinaturas * 1024 * 1024)  # Instancia o objeto Cluster
+    cluster.iniciar()  # Inicia o loop de espera por conexões
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class CacheDerivados:
+    """
+    Arquivos derivados das imagens (prévias PNG, cópias comprimidas), guardados em disco
+    com despejo LRU e limite em bytes. O nome de cada arquivo inclui o checksum da imagem,
+    então um derivado nunca é servido para outra versão; os da versão anterior são
+    descartados ao publicar ou remover a imagem.
+    """
+
+    def __init__(self, diretorio, limite, sufixo=""):
+        self.diretorio = diretorio
+        self.limite = limite
+        self.sufixo = sufixo
+        self.trava = threading.Lock()
+        self.entradas = OrderedDict()  # caminho -> tamanho, do menos para o mais recente
+        self.uso = 0
+        os.makedirs(diretorio, exist_ok=True)
+        # Derivados de execuções anteriores continuam válidos: entram na ordem da última modificação
+        existentes = []
+        for pasta in os.listdir(diretorio):
+            for nome in os.listdir(os.path.join(diretorio, pasta)):
+                caminho = os.path.join(diretorio, pasta, nome)
+                if nome.endswith(".tmp"):
+                    os.remove(caminho)
+                    continue
+                informacoes = os.stat(caminho)
+                existentes.append((informacoes.st_mtime, caminho, informacoes.st_size))
+        for _, caminho, tamanho in sorted(existentes):
+            self.entradas[caminho] = tamanho
+            self.uso += tamanho
+        with self.trava:
+            self._despejar()
+
+    def pasta(self, nome):
+        return os.path.join(self.diretorio, hashlib.blake2b(nome.encode(), digest_size=16).hexdigest())
+
+    def caminho(self, nome, descricao, checksum):
+        return os.path.join(self.pasta(nome), f"{descricao}-{checksum:08x}{self.sufixo}")
+
+    def abrir(self, caminho):
+        """Abre o derivado guardado em `caminho`, ou retorna None se ele ainda não foi gerado."""
+        with self.trava:
+            if caminho not in self.entradas:
+                return None
+            self.entradas.move_to_end(caminho)
+            # Aberto sob a trava: continua legível mesmo se for despejado durante o envio
+            return open(caminho, 'rb')
+
+    def temporario(self, nome):
+        """Cria um arquivo temporário para um derivado da imagem. Retorna (descritor, caminho)."""
+        pasta = self.pasta(nome)
+        os.makedirs(pasta, exist_ok=True)
+        return tempfile.mkstemp(suffix=".tmp", dir=pasta)
+
+    def descartar(self, temporario):
+        """Remove um temporário que não será adotado (e a pasta da imagem, se ficar vazia)."""
+        os.remove(temporario)
+        try:
+            os.rmdir(os.path.dirname(temporario))
+        except OSError:
+            pass  # A pasta ainda guarda outros derivados
+
+    def adotar(self, caminho, temporario):
+        """Guarda um temporário já gravado como o derivado `caminho` (ou o descarta, se não couber)."""
+        tamanho = os.path.getsize(temporario)
+        if tamanho > self.limite:
+            os.remove(temporario)
+            return
+        os.replace(temporario, caminho)
+        with self.trava:
+            self.uso += tamanho - self.entradas.pop(caminho, 0)
+            self.entradas[caminho] = tamanho
+            self._despejar()
+
+    def guardar(self, caminho, dados):
+        if len(dados) > self.limite:
+            return
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        fd, temporario = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(caminho))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(dados)
+        self.adotar(caminho, temporario)
+
+    def _despejar(self):
+        """Remove os derivados menos usados até caber no limite (chamado com a trava)."""
+        while self.uso > self.limite:
+            caminho, tamanho = self.entradas.popitem(last=False)
+            os.remove(caminho)
+            self.uso -= tamanho
+
+    def invalidar(self, nome):
+        """Descarta todos os derivados de uma imagem (chamado com a trava de escrita dela)."""
+        pasta = self.pasta(nome)
+        with self.trava:
+            for caminho in [c for c in self.entradas if os.path.dirname(c) == pasta]:
+                self.uso -= self.entradas.pop(caminho)
+                os.remove(caminho)
+            try:
+                os.rmdir(pasta)
+            except OSError:
+                pass  # Pasta inexistente, ou com temporários de um upload em andamento
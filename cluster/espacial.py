@@ -0,0 +1,205 @@
+"""
+Índice espacial em memória das cenas de um nó, usado pela BUSCA por caixa (bounding box).
+
+As extensões e datas ficam em arrays compactos, indexados por um id numérico de cada
+cena; para cada sistema de referência (código EPSG) há uma grade regular cujas células
+guardam os ids das cenas que as tocam. Uma busca só examina as células cobertas pela
+caixa pedida, em vez de todas as cenas do nó. O índice é montado a partir do SQLite
+(IndiceImagens.pegadas) na primeira busca e mantido em dia pelos uploads e remoções.
+"""
+import heapq
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from array import array
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import metricas
+
+log = logging.getLogger("cluster.espacial")
+
+CENAS = metricas.REGISTRO.medidor("mygeo_cluster_cenas_indexadas", "Cenas no índice espacial")
+EXAMINADAS = metricas.REGISTRO.histograma("mygeo_cluster_busca_examinadas", "Cenas examinadas por busca",
+                                          baldes=(10, 100, 1000, 10000, 100000, 1000000))
+
+MAXIMO_CELULAS = 64  # Cenas que cobrem mais células que isso ficam fora da grade, na lista das grandes
+
+
+class Grade:
+    """
+    Grade regular de um sistema de referência. O tamanho das células é o da primeira cena
+    inserida: as cenas de um mesmo sensor costumam ter extensões parecidas, e assim cada
+    uma toca poucas células.
+    """
+
+    def __init__(self, largura, altura):
+        self.largura = largura
+        self.altura = altura
+        self.celulas = {}  # (coluna, linha) -> array de ids
+        self.grandes = set()  # Ids das cenas que cobrem células demais
+
+    def _intervalo(self, x_min, y_min, x_max, y_max):
+        return (math.floor(x_min / self.largura), math.floor(y_min / self.altura),
+                math.floor(x_max / self.largura), math.floor(y_max / self.altura))
+
+    def inserir(self, id_cena, caixa):
+        c0, l0, c1, l1 = self._intervalo(*caixa)
+        if (c1 - c0 + 1) * (l1 - l0 + 1) > MAXIMO_CELULAS:
+            self.grandes.add(id_cena)
+            return
+        for coluna in range(c0, c1 + 1):
+            for linha in range(l0, l1 + 1):
+                celula = self.celulas.get((coluna, linha))
+                if celula is None:
+                    celula = self.celulas[(coluna, linha)] = array("l")
+                celula.append(id_cena)
+
+    def remover(self, id_cena, caixa):
+        if id_cena in self.grandes:
+            self.grandes.discard(id_cena)
+            return
+        c0, l0, c1, l1 = self._intervalo(*caixa)
+        for coluna in range(c0, c1 + 1):
+            for linha in range(l0, l1 + 1):
+                celula = self.celulas.get((coluna, linha))
+                if celula is None:
+                    continue
+                try:
+                    celula.remove(id_cena)
+                except ValueError:
+                    continue
+                if not celula:
+                    del self.celulas[(coluna, linha)]
+
+    def candidatos(self, caixa):
+        """Ids das cenas que podem intersectar a caixa (a conferência exata fica com quem chama)."""
+        c0, l0, c1, l1 = self._intervalo(*caixa)
+        encontrados = set(self.grandes)
+        if (c1 - c0 + 1) * (l1 - l0 + 1) <= len(self.celulas):
+            for coluna in range(c0, c1 + 1):
+                for linha in range(l0, l1 + 1):
+                    celula = self.celulas.get((coluna, linha))
+                    if celula is not None:
+                        encontrados.update(celula)
+        else:
+            # Caixa maior que a parte ocupada da grade: mais barato percorrer só as células existentes
+            for (coluna, linha), celula in self.celulas.items():
+                if c0 <= coluna <= c1 and l0 <= linha <= l1:
+                    encontrados.update(celula)
+        return encontrados
+
+
+class IndiceEspacial:
+    """
+    Índice das extensões e datas das cenas de um nó. `carregar` é chamada na primeira
+    busca e gera (nome, epsg, x_min, y_min, x_max, y_max, data) de cada cena; atualizações
+    anteriores a isso são ignoradas, já que a carga lê o estado mais recente do SQLite.
+    """
+
+    def __init__(self, carregar):
+        self.carregar = carregar
+        self.trava = threading.Lock()
+        self.construido = False
+        self.ids = {}  # Nome -> id
+        self.nomes = []  # Id -> nome (None nos ids livres)
+        self.livres = []
+        self.caixas = array("d")  # x_min, y_min, x_max, y_max de cada id
+        self.datas = array("d")
+        self.epsgs = array("l")
+        self.grades = {}  # EPSG (0: sem sistema de referência) -> Grade
+
+    def _construir(self):
+        inicio = time.perf_counter()
+        for nome, epsg, *caixa_data in self.carregar():
+            self._inserir(nome, epsg, caixa_data[:4], caixa_data[4])
+        self.construido = True
+        log.info("Índice espacial montado: %d cenas em %.2f s", len(self.ids), time.perf_counter() - inicio)
+
+    def _inserir(self, nome, epsg, caixa, data):
+        epsg = epsg or 0
+        id_cena = self.ids.get(nome)
+        if id_cena is not None:
+            self._remover(nome)
+        if self.livres:
+            id_cena = self.livres.pop()
+            self.nomes[id_cena] = nome
+            self.caixas[4 * id_cena:4 * id_cena + 4] = array("d", caixa)
+            self.datas[id_cena] = data
+            self.epsgs[id_cena] = epsg
+        else:
+            id_cena = len(self.nomes)
+            self.nomes.append(nome)
+            self.caixas.extend(caixa)
+            self.datas.append(data)
+            self.epsgs.append(epsg)
+        self.ids[nome] = id_cena
+        grade = self.grades.get(epsg)
+        if grade is None:
+            largura, altura = caixa[2] - caixa[0], caixa[3] - caixa[1]
+            largura = largura if largura > 0 else altura if altura > 0 else 1.0
+            altura = altura if altura > 0 else largura
+            grade = self.grades[epsg] = Grade(largura, altura)
+        grade.inserir(id_cena, caixa)
+        CENAS.definir(len(self.ids))
+
+    def _remover(self, nome):
+        id_cena = self.ids.pop(nome, None)
+        if id_cena is None:
+            return
+        self.grades[self.epsgs[id_cena]].remover(id_cena, self.caixas[4 * id_cena:4 * id_cena + 4])
+        self.nomes[id_cena] = None
+        self.livres.append(id_cena)
+        CENAS.definir(len(self.ids))
+
+    def atualizar(self, nome, metadados, data_envio):
+        """Insere ou substitui uma cena a partir dos metadados GeoTIFF (sem extensão, apenas a remove)."""
+        caixa = [metadados.get(campo) for campo in ("x_min", "y_min", "x_max", "y_max")]
+        with self.trava:
+            if not self.construido:
+                return
+            if None in caixa:
+                self._remover(nome)
+                return
+            self._inserir(nome, metadados.get("epsg"), caixa, metadados.get("data", data_envio))
+
+    def remover(self, nome):
+        with self.trava:
+            if self.construido:
+                self._remover(nome)
+
+    def buscar(self, caixa, inicio=-math.inf, fim=math.inf, epsg=0, cursor="", limite=1000):
+        """
+        Até `limite` cenas cuja extensão intersecta a caixa (x_min, y_min, x_max, y_max) e cuja
+        data está em [inicio, fim], em ordem de nome e a partir do nome seguinte ao `cursor`.
+        Com epsg 0, compara a caixa com as cenas de todos os sistemas de referência.
+        Retorna uma lista de (nome, epsg, x_min, y_min, x_max, y_max, data).
+        """
+        x_min, y_min, x_max, y_max = caixa
+        with self.trava:
+            if not self.construido:
+                self._construir()
+            if epsg:
+                grades = [self.grades[epsg]] if epsg in self.grades else []
+            else:
+                grades = list(self.grades.values())
+            caixas, datas, nomes = self.caixas, self.datas, self.nomes
+            examinadas = 0
+            encontradas = []
+            for grade in grades:
+                candidatos = grade.candidatos(caixa)
+                examinadas += len(candidatos)
+                for id_cena in candidatos:
+                    base = 4 * id_cena
+                    if (caixas[base] <= x_max and caixas[base + 2] >= x_min and caixas[base + 1] <= y_max
+                            and caixas[base + 3] >= y_min and inicio <= datas[id_cena] <= fim
+                            and nomes[id_cena] > cursor):
+                        encontradas.append(id_cena)
+            selecionadas = heapq.nsmallest(limite, encontradas, key=nomes.__getitem__)
+            resultado = [(nomes[id_cena], self.epsgs[id_cena], *caixas[4 * id_cena:4 * id_cena + 4],
+                          datas[id_cena]) for id_cena in selecionadas]
+        EXAMINADAS.observar(examinadas)
+        return resultado
@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import protocolo
+
+# Colunas de metadados lidas do cabeçalho GeoTIFF (ver comum/geotiff.py)
+CAMPOS_GEOTIFF = ("largura", "altura", "bandas", "bits", "epsg", "x_min", "y_min", "x_max", "y_max", "data")
+
+# Coluna usada em cada ordenação do LIST (o nome desempata e serve de cursor)
+COLUNAS_ORDEM = {
+    protocolo.ORDEM_NOME: None,
+    protocolo.ORDEM_TAMANHO: "tamanho",
+    protocolo.ORDEM_DATA: "enviado_em",
+}
+
+
+class IndiceImagens:
+    """
+    Índice persistente (SQLite) com os metadados das imagens de um nó: nome, tamanho,
+    checksum, data de envio e campos básicos do cabeçalho GeoTIFF. É atualizado a cada
+    upload e remoção, de modo que o LIST não precisa percorrer o diretório de imagens; as
+    extensões georreferenciadas alimentam o índice espacial da BUSCA (ver espacial.py).
+    """
+
+    def __init__(self, caminho):
+        # Uma única conexão compartilhada pelas threads do cluster, protegida por uma trava
+        self.conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self.trava = threading.Lock()
+        with self.trava, self.conexao:
+            # WAL: leituras (LIST) não esperam pelas gravações em andamento
+            self.conexao.execute("PRAGMA journal_mode=WAL")
+            self.conexao.execute("PRAGMA synchronous=NORMAL")
+            self.conexao.execute(f"""
+                CREATE TABLE IF NOT EXISTS imagens (
+                    nome TEXT PRIMARY KEY,
+                    tamanho INTEGER NOT NULL,
+                    checksum INTEGER,
+                    enviado_em REAL NOT NULL,
+                    largura INTEGER, altura INTEGER, bandas INTEGER, bits INTEGER, epsg INTEGER,
+                    x_min REAL, y_min REAL, x_max REAL, y_max REAL, data REAL
+                )""")
+            # Índices criados antes da coluna da data da cena
+            colunas = {coluna for _, coluna, *_ in self.conexao.execute("PRAGMA table_info(imagens)")}
+            if "data" not in colunas:
+                self.conexao.execute("ALTER TABLE imagens ADD COLUMN data REAL")
+            self.conexao.execute("CREATE INDEX IF NOT EXISTS imagens_tamanho ON imagens (tamanho, nome)")
+            self.conexao.execute("CREATE INDEX IF NOT EXISTS imagens_enviado_em ON imagens (enviado_em, nome)")
+
+    def registrar(self, nome, tamanho, checksum, metadados):
+        """Insere ou substitui o registro de uma imagem. Retorna a data de envio registrada."""
+        valores = [metadados.get(campo) for campo in CAMPOS_GEOTIFF]
+        enviado_em = time.time()
+        with self.trava, self.conexao:
+            self.conexao.execute(
+                f"INSERT OR REPLACE INTO imagens (nome, tamanho, checksum, enviado_em, {', '.join(CAMPOS_GEOTIFF)}) "
+                f"VALUES (?, ?, ?, ?, {', '.join('?' * len(CAMPOS_GEOTIFF))})",
+                [nome, tamanho, checksum, enviado_em] + valores)
+        return enviado_em
+
+    def remover(self, nome):
+        with self.trava, self.conexao:
+            self.conexao.execute("DELETE FROM imagens WHERE nome = ?", (nome,))
+
+    def nomes(self):
+        """Conjunto com os nomes de todas as imagens indexadas."""
+        with self.trava:
+            return {nome for nome, in self.conexao.execute("SELECT nome FROM imagens")}
+
+    def consultar(self, nome):
+        """Registro completo de uma imagem (dicionário), ou None se ela não estiver indexada."""
+        with self.trava:
+            cursor = self.conexao.execute("SELECT * FROM imagens WHERE nome = ?", (nome,))
+            linha = cursor.fetchone()
+            if linha is None:
+                return None
+            return dict(zip((coluna for coluna, *_ in cursor.description), linha))
+
+    def pegadas(self):
+        """
+        Gera (nome, epsg, x_min, y_min, x_max, y_max, data) das imagens georreferenciadas,
+        para a construção do índice espacial; sem data da cena, vale a data de envio.
+        """
+        ultimo = ""
+        while True:
+            # Em páginas por nome, para não segurar a trava (nem a tabela inteira em memória) de uma vez
+            with self.trava:
+                linhas = self.conexao.execute(
+                    "SELECT nome, epsg, x_min, y_min, x_max, y_max, COALESCE(data, enviado_em) FROM imagens "
+                    "WHERE nome > ? AND x_min IS NOT NULL AND y_min IS NOT NULL AND x_max IS NOT NULL "
+                    "AND y_max IS NOT NULL ORDER BY nome LIMIT 10000", (ultimo,)).fetchall()
+            if not linhas:
+                return
+            yield from linhas
+            ultimo = linhas[-1][0]
+
+    def resumos(self, nomes):
+        """{nome: (tamanho, checksum, enviado_em)} das imagens indexadas entre os `nomes`."""
+        nomes = list(nomes)
+        resultado = {}
+        with self.trava:
+            # Em grupos, abaixo do limite de parâmetros de uma consulta do SQLite
+            for inicio in range(0, len(nomes), 500):
+                grupo = nomes[inicio:inicio + 500]
+                for nome, tamanho, checksum, enviado_em in self.conexao.execute(
+                        f"SELECT nome, tamanho, checksum, enviado_em FROM imagens "
+                        f"WHERE nome IN ({', '.join('?' * len(grupo))})", grupo):
+                    resultado[nome] = (tamanho, checksum or 0, enviado_em)
+        return resultado
+
+    def listar(self, prefixo, listagem):
+        """
+        Uma página do LIST: até `listagem.limite` imagens cujo nome começa com `prefixo`, na
+        ordem pedida, a partir do cursor (a última imagem da página anterior), sem OFFSET.
+        Retorna uma lista de protocolo.RegistroImagem.
+        """
+        coluna = COLUNAS_ORDEM[listagem.ordem]
+        chave = f"({coluna}, nome)" if coluna else "nome"
+        direcao = "DESC" if listagem.decrescente else "ASC"
+        # Prefixo como intervalo de nomes, para aproveitar o índice da chave primária
+        condicoes, argumentos = ["nome >= ?", "nome < ?"], [prefixo, prefixo + "\U0010ffff"]
+        if listagem.cursor is not None:
+            valor, nome = listagem.cursor
+            condicoes.append(f"{chave} {'<' if listagem.decrescente else '>'} {'(?, ?)' if coluna else '?'}")
+            argumentos += [valor, nome] if coluna else [nome]
+        ordenacao = f"{coluna} {direcao}, nome {direcao}" if coluna else f"nome {direcao}"
+        with self.trava:
+            linhas = self.conexao.execute(
+                f"SELECT nome, tamanho, checksum, enviado_em FROM imagens WHERE {' AND '.join(condicoes)} "
+                f"ORDER BY {ordenacao} LIMIT ?", argumentos + [listagem.limite]).fetchall()
+        return [protocolo.RegistroImagem(nome, tamanho, checksum or 0, enviado_em)
+                for nome, tamanho, checksum, enviado_em in linhas]
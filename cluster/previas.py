@@ -0,0 +1,105 @@
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import geotiff, protocolo
+
+# Tipos de cor do PNG
+PNG_CINZA = 0
+PNG_RGB = 2
+PNG_CINZA_ALFA = 4
+PNG_RGBA = 6
+
+
+def codificar_png(largura, altura, bits, tipo_cor, linhas):
+    """Codifica linhas de pixels já intercalados (amostras de 16 bits em big-endian) como PNG."""
+    def pedaco(tipo, dados):
+        return struct.pack("!I", len(dados)) + tipo + dados + struct.pack("!I", zlib.crc32(tipo + dados))
+
+    cabecalho = struct.pack("!IIBBBBB", largura, altura, bits, tipo_cor, 0, 0, 0)
+    # Cada linha é precedida do filtro 0 (nenhum)
+    bruto = b"".join(b"\x00" + linha for linha in linhas)
+    return (b"\x89PNG\r\n\x1a\n" + pedaco(b"IHDR", cabecalho) +
+            pedaco(b"IDAT", zlib.compress(bruto, 6)) + pedaco(b"IEND", b""))
+
+
+def componentes(raster):
+    """
+    Escolhe as bandas exibidas na prévia e o tipo de cor do PNG. Retorna
+    (tipo de cor, [(plano, deslocamento da amostra no pixel do plano), ...]).
+    """
+    if raster.alfa and raster.bandas in (2, 4):
+        bandas, tipo_cor = range(raster.bandas), PNG_CINZA_ALFA if raster.bandas == 2 else PNG_RGBA
+    elif raster.bandas >= 3:
+        bandas, tipo_cor = range(3), PNG_RGB
+    else:
+        bandas, tipo_cor = range(1), PNG_CINZA
+    if raster.planar:
+        return tipo_cor, [(banda, 0) for banda in bandas]
+    return tipo_cor, [(0, banda * raster.bytes_amostra) for banda in bandas]
+
+
+def amostrar(raster, x, y, largura, altura, passo):
+    """
+    Reduz a janela (x, y, largura, altura) do raster tomando um pixel a cada `passo`
+    (vizinho mais próximo) e a codifica como PNG. Só as linhas amostradas são lidas e
+    cada amostra é copiada com fatiamento estendido, sem laço por pixel.
+    """
+    tipo_cor, escolhidas = componentes(raster)
+    largura_saida = -(-largura // passo)
+    altura_saida = -(-altura // passo)
+    bytes_amostra = raster.bytes_amostra
+    bytes_pixel_saida = len(escolhidas) * bytes_amostra
+    salto = raster.bytes_pixel * passo
+    linhas = []
+    for linha in range(y, y + altura_saida * passo, passo):
+        planos = {plano: raster.ler_linha(plano, linha, x, x + largura) for plano in {p for p, _ in escolhidas}}
+        saida = bytearray(largura_saida * bytes_pixel_saida)
+        for i, (plano, deslocamento) in enumerate(escolhidas):
+            for byte in range(bytes_amostra):
+                saida[i * bytes_amostra + byte::bytes_pixel_saida] = planos[plano][deslocamento + byte::salto]
+        if bytes_amostra == 2 and raster.ordem == "<":
+            # O PNG guarda amostras de 16 bits em big-endian
+            amostras = array("H", saida)
+            amostras.byteswap()
+            saida = amostras.tobytes()
+        linhas.append(bytes(saida))
+    return codificar_png(largura_saida, altura_saida, raster.bits, tipo_cor, linhas)
+
+
+def gerar_miniatura(f, lado):
+    """PNG da cena inteira reduzida para que o maior lado tenha no máximo `lado` pixels."""
+    raster = geotiff.Raster(f)
+    passo = max(1, -(-max(raster.largura, raster.altura) // lado))
+    return amostrar(raster, 0, 0, raster.largura, raster.altura, passo)
+
+
+def nivel_maximo(raster):
+    """Nível de zoom em que um pixel do ladrilho corresponde a um pixel da cena."""
+    nivel = 0
+    while protocolo.TAMANHO_LADRILHO << nivel < max(raster.largura, raster.altura):
+        nivel += 1
+    return nivel
+
+
+def gerar_ladrilho(f, z, x, y):
+    """
+    PNG do ladrilho (z, x, y) de uma pirâmide sobre a cena: no nível 0 a cena inteira
+    cabe em um ladrilho de TAMANHO_LADRILHO pixels, e cada nível dobra a resolução até a
+    original. Os ladrilhos da borda direita e inferior podem ser menores.
+    """
+    raster = geotiff.Raster(f)
+    maximo = nivel_maximo(raster)
+    if z > maximo:
+        raise ValueError(f"nível de zoom acima do máximo ({maximo})")
+    passo = 1 << (maximo - z)
+    lado = protocolo.TAMANHO_LADRILHO * passo  # Pixels da cena cobertos por um ladrilho
+    x0, y0 = x * lado, y * lado
+    if x0 >= raster.largura or y0 >= raster.altura:
+        raise ValueError("ladrilho fora da imagem")
+    return amostrar(raster, x0, y0, min(lado, raster.largura - x0), min(lado, raster.altura - y0), passo)
+
@@ -0,0 +1,87 @@
+import threading
+from contextlib import contextmanager
+
+class TravaLeituraEscrita:
+    """
+    Trava de leitura/escrita: vários leitores simultâneos ou um único escritor.
+    Escritores em espera têm prioridade sobre novos leitores, para que um
+    upload não fique bloqueado indefinidamente por downloads sucessivos.
+    """
+
+    def __init__(self):
+        self.condicao = threading.Condition()
+        self.leitores = 0
+        self.escrevendo = False
+        self.escritores_esperando = 0
+
+    def adquirir_leitura(self):
+        with self.condicao:
+            while self.escrevendo or self.escritores_esperando:
+                self.condicao.wait()
+            self.leitores += 1
+
+    def liberar_leitura(self):
+        with self.condicao:
+            self.leitores -= 1
+            if self.leitores == 0:
+                self.condicao.notify_all()
+
+    def adquirir_escrita(self):
+        with self.condicao:
+            self.escritores_esperando += 1
+            while self.escrevendo or self.leitores:
+                self.condicao.wait()
+            self.escritores_esperando -= 1
+            self.escrevendo = True
+
+    def liberar_escrita(self):
+        with self.condicao:
+            self.escrevendo = False
+            self.condicao.notify_all()
+
+
+class TravasArquivos:
+    """
+    Conjunto de travas por nome de arquivo. As travas são criadas sob demanda e
+    removidas quando nenhuma thread as utiliza, para não acumular uma entrada por
+    imagem já acessada.
+    """
+
+    def __init__(self):
+        self.trava = threading.Lock()
+        self.travas = {}  # nome -> [TravaLeituraEscrita, número de usuários]
+
+    def _obter(self, nome):
+        with self.trava:
+            entrada = self.travas.setdefault(nome, [TravaLeituraEscrita(), 0])
+            entrada[1] += 1
+            return entrada[0]
+
+    def _devolver(self, nome):
+        with self.trava:
+            entrada = self.travas[nome]
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                del self.travas[nome]
+
+    @contextmanager
+    def leitura(self, nome):
+        """Acesso compartilhado ao arquivo (por exemplo, DOWNLOAD)."""
+        trava = self._obter(nome)
+        trava.adquirir_leitura()
+        try:
+            yield
+        finally:
+            trava.liberar_leitura()
+            self._devolver(nome)
+
+    @contextmanager
+    def escrita(self, nome):
+        """Acesso exclusivo ao arquivo (por exemplo, UPLOAD e DELETE)."""
+        trava = self._obter(nome)
+        trava.adquirir_escrita()
+        try:
+            yield
+        finally:
+            trava.liberar_escrita()
+            self._devolver(nome)
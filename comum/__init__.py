@@ -0,0 +1 @@
+"""Código compartilhado entre cliente, servidor e cluster."""
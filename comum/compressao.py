@@ -0,0 +1,166 @@
+"""
+Compressão em trechos dos payloads de UPLOAD e DOWNLOAD.
+
+Um payload comprimido (quadro com FLAG_COMPRIMIDO) é uma sequência de trechos,
+cada um com um cabeçalho TRECHO_COMPRIMIDO (codec, tamanho original e tamanho
+comprimido) seguido dos seus bytes:
+
+    +-------+----------+-------------+------------------+-------+-----
+    | codec | original | comprimido  | bytes do trecho  | codec | ...
+    | 1 B   | 4 B      | 4 B         | comprimido B     | 1 B   |
+    +-------+----------+-------------+------------------+-------+-----
+
+Cada trecho é comprimido de forma independente, então o receptor descomprime à
+medida que os trechos chegam. Trechos que não diminuem (por exemplo, de TIFFs já
+comprimidos) seguem crus, com o codec NENHUM. Os codecs aceitos por cliente,
+servidor e nós do cluster são negociados com CAPACIDADES ao abrir a conexão.
+
+zlib e lzma vêm da biblioteca padrão; zstd é usado se o módulo zstandard estiver
+instalado (e tem a preferência, por ser o mais rápido).
+"""
+import lzma
+import struct
+import zlib
+
+from comum import protocolo
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codecs (o identificador viaja no cabeçalho de cada trecho)
+NENHUM = 0
+ZLIB = 1
+LZMA = 2
+ZSTD = 3
+
+NOMES_CODECS = {NENHUM: "nenhum", ZLIB: "zlib", LZMA: "lzma", ZSTD: "zstd"}
+
+TRECHO_COMPRIMIDO = struct.Struct("!BII")
+TAMANHO_TRECHO = 1024 * 1024  # Bytes originais em cada trecho comprimido
+TAMANHO_MAXIMO_TRECHO = 64 * 1024 * 1024  # Limite de um trecho recebido (protege contra dados corrompidos)
+
+# Níveis escolhidos pela vazão: nos enlaces lentos o ganho de um nível maior não paga a CPU extra
+NIVEL_ZLIB = 1
+PRESET_LZMA = 1
+NIVEL_ZSTD = 3
+
+# Codecs disponíveis neste processo, em ordem de preferência
+CODECS_DISPONIVEIS = ((ZSTD,) if zstandard is not None else ()) + (ZLIB, LZMA)
+
+
+def _comprimir_zstd(dados):
+    return zstandard.ZstdCompressor(level=NIVEL_ZSTD).compress(dados)
+
+
+def _descomprimir_zstd(dados, tamanho):
+    return zstandard.ZstdDecompressor().decompress(dados, max_output_size=tamanho)
+
+
+def _descomprimir_zlib(dados, tamanho):
+    # Limitado ao tamanho anunciado: um trecho corrompido não expande sem controle
+    return zlib.decompressobj().decompress(dados, tamanho)
+
+
+def _descomprimir_lzma(dados, tamanho):
+    return lzma.LZMADecompressor().decompress(dados, tamanho)
+
+
+COMPRESSORES = {
+    ZLIB: lambda dados: zlib.compress(dados, NIVEL_ZLIB),
+    LZMA: lambda dados: lzma.compress(dados, preset=PRESET_LZMA),
+    ZSTD: _comprimir_zstd,
+}
+
+DESCOMPRESSORES = {
+    NENHUM: lambda dados, tamanho: dados,
+    ZLIB: _descomprimir_zlib,
+    LZMA: _descomprimir_lzma,
+    ZSTD: _descomprimir_zstd,
+}
+
+
+def nome_codec(codec):
+    return NOMES_CODECS.get(codec, f"codec {codec}")
+
+
+def escolher(oferecidos, aceitos=CODECS_DISPONIVEIS):
+    """Codecs oferecidos (na ordem de preferência de quem os ofereceu) que também são aceitos."""
+    return [codec for codec in oferecidos if codec in aceitos and codec != NENHUM]
+
+
+def comprimir_trecho(codec, dados):
+    """Cabeçalho e bytes de um trecho; se a compressão não diminuir o trecho, ele segue cru."""
+    comprimido = COMPRESSORES[codec](dados)
+    if len(comprimido) >= len(dados):
+        codec, comprimido = NENHUM, dados
+    return TRECHO_COMPRIMIDO.pack(codec, len(dados), len(comprimido)), comprimido
+
+
+def comprimir(origem, destino, codec, tamanho_trecho=TAMANHO_TRECHO):
+    """
+    Comprime o restante do arquivo aberto `origem` em trechos, gravando-os em `destino`.
+    Retorna (codec efetivo, CRC32 dos bytes gravados): o codec efetivo é NENHUM se
+    nenhum trecho diminuiu com a compressão.
+    """
+    efetivo = NENHUM
+    checksum = 0
+    while True:
+        dados = origem.read(tamanho_trecho)
+        if not dados:
+            return efetivo, checksum
+        cabecalho, comprimido = comprimir_trecho(codec, dados)
+        if len(comprimido) < len(dados):
+            efetivo = codec
+        destino.write(cabecalho)
+        destino.write(comprimido)
+        checksum = zlib.crc32(comprimido, zlib.crc32(cabecalho, checksum))
+
+
+def receber_descomprimindo(sock, cab, f, copia=None):
+    """
+    Recebe o payload comprimido de um quadro e grava os bytes originais em `f`,
+    verificando o checksum do payload ao final. Com `copia`, os trechos recebidos
+    também são gravados nela, como chegaram. Retorna (tamanho original, CRC32 dos
+    bytes originais, codec usado), em que o codec é None se mais de um foi usado.
+    """
+    restante = cab.tamanho
+    checksum_payload = 0
+    checksum = 0
+    tamanho = 0
+    codecs = set()
+    try:
+        while restante > 0:
+            if restante < TRECHO_COMPRIMIDO.size:
+                raise protocolo.ErroProtocolo("Trecho comprimido truncado")
+            cabecalho = protocolo.receber_exato(sock, TRECHO_COMPRIMIDO.size)
+            codec, tamanho_original, tamanho_comprimido = TRECHO_COMPRIMIDO.unpack(cabecalho)
+            restante -= TRECHO_COMPRIMIDO.size
+            if (codec not in DESCOMPRESSORES or codec == ZSTD and zstandard is None
+                    or tamanho_comprimido > restante or tamanho_original > TAMANHO_MAXIMO_TRECHO):
+                raise protocolo.ErroProtocolo(f"Trecho comprimido inválido ({nome_codec(codec)})")
+            comprimido = protocolo.receber_exato(sock, tamanho_comprimido)
+            restante -= tamanho_comprimido
+            checksum_payload = zlib.crc32(comprimido, zlib.crc32(cabecalho, checksum_payload))
+            try:
+                dados = DESCOMPRESSORES[codec](comprimido, tamanho_original)
+            except (zlib.error, lzma.LZMAError, ValueError) as e:
+                raise protocolo.ErroProtocolo(f"Trecho comprimido corrompido: {e}") from e
+            if len(dados) != tamanho_original:
+                raise protocolo.ErroProtocolo("Trecho comprimido com tamanho diferente do anunciado")
+            f.write(dados)
+            if copia is not None:
+                copia.write(cabecalho)
+                copia.write(comprimido)
+            checksum = zlib.crc32(dados, checksum)
+            tamanho += tamanho_original
+            if codec != NENHUM:
+                codecs.add(codec)
+    except protocolo.ErroProtocolo:
+        # Descarta o restante do payload para manter a conexão sincronizada
+        protocolo.descartar(sock, restante)
+        raise
+    protocolo.verificar_checksum(cab, checksum_payload)
+    codec = codecs.pop() if len(codecs) == 1 else NENHUM if not codecs else None
+    return tamanho, checksum, codec
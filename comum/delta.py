@@ -0,0 +1,237 @@
+"""
+Transferência delta de imagens, no estilo do rsync (e do zsync, que inverte os papéis):
+só os trechos que mudaram entre duas versões de uma imagem atravessam a rede.
+
+O cluster guarda as assinaturas de cada imagem, calculadas uma vez ao publicá-la: para
+cada bloco de TAMANHO_BLOCO_DELTA bytes, uma soma fraca (Adler-32, que pode ser
+deslizada byte a byte) e um resumo forte (BLAKE2b). Com as assinaturas da outra versão
+(comando ASSINATURAS), o cliente percorre a sua cópia local procurando aqueles blocos em
+qualquer deslocamento (procurar), e o trabalho pesado fica todo do lado dele:
+
+- no upload, envia só os trechos novos, e os demais viram referências aos blocos da
+  versão armazenada (UPLOAD_DELTA, remontado no cluster por aplicar);
+- no download, copia da cópia local os blocos que já tem e pede só os que faltam
+  (DOWNLOAD_INTERVALO).
+
+O resumo da imagem inteira, calculado a partir das assinaturas, permite pular a
+transferência quando as duas versões são iguais.
+"""
+import hashlib
+import mmap
+import os
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+
+from comum import protocolo
+
+MODULO_ADLER = 65521
+TAMANHO_MAXIMO_LITERAL = 1 << 30  # O comprimento de um LITERAL_DELTA tem 32 bits: trechos maiores são divididos
+TAMANHO_COPIA = 1024 * 1024  # Bytes copiados por vez ao remontar uma imagem
+
+# Itens gerados por procurar
+BLOCO = "bloco"
+LITERAL = "literal"
+
+Assinaturas = namedtuple("Assinaturas", "tamanho tamanho_bloco resumo blocos")
+# Resultado de uma sincronização: tamanho da imagem, bytes que atravessaram a rede e bytes reaproveitados
+ResultadoDelta = namedtuple("ResultadoDelta", "tamanho transferidos reaproveitados")
+
+
+@contextmanager
+def mapear(f):
+    """Mapeia em memória, só para leitura, o arquivo aberto `f` (um arquivo vazio vira b"")."""
+    tamanho = os.fstat(f.fileno()).st_size
+    if not tamanho:
+        yield b""
+        return
+    with mmap.mmap(f.fileno(), tamanho, access=mmap.ACCESS_READ) as dados:
+        yield dados
+
+
+def resumo_forte(dados):
+    return hashlib.blake2b(dados, digest_size=protocolo.TAMANHO_RESUMO_DELTA).digest()
+
+
+def assinar(f, tamanho_bloco=protocolo.TAMANHO_BLOCO_DELTA):
+    """Assinaturas de um arquivo binário aberto, lido do início. Retorna um Assinaturas."""
+    f.seek(0)
+    blocos = []
+    tamanho = 0
+    while True:
+        dados = f.read(tamanho_bloco)
+        if not dados:
+            break
+        tamanho += len(dados)
+        blocos.append((zlib.adler32(dados), resumo_forte(dados)))
+    return Assinaturas(tamanho, tamanho_bloco, resumir(tamanho, blocos), blocos)
+
+
+def resumir(tamanho, blocos):
+    """Resumo da imagem inteira: BLAKE2b do tamanho e dos resumos fortes dos blocos."""
+    resumo = hashlib.blake2b(protocolo.DESLOCAMENTO.pack(tamanho), digest_size=protocolo.TAMANHO_RESUMO_DELTA)
+    for _, forte in blocos:
+        resumo.update(forte)
+    return resumo.digest()
+
+
+def empacotar_assinaturas(assinaturas):
+    """Payload da resposta ao ASSINATURAS: o cabeçalho e a assinatura de cada bloco."""
+    return protocolo.CABECALHO_ASSINATURAS.pack(assinaturas.tamanho, assinaturas.tamanho_bloco, assinaturas.resumo) + \
+        b"".join(protocolo.ASSINATURA_BLOCO.pack(fraco, forte) for fraco, forte in assinaturas.blocos)
+
+
+def desempacotar_assinaturas(payload):
+    """
+    Decodifica a resposta ao ASSINATURAS. `blocos` é None se a resposta trouxe só o
+    cabeçalho (a cópia do cliente tem o mesmo resumo).
+    """
+    tamanho, tamanho_bloco, resumo = protocolo.CABECALHO_ASSINATURAS.unpack_from(payload)
+    corpo = memoryview(payload)[protocolo.CABECALHO_ASSINATURAS.size:]
+    if tamanho and not corpo:
+        return Assinaturas(tamanho, tamanho_bloco, resumo, None)
+    blocos = list(protocolo.ASSINATURA_BLOCO.iter_unpack(corpo))
+    if len(blocos) != -(-tamanho // tamanho_bloco):
+        raise protocolo.ErroProtocolo("Assinaturas incompletas")
+    return Assinaturas(tamanho, tamanho_bloco, resumo, blocos)
+
+
+def deslizar(fraco, saida, entrada, tamanho_bloco):
+    """Soma Adler-32 da janela deslocada de um byte: sem o byte `saida` e com o byte `entrada`."""
+    a = (fraco & 0xffff) - saida + entrada
+    b = (fraco >> 16) - tamanho_bloco * saida + a - 1
+    return (b % MODULO_ADLER) << 16 | a % MODULO_ADLER
+
+
+def procurar(dados, assinaturas):
+    """
+    Percorre `dados` (a cópia local, bytes ou mmap) à procura dos blocos descritos pelas
+    `assinaturas` de outra versão, em qualquer deslocamento. Gera (BLOCO, índice, posição)
+    para cada bloco encontrado e (LITERAL, início, fim) para os trechos sem correspondência,
+    na ordem de `dados` e cobrindo-os por inteiro.
+
+    Os blocos são testados alinhados ao fim do último encontrado, o que basta quando só
+    alguns ladrilhos mudaram no lugar. Depois de um bloco sem correspondência, a janela
+    desliza byte a byte por até um bloco, para ressincronizar após inserções e remoções;
+    numa sequência de falhas isso só se repete na 2ª, 4ª, 8ª... e uma cópia toda diferente
+    não cai no laço por byte do começo ao fim.
+    """
+    tamanho_bloco = assinaturas.tamanho_bloco
+    tabela = {}  # Soma fraca -> {resumo forte: índice}
+    completos = assinaturas.tamanho // tamanho_bloco  # Um último bloco menor só é procurado no fim
+    for indice, (fraco, forte) in enumerate(assinaturas.blocos[:completos]):
+        tabela.setdefault(fraco, {}).setdefault(forte, indice)
+
+    def casar(posicao, fraco):
+        candidatos = tabela.get(fraco)
+        if candidatos is None:
+            return None
+        return candidatos.get(resumo_forte(dados[posicao:posicao + tamanho_bloco]))
+
+    total = len(dados)
+    inicio_literal = posicao = 0
+    falhas = 0  # Blocos seguidos sem correspondência
+    while posicao + tamanho_bloco <= total:
+        fraco = zlib.adler32(dados[posicao:posicao + tamanho_bloco])
+        indice = casar(posicao, fraco)
+        if indice is None and not falhas & (falhas - 1):
+            fim = min(total - tamanho_bloco, posicao + tamanho_bloco - 1)
+            deslizada = posicao
+            while deslizada < fim:
+                fraco = deslizar(fraco, dados[deslizada], dados[deslizada + tamanho_bloco], tamanho_bloco)
+                deslizada += 1
+                if fraco in tabela:
+                    indice = casar(deslizada, fraco)
+                    if indice is not None:
+                        posicao = deslizada
+                        break
+        if indice is None:
+            falhas += 1
+            posicao += tamanho_bloco
+            continue
+        if inicio_literal < posicao:
+            yield LITERAL, inicio_literal, posicao
+        yield BLOCO, indice, posicao
+        posicao += tamanho_bloco
+        inicio_literal = posicao
+        falhas = 0
+    resto = assinaturas.tamanho - completos * tamanho_bloco
+    if resto and total - posicao == resto and resumo_forte(dados[posicao:]) == assinaturas.blocos[-1][1]:
+        # O fim da cópia é o último bloco (menor) da outra versão
+        if inicio_literal < posicao:
+            yield LITERAL, inicio_literal, posicao
+        yield BLOCO, completos, posicao
+        inicio_literal = total
+    if inicio_literal < total:
+        yield LITERAL, inicio_literal, total
+
+
+def instrucoes(dados, assinaturas):
+    """
+    Instruções que montam `dados` a partir da versão descrita pelas `assinaturas`: lista de
+    (DELTA_COPIA, primeiro bloco, quantidade) e (DELTA_LITERAL, início, fim), com os blocos
+    consecutivos agrupados numa só cópia.
+    """
+    resultado = []
+    for tipo, a, b in procurar(dados, assinaturas):
+        if tipo == BLOCO:
+            ultima = resultado[-1] if resultado else None
+            if ultima is not None and ultima[0] == protocolo.DELTA_COPIA and ultima[1] + ultima[2] == a:
+                resultado[-1] = (protocolo.DELTA_COPIA, ultima[1], ultima[2] + 1)
+            else:
+                resultado.append((protocolo.DELTA_COPIA, a, 1))
+        else:
+            for inicio in range(a, b, TAMANHO_MAXIMO_LITERAL):
+                resultado.append((protocolo.DELTA_LITERAL, inicio, min(b, inicio + TAMANHO_MAXIMO_LITERAL)))
+    return resultado
+
+
+def tamanho_payload(lista):
+    """Tamanho do payload de um UPLOAD_DELTA com as instruções da `lista` (e o preâmbulo)."""
+    return protocolo.PREAMBULO_DELTA.size + sum(
+        protocolo.COPIA_DELTA.size if tipo == protocolo.DELTA_COPIA else protocolo.LITERAL_DELTA.size + b - a
+        for tipo, a, b in lista)
+
+
+def aplicar(entrada, base, saida, tamanho_base, tamanho_bloco):
+    """
+    Remonta uma imagem lendo as instruções de `entrada` (o payload de um UPLOAD_DELTA, já
+    sem o preâmbulo): as cópias vêm de `base` (a versão armazenada, com `tamanho_base`
+    bytes) e os trechos novos, da própria entrada. Grava em `saida`. Retorna (tamanho,
+    CRC32) da imagem montada; ErroProtocolo se as instruções forem inválidas.
+    """
+    tamanho = 0
+    checksum = 0
+
+    def copiar(origem, comprimento):
+        nonlocal tamanho, checksum
+        while comprimento:
+            dados = origem.read(min(TAMANHO_COPIA, comprimento))
+            if not dados:
+                raise protocolo.ErroProtocolo("Instruções delta truncadas")
+            saida.write(dados)
+            checksum = zlib.crc32(dados, checksum)
+            tamanho += len(dados)
+            comprimento -= len(dados)
+
+    while True:
+        tipo = entrada.read(1)
+        if not tipo:
+            return tamanho, checksum
+        if tipo[0] == protocolo.DELTA_COPIA:
+            _, primeiro, quantidade = protocolo.COPIA_DELTA.unpack(
+                tipo + entrada.read(protocolo.COPIA_DELTA.size - 1).ljust(protocolo.COPIA_DELTA.size - 1, b"\0"))
+            inicio = primeiro * tamanho_bloco
+            fim = min(tamanho_base, (primeiro + quantidade) * tamanho_bloco)
+            if not quantidade or inicio >= fim:
+                raise protocolo.ErroProtocolo("Cópia delta fora da versão armazenada")
+            base.seek(inicio)
+            copiar(base, fim - inicio)
+        elif tipo[0] == protocolo.DELTA_LITERAL:
+            cabecalho = tipo + entrada.read(protocolo.LITERAL_DELTA.size - 1)
+            if len(cabecalho) != protocolo.LITERAL_DELTA.size:
+                raise protocolo.ErroProtocolo("Instruções delta truncadas")
+            _, comprimento = protocolo.LITERAL_DELTA.unpack(cabecalho)
+            copiar(entrada, comprimento)
+        else:
+            raise protocolo.ErroProtocolo(f"Instrução delta inválida: {tipo[0]}")
@@ -0,0 +1,332 @@
+"""
+Leitura de arquivos TIFF/GeoTIFF (clássico e BigTIFF), sem dependências externas.
+
+Apenas o primeiro IFD é examinado. ler_metadados extrai dimensões, bandas, bits
+por amostra e, se houver, o código EPSG, a extensão (bounding box)
+georreferenciada e a data da cena; arquivos que não são TIFF resultam num dicionário
+vazio. Raster lê janelas de pixels sob demanda, decodificando apenas as faixas
+(strips) ou blocos (tiles) que contêm as linhas pedidas.
+"""
+import calendar
+import struct
+import time
+import zlib
+
+# Tags TIFF e GeoTIFF usadas
+LARGURA = 256
+ALTURA = 257
+BITS_POR_AMOSTRA = 258
+COMPRESSAO = 259
+DESLOCAMENTOS_FAIXAS = 273
+AMOSTRAS_POR_PIXEL = 277
+LINHAS_POR_FAIXA = 278
+BYTES_FAIXAS = 279
+CONFIGURACAO_PLANAR = 284
+DATA_HORA = 306  # DateTime, "AAAA:MM:DD HH:MM:SS"
+PREDITOR = 317
+LARGURA_BLOCO = 322
+ALTURA_BLOCO = 323
+DESLOCAMENTOS_BLOCOS = 324
+BYTES_BLOCOS = 325
+AMOSTRAS_EXTRAS = 338
+FORMATO_AMOSTRA = 339
+ESCALA_PIXEL = 33550  # ModelPixelScaleTag
+PONTO_AMARRACAO = 33922  # ModelTiepointTag
+DIRETORIO_CHAVES_GEO = 34735  # GeoKeyDirectoryTag
+
+# Chaves do GeoKeyDirectory com o código EPSG do sistema de referência
+CHAVE_CRS_GEOGRAFICO = 2048
+CHAVE_CRS_PROJETADO = 3072
+
+# Tipo TIFF -> (formato struct, tamanho em bytes) de um valor
+TIPOS = {
+    1: ("B", 1), 2: ("B", 1), 3: ("H", 2), 4: ("I", 4), 6: ("b", 1), 7: ("B", 1),
+    8: ("h", 2), 9: ("i", 4), 11: ("f", 4), 12: ("d", 8), 16: ("Q", 8), 17: ("q", 8),
+}
+
+TAMANHO_MAXIMO_VALOR = 64 * 1024  # Valores de tags maiores que isso não são lidos
+MAXIMO_ENTRADAS = 4096  # Limite de entradas do IFD (protege contra arquivos corrompidos)
+# Limite das tabelas de deslocamentos das faixas/blocos, que crescem com o tamanho da cena
+TAMANHO_MAXIMO_TABELA = 64 * 1024 * 1024
+
+# Compressões suportadas pelo Raster
+SEM_COMPRESSAO = 1
+LZW = 5
+DEFLATE = 8
+DEFLATE_ANTIGO = 32946
+PACKBITS = 32773
+
+
+def ler_exato(f, deslocamento, tamanho):
+    f.seek(deslocamento)
+    dados = f.read(tamanho)
+    if len(dados) != tamanho:
+        raise ValueError("Arquivo TIFF truncado")
+    return dados
+
+
+def ler_ifd(f):
+    """
+    Lê o primeiro IFD do arquivo. Retorna (ordem, {tag: (tipo, quantidade, valor_ou_deslocamento)}),
+    em que `valor_ou_deslocamento` são os bytes do valor (quando cabem na entrada) ou o
+    deslocamento (int) onde ele está; ou None se o arquivo não for TIFF.
+    """
+    f.seek(0, 2)  # tell() em vez do retorno de seek(): também serve para arquivos mapeados (mmap)
+    cabecalho = ler_exato(f, 0, 16) if f.tell() >= 16 else b""
+    if cabecalho[:2] == b"II":
+        ordem = "<"
+    elif cabecalho[:2] == b"MM":
+        ordem = ">"
+    else:
+        return None
+    versao, = struct.unpack(ordem + "H", cabecalho[2:4])
+    if versao == 42:
+        deslocamento, = struct.unpack(ordem + "I", cabecalho[4:8])
+        formato_quantidade, tamanho_entrada, formato_entrada = "H", 12, "HHI4s"
+    elif versao == 43:  # BigTIFF
+        deslocamento, = struct.unpack(ordem + "Q", cabecalho[8:16])
+        formato_quantidade, tamanho_entrada, formato_entrada = "Q", 20, "HHQ8s"
+    else:
+        return None
+    tamanho_quantidade = struct.calcsize(formato_quantidade)
+    quantidade, = struct.unpack(ordem + formato_quantidade, ler_exato(f, deslocamento, tamanho_quantidade))
+    quantidade = min(quantidade, MAXIMO_ENTRADAS)
+    bruto = ler_exato(f, deslocamento + tamanho_quantidade, quantidade * tamanho_entrada)
+    tamanho_campo = tamanho_entrada - 4 - (4 if versao == 42 else 8)
+    entradas = {}
+    for tag, tipo, contagem, campo in struct.iter_unpack(ordem + formato_entrada, bruto):
+        if tipo not in TIPOS:
+            continue
+        tamanho = TIPOS[tipo][1] * contagem
+        if tamanho <= tamanho_campo:
+            entradas[tag] = (tipo, contagem, campo[:tamanho])
+        else:
+            entradas[tag] = (tipo, contagem, struct.unpack(ordem + ("I" if versao == 42 else "Q"), campo)[0])
+    return ordem, entradas
+
+
+def valores_tag(f, ordem, entrada, limite=TAMANHO_MAXIMO_VALOR):
+    """Decodifica os valores de uma entrada do IFD (lendo-os do arquivo, se necessário)."""
+    tipo, contagem, valor = entrada
+    formato, tamanho = TIPOS[tipo]
+    if isinstance(valor, int):
+        if tamanho * contagem > limite:
+            raise ValueError("Valor de tag muito grande")
+        valor = ler_exato(f, valor, tamanho * contagem)
+    return struct.unpack(f"{ordem}{contagem}{formato}", valor)
+
+
+def ler_metadados(f):
+    """
+    Lê os metadados básicos de um TIFF/GeoTIFF a partir de um arquivo binário aberto
+    (com seek). Retorna um dicionário com as chaves presentes entre largura, altura,
+    bandas, bits, epsg, x_min, y_min, x_max, y_max e data (da tag DateTime, em segundos
+    desde a época, tomada como UTC).
+    """
+    try:
+        ifd = ler_ifd(f)
+        if ifd is None:
+            return {}
+        ordem, entradas = ifd
+        metadados = {}
+        for tag, chave in ((LARGURA, "largura"), (ALTURA, "altura"), (AMOSTRAS_POR_PIXEL, "bandas")):
+            if tag in entradas:
+                metadados[chave] = valores_tag(f, ordem, entradas[tag])[0]
+        if BITS_POR_AMOSTRA in entradas:
+            metadados["bits"] = valores_tag(f, ordem, entradas[BITS_POR_AMOSTRA])[0]
+        metadados.setdefault("bandas", 1)
+        if DATA_HORA in entradas:
+            texto = bytes(valores_tag(f, ordem, entradas[DATA_HORA])).rstrip(b"\0").decode("ascii", "replace")
+            try:
+                metadados["data"] = float(calendar.timegm(time.strptime(texto.strip(), "%Y:%m:%d %H:%M:%S")))
+            except ValueError:
+                pass  # Data em formato não padronizado: a cena fica só com a data de envio
+
+        if DIRETORIO_CHAVES_GEO in entradas:
+            chaves = valores_tag(f, ordem, entradas[DIRETORIO_CHAVES_GEO])
+            for i in range(4, 4 + 4 * chaves[3], 4):
+                chave, local, _, valor = chaves[i:i + 4]
+                if chave in (CHAVE_CRS_PROJETADO, CHAVE_CRS_GEOGRAFICO) and local == 0 and valor not in (0, 32767):
+                    # O CRS projetado, quando existe, é o que descreve as coordenadas do raster
+                    if chave == CHAVE_CRS_PROJETADO or "epsg" not in metadados:
+                        metadados["epsg"] = valor
+
+        if {ESCALA_PIXEL, PONTO_AMARRACAO} <= entradas.keys() and {"largura", "altura"} <= metadados.keys():
+            escala_x, escala_y = valores_tag(f, ordem, entradas[ESCALA_PIXEL])[:2]
+            i, j, _, x, y, _ = valores_tag(f, ordem, entradas[PONTO_AMARRACAO])[:6]
+            # Coordenadas do canto superior esquerdo do raster a partir do ponto de amarração
+            x_min = x - i * escala_x
+            y_max = y + j * escala_y
+            metadados.update(x_min=x_min, y_max=y_max,
+                             x_max=x_min + metadados["largura"] * escala_x,
+                             y_min=y_max - metadados["altura"] * escala_y)
+        return metadados
+    except (ValueError, IndexError, struct.error):
+        return {}
+
+
+def descomprimir_lzw(dados):
+    """Decodifica um trecho comprimido com o LZW do TIFF (códigos MSB de 9 a 12 bits)."""
+    saida = bytearray()
+    tabela = [bytes((i,)) for i in range(256)] + [b"", b""]
+    largura = 9
+    acumulado = 0
+    bits = 0
+    anterior = None
+    for byte in dados:
+        acumulado = (acumulado << 8) | byte
+        bits += 8
+        while bits >= largura:
+            bits -= largura
+            codigo = acumulado >> bits
+            acumulado &= (1 << bits) - 1
+            if codigo == 256:  # Limpa a tabela
+                del tabela[258:]
+                largura = 9
+                anterior = None
+                continue
+            if codigo == 257:  # Fim da informação
+                return bytes(saida)
+            if anterior is None:
+                entrada = tabela[codigo]
+            else:
+                if codigo < len(tabela):
+                    entrada = tabela[codigo]
+                    tabela.append(anterior + entrada[:1])
+                else:
+                    entrada = anterior + anterior[:1]
+                    tabela.append(entrada)
+                # O TIFF aumenta a largura um código antes de a tabela encher ("early change")
+                if len(tabela) >= (1 << largura) - 1 and largura < 12:
+                    largura += 1
+            saida += entrada
+            anterior = entrada
+    return bytes(saida)
+
+
+def descomprimir_packbits(dados):
+    """Decodifica um trecho comprimido com PackBits (repetições codificadas por contagem)."""
+    saida = bytearray()
+    posicao = 0
+    while posicao < len(dados):
+        n = dados[posicao]
+        posicao += 1
+        if n < 128:
+            saida += dados[posicao:posicao + n + 1]
+            posicao += n + 1
+        elif n > 128:
+            saida += dados[posicao:posicao + 1] * (257 - n)
+            posicao += 1
+    return bytes(saida)
+
+
+DESCOMPRESSORES = {
+    SEM_COMPRESSAO: bytes,
+    LZW: descomprimir_lzw,
+    DEFLATE: zlib.decompress,
+    DEFLATE_ANTIGO: zlib.decompress,
+    PACKBITS: descomprimir_packbits,
+}
+
+
+class Raster:
+    """
+    Acesso aos pixels do primeiro IFD de um TIFF aberto (com seek), organizado em faixas
+    ou em blocos, intercalado (um plano) ou planar (um plano por banda). São suportadas
+    amostras inteiras sem sinal de 8 ou 16 bits, sem preditor. Erros de formato geram ValueError.
+    """
+
+    def __init__(self, f):
+        ifd = ler_ifd(f)
+        if ifd is None:
+            raise ValueError("O arquivo não é um TIFF")
+        self.f = f
+        self.ordem, entradas = ifd
+
+        def valor(tag, padrao=None):
+            return valores_tag(f, self.ordem, entradas[tag])[0] if tag in entradas else padrao
+
+        self.largura = valor(LARGURA)
+        self.altura = valor(ALTURA)
+        if not self.largura or not self.altura:
+            raise ValueError("TIFF sem dimensões")
+        self.bandas = valor(AMOSTRAS_POR_PIXEL, 1)
+        self.bits = valor(BITS_POR_AMOSTRA, 1)
+        if self.bits not in (8, 16) or valor(FORMATO_AMOSTRA, 1) != 1:
+            raise ValueError("Somente amostras inteiras sem sinal de 8 ou 16 bits são suportadas")
+        self.compressao = valor(COMPRESSAO, SEM_COMPRESSAO)
+        if self.compressao not in DESCOMPRESSORES:
+            raise ValueError(f"Compressão TIFF não suportada: {self.compressao}")
+        if valor(PREDITOR, 1) != 1:
+            raise ValueError("Preditor TIFF não suportado")
+        # Bandas extras marcadas como transparência (alfa)
+        extras = valores_tag(f, self.ordem, entradas[AMOSTRAS_EXTRAS]) if AMOSTRAS_EXTRAS in entradas else ()
+        self.alfa = bool(extras) and extras[0] in (1, 2)
+
+        self.bytes_amostra = self.bits // 8
+        self.planar = valor(CONFIGURACAO_PLANAR, 1) == 2 and self.bandas > 1
+        # Bytes de um pixel em cada plano: todas as bandas juntas ou uma banda por plano
+        self.bytes_pixel = self.bytes_amostra * (1 if self.planar else self.bandas)
+        if LARGURA_BLOCO in entradas:
+            self.largura_bloco = valor(LARGURA_BLOCO)
+            self.altura_bloco = valor(ALTURA_BLOCO)
+            tags = DESLOCAMENTOS_BLOCOS, BYTES_BLOCOS
+        else:
+            # Uma faixa é um bloco da largura da imagem
+            self.largura_bloco = self.largura
+            self.altura_bloco = min(valor(LINHAS_POR_FAIXA, self.altura), self.altura)
+            tags = DESLOCAMENTOS_FAIXAS, BYTES_FAIXAS
+        if not self.largura_bloco or not self.altura_bloco or tags[0] not in entradas:
+            raise ValueError("TIFF sem faixas ou blocos")
+        self.deslocamentos = valores_tag(f, self.ordem, entradas[tags[0]], TAMANHO_MAXIMO_TABELA)
+        self.bytes_blocos = valores_tag(f, self.ordem, entradas[tags[1]], TAMANHO_MAXIMO_TABELA)
+        self.blocos_por_linha = -(-self.largura // self.largura_bloco)
+        self.blocos_por_plano = self.blocos_por_linha * -(-self.altura // self.altura_bloco)
+        if len(self.deslocamentos) < self.blocos_por_plano * (self.bandas if self.planar else 1):
+            raise ValueError("Tabela de faixas/blocos incompleta")
+        # Blocos decodificados da última linha de blocos lida (as linhas seguintes costumam usá-los)
+        self.decodificados = {}
+        self.linha_decodificada = None
+
+    @property
+    def planos(self):
+        return self.bandas if self.planar else 1
+
+    def _bloco(self, plano, linha_bloco, coluna_bloco):
+        """Bytes descomprimidos de um bloco (ou faixa), guardados enquanto a linha de blocos for a mesma."""
+        if linha_bloco != self.linha_decodificada:
+            self.decodificados.clear()
+            self.linha_decodificada = linha_bloco
+        indice = plano * self.blocos_por_plano + linha_bloco * self.blocos_por_linha + coluna_bloco
+        if indice not in self.decodificados:
+            dados = ler_exato(self.f, self.deslocamentos[indice], self.bytes_blocos[indice])
+            try:
+                self.decodificados[indice] = DESCOMPRESSORES[self.compressao](dados)
+            except (zlib.error, IndexError) as e:
+                raise ValueError(f"Bloco TIFF corrompido: {e}") from e
+        return self.decodificados[indice]
+
+    def ler_linha(self, plano, linha, coluna_inicial, coluna_final):
+        """
+        Bytes dos pixels [coluna_inicial, coluna_final) de uma linha de um plano, na ordem
+        de bytes do arquivo. Sem compressão, apenas esse trecho é lido do arquivo.
+        """
+        linha_bloco, linha_no_bloco = divmod(linha, self.altura_bloco)
+        bytes_linha_bloco = self.largura_bloco * self.bytes_pixel
+        partes = []
+        coluna = coluna_inicial
+        while coluna < coluna_final:
+            coluna_bloco, coluna_no_bloco = divmod(coluna, self.largura_bloco)
+            ate = min(coluna_final - coluna, self.largura_bloco - coluna_no_bloco)
+            inicio = linha_no_bloco * bytes_linha_bloco + coluna_no_bloco * self.bytes_pixel
+            comprimento = ate * self.bytes_pixel
+            if self.compressao == SEM_COMPRESSAO:
+                indice = plano * self.blocos_por_plano + linha_bloco * self.blocos_por_linha + coluna_bloco
+                partes.append(ler_exato(self.f, self.deslocamentos[indice] + inicio, comprimento))
+            else:
+                trecho = self._bloco(plano, linha_bloco, coluna_bloco)[inicio:inicio + comprimento]
+                if len(trecho) != comprimento:
+                    raise ValueError("Bloco TIFF menor que o esperado")
+                partes.append(trecho)
+            coluna += ate
+        return b"".join(partes)
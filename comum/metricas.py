@@ -0,0 +1,314 @@
+"""
+Instrumentação do servidor e do cluster: log com níveis, métricas (contadores,
+medidores e histogramas) e ids de rastreio das requisições.
+
+O log das threads de atendimento só coloca o registro numa fila (QueueHandler); a
+escrita no stdout é feita pela thread de um QueueListener, fora do caminho dos dados.
+Mensagens abaixo do nível configurado (por exemplo, as de DEBUG de cada requisição)
+nem chegam a ser formatadas.
+
+As métricas ficam em memória, cada uma protegida pela sua trava, e são exportadas em
+JSON (comando ESTATISTICAS) ou no formato de texto do Prometheus (endpoint HTTP
+/metrics, ver servir_http).
+"""
+import atexit
+import bisect
+import http.server
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+FORMATO_LOG = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+NIVEIS_LOG = ["debug", "info", "warning", "error"]
+
+# Limites superiores (em segundos) dos baldes dos histogramas de latência
+BALDES_LATENCIA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0)
+QUANTIS = (0.5, 0.95, 0.99)  # Estimados a partir dos baldes na exportação em JSON
+
+log = logging.getLogger("metricas")
+
+
+def configurar_log(nivel="info"):
+    """Envia o log ao stdout por uma fila, escrita por uma thread própria."""
+    fila = queue.SimpleQueue()
+    saida = logging.StreamHandler(sys.stdout)
+    saida.setFormatter(logging.Formatter(FORMATO_LOG))
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [logging.handlers.QueueHandler(fila)]
+    raiz.setLevel(nivel.upper())
+    ouvinte = logging.handlers.QueueListener(fila, saida)
+    ouvinte.start()
+    atexit.register(ouvinte.stop)  # Escreve o que ainda estiver na fila ao encerrar
+
+
+def novo_rastreio():
+    """Id de rastreio de uma requisição (64 bits, nunca 0, que significa "sem rastreio")."""
+    return random.getrandbits(64) or 1
+
+
+class Metrica:
+    """Base das métricas: uma série de valores para cada combinação de valores dos rótulos."""
+
+    tipo = "untyped"
+
+    def __init__(self, nome, ajuda, rotulos=()):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = tuple(rotulos)
+        self.trava = threading.Lock()
+        self.series = {}  # Valores dos rótulos (tupla) -> valor da série
+
+    def _chave(self, rotulos):
+        return tuple(str(rotulos[rotulo]) for rotulo in self.rotulos)
+
+    def valores(self):
+        """Cópia das séries: lista de (valores dos rótulos, valor)."""
+        with self.trava:
+            return list(self.series.items())
+
+
+class Contador(Metrica):
+    """Valor que só aumenta (requisições, bytes transferidos, reconexões...)."""
+
+    tipo = "counter"
+
+    def inc(self, valor=1, **rotulos):
+        chave = self._chave(rotulos)
+        with self.trava:
+            self.series[chave] = self.series.get(chave, 0) + valor
+
+
+class Medidor(Metrica):
+    """
+    Valor que sobe e desce (conexões ativas). Com `funcao`, o valor é lido só na
+    exportação: funcao() retorna um número ou, com rótulos, {valores dos rótulos: número}.
+    """
+
+    tipo = "gauge"
+
+    def __init__(self, nome, ajuda, rotulos=(), funcao=None):
+        super().__init__(nome, ajuda, rotulos)
+        self.funcao = funcao
+
+    def inc(self, valor=1, **rotulos):
+        chave = self._chave(rotulos)
+        with self.trava:
+            self.series[chave] = self.series.get(chave, 0) + valor
+
+    def dec(self, valor=1, **rotulos):
+        self.inc(-valor, **rotulos)
+
+    def definir(self, valor, **rotulos):
+        chave = self._chave(rotulos)
+        with self.trava:
+            self.series[chave] = valor
+
+    def valores(self):
+        if self.funcao is None:
+            return super().valores()
+        try:
+            resultado = self.funcao()
+        except Exception as e:  # Um medidor com defeito não pode derrubar a exportação das demais
+            log.warning("Falha ao ler o medidor %s: %s", self.nome, e)
+            return []
+        if not self.rotulos:
+            return [((), resultado)]
+        return [(tuple(str(valor) for valor in chave), valor) for chave, valor in resultado.items()]
+
+
+class Histograma(Metrica):
+    """Distribuição de valores (latências) em baldes de limites fixos, com soma e contagem."""
+
+    tipo = "histogram"
+
+    def __init__(self, nome, ajuda, rotulos=(), baldes=BALDES_LATENCIA):
+        super().__init__(nome, ajuda, rotulos)
+        self.baldes = tuple(baldes)
+
+    def observar(self, valor, **rotulos):
+        chave = self._chave(rotulos)
+        indice = bisect.bisect_left(self.baldes, valor)
+        with self.trava:
+            serie = self.series.get(chave)
+            if serie is None:
+                # Contagem de cada balde (o último é o +Inf), soma e quantidade
+                serie = self.series[chave] = [[0] * (len(self.baldes) + 1), 0.0, 0]
+            serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    @contextmanager
+    def medir(self, **rotulos):
+        """Observa a duração do bloco, em segundos."""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(time.perf_counter() - inicio, **rotulos)
+
+    def valores(self):
+        with self.trava:
+            return [(chave, (list(contagens), soma, quantidade))
+                    for chave, (contagens, soma, quantidade) in self.series.items()]
+
+    def quantil(self, contagens, quantidade, q):
+        """Estimativa de um quantil, interpolando dentro do balde em que ele cai."""
+        alvo = q * quantidade
+        acumulado = 0
+        for indice, contagem in enumerate(contagens):
+            if contagem and acumulado + contagem >= alvo:
+                if indice == len(self.baldes):
+                    return self.baldes[-1]  # Além do último limite: só se sabe que é maior que ele
+                inferior = self.baldes[indice - 1] if indice else 0.0
+                return inferior + (self.baldes[indice] - inferior) * (alvo - acumulado) / contagem
+            acumulado += contagem
+        return 0.0
+
+
+def escapar_rotulo(valor):
+    return valor.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatar_rotulos(nomes, valores, extra=()):
+    pares = list(zip(nomes, valores)) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{nome}="{escapar_rotulo(valor)}"' for nome, valor in pares) + "}"
+
+
+class Registro:
+    """Conjunto das métricas de um processo, exportável em JSON ou no formato do Prometheus."""
+
+    def __init__(self):
+        self.trava = threading.Lock()
+        self.metricas = {}
+
+    def _registrar(self, metrica):
+        # Registrar de novo o mesmo nome retorna a métrica existente (por exemplo, num segundo Servidor)
+        with self.trava:
+            return self.metricas.setdefault(metrica.nome, metrica)
+
+    def contador(self, nome, ajuda, rotulos=()):
+        return self._registrar(Contador(nome, ajuda, rotulos))
+
+    def medidor(self, nome, ajuda, rotulos=(), funcao=None):
+        medidor = self._registrar(Medidor(nome, ajuda, rotulos, funcao))
+        if funcao is not None:
+            medidor.funcao = funcao  # A instância mais recente é a que está em uso
+        return medidor
+
+    def histograma(self, nome, ajuda, rotulos=(), baldes=BALDES_LATENCIA):
+        return self._registrar(Histograma(nome, ajuda, rotulos, baldes))
+
+    def _ordenadas(self):
+        with self.trava:
+            return sorted(self.metricas.values(), key=lambda metrica: metrica.nome)
+
+    def json(self):
+        """Métricas como dicionário: {nome: [{rótulo: valor, ..., "valor" ou quantis}]}."""
+        resultado = {}
+        for metrica in self._ordenadas():
+            series = []
+            for chave, valor in sorted(metrica.valores()):
+                serie = dict(zip(metrica.rotulos, chave))
+                if isinstance(metrica, Histograma):
+                    contagens, soma, quantidade = valor
+                    serie.update(quantidade=quantidade, soma=soma,
+                                 **{f"p{round(q * 100)}": metrica.quantil(contagens, quantidade, q) for q in QUANTIS})
+                else:
+                    serie["valor"] = valor
+                series.append(serie)
+            resultado[metrica.nome] = series
+        return resultado
+
+    def prometheus(self):
+        """Métricas no formato de texto do Prometheus (versão 0.0.4)."""
+        linhas = []
+        for metrica in self._ordenadas():
+            linhas.append(f"# HELP {metrica.nome} {metrica.ajuda}")
+            linhas.append(f"# TYPE {metrica.nome} {metrica.tipo}")
+            for chave, valor in sorted(metrica.valores()):
+                if not isinstance(metrica, Histograma):
+                    linhas.append(f"{metrica.nome}{formatar_rotulos(metrica.rotulos, chave)} {valor}")
+                    continue
+                contagens, soma, quantidade = valor
+                acumulado = 0
+                for limite, contagem in zip(list(metrica.baldes) + ["+Inf"], contagens):
+                    acumulado += contagem
+                    rotulos = formatar_rotulos(metrica.rotulos, chave, [("le", str(limite))])
+                    linhas.append(f"{metrica.nome}_bucket{rotulos} {acumulado}")
+                linhas.append(f"{metrica.nome}_sum{formatar_rotulos(metrica.rotulos, chave)} {soma}")
+                linhas.append(f"{metrica.nome}_count{formatar_rotulos(metrica.rotulos, chave)} {quantidade}")
+        return "\n".join(linhas) + "\n"
+
+
+# Registro único do processo: os módulos do servidor e do cluster declaram nele as suas métricas
+REGISTRO = Registro()
+
+
+class ExecutorMedido(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor que conta em `pendentes` as tarefas submetidas que ainda esperam uma
+    thread, para os medidores de fila. Uma tarefa sai da contagem ao começar a executar ou,
+    se for cancelada antes disso, quando o seu futuro termina.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.trava_pendentes = threading.Lock()
+        self.pendentes = 0
+
+    def _retirar(self, aguardando):
+        with self.trava_pendentes:
+            if aguardando[0]:
+                aguardando[0] = False
+                self.pendentes -= 1
+
+    def submit(self, funcao, /, *args, **kwargs):
+        aguardando = [True]  # Compartilhado pela tarefa e pelo callback: só o primeiro a retira da contagem
+
+        def executar():
+            self._retirar(aguardando)
+            return funcao(*args, **kwargs)
+
+        with self.trava_pendentes:
+            self.pendentes += 1
+        try:
+            futuro = super().submit(executar)
+        except BaseException:
+            self._retirar(aguardando)
+            raise
+        futuro.add_done_callback(lambda _: self._retirar(aguardando))
+        return futuro
+
+
+def servir_http(host, porta, registro=REGISTRO):
+    """Publica as métricas em http://host:porta/metrics, numa thread própria. Retorna o servidor HTTP."""
+
+    class TratadorMetricas(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            corpo = registro.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, formato, *args):
+            log.debug("HTTP %s: " + formato, self.address_string(), *args)
+
+    servidor = http.server.ThreadingHTTPServer((host, porta), TratadorMetricas)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True, name="metricas").start()
+    log.info("Métricas em http://%s:%d/metrics", host, servidor.server_address[1])
+    return servidor
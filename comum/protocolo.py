@@ -0,0 +1,718 @@
+"""
+Protocolo binário com enquadramento por tamanho, compartilhado entre cliente,
+servidor e cluster.
+
+Cada mensagem (quadro) é formada por um cabeçalho fixo, seguido do nome
+(UTF-8) e do payload:
+
+    +--------+--------+--------+-------+-----------+---------------+-----------------+----------+
+    | mágico | versão | opcode | flags | tam. nome | id requisição | tam. payload    | checksum |
+    | 2 B    | 1 B    | 1 B    | 1 B   | 2 B       | 4 B           | 8 B             | 4 B      |
+    +--------+--------+--------+-------+-----------+---------------+-----------------+----------+
+
+Com a flag FLAG_RASTREIO, o cabeçalho é seguido de um id de rastreio (8 B) antes do
+nome: o servidor o repassa ao cluster, e os logs das duas pontas mostram o mesmo id
+para a mesma requisição.
+
+Como o tamanho do payload é conhecido de antemão, os dados são transmitidos
+com contagem exata de bytes, sem procurar marcadores como "FIM" em cada bloco,
+e várias requisições podem ser enviadas em sequência na mesma conexão.
+"""
+import hashlib
+import os
+import socket
+import struct
+import zlib
+from collections import namedtuple
+
+MAGICO = b"MG"
+VERSAO = 1
+
+# Formato do cabeçalho (ordem de rede): mágico, versão, opcode, flags,
+# tamanho do nome, id da requisição, tamanho do payload e checksum (CRC32)
+CABECALHO = struct.Struct("!2sBBBHIQI")
+
+TAMANHO_BLOCO = 64 * 1024  # Tamanho dos blocos usados ao transmitir payloads grandes
+TAMANHO_BUFFER_RECEPCAO = 1024 * 1024  # Tamanho dos buffers pré-alocados para receber arquivos
+TAMANHO_MAXIMO_PARAMETROS = 64 * 1024  # Limite dos payloads de parâmetros lidos inteiros em memória
+TAMANHO_BLOCO_DEDUP = 4 * 1024 * 1024  # Tamanho dos blocos do armazenamento deduplicado
+TAMANHO_RESUMO = 32  # Tamanho (bytes) do resumo BLAKE2b que identifica cada bloco
+
+# Opcodes de requisição
+UPLOAD = 0x01
+LIST = 0x02  # nome: prefixo; payload opcional: ordenação e página (LISTAGEM); resposta: REGISTRO_IMAGEM...
+DOWNLOAD = 0x03  # payload opcional: codecs aceitos na resposta (ver CAPACIDADES)
+DELETE = 0x04
+PING = 0x05
+# Transferências em pedaços, em várias conexões paralelas
+UPLOAD_INICIO = 0x06  # payload: tamanho total (DESLOCAMENTO)
+UPLOAD_PEDACO = 0x07  # payload: deslocamento (DESLOCAMENTO) seguido dos bytes do pedaço
+# payload: CRC32 do arquivo inteiro (CHECKSUM), opcional só no upload deduplicado; publica o arquivo definitivo
+UPLOAD_FIM = 0x08
+DOWNLOAD_INTERVALO = 0x09  # payload: deslocamento e comprimento (INTERVALO)
+TAMANHO = 0x0A  # resposta: tamanho do arquivo (DESLOCAMENTO)
+# Upload retomável: payload tamanho total (DESLOCAMENTO); resposta: bytes já recebidos (DESLOCAMENTO)
+UPLOAD_RETOMAR = 0x0B
+# Upload deduplicado: payload sequência de BLOCO_INFO; resposta: índices dos blocos que faltam (INDICE)
+BLOCOS_CONSULTAR = 0x0C
+BLOCO = 0x0D  # payload: resumo do bloco (TAMANHO_RESUMO bytes) seguido dos seus bytes
+ESTATISTICAS = 0x0E  # resposta: estatísticas do servidor (JSON)
+# Prévias de cenas GeoTIFF geradas no cluster; resposta: imagem PNG
+MINIATURA = 0x0F  # payload: maior lado, em pixels (LADO_MINIATURA)
+LADRILHO = 0x10  # payload: nível de zoom, coluna e linha (POSICAO_LADRILHO)
+# Negociação da compressão: payload e resposta são listas de codecs (um byte cada, em ordem de preferência)
+CAPACIDADES = 0x11
+# Comandos em lote: vários arquivos numa só requisição, com o resultado de cada um no fim (RESULTADO_LOTE...)
+MUPLOAD = 0x12  # payload: quantidade (QUANTIDADE_LOTE); após o OK do servidor, seguem os quadros UPLOAD
+MDOWNLOAD = 0x13  # payload: codecs aceitos e nomes (empacotar_lote_download); resposta: um quadro por imagem
+MDELETE = 0x14  # payload: nomes (empacotar_nomes)
+# Busca espacial: nome é o cursor (o último nome da página anterior, ou vazio); payload: PARAMETROS_BUSCA;
+# resposta: REGISTRO_BUSCA... das cenas cuja extensão intersecta a caixa, por nome
+BUSCA = 0x15
+# Análise de uma cena no cluster: payload: PARAMETROS_CALCULO; resposta: resultado em JSON
+CALCULO = 0x16
+# Transferência delta (ver comum/delta.py). ASSINATURAS: payload opcional, o resumo (RESUMO_DELTA) da cópia
+# que o cliente já tem; resposta: CABECALHO_ASSINATURAS, seguido das ASSINATURA_BLOCO da imagem, omitidas
+# se o resumo for o mesmo (a cópia está atualizada)
+ASSINATURAS = 0x17
+# UPLOAD_DELTA: payload: PREAMBULO_DELTA seguido das instruções (COPIA_DELTA ou LITERAL_DELTA e os bytes)
+# que montam a nova versão a partir dos blocos da versão armazenada
+UPLOAD_DELTA = 0x18
+
+# Opcodes de resposta
+OK = 0x80
+ERRO = 0x81
+# Servidor sobrecarregado (limite de taxa, de conexões ou fila cheia): a requisição não foi executada e pode
+# ser repetida. payload: espera sugerida (ESPERA, em milissegundos) seguida da mensagem
+OCUPADO = 0x82
+
+NOMES_OPCODES = {
+    UPLOAD: "UPLOAD",
+    LIST: "LIST",
+    DOWNLOAD: "DOWNLOAD",
+    DELETE: "DELETE",
+    PING: "PING",
+    UPLOAD_INICIO: "UPLOAD_INICIO",
+    UPLOAD_PEDACO: "UPLOAD_PEDACO",
+    UPLOAD_FIM: "UPLOAD_FIM",
+    DOWNLOAD_INTERVALO: "DOWNLOAD_INTERVALO",
+    TAMANHO: "TAMANHO",
+    UPLOAD_RETOMAR: "UPLOAD_RETOMAR",
+    BLOCOS_CONSULTAR: "BLOCOS_CONSULTAR",
+    BLOCO: "BLOCO",
+    ESTATISTICAS: "ESTATISTICAS",
+    MINIATURA: "MINIATURA",
+    LADRILHO: "LADRILHO",
+    CAPACIDADES: "CAPACIDADES",
+    MUPLOAD: "MUPLOAD",
+    MDOWNLOAD: "MDOWNLOAD",
+    MDELETE: "MDELETE",
+    BUSCA: "BUSCA",
+    CALCULO: "CALCULO",
+    ASSINATURAS: "ASSINATURAS",
+    UPLOAD_DELTA: "UPLOAD_DELTA",
+    OK: "OK",
+    ERRO: "ERRO",
+    OCUPADO: "OCUPADO",
+}
+
+# Flags
+FLAG_CHECKSUM = 0x01  # O campo checksum contém o CRC32 do payload
+# O payload é uma sequência de trechos comprimidos (ver comum/compressao.py). Num DOWNLOAD, o
+# payload da requisição lista os codecs aceitos e a resposta pode vir comprimida com um deles
+FLAG_COMPRIMIDO = 0x02
+FLAG_RASTREIO = 0x04  # O cabeçalho é seguido do id de rastreio da requisição (RASTREIO), antes do nome
+
+# Campos binários usados nos payloads das transferências em pedaços
+DESLOCAMENTO = struct.Struct("!Q")
+INTERVALO = struct.Struct("!QQ")
+CHECKSUM = struct.Struct("!I")
+BLOCO_INFO = struct.Struct(f"!{TAMANHO_RESUMO}sQ")  # Resumo e comprimento de um bloco
+INDICE = struct.Struct("!I")
+RASTREIO = struct.Struct("!Q")
+ESPERA = struct.Struct("!I")
+
+# LIST paginado: ordem, decrescente, tem cursor, limite, valor do cursor e tamanho do nome do cursor
+# (seguido do nome). O cursor é a chave da última imagem da página anterior.
+LISTAGEM = struct.Struct("!BBBIdH")
+# Cada imagem da resposta do LIST: tamanho do nome, tamanho da imagem, checksum e data de envio
+# (seguidos do nome)
+REGISTRO_IMAGEM = struct.Struct("!HQId")
+ORDEM_NOME = 0
+ORDEM_TAMANHO = 1
+ORDEM_DATA = 2
+LIMITE_LISTAGEM = 1000  # Imagens por página, se o cliente não pedir outro valor
+LIMITE_MAXIMO_LISTAGEM = 10000  # Cada página é lida inteira em memória: limita o seu tamanho
+
+# BUSCA: caixa (x_min, y_min, x_max, y_max), intervalo de datas da cena (início e fim, em segundos desde a
+# época; infinitos para não limitar), código EPSG da caixa (0: compara com as cenas de qualquer sistema de
+# referência) e limite da página. Cada cena da resposta: tamanho do nome, tamanho, checksum, data de envio,
+# EPSG, extensão e data da cena (seguidos do nome)
+PARAMETROS_BUSCA = struct.Struct("!ddddddII")
+REGISTRO_BUSCA = struct.Struct("!HQIdIddddd")
+
+# CALCULO: operação, janela (coluna, linha, largura e altura; largura ou altura 0 vão até a borda da
+# cena), duas bandas (numeradas a partir de 1), classes do histograma e limiar
+PARAMETROS_CALCULO = struct.Struct("!BIIIIBBHd")
+CALCULO_ESTATISTICAS = 1  # Mínimo, máximo, média, desvio padrão e histograma de cada banda
+CALCULO_NDVI = 2  # NDVI das bandas vermelho (a primeira) e infravermelho próximo (a segunda)
+CALCULO_NUVENS = 3  # Fração dos pixels com a primeira banda acima do limiar (máscara de nuvens)
+OPERACOES_CALCULO = {"estatisticas": CALCULO_ESTATISTICAS, "ndvi": CALCULO_NDVI, "nuvens": CALCULO_NUVENS}
+CLASSES_MAXIMAS_HISTOGRAMA = 4096
+
+# Transferência delta: tamanho da imagem, tamanho dos blocos e resumo da imagem inteira; por bloco, a soma
+# fraca (Adler-32, deslizante) e o resumo forte (BLAKE2b). O preâmbulo de um UPLOAD_DELTA traz o resumo da
+# versão base, o tamanho e o CRC32 da nova versão
+TAMANHO_BLOCO_DELTA = 64 * 1024
+TAMANHO_RESUMO_DELTA = 16
+CABECALHO_ASSINATURAS = struct.Struct(f"!QI{TAMANHO_RESUMO_DELTA}s")
+ASSINATURA_BLOCO = struct.Struct(f"!I{TAMANHO_RESUMO_DELTA}s")
+PREAMBULO_DELTA = struct.Struct(f"!{TAMANHO_RESUMO_DELTA}sQI")
+COPIA_DELTA = struct.Struct("!BII")  # Tipo, primeiro bloco da base e quantidade de blocos consecutivos
+LITERAL_DELTA = struct.Struct("!BI")  # Tipo e comprimento dos bytes que seguem
+DELTA_COPIA = 1
+DELTA_LITERAL = 2
+
+LADO_MINIATURA = struct.Struct("!H")
+POSICAO_LADRILHO = struct.Struct("!BII")
+LADO_MAXIMO_MINIATURA = 1024
+TAMANHO_LADRILHO = 256  # Lado, em pixels, dos ladrilhos (os da borda da cena podem ser menores)
+
+# Comandos em lote: os nomes vão em sequência, cada um precedido do seu tamanho (NOME_LOTE). O resultado
+# de cada arquivo é um RESULTADO_LOTE (sucesso, tamanho do nome e da mensagem), seguido do nome e da mensagem
+QUANTIDADE_LOTE = struct.Struct("!I")
+NOME_LOTE = struct.Struct("!H")
+RESULTADO_LOTE = struct.Struct("!BHH")
+LIMITE_LOTE = 1000  # Arquivos por requisição em lote (os nomes também precisam caber nos parâmetros)
+
+# Comandos que gravam no cluster (repassados a todas as réplicas da imagem)
+OPCODES_ESCRITA = frozenset({UPLOAD, UPLOAD_INICIO, UPLOAD_PEDACO, UPLOAD_FIM, UPLOAD_RETOMAR,
+                             BLOCOS_CONSULTAR, BLOCO, UPLOAD_DELTA})
+# Comandos de leitura de uma imagem (atendidos por qualquer réplica)
+OPCODES_LEITURA = frozenset({DOWNLOAD, DOWNLOAD_INTERVALO, TAMANHO, MINIATURA, LADRILHO, CALCULO, ASSINATURAS})
+
+Cabecalho = namedtuple("Cabecalho", "opcode flags nome id_requisicao tamanho checksum rastreio", defaults=(0,))
+Listagem = namedtuple("Listagem", "ordem decrescente limite cursor")
+RegistroImagem = namedtuple("RegistroImagem", "nome tamanho checksum enviado_em")
+ResultadoLote = namedtuple("ResultadoLote", "nome sucesso mensagem")
+Calculo = namedtuple("Calculo", "operacao x y largura altura banda_a banda_b classes limiar")
+Busca = namedtuple("Busca", "x_min y_min x_max y_max inicio fim epsg limite")
+CenaEncontrada = namedtuple("CenaEncontrada", "nome tamanho checksum enviado_em epsg x_min y_min x_max y_max data")
+
+
+class ErroProtocolo(Exception):
+    """Erro de enquadramento, versão ou integridade dos dados recebidos."""
+
+
+def nome_opcode(opcode):
+    """Retorna o nome legível de um opcode (usado nas mensagens de depuração)."""
+    return NOMES_OPCODES.get(opcode, f"0x{opcode:02x}")
+
+
+def desativar_nagle(sock):
+    """
+    Desativa o algoritmo de Nagle: o cabeçalho de um quadro e o payload enviado logo depois
+    (sendfile, splice) são escritos separadamente, e com Nagle cada quadro pequeno esperaria
+    o ACK atrasado do outro lado (dezenas de ms) antes de seguir.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def montar_cabecalho(opcode, nome="", tamanho=0, id_requisicao=0, flags=0, checksum=0, rastreio=0):
+    """Monta os bytes do cabeçalho (com o id de rastreio, se houver) seguido do nome codificado em UTF-8."""
+    nome_bytes = nome.encode()
+    prefixo = b""
+    flags &= ~FLAG_RASTREIO
+    if rastreio:
+        flags |= FLAG_RASTREIO
+        prefixo = RASTREIO.pack(rastreio)
+    return CABECALHO.pack(MAGICO, VERSAO, opcode, flags, len(nome_bytes),
+                          id_requisicao, tamanho, checksum) + prefixo + nome_bytes
+
+
+def enviar_quadro(sock, opcode, nome="", payload=b"", id_requisicao=0, com_checksum=False, rastreio=0):
+    """Envia um quadro completo (cabeçalho, nome e payload em memória)."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    flags, checksum = 0, 0
+    if com_checksum:
+        flags |= FLAG_CHECKSUM
+        checksum = zlib.crc32(payload)
+    cabecalho = montar_cabecalho(opcode, nome, len(payload), id_requisicao, flags, checksum, rastreio)
+    sock.sendall(cabecalho + payload)
+
+
+def reenviar_cabecalho(sock, cab, id_requisicao=None):
+    """
+    Reenvia um cabeçalho recebido (por exemplo, do cliente para o cluster), mantendo
+    flags, checksum e id de rastreio para que a verificação de integridade aconteça no
+    destino final e os logs das duas pontas mostrem a mesma requisição.
+    """
+    if id_requisicao is None:
+        id_requisicao = cab.id_requisicao
+    sock.sendall(montar_cabecalho(cab.opcode, cab.nome, cab.tamanho, id_requisicao,
+                                  cab.flags, cab.checksum, cab.rastreio))
+
+
+def calcular_checksum(f):
+    """Calcula o CRC32 do restante de um arquivo aberto, lendo-o em blocos."""
+    checksum = 0
+    while True:
+        dados = f.read(TAMANHO_BLOCO)
+        if not dados:
+            return checksum
+        checksum = zlib.crc32(dados, checksum)
+
+
+def calcular_checksum_arquivo(caminho):
+    """Calcula o CRC32 de um arquivo lendo-o em blocos."""
+    with open(caminho, "rb") as f:
+        return calcular_checksum(f)
+
+
+def novo_resumo(dados=b""):
+    """Cria o resumo BLAKE2b que identifica um bloco no armazenamento deduplicado."""
+    return hashlib.blake2b(dados, digest_size=TAMANHO_RESUMO)
+
+
+def empacotar_indices(indices):
+    """Codifica uma lista de índices de blocos (resposta do BLOCOS_CONSULTAR)."""
+    return b"".join(INDICE.pack(i) for i in indices)
+
+
+def desempacotar_indices(payload):
+    """Decodifica uma lista de índices de blocos."""
+    return [i for i, in INDICE.iter_unpack(payload)]
+
+
+def empacotar_listagem(ordem=ORDEM_NOME, decrescente=False, limite=LIMITE_LISTAGEM, cursor=None):
+    """Codifica os parâmetros de uma página do LIST; `cursor` é (valor, nome) ou None."""
+    valor, nome = cursor if cursor is not None else (0, "")
+    nome_bytes = nome.encode()
+    return LISTAGEM.pack(ordem, decrescente, cursor is not None, limite, valor, len(nome_bytes)) + nome_bytes
+
+
+def desempacotar_listagem(payload):
+    """
+    Decodifica os parâmetros de uma página do LIST. Um payload vazio pede a primeira
+    página, por nome; o limite é ajustado a LIMITE_MAXIMO_LISTAGEM.
+    """
+    if not payload:
+        return Listagem(ORDEM_NOME, False, LIMITE_LISTAGEM, None)
+    ordem, decrescente, tem_cursor, limite, valor, tamanho_nome = LISTAGEM.unpack_from(payload)
+    if ordem not in (ORDEM_NOME, ORDEM_TAMANHO, ORDEM_DATA):
+        raise ErroProtocolo(f"Ordenação desconhecida: {ordem}")
+    nome = payload[LISTAGEM.size:LISTAGEM.size + tamanho_nome].decode()
+    cursor = (valor, nome) if tem_cursor else None
+    return Listagem(ordem, bool(decrescente), max(1, min(limite, LIMITE_MAXIMO_LISTAGEM)), cursor)
+
+
+def empacotar_registros(registros):
+    """Codifica as imagens de uma página do LIST (uma sequência de REGISTRO_IMAGEM)."""
+    partes = []
+    for registro in registros:
+        nome_bytes = registro.nome.encode()
+        partes.append(REGISTRO_IMAGEM.pack(len(nome_bytes), registro.tamanho, registro.checksum,
+                                           registro.enviado_em) + nome_bytes)
+    return b"".join(partes)
+
+
+def desempacotar_registros(payload):
+    """Decodifica as imagens de uma página do LIST. Retorna uma lista de RegistroImagem."""
+    registros = []
+    posicao = 0
+    while posicao < len(payload):
+        tamanho_nome, tamanho, checksum, enviado_em = REGISTRO_IMAGEM.unpack_from(payload, posicao)
+        posicao += REGISTRO_IMAGEM.size
+        nome = bytes(payload[posicao:posicao + tamanho_nome]).decode()
+        posicao += tamanho_nome
+        registros.append(RegistroImagem(nome, tamanho, checksum, enviado_em))
+    return registros
+
+
+def cursor_registro(registro, ordem):
+    """Chave (valor, nome) de uma imagem na ordenação pedida, usada como cursor e para ordenar."""
+    if ordem == ORDEM_TAMANHO:
+        return registro.tamanho, registro.nome
+    if ordem == ORDEM_DATA:
+        return registro.enviado_em, registro.nome
+    return 0, registro.nome
+
+
+def empacotar_busca(caixa, inicio=None, fim=None, epsg=0, limite=LIMITE_LISTAGEM):
+    """Codifica os parâmetros de uma BUSCA; `caixa` é (x_min, y_min, x_max, y_max) e as datas podem ser None."""
+    return PARAMETROS_BUSCA.pack(*caixa, float("-inf") if inicio is None else inicio,
+                                 float("inf") if fim is None else fim, epsg, limite)
+
+
+def desempacotar_busca(payload):
+    """Decodifica os parâmetros de uma BUSCA; o limite é ajustado a LIMITE_MAXIMO_LISTAGEM."""
+    busca = Busca(*PARAMETROS_BUSCA.unpack(payload))
+    if not (busca.x_min <= busca.x_max and busca.y_min <= busca.y_max):
+        raise ErroProtocolo("Caixa da busca vazia ou invertida")
+    return busca._replace(limite=max(1, min(busca.limite, LIMITE_MAXIMO_LISTAGEM)))
+
+
+def empacotar_calculo(operacao, janela=None, banda_a=1, banda_b=2, classes=256, limiar=0.0):
+    """Codifica os parâmetros de um CALCULO; `janela` é (x, y, largura, altura), ou None para a cena inteira."""
+    return PARAMETROS_CALCULO.pack(operacao, *(janela or (0, 0, 0, 0)), banda_a, banda_b, classes, limiar)
+
+
+def desempacotar_calculo(payload):
+    """Decodifica os parâmetros de um CALCULO; operação ou número de classes inválidos levantam ErroProtocolo."""
+    calculo = Calculo(*PARAMETROS_CALCULO.unpack(payload))
+    if calculo.operacao not in OPERACOES_CALCULO.values():
+        raise ErroProtocolo(f"Operação de cálculo desconhecida: {calculo.operacao}")
+    if not 1 <= calculo.classes <= CLASSES_MAXIMAS_HISTOGRAMA:
+        raise ErroProtocolo(f"O histograma deve ter entre 1 e {CLASSES_MAXIMAS_HISTOGRAMA} classes")
+    return calculo
+
+
+def empacotar_cenas(cenas):
+    """Codifica as cenas de uma página da BUSCA (uma sequência de REGISTRO_BUSCA)."""
+    partes = []
+    for cena in cenas:
+        nome_bytes = cena.nome.encode()
+        partes.append(REGISTRO_BUSCA.pack(len(nome_bytes), *cena[1:]) + nome_bytes)
+    return b"".join(partes)
+
+
+def desempacotar_cenas(payload):
+    """Decodifica as cenas de uma página da BUSCA. Retorna uma lista de CenaEncontrada."""
+    cenas = []
+    posicao = 0
+    while posicao < len(payload):
+        tamanho_nome, *campos = REGISTRO_BUSCA.unpack_from(payload, posicao)
+        posicao += REGISTRO_BUSCA.size
+        nome = bytes(payload[posicao:posicao + tamanho_nome]).decode()
+        posicao += tamanho_nome
+        cenas.append(CenaEncontrada(nome, *campos))
+    return cenas
+
+
+def empacotar_nomes(nomes):
+    """Codifica os nomes de um comando em lote (cada um precedido de NOME_LOTE)."""
+    partes = []
+    for nome in nomes:
+        nome_bytes = nome.encode()
+        partes.append(NOME_LOTE.pack(len(nome_bytes)) + nome_bytes)
+    return b"".join(partes)
+
+
+def desempacotar_nomes(payload):
+    """Decodifica os nomes de um comando em lote."""
+    nomes = []
+    posicao = 0
+    while posicao < len(payload):
+        tamanho_nome, = NOME_LOTE.unpack_from(payload, posicao)
+        posicao += NOME_LOTE.size
+        if posicao + tamanho_nome > len(payload):
+            raise ErroProtocolo("Nome truncado no lote")
+        nomes.append(bytes(payload[posicao:posicao + tamanho_nome]).decode())
+        posicao += tamanho_nome
+    if len(nomes) > LIMITE_LOTE:
+        raise ErroProtocolo(f"Lote com mais de {LIMITE_LOTE} arquivos")
+    return nomes
+
+
+def empacotar_lote_download(codecs, nomes):
+    """Codifica os parâmetros de um MDOWNLOAD: a quantidade de codecs, os codecs e os nomes."""
+    return bytes([len(codecs)]) + bytes(codecs) + empacotar_nomes(nomes)
+
+
+def desempacotar_lote_download(payload):
+    """Decodifica os parâmetros de um MDOWNLOAD. Retorna (codecs, nomes)."""
+    if not payload:
+        raise ErroProtocolo("Parâmetros de MDOWNLOAD vazios")
+    quantidade = payload[0]
+    return bytes(payload[1:1 + quantidade]), desempacotar_nomes(payload[1 + quantidade:])
+
+
+def dividir_lotes(nomes, reservado=0):
+    """
+    Divide os nomes em lotes de até LIMITE_LOTE arquivos cujos nomes empacotados (mais
+    `reservado` bytes de outros parâmetros) cabem em TAMANHO_MAXIMO_PARAMETROS.
+    """
+    lote, tamanho = [], reservado
+    for nome in nomes:
+        tamanho_nome = NOME_LOTE.size + len(nome.encode())
+        if lote and (len(lote) == LIMITE_LOTE or tamanho + tamanho_nome > TAMANHO_MAXIMO_PARAMETROS):
+            yield lote
+            lote, tamanho = [], reservado
+        lote.append(nome)
+        tamanho += tamanho_nome
+    if lote:
+        yield lote
+
+
+def empacotar_ocupado(espera, mensagem):
+    """Payload de uma resposta OCUPADO: a espera sugerida (segundos) e a mensagem."""
+    return ESPERA.pack(min(round(espera * 1000), 0xFFFFFFFF)) + mensagem.encode()
+
+
+def espera_ocupado(payload):
+    """Espera sugerida (segundos) de uma resposta OCUPADO."""
+    return ESPERA.unpack_from(payload)[0] / 1000
+
+
+def mensagem_resposta(cab, payload):
+    """Texto de uma resposta OK, ERRO ou OCUPADO (sem a espera sugerida, que precede a mensagem)."""
+    if cab.opcode == OCUPADO:
+        payload = payload[ESPERA.size:]
+    return bytes(payload).decode(errors="replace")
+
+
+def empacotar_resultados(resultados):
+    """Codifica o resultado de cada arquivo de um comando em lote (uma sequência de RESULTADO_LOTE)."""
+    partes = []
+    for resultado in resultados:
+        nome_bytes = resultado.nome.encode()
+        mensagem_bytes = resultado.mensagem.encode()[:0xFFFF]
+        partes.append(RESULTADO_LOTE.pack(bool(resultado.sucesso), len(nome_bytes), len(mensagem_bytes))
+                      + nome_bytes + mensagem_bytes)
+    return b"".join(partes)
+
+
+def desempacotar_resultados(payload):
+    """Decodifica os resultados de um comando em lote. Retorna uma lista de ResultadoLote."""
+    resultados = []
+    posicao = 0
+    while posicao < len(payload):
+        sucesso, tamanho_nome, tamanho_mensagem = RESULTADO_LOTE.unpack_from(payload, posicao)
+        posicao += RESULTADO_LOTE.size
+        nome = bytes(payload[posicao:posicao + tamanho_nome]).decode()
+        posicao += tamanho_nome
+        mensagem = bytes(payload[posicao:posicao + tamanho_mensagem]).decode(errors="replace")
+        posicao += tamanho_mensagem
+        resultados.append(ResultadoLote(nome, bool(sucesso), mensagem))
+    return resultados
+
+
+def enviar_arquivo(sock, opcode, nome, caminho, id_requisicao=0, com_checksum=False):
+    """
+    Envia um arquivo como payload de um quadro. Depois do cabeçalho com o tamanho,
+    o conteúdo é entregue ao kernel com sendfile (cópia zero), sem passar pelo Python;
+    em plataformas sem sendfile, socket.sendfile recorre automaticamente a send.
+    """
+    tamanho = os.path.getsize(caminho)
+    flags, checksum = 0, 0
+    if com_checksum:
+        flags |= FLAG_CHECKSUM
+        checksum = calcular_checksum_arquivo(caminho)
+    sock.sendall(montar_cabecalho(opcode, nome, tamanho, id_requisicao, flags, checksum))
+    with open(caminho, "rb") as f:
+        enviar_trecho(sock, f, 0, tamanho)
+
+
+def enviar_trecho(sock, f, deslocamento, comprimento):
+    """Envia `comprimento` bytes de um arquivo aberto a partir de `deslocamento`, com sendfile."""
+    if comprimento == 0:
+        return
+    # Sem um descritor (BytesIO, temporário em memória), o sendfile lê o objeto a partir da
+    # posição atual quando o deslocamento é 0: a posição é ajustada antes
+    f.seek(deslocamento)
+    enviados = sock.sendfile(f, deslocamento, comprimento)
+    if enviados != comprimento:
+        raise ErroProtocolo(f"Arquivo {getattr(f, 'name', '')} terminou antes do tamanho anunciado")
+
+
+def enviar_pedaco(sock, opcode, nome, f, deslocamento, comprimento, id_requisicao=0):
+    """
+    Envia um quadro cujo payload é o deslocamento (DESLOCAMENTO) seguido de um trecho
+    do arquivo aberto `f`, usado nos uploads em pedaços.
+    """
+    prefixo = DESLOCAMENTO.pack(deslocamento)
+    sock.sendall(montar_cabecalho(opcode, nome, len(prefixo) + comprimento, id_requisicao) + prefixo)
+    enviar_trecho(sock, f, deslocamento, comprimento)
+
+
+def enviar_bloco(sock, nome, resumo, f, deslocamento, comprimento, id_requisicao=0):
+    """
+    Envia um quadro BLOCO cujo payload é o resumo do bloco seguido de um trecho do
+    arquivo aberto `f`, usado nos uploads deduplicados.
+    """
+    sock.sendall(montar_cabecalho(BLOCO, nome, len(resumo) + comprimento, id_requisicao) + resumo)
+    enviar_trecho(sock, f, deslocamento, comprimento)
+
+
+def novo_buffer(tamanho=TAMANHO_BUFFER_RECEPCAO):
+    """Aloca um buffer de recepção para ser reutilizado entre transferências."""
+    return bytearray(tamanho)
+
+
+def receber_exato(sock, tamanho):
+    """Recebe exatamente `tamanho` bytes do socket."""
+    buffer = bytearray(tamanho)
+    visao = memoryview(buffer)
+    recebidos = 0
+    while recebidos < tamanho:
+        n = sock.recv_into(visao[recebidos:])
+        if n == 0:
+            raise ConnectionError("Conexão encerrada no meio de um quadro")
+        recebidos += n
+    return buffer
+
+
+def desempacotar_cabecalho(bruto):
+    """
+    Valida os bytes fixos de um cabeçalho e retorna a tupla
+    (opcode, flags, tamanho_nome, id_requisicao, tamanho, checksum).
+    """
+    magico, versao, opcode, flags, tamanho_nome, id_requisicao, tamanho, checksum = CABECALHO.unpack(bruto)
+    if magico != MAGICO:
+        raise ErroProtocolo("Quadro inválido (mágico incorreto)")
+    if versao != VERSAO:
+        raise ErroProtocolo(f"Versão de protocolo não suportada: {versao}")
+    return opcode, flags, tamanho_nome, id_requisicao, tamanho, checksum
+
+
+def receber_cabecalho(sock):
+    """
+    Recebe e valida o próximo cabeçalho (incluindo o nome).
+    Retorna None se a conexão foi encerrada de forma limpa antes de um novo quadro.
+    """
+    primeiro = sock.recv(CABECALHO.size)
+    if not primeiro:
+        return None
+    bruto = primeiro
+    if len(bruto) < CABECALHO.size:
+        bruto += receber_exato(sock, CABECALHO.size - len(bruto))
+    opcode, flags, tamanho_nome, id_requisicao, tamanho, checksum = desempacotar_cabecalho(bruto)
+    rastreio = RASTREIO.unpack(receber_exato(sock, RASTREIO.size))[0] if flags & FLAG_RASTREIO else 0
+    nome = receber_exato(sock, tamanho_nome).decode() if tamanho_nome else ""
+    return Cabecalho(opcode, flags, nome, id_requisicao, tamanho, checksum, rastreio)
+
+
+def verificar_checksum(cab, checksum):
+    """Confere o checksum calculado com o anunciado no cabeçalho (se houver)."""
+    if cab.flags & FLAG_CHECKSUM and checksum != cab.checksum:
+        raise ErroProtocolo(f"Checksum inválido para {cab.nome or nome_opcode(cab.opcode)}")
+
+
+def receber_payload(sock, cab):
+    """Recebe o payload inteiro de um quadro em memória, verificando o checksum."""
+    payload = bytes(receber_exato(sock, cab.tamanho))
+    verificar_checksum(cab, zlib.crc32(payload))
+    return payload
+
+
+def receber_para_arquivo(sock, cab, f, buffer=None):
+    """
+    Grava o payload de um quadro diretamente em um arquivo aberto, verificando o
+    checksum ao final. Os dados são recebidos com recv_into em um buffer pré-alocado
+    (reutilizado entre chamadas quando fornecido), que só é gravado quando fica cheio:
+    o arquivo recebe poucas escritas grandes, alinhadas ao tamanho do buffer, em vez de
+    uma por recv. Retorna a quantidade de bytes gravados.
+    """
+    if buffer is None:
+        buffer = novo_buffer()
+    visao = memoryview(buffer)
+    tamanho_buffer = len(buffer)
+    verificar = cab.flags & FLAG_CHECKSUM
+    restante = cab.tamanho
+    checksum = 0
+    preenchido = 0  # Bytes do buffer ainda não gravados
+    while restante > 0:
+        n = sock.recv_into(visao[preenchido:preenchido + min(tamanho_buffer - preenchido, restante)])
+        if n == 0:
+            raise ConnectionError("Conexão encerrada no meio da transferência")
+        if verificar:
+            checksum = zlib.crc32(visao[preenchido:preenchido + n], checksum)
+        preenchido += n
+        restante -= n
+        if preenchido == tamanho_buffer or restante == 0:
+            f.write(visao[:preenchido])
+            preenchido = 0
+    verificar_checksum(cab, checksum)
+    return cab.tamanho
+
+
+def receber_em_posicao(sock, fd, deslocamento, tamanho, buffer=None, checksum=0):
+    """
+    Recebe `tamanho` bytes e os grava com os.pwrite a partir de `deslocamento` no
+    descritor `fd`, sem mover a posição do arquivo (várias conexões podem gravar
+    pedaços diferentes do mesmo arquivo ao mesmo tempo). Retorna o CRC32 acumulado
+    a partir de `checksum`.
+    """
+    if buffer is None:
+        buffer = novo_buffer()
+    visao = memoryview(buffer)
+    tamanho_buffer = len(buffer)
+    restante = tamanho
+    while restante > 0:
+        n = sock.recv_into(visao[:min(tamanho_buffer, restante)])
+        if n == 0:
+            raise ConnectionError("Conexão encerrada no meio da transferência")
+        gravados = 0
+        while gravados < n:
+            gravados += os.pwrite(fd, visao[gravados:n], deslocamento + gravados)
+        checksum = zlib.crc32(visao[:n], checksum)
+        deslocamento += n
+        restante -= n
+    return checksum
+
+
+def receber_com_resumo(sock, f, tamanho, buffer=None):
+    """
+    Grava `tamanho` bytes recebidos em um arquivo aberto, calculando ao mesmo tempo o
+    resumo BLAKE2b do conteúdo. Retorna o resumo (bytes).
+    """
+    if buffer is None:
+        buffer = novo_buffer()
+    visao = memoryview(buffer)
+    tamanho_buffer = len(buffer)
+    resumo = novo_resumo()
+    restante = tamanho
+    while restante > 0:
+        n = sock.recv_into(visao[:min(tamanho_buffer, restante)])
+        if n == 0:
+            raise ConnectionError("Conexão encerrada no meio da transferência")
+        f.write(visao[:n])
+        resumo.update(visao[:n])
+        restante -= n
+    return resumo.digest()
+
+
+def repassar(origem, destino, tamanho, buffer=None):
+    """Repassa exatamente `tamanho` bytes de um socket para outro."""
+    if buffer is None:
+        buffer = novo_buffer()
+    visao = memoryview(buffer)
+    tamanho_buffer = len(buffer)
+    restante = tamanho
+    while restante > 0:
+        n = origem.recv_into(visao[:min(tamanho_buffer, restante)])
+        if n == 0:
+            raise ConnectionError("Conexão encerrada no meio da transferência")
+        destino.sendall(visao[:n])
+        restante -= n
+
+
+def descartar(sock, tamanho):
+    """Lê e descarta `tamanho` bytes (payload de um quadro que não será tratado)."""
+    buffer = bytearray(TAMANHO_BLOCO)
+    visao = memoryview(buffer)
+    restante = tamanho
+    while restante > 0:
+        n = sock.recv_into(visao[:min(TAMANHO_BLOCO, restante)])
+        if n == 0:
+            raise ConnectionError("Conexão encerrada no meio da transferência")
+        restante -= n
+
+
+def receber_cabecalho_resposta(sock):
+    """Recebe o cabeçalho de uma resposta; a conexão encerrada antes dela é um erro."""
+    cab = receber_cabecalho(sock)
+    if cab is None:
+        raise ConnectionError("Conexão encerrada antes da resposta")
+    return cab
+
+
+def receber_resposta(sock):
+    """
+    Recebe um quadro de resposta com payload textual.
+    Retorna uma tupla (sucesso, mensagem).
+    """
+    cab = receber_cabecalho_resposta(sock)
+    mensagem = mensagem_resposta(cab, receber_payload(sock, cab))
+    return cab.opcode == OK, mensagem
@@ -0,0 +1,106 @@
+"""
+Versão asyncio das funções de envio e recepção de quadros do protocolo
+(ver comum/protocolo.py), operando sobre asyncio.StreamReader/StreamWriter.
+
+Toda escrita de payload é seguida de `await writer.drain()`, o que aplica
+contrapressão: se o destino for mais lento que a origem, a leitura da origem
+é suspensa até que o buffer de envio esvazie.
+"""
+import asyncio
+import zlib
+
+from comum import protocolo
+from comum.protocolo import Cabecalho
+
+
+async def receber_cabecalho(reader):
+    """
+    Recebe e valida o próximo cabeçalho (incluindo o nome).
+    Retorna None se a conexão foi encerrada de forma limpa antes de um novo quadro.
+    """
+    try:
+        bruto = await reader.readexactly(protocolo.CABECALHO.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Conexão encerrada no meio de um quadro")
+    opcode, flags, tamanho_nome, id_requisicao, tamanho, checksum = protocolo.desempacotar_cabecalho(bruto)
+    rastreio = 0
+    if flags & protocolo.FLAG_RASTREIO:
+        rastreio, = protocolo.RASTREIO.unpack(await receber_exato(reader, protocolo.RASTREIO.size))
+    nome = (await receber_exato(reader, tamanho_nome)).decode() if tamanho_nome else ""
+    return Cabecalho(opcode, flags, nome, id_requisicao, tamanho, checksum, rastreio)
+
+
+async def receber_exato(reader, tamanho):
+    """Recebe exatamente `tamanho` bytes do stream."""
+    try:
+        return await reader.readexactly(tamanho)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Conexão encerrada no meio de um quadro")
+
+
+async def receber_payload(reader, cab):
+    """Recebe o payload inteiro de um quadro em memória, verificando o checksum."""
+    payload = await receber_exato(reader, cab.tamanho)
+    protocolo.verificar_checksum(cab, zlib.crc32(payload))
+    return payload
+
+
+async def enviar_quadro(writer, opcode, nome="", payload=b"", id_requisicao=0, com_checksum=False):
+    """Envia um quadro completo (cabeçalho, nome e payload em memória)."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    flags, checksum = 0, 0
+    if com_checksum:
+        flags |= protocolo.FLAG_CHECKSUM
+        checksum = zlib.crc32(payload)
+    writer.write(protocolo.montar_cabecalho(opcode, nome, len(payload), id_requisicao, flags, checksum) + payload)
+    await writer.drain()
+
+
+async def reenviar_cabecalho(writer, cab, id_requisicao=None):
+    """Reenvia um cabeçalho recebido, mantendo flags e checksum."""
+    if id_requisicao is None:
+        id_requisicao = cab.id_requisicao
+    writer.write(protocolo.montar_cabecalho(cab.opcode, cab.nome, cab.tamanho, id_requisicao,
+                                            cab.flags, cab.checksum, cab.rastreio))
+    await writer.drain()
+
+
+async def repassar(reader, writer, tamanho, tamanho_bloco=protocolo.TAMANHO_BUFFER_RECEPCAO, tempo_limite=None):
+    """
+    Repassa exatamente `tamanho` bytes de um stream para outro, com contrapressão. Com
+    `tempo_limite`, uma leitura ou escrita parada por mais que isso (em segundos) levanta
+    TimeoutError, em vez de prender os dois streams indefinidamente.
+    """
+    restante = tamanho
+    while restante > 0:
+        dados = await asyncio.wait_for(reader.read(min(tamanho_bloco, restante)), tempo_limite)
+        if not dados:
+            raise ConnectionError("Conexão encerrada no meio da transferência")
+        writer.write(dados)
+        await asyncio.wait_for(writer.drain(), tempo_limite)  # Aguarda o destino consumir antes de ler mais
+        restante -= len(dados)
+
+
+async def descartar(reader, tamanho):
+    """Lê e descarta `tamanho` bytes (payload de um quadro que não será tratado)."""
+    restante = tamanho
+    while restante > 0:
+        dados = await reader.read(min(protocolo.TAMANHO_BLOCO, restante))
+        if not dados:
+            raise ConnectionError("Conexão encerrada no meio da transferência")
+        restante -= len(dados)
+
+
+async def receber_resposta(reader):
+    """
+    Recebe um quadro de resposta com payload textual.
+    Retorna uma tupla (sucesso, mensagem).
+    """
+    cab = await receber_cabecalho(reader)
+    if cab is None:
+        raise ConnectionError("Conexão encerrada antes da resposta")
+    mensagem = (await receber_payload(reader, cab)).decode()
+    return cab.opcode == protocolo.OK, mensagem
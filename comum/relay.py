@@ -0,0 +1,173 @@
+"""
+Motor de repasse (relay) de bytes entre dois sockets.
+
+No Linux, os dados são emendados com os.splice através de um pipe, ficando
+inteiramente no kernel. Nas demais plataformas (ou se o splice falhar), usa
+recv_into em um buffer grande reutilizado e sendall sobre memoryview, sem criar
+novos objetos bytes a cada bloco.
+"""
+import os
+import time
+from collections import namedtuple
+
+from comum import protocolo
+
+TAMANHO_PIPE = 1024 * 1024  # Capacidade solicitada para o pipe usado pelo splice
+
+Estatistica = namedtuple("Estatistica", "bytes segundos bytes_por_segundo")
+
+
+class Relay:
+    """
+    Repassa uma quantidade conhecida de bytes de um socket para outro.
+    Cada conexão deve ter o seu próprio Relay, pois o buffer e o pipe são reutilizados.
+    Com um `limitador` (objeto com consumir(bytes), como um balde de fichas), cada bloco
+    repassado é descontado dele, o que limita a vazão da conexão.
+    """
+
+    def __init__(self, tamanho_buffer=protocolo.TAMANHO_BUFFER_RECEPCAO, usar_splice=None, limitador=None):
+        # O buffer só é alocado na primeira transferência que precisar dele, para que
+        # conexões ociosas (ou que usam apenas o splice) não reservem memória
+        self.tamanho_buffer = tamanho_buffer
+        self.buffer = None
+        if usar_splice is None:
+            usar_splice = hasattr(os, "splice")
+        self.usar_splice = usar_splice
+        self.pipe = None
+        self.limitador = limitador
+
+    def _abrir_pipe(self):
+        """Cria (uma única vez) o pipe intermediário do splice, aumentando sua capacidade."""
+        if self.pipe is None:
+            leitura, escrita = os.pipe()
+            try:
+                import fcntl
+                fcntl.fcntl(escrita, fcntl.F_SETPIPE_SZ, TAMANHO_PIPE)
+            except (ImportError, AttributeError, OSError):
+                pass  # Mantém a capacidade padrão do pipe
+            self.pipe = (leitura, escrita)
+        return self.pipe
+
+    def fechar(self):
+        """Libera o pipe do splice, se tiver sido criado."""
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+    def ritmar(self, n):
+        """Desconta `n` bytes repassados do limitador, esperando se a conexão passou da sua taxa."""
+        if self.limitador is not None:
+            self.limitador.consumir(n)
+
+    def transferir(self, origem, destino, tamanho):
+        """
+        Repassa exatamente `tamanho` bytes de `origem` para `destino`.
+        Retorna uma Estatistica com bytes, duração e vazão da transferência.
+        """
+        inicio = time.perf_counter()
+        restante = tamanho
+        # O splice exige sockets bloqueantes (sem timeout); caso contrário usa o buffer
+        if self.usar_splice and origem.gettimeout() is None and destino.gettimeout() is None:
+            restante = self._transferir_splice(origem, destino, restante)
+        if restante:
+            self._transferir_buffer(origem, destino, restante)
+        segundos = time.perf_counter() - inicio
+        return Estatistica(tamanho, segundos, tamanho / segundos if segundos > 0 else 0.0)
+
+    def _transferir_splice(self, origem, destino, restante):
+        """
+        Repassa os bytes via socket -> pipe -> socket usando os.splice.
+        Se o primeiro splice não for suportado pelos descritores, desativa o splice
+        e devolve o restante para ser repassado pelo buffer.
+        """
+        leitura, escrita = self._abrir_pipe()
+        fd_origem, fd_destino = origem.fileno(), destino.fileno()
+        primeiro = True
+        while restante > 0:
+            try:
+                n = os.splice(fd_origem, escrita, min(TAMANHO_PIPE, restante))
+            except OSError as e:
+                if not primeiro or isinstance(e, ConnectionError):
+                    raise
+                self.usar_splice = False
+                self.fechar()
+                return restante
+            primeiro = False
+            if n == 0:
+                raise ConnectionError("Conexão encerrada no meio da transferência")
+            no_pipe = n
+            while no_pipe > 0:
+                no_pipe -= os.splice(leitura, fd_destino, no_pipe)
+            restante -= n
+            self.ritmar(n)
+        return restante
+
+    def transferir_para_varios(self, origem, destinos, tamanho):
+        """
+        Repassa exatamente `tamanho` bytes de `origem` para todos os `destinos` (por exemplo,
+        as réplicas de uma imagem), lendo a origem uma única vez. Um destino que falhar é
+        descartado sem interromper os demais. Retorna (Estatistica, índices dos destinos que falharam).
+        """
+        inicio = time.perf_counter()
+        if self.buffer is None:
+            self.buffer = protocolo.novo_buffer(self.tamanho_buffer)
+        visao = memoryview(self.buffer)
+        falhas = set()
+        restante = tamanho
+        while restante > 0:
+            n = origem.recv_into(visao[:min(self.tamanho_buffer, restante)])
+            if n == 0:
+                raise ConnectionError("Conexão encerrada no meio da transferência")
+            for i, destino in enumerate(destinos):
+                if i in falhas:
+                    continue
+                try:
+                    destino.sendall(visao[:n])
+                except OSError:
+                    falhas.add(i)
+            restante -= n
+            self.ritmar(n)
+        segundos = time.perf_counter() - inicio
+        return Estatistica(tamanho, segundos, tamanho / segundos if segundos > 0 else 0.0), falhas
+
+    def transferir_copiando(self, origem, destino, copia):
+        """
+        Repassa `len(copia)` bytes de `origem` para `destino`, recebendo-os diretamente na
+        área gravável `copia` (um bytearray ou um mmap), que fica com uma cópia do conteúdo.
+        Retorna uma Estatistica.
+        """
+        inicio = time.perf_counter()
+        tamanho = len(copia)
+        visao = memoryview(copia)
+        posicao = 0
+        while posicao < tamanho:
+            n = origem.recv_into(visao[posicao:min(posicao + self.tamanho_buffer, tamanho)])
+            if n == 0:
+                raise ConnectionError("Conexão encerrada no meio da transferência")
+            destino.sendall(visao[posicao:posicao + n])
+            posicao += n
+            self.ritmar(n)
+        visao.release()
+        segundos = time.perf_counter() - inicio
+        return Estatistica(tamanho, segundos, tamanho / segundos if segundos > 0 else 0.0)
+
+    def _transferir_buffer(self, origem, destino, restante):
+        """Repassa os bytes com recv_into no buffer reutilizado e sendall sobre memoryview."""
+        if self.buffer is None:
+            self.buffer = protocolo.novo_buffer(self.tamanho_buffer)
+        visao = memoryview(self.buffer)
+        tamanho_buffer = self.tamanho_buffer
+        while restante > 0:
+            n = origem.recv_into(visao[:min(tamanho_buffer, restante)])
+            if n == 0:
+                raise ConnectionError("Conexão encerrada no meio da transferência")
+            destino.sendall(visao[:n])
+            restante -= n
+            self.ritmar(n)
+
+
+def formatar_vazao(estatistica):
+    """Formata a vazão de uma transferência para as mensagens de depuração."""
+    return (f"{estatistica.bytes} bytes em {estatistica.segundos:.3f} s "
+            f"({estatistica.bytes_por_segundo / (1024 * 1024):.1f} MB/s)")
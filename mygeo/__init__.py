@@ -0,0 +1,31 @@
+"""
+Biblioteca cliente do MyGeo Eye, para scripts e pipelines de ingestão: as operações
+retornam valores (bytes, iteradores, leitores e escritores de arquivo) em vez de
+exibir mensagens, as conexões com o servidor são reutilizadas entre chamadas e as
+falhas de conexão são repetidas com espera crescente.
+
+    from mygeo import Client
+
+    with Client("localhost", 6000) as client:
+        client.upload_file("cenas/amazonia1.tif")
+        resultados = client.upload_many(["cenas/*.tif"])
+        for imagem in client.list(prefix="amazonia", order="data"):
+            print(imagem.nome, imagem.tamanho)
+        for cena in client.search((-60.0, -10.0, -50.0, 0.0), epsg=4326):
+            print(cena.nome, cena.data)
+        with client.open_download("amazonia1.tif") as leitor:
+            cabecalho = leitor.read(8)
+        client.download_delta("amazonia1.tif", "copias/amazonia1.tif")  # Só os blocos que mudaram
+
+AsyncClient é a variante asyncio; `python -m mygeo` é a linha de comando para
+tarefas em lote (veja `python -m mygeo --help`).
+"""
+from comum.delta import ResultadoDelta
+from comum.protocolo import CenaEncontrada, RegistroImagem, ResultadoLote
+from mygeo.assincrono import AsyncClient
+from mygeo.cliente import Client, expand_paths
+from mygeo.conexao import ServerBusy, ServerError
+from mygeo.fluxos import DownloadReader, UploadWriter
+
+__all__ = ["AsyncClient", "CenaEncontrada", "Client", "DownloadReader", "RegistroImagem", "ResultadoDelta", "ResultadoLote",
+           "ServerBusy", "ServerError", "UploadWriter", "expand_paths"]
@@ -0,0 +1,241 @@
+"""
+Linha de comando do MyGeo Eye para tarefas em lote, sem o menu interativo.
+
+Os subcomandos têm os nomes dos comandos do protocolo. Onde se esperam arquivos ou
+nomes de imagens, "-" lê a lista da entrada padrão (um por linha), o que permite
+encadear os comandos em pipelines. Cada arquivo gera uma linha "ok" ou "erro" (ou um
+objeto JSON com --json), e o código de saída é 1 se algum deles falhou.
+
+Exemplos:
+    python -m mygeo upload cenas/*.tif cenas/2024/
+    python -m mygeo list --prefixo amazonia --ordem data --json
+    python -m mygeo list --somente-nomes | python -m mygeo download - -d copias/
+    python -m mygeo download --delta amazonia1.tif -d copias/
+    python -m mygeo busca -60 -10 -50 0 --epsg 4326 --desde 2024-01-01 --somente-nomes
+    python -m mygeo miniatura amazonia1.tif --lado 512 -o amazonia1.png
+    python -m mygeo calculo amazonia1.tif ndvi --bandas 3 4 --janela 0 0 1024 1024
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timezone
+
+from comum import protocolo
+from mygeo.cliente import ORDENS, Client, expand_paths
+from mygeo.conexao import ServerError
+
+
+def ler_entradas(valores):
+    """Expande "-" nas linhas (não vazias) da entrada padrão."""
+    entradas = []
+    for valor in valores:
+        if valor == "-":
+            entradas.extend(linha.strip() for linha in sys.stdin if linha.strip())
+        else:
+            entradas.append(valor)
+    return entradas
+
+
+def exibir_resultados(resultados, como_json):
+    """Exibe o resultado de cada arquivo. Retorna o código de saída (1 se algum falhou)."""
+    for resultado in resultados:
+        if como_json:
+            print(json.dumps(resultado._asdict(), ensure_ascii=False))
+        else:
+            print(f"{'ok' if resultado.sucesso else 'erro'}\t{resultado.nome}\t{resultado.mensagem}")
+    return 0 if all(resultado.sucesso for resultado in resultados) else 1
+
+
+def sincronizar(nome, transferir):
+    """Resultado (ResultadoLote) de uma transferência delta, com os bytes que atravessaram a rede."""
+    try:
+        resultado = transferir()
+    except (OSError, ServerError, protocolo.ErroProtocolo) as e:
+        return protocolo.ResultadoLote(nome, False, str(e))
+    return protocolo.ResultadoLote(nome, True, f"{resultado.transferidos} de {resultado.tamanho} bytes transferidos")
+
+
+def comando_upload(cliente, args):
+    arquivos = ler_entradas(args.arquivos)
+    if args.delta:
+        return exibir_resultados([sincronizar(os.path.basename(caminho), lambda: cliente.upload_delta(caminho))
+                                  for caminho in expand_paths(arquivos)], args.json)
+    return exibir_resultados(cliente.upload_many(arquivos), args.json)
+
+
+def comando_download(cliente, args):
+    nomes = ler_entradas(args.nomes)
+    if args.delta:
+        os.makedirs(args.diretorio, exist_ok=True)
+        return exibir_resultados([sincronizar(nome, lambda: cliente.download_delta(
+            nome, os.path.join(args.diretorio, os.path.basename(nome)))) for nome in nomes], args.json)
+    return exibir_resultados(cliente.download_many(nomes, args.diretorio), args.json)
+
+
+def comando_delete(cliente, args):
+    return exibir_resultados(cliente.delete_many(ler_entradas(args.nomes)), args.json)
+
+
+def comando_list(cliente, args):
+    for quantidade, imagem in enumerate(cliente.list(args.prefixo, args.ordem, args.decrescente), 1):
+        if args.somente_nomes:
+            print(imagem.nome)
+        elif args.json:
+            print(json.dumps(imagem._asdict(), ensure_ascii=False))
+        else:
+            enviada = datetime.fromtimestamp(imagem.enviado_em).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{imagem.nome}\t{imagem.tamanho}\t{enviada}")
+        if quantidade == args.limite:
+            break
+    return 0
+
+
+def data_utc(texto):
+    """Data ISO (AAAA-MM-DD ou AAAA-MM-DDTHH:MM:SS), tomada como UTC, em segundos desde a época."""
+    try:
+        data = datetime.fromisoformat(texto)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"data inválida: {texto!r}")
+    if data.tzinfo is None:
+        data = data.replace(tzinfo=timezone.utc)
+    return data.timestamp()
+
+
+def comando_busca(cliente, args):
+    cenas = cliente.search((args.x_min, args.y_min, args.x_max, args.y_max), args.desde, args.ate, args.epsg)
+    for quantidade, cena in enumerate(cenas, 1):
+        if args.somente_nomes:
+            print(cena.nome)
+        elif args.json:
+            print(json.dumps(cena._asdict(), ensure_ascii=False))
+        else:
+            data = datetime.fromtimestamp(cena.data, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{cena.nome}\t{cena.epsg}\t{cena.x_min:g} {cena.y_min:g} {cena.x_max:g} {cena.y_max:g}\t{data}")
+        if quantidade == args.limite:
+            break
+    return 0
+
+
+def comando_tamanho(cliente, args):
+    print(cliente.size(args.nome))
+    return 0
+
+
+def gravar_previa(png, saida):
+    with open(saida, "wb") as f:
+        f.write(png)
+    print(saida)
+    return 0
+
+
+def comando_miniatura(cliente, args):
+    saida = args.saida or f"{os.path.splitext(args.nome)[0]}_miniatura_{args.lado}.png"
+    return gravar_previa(cliente.thumbnail(args.nome, args.lado), saida)
+
+
+def comando_ladrilho(cliente, args):
+    saida = args.saida or f"{os.path.splitext(args.nome)[0]}_{args.z}_{args.x}_{args.y}.png"
+    return gravar_previa(cliente.tile(args.nome, args.z, args.x, args.y), saida)
+
+
+def comando_calculo(cliente, args):
+    resultado = cliente.compute(args.nome, args.operacao, args.janela, args.bandas, args.classes, args.limiar)
+    print(json.dumps(resultado, ensure_ascii=False, indent=None if args.json else 2))
+    return 0
+
+
+def comando_estatisticas(cliente, args):
+    print(json.dumps(cliente.stats(), ensure_ascii=False, indent=2))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m mygeo", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--porta", type=int, default=6000)
+    parser.add_argument("--tentativas", type=int, default=3, help="Novas tentativas após falhas de conexão")
+    parser.add_argument("--sem-compressao", action="store_true", help="Não negocia compressão com o servidor")
+    parser.add_argument("--json", action="store_true", help="Uma linha JSON por resultado")
+    subcomandos = parser.add_subparsers(dest="comando", required=True)
+
+    sub = subcomandos.add_parser("upload", help="Envia arquivos, diretórios ou padrões glob (em lotes MUPLOAD)")
+    sub.add_argument("arquivos", nargs="+")
+    sub.add_argument("--delta", action="store_true",
+                     help="Envia só os trechos que mudaram em relação às versões já armazenadas (um arquivo por vez)")
+    sub.set_defaults(funcao=comando_upload)
+
+    sub = subcomandos.add_parser("download", help="Baixa imagens (em lotes MDOWNLOAD)")
+    sub.add_argument("nomes", nargs="+")
+    sub.add_argument("-d", "--diretorio", default=".", help="Diretório de destino")
+    sub.add_argument("--delta", action="store_true",
+                     help="Atualiza as cópias já presentes no diretório baixando só os blocos que mudaram")
+    sub.set_defaults(funcao=comando_download)
+
+    sub = subcomandos.add_parser("delete", help="Remove imagens (em lotes MDELETE)")
+    sub.add_argument("nomes", nargs="+")
+    sub.set_defaults(funcao=comando_delete)
+
+    sub = subcomandos.add_parser("list", help="Lista as imagens")
+    sub.add_argument("--prefixo", default="")
+    sub.add_argument("--ordem", choices=sorted(ORDENS), default="nome")
+    sub.add_argument("--decrescente", action="store_true")
+    sub.add_argument("--limite", type=int, help="Número máximo de imagens listadas")
+    sub.add_argument("--somente-nomes", action="store_true", help="Só os nomes (para encadear com download/delete)")
+    sub.set_defaults(funcao=comando_list)
+
+    sub = subcomandos.add_parser("busca", help="Cenas cuja extensão intersecta uma caixa (bounding box)")
+    for coordenada in ("x_min", "y_min", "x_max", "y_max"):
+        sub.add_argument(coordenada, type=float)
+    sub.add_argument("--epsg", type=int, default=0, help="Sistema de referência da caixa (0: compara com todos)")
+    sub.add_argument("--desde", type=data_utc, help="Data mínima da cena (ISO, UTC)")
+    sub.add_argument("--ate", type=data_utc, help="Data máxima da cena (ISO, UTC)")
+    sub.add_argument("--limite", type=int, help="Número máximo de cenas listadas")
+    sub.add_argument("--somente-nomes", action="store_true", help="Só os nomes (para encadear com download/delete)")
+    sub.set_defaults(funcao=comando_busca)
+
+    sub = subcomandos.add_parser("tamanho", help="Tamanho de uma imagem, em bytes")
+    sub.add_argument("nome")
+    sub.set_defaults(funcao=comando_tamanho)
+
+    sub = subcomandos.add_parser("miniatura", help="Miniatura PNG de uma cena")
+    sub.add_argument("nome")
+    sub.add_argument("--lado", type=int, default=256)
+    sub.add_argument("-o", "--saida")
+    sub.set_defaults(funcao=comando_miniatura)
+
+    sub = subcomandos.add_parser("ladrilho", help="Ladrilho PNG (z, x, y) de uma cena")
+    sub.add_argument("nome")
+    sub.add_argument("z", type=int)
+    sub.add_argument("x", type=int)
+    sub.add_argument("y", type=int)
+    sub.add_argument("-o", "--saida")
+    sub.set_defaults(funcao=comando_ladrilho)
+
+    sub = subcomandos.add_parser("calculo", help="Análise de uma cena feita no cluster, sem baixá-la")
+    sub.add_argument("nome")
+    sub.add_argument("operacao", choices=sorted(protocolo.OPERACOES_CALCULO))
+    sub.add_argument("--janela", type=int, nargs=4, metavar=("X", "Y", "LARGURA", "ALTURA"),
+                     help="Janela da cena, em pixels (padrão: a cena inteira)")
+    sub.add_argument("--bandas", type=int, nargs="+", default=[1, 2],
+                     help="Bandas vermelho e infravermelho do NDVI, ou a banda da máscara de nuvens (a partir de 1)")
+    sub.add_argument("--classes", type=int, default=256, help="Classes dos histogramas")
+    sub.add_argument("--limiar", type=float, default=0.0, help="Valor a partir do qual um pixel é nuvem")
+    sub.set_defaults(funcao=comando_calculo)
+
+    sub = subcomandos.add_parser("estatisticas", help="Estatísticas do servidor")
+    sub.set_defaults(funcao=comando_estatisticas)
+
+    args = parser.parse_args(argv)
+    with Client(args.host, args.porta, pool_size=1, retries=args.tentativas,
+                compression=not args.sem_compressao) as cliente:
+        try:
+            return args.funcao(cliente, args)
+        except (ServerError, protocolo.ErroProtocolo, OSError) as e:
+            print(f"Erro: {e}", file=sys.stderr)
+            return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
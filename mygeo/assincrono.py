@@ -0,0 +1,239 @@
+import asyncio
+import json
+import os
+import zlib
+from contextlib import asynccontextmanager
+
+from comum import protocolo, protocolo_async
+from mygeo.cliente import ORDENS
+from mygeo.conexao import ERROS_CONEXAO, TENTATIVAS, ServerBusy, ServerError, raise_for_response, retry_delay
+
+TAMANHO_BLOCO_ARQUIVO = 1024 * 1024  # Bytes lidos do socket por vez ao gravar um download em arquivo
+
+
+class AsyncConnection:
+    """Uma conexão asyncio com o servidor. As transferências desta variante seguem sem compressão."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port):
+        # O asyncio já desativa o algoritmo de Nagle nas conexões TCP
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def receive(self):
+        """Recebe uma resposta com o payload em memória. Retorna (cabeçalho, payload)."""
+        cab = await self.receive_header()
+        return cab, await protocolo_async.receber_payload(self.reader, cab)
+
+    async def receive_header(self):
+        cab = await protocolo_async.receber_cabecalho(self.reader)
+        if cab is None:
+            raise ConnectionError("Conexão encerrada antes da resposta")
+        return cab
+
+    async def request(self, opcode, name="", payload=b""):
+        await protocolo_async.enviar_quadro(self.writer, opcode, name, payload)
+        return await self.receive()
+
+    def closed_by_server(self):
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+
+def check(cab, payload):
+    """Retorna o payload de uma resposta OK; uma resposta ERRO vira ServerError (OCUPADO, ServerBusy)."""
+    raise_for_response(cab, payload)
+    return payload
+
+
+class AsyncClient:
+    """
+    Variante asyncio do mygeo.Client, para pipelines que já rodam num laço de eventos:
+    várias operações podem ser disparadas ao mesmo tempo (asyncio.gather) e usam até
+    `pool_size` conexões reutilizadas. As falhas de conexão são repetidas como no Client.
+    """
+
+    def __init__(self, host="localhost", port=6000, pool_size=4, retries=TENTATIVAS):
+        self.host = host
+        self.port = port
+        self.retries = retries
+        self.slots = asyncio.Semaphore(pool_size)
+        self.idle = []
+
+    @asynccontextmanager
+    async def _connection(self):
+        async with self.slots:
+            conn = None
+            while self.idle and conn is None:
+                conn = self.idle.pop()
+                if conn.closed_by_server():
+                    conn.close()
+                    conn = None
+            if conn is None:
+                conn = await AsyncConnection.open(self.host, self.port)
+            try:
+                yield conn
+            except ServerError:
+                self.idle.append(conn)  # A resposta de erro foi lida inteira
+                raise
+            except BaseException:
+                conn.close()  # Pode ter ficado no meio de um quadro
+                raise
+            self.idle.append(conn)
+
+    async def _call(self, operation, retries=None):
+        """
+        Executa `await operation(conexão)`, repetindo com outra conexão após falhas de conexão
+        e respostas OCUPADO.
+        """
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                async with self._connection() as conn:
+                    return await operation(conn)
+            except (*ERROS_CONEXAO, ServerBusy) as e:
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(retry_delay(attempt, e))
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *excecao):
+        await self.close()
+
+    async def upload(self, name, data):
+        """Envia uma imagem (bytes) com o nome `name`. Retorna a confirmação do servidor."""
+        data = bytes(data)
+
+        async def operation(conn):
+            await protocolo_async.enviar_quadro(conn.writer, protocolo.UPLOAD, name, data, com_checksum=True)
+            return check(*await conn.receive()).decode()
+        return await self._call(operation)
+
+    async def upload_file(self, path, name=None):
+        """
+        Envia o arquivo `path` (com o seu nome de arquivo, ou `name`), entregue ao kernel
+        com sendfile pelo laço de eventos. Retorna a confirmação do servidor.
+        """
+        name = name or os.path.basename(path)
+        checksum = await asyncio.to_thread(protocolo.calcular_checksum_arquivo, path)
+
+        async def operation(conn):
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                conn.writer.write(protocolo.montar_cabecalho(protocolo.UPLOAD, name, size,
+                                                             flags=protocolo.FLAG_CHECKSUM, checksum=checksum))
+                await conn.writer.drain()
+                if size:
+                    await asyncio.get_running_loop().sendfile(conn.writer.transport, f, 0, size)
+            return check(*await conn.receive()).decode()
+        return await self._call(operation)
+
+    async def _open_download(self, conn, name):
+        await protocolo_async.enviar_quadro(conn.writer, protocolo.DOWNLOAD, name)
+        cab = await conn.receive_header()
+        if cab.opcode != protocolo.OK:
+            check(cab, await protocolo_async.receber_payload(conn.reader, cab))
+        return cab
+
+    async def download(self, name):
+        """Baixa uma imagem inteira para a memória. Retorna os seus bytes."""
+        async def operation(conn):
+            cab = await self._open_download(conn, name)
+            return await protocolo_async.receber_payload(conn.reader, cab)
+        return await self._call(operation)
+
+    async def download_to(self, name, path):
+        """Baixa uma imagem para o arquivo `path` (via temporário). Retorna o tamanho da imagem."""
+        async def operation(conn):
+            cab = await self._open_download(conn, name)
+            temporary = os.fspath(path) + ".parcial"
+            try:
+                with open(temporary, "wb") as f:
+                    restante, checksum = cab.tamanho, 0
+                    while restante > 0:
+                        dados = await conn.reader.read(min(TAMANHO_BLOCO_ARQUIVO, restante))
+                        if not dados:
+                            raise ConnectionError("Conexão encerrada no meio do download")
+                        f.write(dados)
+                        checksum = zlib.crc32(dados, checksum)
+                        restante -= len(dados)
+                protocolo.verificar_checksum(cab, checksum)
+            except BaseException:
+                os.remove(temporary)
+                raise
+            os.replace(temporary, path)
+            return cab.tamanho
+        return await self._call(operation)
+
+    async def size(self, name):
+        """Tamanho da imagem, em bytes."""
+        payload = await self._call(lambda conn: self._request(conn, protocolo.TAMANHO, name))
+        return protocolo.DESLOCAMENTO.unpack(payload)[0]
+
+    async def thumbnail(self, name, size=256):
+        """Miniatura PNG da cena, com o maior lado de até `size` pixels."""
+        return await self._call(lambda conn: self._request(conn, protocolo.MINIATURA, name,
+                                                           protocolo.LADO_MINIATURA.pack(size)))
+
+    async def tile(self, name, z, x, y):
+        """Ladrilho PNG (z, x, y) da pirâmide sobre a cena."""
+        return await self._call(lambda conn: self._request(conn, protocolo.LADRILHO, name,
+                                                           protocolo.POSICAO_LADRILHO.pack(z, x, y)))
+
+    async def compute(self, name, operation="estatisticas", window=None, bands=(1, 2), bins=256, threshold=0.0):
+        """Análise da cena feita no cluster, como um dicionário (ver Client.compute)."""
+        parameters = protocolo.empacotar_calculo(protocolo.OPERACOES_CALCULO[operation], window, bands[0], bands[-1],
+                                                 bins, threshold)
+        return json.loads(await self._call(lambda conn: self._request(conn, protocolo.CALCULO, name, parameters)))
+
+    @staticmethod
+    async def _request(conn, opcode, name="", payload=b""):
+        return check(*await conn.request(opcode, name, payload))
+
+    async def list(self, prefix="", order="nome", descending=False, page_size=protocolo.LIMITE_LISTAGEM):
+        """Itera (async for) pelas imagens cujo nome começa com `prefix`, página por página."""
+        order = ORDENS.get(order, order)
+        cursor = None
+        while True:
+            parameters = protocolo.empacotar_listagem(order, descending, page_size, cursor)
+            page = protocolo.desempacotar_registros(await self._call(
+                lambda conn: self._request(conn, protocolo.LIST, prefix, parameters)))
+            if not page:
+                return
+            for image in page:
+                yield image
+            cursor = protocolo.cursor_registro(page[-1], order)
+
+    async def search(self, bbox, start=None, end=None, epsg=0, page_size=protocolo.LIMITE_LISTAGEM):
+        """Itera (async for) pelas cenas que intersectam `bbox`, página por página (ver Client.search)."""
+        parameters = protocolo.empacotar_busca(bbox, start, end, epsg, page_size)
+        cursor = ""
+        while True:
+            page = protocolo.desempacotar_cenas(await self._call(
+                lambda conn: self._request(conn, protocolo.BUSCA, cursor, parameters)))
+            if not page:
+                return
+            for scene in page:
+                yield scene
+            cursor = page[-1].nome
+
+    async def delete(self, name):
+        """Remove uma imagem de todas as réplicas. Retorna a confirmação do servidor."""
+        return (await self._call(lambda conn: self._request(conn, protocolo.DELETE, name))).decode()
+
+    async def stats(self):
+        """Estatísticas do servidor, como um dicionário."""
+        return json.loads(await self._call(lambda conn: self._request(conn, protocolo.ESTATISTICAS)))
@@ -0,0 +1,601 @@
+import glob
+import io
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from comum import compressao, delta, protocolo
+from mygeo.conexao import TENTATIVAS, ConnectionPool, ServerError, call, call_holding
+from mygeo.fluxos import DownloadReader, UploadWriter
+
+TAMANHO_ACUMULO_COMPRIMIDO = 64 * 1024 * 1024  # Bytes comprimidos mantidos em memória antes de irem para o disco
+TAMANHO_INTERVALO_DELTA = 4 * 1024 * 1024  # Bytes pedidos por DOWNLOAD_INTERVALO num download delta
+TAMANHO_PEDACO = 8 * 1024 * 1024  # Pedaços das transferências em pedaços (paralelas e retomáveis)
+CONEXOES_PARALELAS = 4  # Conexões usadas ao mesmo tempo pelas transferências paralelas
+
+ORDENS = {"nome": protocolo.ORDEM_NOME, "tamanho": protocolo.ORDEM_TAMANHO, "data": protocolo.ORDEM_DATA}
+
+
+def expand_paths(sources):
+    """
+    Arquivos indicados por caminhos, diretórios (os arquivos de primeiro nível) ou padrões
+    glob (por exemplo, "cenas/**/*.tif"), na ordem dada e sem repetições.
+    """
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            found = [os.path.join(source, name) for name in sorted(os.listdir(source))]
+        elif glob.has_magic(source):
+            found = sorted(glob.glob(source, recursive=True))
+        else:
+            found = [source]  # Um arquivo inexistente aparece como falha no resultado do lote
+        paths.extend(path for path in found if not os.path.isdir(path))
+    return list(dict.fromkeys(paths))
+
+
+class Client:
+    """
+    Cliente do MyGeo Eye para scripts e pipelines. Cada operação usa uma conexão do pool
+    (aberta na primeira vez e reutilizada depois) e retorna o seu resultado; respostas ERRO
+    do servidor viram ServerError, e falhas de conexão são repetidas com outra conexão (as
+    respostas OCUPADO também, após a espera sugerida pelo servidor). Pode ser usado por
+    várias threads ao mesmo tempo (até `pool_size` operações simultâneas).
+    """
+
+    def __init__(self, host="localhost", port=6000, pool_size=4, retries=TENTATIVAS, compression=True,
+                 timeout=None):
+        self.pool = ConnectionPool(host, port, pool_size, compression, timeout)
+        self.retries = retries
+
+    def _call(self, operation, retries=None):
+        return call(self.pool, operation, self.retries if retries is None else retries)
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excecao):
+        self.close()
+
+    # Upload
+
+    def _send_upload(self, conn, name, f, start, size):
+        """
+        Envia o quadro UPLOAD com o restante do arquivo aberto `f` (`size` bytes a partir de
+        `start`), comprimido com o codec negociado se isso diminuir o envio. Não lê a resposta.
+        """
+        if conn.codecs and size:
+            f.seek(start)
+            with tempfile.SpooledTemporaryFile(max_size=TAMANHO_ACUMULO_COMPRIMIDO) as compressed:
+                codec, checksum = compressao.comprimir(f, compressed, conn.codecs[0])
+                compressed_size = compressed.tell()
+                if codec != compressao.NENHUM and compressed_size < size:
+                    conn.socket.sendall(protocolo.montar_cabecalho(
+                        protocolo.UPLOAD, name, compressed_size,
+                        flags=protocolo.FLAG_COMPRIMIDO | protocolo.FLAG_CHECKSUM, checksum=checksum))
+                    protocolo.enviar_trecho(conn.socket, compressed, 0, compressed_size)
+                    return
+        f.seek(start)
+        checksum = protocolo.calcular_checksum(f)
+        conn.socket.sendall(protocolo.montar_cabecalho(protocolo.UPLOAD, name, size,
+                                                       flags=protocolo.FLAG_CHECKSUM, checksum=checksum))
+        protocolo.enviar_trecho(conn.socket, f, start, size)
+
+    def upload(self, name, data):
+        """
+        Envia uma imagem com o nome `name`. `data` são bytes ou um arquivo aberto em modo
+        binário (enviado da posição atual até o fim). Retorna a confirmação do servidor.
+        """
+        f = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+        start = f.tell()
+        size = f.seek(0, os.SEEK_END) - start
+
+        def operation(conn):
+            self._send_upload(conn, name, f, start, size)
+            return conn.check(*conn.receive()).decode()
+        return self._call(operation)
+
+    def upload_file(self, path, name=None):
+        """Envia o arquivo `path` (com o seu nome de arquivo, ou `name`). Retorna a confirmação."""
+        with open(path, "rb") as f:
+            return self.upload(name or os.path.basename(path), f)
+
+    def upload_delta(self, path, name=None):
+        """
+        Envia o arquivo `path` (com o seu nome de arquivo, ou `name`) como delta da versão já
+        armazenada: só os trechos que mudaram atravessam a rede, e nada é enviado se as duas
+        versões forem iguais. Sem versão armazenada, ou se o delta for recusado (a imagem
+        mudou nesse meio tempo, ou uma réplica tem outra versão), o arquivo segue inteiro.
+        Retorna um delta.ResultadoDelta.
+        """
+        name = name or os.path.basename(path)
+        with open(path, "rb") as f:
+            local = delta.assinar(f)
+            try:
+                stored = self._signatures(name, local.resumo)
+            except ServerError:
+                stored = None  # Imagem ainda não armazenada
+            if stored is not None and stored.resumo == local.resumo:
+                return delta.ResultadoDelta(local.tamanho, 0, local.tamanho)
+            if stored is not None:
+                with delta.mapear(f) as data:
+                    instructions = delta.instrucoes(data, stored)
+                size = delta.tamanho_payload(instructions)
+                if size < local.tamanho:
+                    f.seek(0)
+                    preamble = protocolo.PREAMBULO_DELTA.pack(stored.resumo, local.tamanho,
+                                                              protocolo.calcular_checksum(f))
+                    try:
+                        self._call(lambda conn: self._send_delta(conn, name, f, size, preamble, instructions))
+                    except ServerError:
+                        pass
+                    else:
+                        new = sum(last - first for kind, first, last in instructions
+                                  if kind == protocolo.DELTA_LITERAL)
+                        return delta.ResultadoDelta(local.tamanho, size, local.tamanho - new)
+            f.seek(0)
+            self.upload(name, f)
+            return delta.ResultadoDelta(local.tamanho, local.tamanho, 0)
+
+    @staticmethod
+    def _send_delta(conn, name, f, size, preamble, instructions):
+        """Envia o UPLOAD_DELTA: as cópias vão juntas num sendall, e os trechos novos com sendfile."""
+        pending = bytearray(protocolo.montar_cabecalho(protocolo.UPLOAD_DELTA, name, size) + preamble)
+        for kind, first, last in instructions:
+            if kind == protocolo.DELTA_COPIA:
+                pending += protocolo.COPIA_DELTA.pack(kind, first, last)
+                continue
+            pending += protocolo.LITERAL_DELTA.pack(kind, last - first)
+            conn.socket.sendall(pending)
+            pending.clear()
+            protocolo.enviar_trecho(conn.socket, f, first, last - first)
+        conn.socket.sendall(pending)
+        return conn.check(*conn.receive())
+
+    def _signatures(self, name, digest=b""):
+        """
+        Assinaturas dos blocos da imagem armazenada (delta.Assinaturas), sem os blocos se
+        `digest` for o resumo dela.
+        """
+        return delta.desempacotar_assinaturas(self._call(
+            lambda conn: conn.check(*conn.request(protocolo.ASSINATURAS, name, digest))))
+
+    def open_upload(self, name, size=None):
+        """
+        Abre um UploadWriter para enviar a imagem aos poucos (por exemplo, gerada em
+        memória por outro programa). Use como gerenciador de contexto: a imagem é
+        publicada ao fechar, e descartada se o bloco terminar com uma exceção.
+        """
+        return UploadWriter(self, name, size)
+
+    def upload_many(self, sources):
+        """
+        Envia vários arquivos com MUPLOAD (um lote de até LIMITE_LOTE arquivos por ida e volta).
+        `sources` são caminhos, diretórios ou padrões glob. Retorna um protocolo.ResultadoLote
+        por arquivo, na ordem.
+        """
+        paths = expand_paths(sources)
+        results = {path: protocolo.ResultadoLote(os.path.basename(path), False, "Arquivo não encontrado")
+                   for path in paths if not os.path.isfile(path)}
+        existing = [path for path in paths if path not in results]
+        for start in range(0, len(existing), protocolo.LIMITE_LOTE):
+            batch = existing[start:start + protocolo.LIMITE_LOTE]
+            # O servidor responde com um resultado por arquivo, na ordem do envio
+            results.update(zip(batch, self._call(lambda conn: self._upload_batch(conn, batch))))
+        return [results[path] for path in paths]
+
+    def _upload_batch(self, conn, paths):
+        conn.check(*conn.request(protocolo.MUPLOAD, payload=protocolo.QUANTIDADE_LOTE.pack(len(paths))))
+        # O servidor aceitou o lote: os arquivos seguem sem esperar resposta, que vem toda no fim
+        for path in paths:
+            with open(path, "rb") as f:
+                self._send_upload(conn, os.path.basename(path), f, 0, os.fstat(f.fileno()).st_size)
+        return protocolo.desempacotar_resultados(conn.check(*conn.receive()))
+
+    # Transferências em pedaços
+
+    @staticmethod
+    def _chunks(size, chunk_size):
+        """Divide `size` bytes em pedaços (deslocamento, comprimento)."""
+        return [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+
+    @staticmethod
+    def _run_parallel(task, arguments, streams):
+        """
+        Executa task(*argumentos) para cada item de `arguments`, em até `streams` threads (cada
+        uma com uma conexão do pool). A primeira falha cancela os itens ainda não iniciados e é
+        levantada.
+        """
+        executor = ThreadPoolExecutor(max_workers=max(1, min(streams, len(arguments))))
+        try:
+            for future in [executor.submit(task, *item) for item in arguments]:
+                future.result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _send_chunk(self, path, name, offset, length):
+        """Envia um UPLOAD_PEDACO com um trecho do arquivo (aberto por pedaço: as threads não dividem a posição)."""
+        def operation(conn):
+            with open(path, "rb") as f:
+                protocolo.enviar_pedaco(conn.socket, protocolo.UPLOAD_PEDACO, name, f, offset, length)
+            return conn.check(*conn.receive())
+        self._call(operation)
+
+    def _finish_chunks(self, name, checksum):
+        """Pede ao cluster que confira o CRC32 do arquivo montado e o publique. Retorna a confirmação."""
+        return self._call(lambda conn: conn.check(*conn.request(
+            protocolo.UPLOAD_FIM, name, protocolo.CHECKSUM.pack(checksum)))).decode()
+
+    def upload_parallel(self, path, name=None, streams=CONEXOES_PARALELAS, chunk_size=TAMANHO_PEDACO):
+        """
+        Envia o arquivo `path` em pedaços, por até `streams` conexões ao mesmo tempo: o cluster
+        grava cada pedaço na sua posição e só publica a imagem quando todos chegarem. Um pedaço
+        que falha é repetido sozinho. Retorna a confirmação do servidor.
+        """
+        name = name or os.path.basename(path)
+        size = os.path.getsize(path)
+        checksum = protocolo.calcular_checksum_arquivo(path)
+        # Reserva no cluster o arquivo temporário com o tamanho final
+        self._call(lambda conn: conn.check(*conn.request(protocolo.UPLOAD_INICIO, name,
+                                                         protocolo.DESLOCAMENTO.pack(size))))
+        self._run_parallel(lambda offset, length: self._send_chunk(path, name, offset, length),
+                           self._chunks(size, chunk_size), streams)
+        return self._finish_chunks(name, checksum)
+
+    def upload_resumable(self, path, name=None, chunk_size=TAMANHO_PEDACO):
+        """
+        Envia o arquivo `path` em pedaços sequenciais, que o cluster registra à medida que
+        chegam. Uma nova chamada, mesmo depois de uma falha ou noutra execução, continua do
+        último pedaço confirmado em vez de recomeçar do byte 0. Retorna a confirmação do servidor.
+        """
+        name = name or os.path.basename(path)
+        size = os.path.getsize(path)
+        checksum = protocolo.calcular_checksum_arquivo(path)
+        # Pergunta ao cluster quantos bytes deste arquivo já foram recebidos
+        offset, = protocolo.DESLOCAMENTO.unpack(self._call(lambda conn: conn.check(*conn.request(
+            protocolo.UPLOAD_RETOMAR, name, protocolo.DESLOCAMENTO.pack(size)))))
+        while offset < size:
+            length = min(chunk_size, size - offset)
+            self._send_chunk(path, name, offset, length)
+            offset += length
+        return self._finish_chunks(name, checksum)
+
+    def upload_dedup(self, path, name=None, streams=CONEXOES_PARALELAS, chunk_size=protocolo.TAMANHO_BLOCO_DEDUP):
+        """
+        Envia o arquivo `path` deduplicado: primeiro os resumos BLAKE2b dos seus blocos e depois,
+        por até `streams` conexões, só os blocos que o cluster ainda não tem. Se o cluster não
+        deduplicar, o arquivo segue inteiro. Retorna a confirmação do servidor.
+        """
+        name = name or os.path.basename(path)
+        chunks = self._chunks(os.path.getsize(path), chunk_size)
+        with open(path, "rb") as f:
+            digests = [protocolo.novo_resumo(f.read(length)).digest() for _, length in chunks]
+        request = b"".join(protocolo.BLOCO_INFO.pack(digest, length) for digest, (_, length) in zip(digests, chunks))
+        try:
+            missing = protocolo.desempacotar_indices(self._call(lambda conn: conn.check(*conn.request(
+                protocolo.BLOCOS_CONSULTAR, name, request))))
+        except ServerError:
+            return self.upload_file(path, name)  # Deduplicação desativada no cluster
+
+        def send_block(offset, length, digest):
+            def operation(conn):
+                with open(path, "rb") as f:
+                    protocolo.enviar_bloco(conn.socket, name, digest, f, offset, length)
+                return conn.check(*conn.receive())
+            self._call(operation)
+        self._run_parallel(send_block, [chunks[i] + (digests[i],) for i in missing], streams)
+        # Todos os blocos estão no cluster: ele publica o manifesto da imagem (o CRC32 vai para o índice)
+        return self._finish_chunks(name, protocolo.calcular_checksum_arquivo(path))
+
+    def download_parallel(self, name, path, streams=CONEXOES_PARALELAS, chunk_size=TAMANHO_PEDACO):
+        """
+        Baixa a imagem para `path` por intervalos, em até `streams` conexões ao mesmo tempo.
+        Cada intervalo é gravado na sua posição de um arquivo temporário, renomeado para
+        `path` no fim. Retorna o tamanho da imagem.
+        """
+        size = self.size(name)
+        temporary = os.fspath(path) + ".parcial"
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+
+            def receive(offset, length):
+                def operation(conn):
+                    conn.send(protocolo.DOWNLOAD_INTERVALO, name, protocolo.INTERVALO.pack(offset, length))
+                    cab = protocolo.receber_cabecalho_resposta(conn.socket)
+                    if cab.opcode != protocolo.OK:
+                        conn.check(cab, protocolo.receber_payload(conn.socket, cab))
+                    if cab.tamanho != length:
+                        protocolo.descartar(conn.socket, cab.tamanho)
+                        raise ServerError(f"A imagem {name} mudou durante o download")
+                    protocolo.receber_em_posicao(conn.socket, fd, offset, length, conn.buffer)
+                self._call(operation)
+            self._run_parallel(receive, self._chunks(size, chunk_size), streams)
+        except BaseException:
+            os.close(fd)
+            os.remove(temporary)
+            raise
+        os.close(fd)
+        os.replace(temporary, path)
+        return size
+
+    def download_resumable(self, name, path, chunk_size=TAMANHO_PEDACO):
+        """
+        Baixa a imagem para `path` por intervalos sequenciais, acrescentados a um arquivo
+        temporário. Uma nova chamada, mesmo depois de uma falha ou noutra execução, pede só
+        o que falta a partir do tamanho do temporário. Retorna o tamanho da imagem.
+        """
+        size = self.size(name)
+        temporary = os.fspath(path) + ".parcial"
+        with open(temporary, "ab") as f:
+            if f.seek(0, os.SEEK_END) > size:
+                f.truncate(0)  # Sobra de uma versão maior da imagem: recomeça
+            offset = f.seek(0, os.SEEK_END)
+            while offset < size:
+                interval = protocolo.INTERVALO.pack(offset, min(chunk_size, size - offset))
+
+                def operation(conn):
+                    f.truncate(offset)  # Descarta o que uma tentativa interrompida gravou deste intervalo
+                    conn.send(protocolo.DOWNLOAD_INTERVALO, name, interval)
+                    cab = protocolo.receber_cabecalho_resposta(conn.socket)
+                    if cab.opcode != protocolo.OK:
+                        conn.check(cab, protocolo.receber_payload(conn.socket, cab))
+                    if not cab.tamanho:
+                        raise ServerError(f"A imagem {name} mudou durante o download")
+                    received = protocolo.receber_para_arquivo(conn.socket, cab, f, conn.buffer)
+                    f.flush()
+                    return received
+                offset += self._call(operation)
+        os.replace(temporary, path)
+        return size
+
+    # Download
+
+    def _receive_image(self, conn, cab, f):
+        """Grava em `f` o payload de uma resposta OK de DOWNLOAD (descomprimindo, se preciso)."""
+        if cab.flags & protocolo.FLAG_COMPRIMIDO:
+            return compressao.receber_descomprimindo(conn.socket, cab, f)[0]
+        return protocolo.receber_para_arquivo(conn.socket, cab, f, conn.buffer)
+
+    def _download(self, conn, name, f):
+        conn.send(protocolo.DOWNLOAD, name, bytes(conn.codecs))
+        cab = protocolo.receber_cabecalho_resposta(conn.socket)
+        if cab.opcode != protocolo.OK:
+            conn.check(cab, protocolo.receber_payload(conn.socket, cab))
+        return self._receive_image(conn, cab, f)
+
+    def download(self, name):
+        """Baixa uma imagem inteira para a memória. Retorna os seus bytes."""
+        def operation(conn):
+            f = io.BytesIO()
+            self._download(conn, name, f)
+            return f.getvalue()
+        return self._call(operation)
+
+    def download_to(self, name, destination):
+        """
+        Baixa uma imagem para `destination`: um caminho (gravado num temporário e renomeado
+        no fim) ou um arquivo aberto em modo binário. Retorna o tamanho da imagem.
+        """
+        if not isinstance(destination, (str, os.PathLike)):
+            # Um arquivo do chamador não pode ser regravado do início: sem novas tentativas
+            return self._call(lambda conn: self._download(conn, name, destination), retries=0)
+
+        def operation(conn):
+            temporary = os.fspath(destination) + ".parcial"
+            try:
+                with open(temporary, "wb") as f:
+                    size = self._download(conn, name, f)
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+            os.replace(temporary, destination)
+            return size
+        return self._call(operation)
+
+    def download_delta(self, name, path):
+        """
+        Atualiza a cópia local `path` da imagem baixando só os blocos que mudaram: os demais
+        são copiados da própria cópia, mesmo que tenham mudado de posição. Nada é baixado se
+        a cópia já estiver atualizada; sem cópia local, ou se a imagem mudar durante a
+        atualização, ela é baixada inteira. Retorna um delta.ResultadoDelta.
+        """
+        if not os.path.isfile(path):
+            size = self.download_to(name, path)
+            return delta.ResultadoDelta(size, size, 0)
+        temporary = os.fspath(path) + ".parcial"
+        with open(path, "rb") as f:
+            local = delta.assinar(f)
+            stored = self._signatures(name, local.resumo)
+            if stored.resumo == local.resumo:
+                return delta.ResultadoDelta(stored.tamanho, 0, stored.tamanho)
+            try:
+                with delta.mapear(f) as data, open(temporary, "wb") as output:
+                    transferred = self._rebuild(name, stored, data, output)
+            except protocolo.ErroProtocolo:
+                os.remove(temporary)
+                transferred = None
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+        if transferred is None:
+            size = self.download_to(name, path)
+            return delta.ResultadoDelta(size, size, 0)
+        os.replace(temporary, path)
+        return delta.ResultadoDelta(stored.tamanho, transferred, stored.tamanho - transferred)
+
+    def _rebuild(self, name, stored, data, output):
+        """
+        Grava em `output` a imagem descrita pelas assinaturas `stored`, copiando de `data` (a
+        cópia local) os blocos encontrados nela e baixando os demais com DOWNLOAD_INTERVALO,
+        conferidos pelos seus resumos. Retorna os bytes baixados.
+        """
+        block_size = stored.tamanho_bloco
+        found = {}  # Índice do bloco -> posição na cópia local
+        for kind, index, position in delta.procurar(data, stored):
+            if kind == delta.BLOCO:
+                found.setdefault(index, position)
+        count = len(stored.blocos)
+        transferred = 0
+        index = 0
+        while index < count:
+            if index in found:
+                position = found[index]
+                output.write(data[position:position + min(block_size, stored.tamanho - index * block_size)])
+                index += 1
+                continue
+            # Blocos que faltam em sequência vêm num só intervalo
+            end = index + 1
+            while end < count and end not in found and (end + 1 - index) * block_size <= TAMANHO_INTERVALO_DELTA:
+                end += 1
+            start = index * block_size
+            length = min(stored.tamanho, end * block_size) - start
+            interval = protocolo.INTERVALO.pack(start, length)
+            received = self._call(lambda conn: conn.check(*conn.request(protocolo.DOWNLOAD_INTERVALO, name,
+                                                                          interval)))
+            if len(received) != length or any(
+                    delta.resumo_forte(received[offset:offset + block_size]) != strong
+                    for offset, (_, strong) in zip(range(0, length, block_size), stored.blocos[index:end])):
+                raise protocolo.ErroProtocolo(f"A imagem {name} mudou durante a atualização")
+            output.write(received)
+            transferred += len(received)
+            index = end
+        return transferred
+
+    def open_download(self, name):
+        """
+        Abre um DownloadReader com a imagem, lida do socket à medida que o chamador consome.
+        Feche-o (ou use-o como gerenciador de contexto) para liberar a conexão.
+        """
+        def operation(conn):
+            # Sem codecs: o leitor entrega os bytes como chegam
+            conn.send(protocolo.DOWNLOAD, name)
+            cab = protocolo.receber_cabecalho_resposta(conn.socket)
+            if cab.opcode != protocolo.OK:
+                conn.check(cab, protocolo.receber_payload(conn.socket, cab))
+            return cab
+        conn, cab = call_holding(self.pool, operation, self.retries)
+        return DownloadReader(self.pool, conn, cab)
+
+    def download_many(self, names, directory="."):
+        """
+        Baixa várias imagens com MDOWNLOAD para `directory` (criado se preciso). Retorna um
+        protocolo.ResultadoLote por imagem, na ordem.
+        """
+        os.makedirs(directory, exist_ok=True)
+        results = []
+        for batch in protocolo.dividir_lotes(list(names), reservado=1 + len(compressao.CODECS_DISPONIVEIS)):
+            results.extend(self._call(lambda conn: self._download_batch(conn, batch, directory)))
+        return results
+
+    def _download_batch(self, conn, names, directory):
+        conn.send(protocolo.MDOWNLOAD, payload=protocolo.empacotar_lote_download(conn.codecs, names))
+        failures = {}  # Imagens recebidas com erro de integridade (o servidor as enviou com sucesso)
+        for _ in names:
+            cab = protocolo.receber_cabecalho_resposta(conn.socket)
+            if not cab.nome:
+                # Lote recusado: um só quadro de erro, sem o nome de uma imagem
+                conn.check(cab, protocolo.receber_payload(conn.socket, cab))
+            if cab.opcode != protocolo.OK:
+                protocolo.descartar(conn.socket, cab.tamanho)
+                continue
+            path = os.path.join(directory, os.path.basename(cab.nome))
+            temporary = path + ".parcial"
+            try:
+                with open(temporary, "wb") as f:
+                    self._receive_image(conn, cab, f)
+            except protocolo.ErroProtocolo as e:
+                # O payload inteiro já foi lido: o lote segue com a próxima imagem
+                os.remove(temporary)
+                failures[cab.nome] = str(e)
+                continue
+            os.replace(temporary, path)
+        results = protocolo.desempacotar_resultados(conn.check(*conn.receive()))
+        return [result._replace(sucesso=False, mensagem=failures[result.nome]) if result.nome in failures
+                else result for result in results]
+
+    def size(self, name):
+        """Tamanho da imagem, em bytes."""
+        payload = self._call(lambda conn: conn.check(*conn.request(protocolo.TAMANHO, name)))
+        return protocolo.DESLOCAMENTO.unpack(payload)[0]
+
+    def thumbnail(self, name, size=256):
+        """Miniatura PNG da cena, com o maior lado de até `size` pixels. Retorna os bytes do PNG."""
+        return bytes(self._call(lambda conn: conn.check(*conn.request(
+            protocolo.MINIATURA, name, protocolo.LADO_MINIATURA.pack(size)))))
+
+    def tile(self, name, z, x, y):
+        """Ladrilho PNG (z, x, y) da pirâmide sobre a cena. Retorna os bytes do PNG."""
+        return bytes(self._call(lambda conn: conn.check(*conn.request(
+            protocolo.LADRILHO, name, protocolo.POSICAO_LADRILHO.pack(z, x, y)))))
+
+    def compute(self, name, operation="estatisticas", window=None, bands=(1, 2), bins=256, threshold=0.0):
+        """
+        Análise da cena feita no cluster, sem baixá-la: "estatisticas" (de cada banda), "ndvi"
+        (bands = vermelho e infravermelho próximo) ou "nuvens" (fração dos pixels da primeira
+        banda de `bands` com valor a partir de `threshold`). `window` é (x, y, largura, altura),
+        ou None para a cena inteira; `bins` é o número de classes dos histogramas. Retorna o
+        resultado como um dicionário.
+        """
+        parameters = protocolo.empacotar_calculo(protocolo.OPERACOES_CALCULO[operation], window, bands[0], bands[-1],
+                                                 bins, threshold)
+        return json.loads(self._call(lambda conn: conn.check(*conn.request(protocolo.CALCULO, name, parameters))))
+
+    # Listagem, remoção e estatísticas
+
+    def list(self, prefix="", order="nome", descending=False, page_size=protocolo.LIMITE_LISTAGEM):
+        """
+        Itera pelas imagens cujo nome começa com `prefix` (protocolo.RegistroImagem), na ordem
+        pedida ("nome", "tamanho" ou "data"). As páginas são pedidas à medida que a iteração avança.
+        """
+        order = ORDENS.get(order, order)
+        cursor = None
+        while True:
+            parameters = protocolo.empacotar_listagem(order, descending, page_size, cursor)
+            page = protocolo.desempacotar_registros(self._call(
+                lambda conn: conn.check(*conn.request(protocolo.LIST, prefix, parameters))))
+            if not page:
+                return
+            yield from page
+            cursor = protocolo.cursor_registro(page[-1], order)
+
+    def search(self, bbox, start=None, end=None, epsg=0, page_size=protocolo.LIMITE_LISTAGEM):
+        """
+        Itera pelas cenas (protocolo.CenaEncontrada), em ordem de nome, cuja extensão intersecta
+        `bbox` = (x_min, y_min, x_max, y_max) e cuja data (a da cena ou, sem ela, a de envio, em
+        segundos desde a época) está entre `start` e `end`. A caixa está no sistema de referência
+        `epsg`; com 0, é comparada às cenas de todos. As páginas são pedidas à medida que a
+        iteração avança.
+        """
+        parameters = protocolo.empacotar_busca(bbox, start, end, epsg, page_size)
+        cursor = ""
+        while True:
+            page = protocolo.desempacotar_cenas(self._call(
+                lambda conn: conn.check(*conn.request(protocolo.BUSCA, cursor, parameters))))
+            if not page:
+                return
+            yield from page
+            cursor = page[-1].nome
+
+    def delete(self, name):
+        """Remove uma imagem de todas as réplicas. Retorna a confirmação do servidor."""
+        return self._call(lambda conn: conn.check(*conn.request(protocolo.DELETE, name))).decode()
+
+    def delete_many(self, names):
+        """Remove várias imagens com MDELETE. Retorna um protocolo.ResultadoLote por imagem, na ordem."""
+        results = []
+        for batch in protocolo.dividir_lotes(list(names)):
+            payload = self._call(lambda conn: conn.check(*conn.request(
+                protocolo.MDELETE, payload=protocolo.empacotar_nomes(batch))))
+            results.extend(protocolo.desempacotar_resultados(payload))
+        return results
+
+    def stats(self):
+        """Estatísticas do servidor (por exemplo, do cache de imagens), como um dicionário."""
+        return json.loads(self._call(lambda conn: conn.check(*conn.request(protocolo.ESTATISTICAS))))
+
@@ -0,0 +1,196 @@
+import select
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from comum import compressao, protocolo
+
+TENTATIVAS = 3  # Novas tentativas após uma falha de conexão
+ESPERA_INICIAL = 0.2  # Segundos antes da primeira nova tentativa (dobra a cada falha)
+ESPERA_MAXIMA = 5.0
+
+# Falhas que justificam abrir outra conexão e repetir a operação
+ERROS_CONEXAO = (ConnectionError, TimeoutError)
+
+
+class ServerError(Exception):
+    """O servidor respondeu ERRO (por exemplo, imagem inexistente); a operação não é repetida."""
+
+
+class ServerBusy(ServerError):
+    """
+    O servidor respondeu OCUPADO (limite de taxa, fila cheia) sem executar a operação, que é
+    repetida depois de `retry_after` segundos, a espera sugerida por ele.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def retry_delay(attempt, error):
+    """Espera antes da nova tentativa: a sugerida pelo servidor ocupado, ou crescente a cada falha."""
+    delay = min(ESPERA_INICIAL * 2 ** attempt, ESPERA_MAXIMA)
+    if isinstance(error, ServerBusy):
+        return max(error.retry_after, delay)
+    return delay
+
+
+def raise_for_response(cab, payload):
+    """Levanta ServerBusy para uma resposta OCUPADO e ServerError para as demais respostas que não são OK."""
+    if cab.opcode == protocolo.OCUPADO:
+        raise ServerBusy(protocolo.mensagem_resposta(cab, payload), protocolo.espera_ocupado(payload))
+    if cab.opcode != protocolo.OK:
+        raise ServerError(protocolo.mensagem_resposta(cab, payload))
+
+
+class Connection:
+    """Uma conexão com o servidor, com a compressão já negociada."""
+
+    def __init__(self, host, port, compression=True, timeout=None):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        protocolo.desativar_nagle(self.socket)
+        self.buffer = protocolo.novo_buffer()  # Reutilizado entre downloads
+        self.codecs = self._negotiate_compression() if compression else []
+
+    def _negotiate_compression(self):
+        """Oferece os codecs disponíveis e retorna os aceitos pelo servidor (em ordem de preferência)."""
+        cab, payload = self.request(protocolo.CAPACIDADES, payload=bytes(compressao.CODECS_DISPONIVEIS))
+        return compressao.escolher(payload) if cab.opcode == protocolo.OK else []
+
+    def send(self, opcode, name="", payload=b""):
+        protocolo.enviar_quadro(self.socket, opcode, name, payload)
+
+    def receive(self):
+        """Recebe uma resposta com o payload em memória. Retorna (cabeçalho, payload)."""
+        cab = protocolo.receber_cabecalho_resposta(self.socket)
+        return cab, protocolo.receber_payload(self.socket, cab)
+
+    def request(self, opcode, name="", payload=b""):
+        self.send(opcode, name, payload)
+        return self.receive()
+
+    @staticmethod
+    def check(cab, payload):
+        """Retorna o payload de uma resposta OK; uma resposta ERRO vira ServerError (OCUPADO, ServerBusy)."""
+        raise_for_response(cab, payload)
+        return payload
+
+    def closed_by_server(self):
+        """Verifica, sem bloquear, se o servidor encerrou a conexão enquanto ela estava ociosa."""
+        legiveis, _, _ = select.select([self.socket], [], [], 0)
+        if not legiveis:
+            return False
+        try:
+            return not self.socket.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def close(self):
+        self.socket.close()
+
+
+class ConnectionPool:
+    """
+    Conexões reutilizadas entre as operações de um cliente (seguro entre threads). No
+    máximo `size` ficam em uso ao mesmo tempo; uma conexão que falhou no meio de um
+    quadro é fechada em vez de voltar ao pool.
+    """
+
+    def __init__(self, host, port, size=4, compression=True, timeout=None):
+        self.host = host
+        self.port = port
+        self.compression = compression
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def checkout(self):
+        """Retira uma conexão ociosa saudável (ou abre uma nova), esperando uma vaga se preciso."""
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    return Connection(self.host, self.port, self.compression, self.timeout)
+                if not conn.closed_by_server():
+                    return conn
+                conn.close()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def checkin(self, conn, valid=True):
+        """Devolve a conexão ao pool; uma conexão inválida (no meio de um quadro) é fechada."""
+        if valid:
+            with self.lock:
+                self.idle.append(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        except ServerBusy:
+            # Uma recusa de conexão ou de transferência encerra a conexão no servidor: não volta ao pool
+            self.checkin(conn, valid=False)
+            raise
+        except ServerError:
+            self.checkin(conn)  # A resposta de erro foi lida inteira: a conexão continua sincronizada
+            raise
+        except BaseException:
+            self.checkin(conn, valid=False)
+            raise
+        self.checkin(conn)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+def call(pool, operation, retries=TENTATIVAS):
+    """
+    Executa operation(conexão) com uma conexão do pool. Após uma falha de conexão ou uma
+    resposta OCUPADO, repete com outra conexão até `retries` vezes, esperando mais a cada
+    tentativa; por isso `operation` deve poder ser repetida do início (o que vale para todas
+    as operações do protocolo, inclusive o UPLOAD, que substitui a imagem).
+    """
+    for attempt in range(retries + 1):
+        try:
+            with pool.connection() as conn:
+                return operation(conn)
+        except (*ERROS_CONEXAO, ServerBusy) as e:
+            if attempt == retries:
+                raise
+            time.sleep(retry_delay(attempt, e))
+
+
+def call_holding(pool, operation, retries=TENTATIVAS):
+    """
+    Como call, mas a conexão continua retirada do pool depois de uma operação bem-sucedida
+    (por exemplo, com o payload de um download ainda por ler). Retorna (conexão, resultado);
+    quem a recebe deve devolvê-la com pool.checkin.
+    """
+    for attempt in range(retries + 1):
+        conn = pool.checkout()
+        try:
+            return conn, operation(conn)
+        except ServerError as e:
+            pool.checkin(conn)
+            if not isinstance(e, ServerBusy) or attempt == retries:
+                raise
+            error = e
+        except BaseException as e:
+            pool.checkin(conn, valid=False)
+            if not isinstance(e, ERROS_CONEXAO) or attempt == retries:
+                raise
+            error = e
+        time.sleep(retry_delay(attempt, error))
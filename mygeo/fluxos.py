@@ -0,0 +1,146 @@
+import io
+import tempfile
+import zlib
+
+from comum import protocolo
+from mygeo.conexao import Connection
+
+TAMANHO_ACUMULO = 8 * 1024 * 1024  # Bytes acumulados em memória pelo UploadWriter antes de irem para o disco
+
+
+class DownloadReader(io.RawIOBase):
+    """
+    Leitor sequencial do payload de um DOWNLOAD, direto do socket: a imagem não passa
+    inteira pela memória. A conexão volta ao pool quando o payload termina; fechado
+    antes disso, o leitor descarta a conexão (que ficou no meio do quadro).
+    """
+
+    def __init__(self, pool, conn, cab):
+        super().__init__()
+        self.pool = pool
+        self.conn = conn
+        self.name = cab.nome
+        self.size = cab.tamanho
+        self.cab = cab
+        self.remaining = cab.tamanho
+        self.checksum = 0
+        if self.remaining == 0:
+            self._release(True)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining == 0:
+            return 0
+        visao = memoryview(buffer)
+        n = self.conn.socket.recv_into(visao[:min(len(visao), self.remaining)])
+        if n == 0:
+            self._release(False)
+            raise ConnectionError("Conexão encerrada no meio do download")
+        if self.cab.flags & protocolo.FLAG_CHECKSUM:
+            self.checksum = zlib.crc32(visao[:n], self.checksum)
+        self.remaining -= n
+        if self.remaining == 0:
+            self._release(True)
+            protocolo.verificar_checksum(self.cab, self.checksum)
+        return n
+
+    def _release(self, valid):
+        if self.conn is not None:
+            self.pool.checkin(self.conn, valid)
+            self.conn = None
+
+    def close(self):
+        self._release(self.remaining == 0)
+        super().close()
+
+
+class UploadWriter(io.RawIOBase):
+    """
+    Escritor do conteúdo de um UPLOAD. Com o tamanho anunciado em `size`, os bytes seguem
+    direto para o socket, sem checksum no cabeçalho (ele precisaria do conteúdo inteiro
+    antes do envio). Sem o tamanho, são acumulados num temporário e enviados, com checksum
+    e compressão, ao fechar. A resposta do servidor fica em `message`.
+    """
+
+    def __init__(self, client, name, size=None):
+        super().__init__()
+        self.client = client
+        self.name = name
+        self.size = size
+        self.written = 0
+        self.message = None
+        self.conn = None
+        self.spool = None
+        if size is None:
+            self.spool = tempfile.SpooledTemporaryFile(max_size=TAMANHO_ACUMULO)
+        else:
+            self.conn = client.pool.checkout()
+            try:
+                self.conn.socket.sendall(protocolo.montar_cabecalho(protocolo.UPLOAD, name, size))
+            except BaseException:
+                self._release(False)
+                raise
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("Escrita num UploadWriter fechado")
+        n = len(memoryview(data).cast("B"))
+        if self.spool is not None:
+            self.spool.write(data)
+        else:
+            if self.written + n > self.size:
+                raise ValueError(f"Escrita além do tamanho anunciado ({self.size} bytes)")
+            try:
+                self.conn.socket.sendall(data)
+            except BaseException:
+                self._release(False)
+                raise
+        self.written += n
+        return n
+
+    def _release(self, valid):
+        if self.conn is not None:
+            self.client.pool.checkin(self.conn, valid)
+            self.conn = None
+
+    def abort(self):
+        """Abandona o upload: nada é publicado (a conexão, no meio do quadro, é descartada)."""
+        self._release(False)
+        if self.spool is not None:
+            self.spool.close()
+        super().close()
+
+    def close(self):
+        """Conclui o upload e aguarda a confirmação do servidor (ServerError se ele recusar)."""
+        if self.closed:
+            return
+        try:
+            if self.spool is not None:
+                self.spool.seek(0)
+                self.message = self.client.upload(self.name, self.spool)
+                return
+            if self.written != self.size:
+                self._release(False)
+                raise ValueError(f"Upload de {self.name} fechado com {self.written} de {self.size} bytes")
+            try:
+                cab, payload = self.conn.receive()
+            except BaseException:
+                self._release(False)
+                raise
+            self._release(True)
+            self.message = Connection.check(cab, payload).decode()
+        finally:
+            if self.spool is not None:
+                self.spool.close()
+            super().close()
+
+    def __exit__(self, tipo, valor, rastro):
+        if tipo is not None:
+            self.abort()
+        else:
+            self.close()
@@ -0,0 +1,305 @@
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import metricas, protocolo
+
+REJEICOES = metricas.REGISTRO.contador("mygeo_servidor_rejeicoes_total",
+                                       "Conexões e requisições recusadas com OCUPADO, por motivo", ["motivo"])
+ESPERA_VAGA = metricas.REGISTRO.histograma("mygeo_servidor_espera_vaga_segundos",
+                                           "Espera por uma vaga do escalonador, por classe de requisição", ["classe"])
+
+# Classes de requisição do escalonador
+LEVE = "leve"
+TRANSFERENCIA = "transferencia"
+PESOS = {LEVE: 4, TRANSFERENCIA: 1}  # Havendo fila nas duas classes, 4 leves são atendidas a cada transferência
+
+# Comandos que transferem imagens (ou partes delas), ou as percorrem inteiras no cluster (CALCULO,
+# UPLOAD_DELTA), e ocupam uma conexão com o cluster por muito tempo
+OPCODES_TRANSFERENCIA = frozenset({protocolo.UPLOAD, protocolo.UPLOAD_PEDACO, protocolo.BLOCO, protocolo.DOWNLOAD,
+                                   protocolo.DOWNLOAD_INTERVALO, protocolo.MUPLOAD, protocolo.MDOWNLOAD,
+                                   protocolo.CALCULO, protocolo.UPLOAD_DELTA})
+# Comandos baratos e de diagnóstico: nunca são limitados nem recusados
+OPCODES_LIVRES = frozenset({protocolo.PING, protocolo.CAPACIDADES, protocolo.ESTATISTICAS})
+
+ESPERA_MINIMA = 0.05  # Menor espera sugerida numa resposta OCUPADO, em segundos
+
+
+class ServidorOcupado(Exception):
+    """A conexão ou requisição foi recusada por sobrecarga; `espera` é o tempo sugerido (s) para repeti-la."""
+
+    def __init__(self, mensagem, espera):
+        super().__init__(mensagem)
+        self.espera = max(ESPERA_MINIMA, espera)
+
+
+class BaldeFichas:
+    """
+    Balde de fichas (token bucket): recebe `taxa` fichas por segundo e acumula no máximo
+    `capacidade`, o tamanho da rajada permitida depois de um período ocioso.
+    """
+
+    def __init__(self, taxa, capacidade=None):
+        self.taxa = taxa
+        self.capacidade = capacidade if capacidade is not None else taxa
+        self.fichas = self.capacidade
+        self.atualizado = time.monotonic()
+        self.trava = threading.Lock()
+
+    def _repor(self):
+        agora = time.monotonic()
+        self.fichas = min(self.capacidade, self.fichas + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+
+    def retirar(self, quantidade=1):
+        """
+        Retira as fichas, se houver saldo. Caso contrário, nada é retirado e o retorno são os
+        segundos até o saldo ser suficiente (0 se as fichas foram retiradas).
+        """
+        with self.trava:
+            self._repor()
+            if self.fichas >= quantidade:
+                self.fichas -= quantidade
+                return 0.0
+            return (quantidade - self.fichas) / self.taxa
+
+    def consumir(self, quantidade):
+        """
+        Retira as fichas mesmo sem saldo e espera até a dívida ser paga: usado como limitador
+        do Relay, dá o ritmo de uma transferência já em andamento.
+        """
+        with self.trava:
+            self._repor()
+            self.fichas -= quantidade
+            divida = -self.fichas
+        if divida > 0:
+            time.sleep(divida / self.taxa)
+
+
+class Pedido:
+    """Requisição à espera de uma vaga (comparada por identidade ao ser retirada da fila)."""
+    __slots__ = ("atendido", "nos", "todos", "atribuidos")
+
+    def __init__(self, nos=(), todos=True):
+        self.atendido = False
+        self.nos = nos  # Nós do cluster que a requisição ocupa (`todos`) ou entre os quais usa um
+        self.todos = todos
+        self.atribuidos = ()  # Nós ocupados, ao ser atendida
+
+
+class Escalonador:
+    """
+    Vagas para as requisições em execução, com uma fila limitada para as que chegam com as
+    vagas ocupadas. As vagas liberadas são repartidas entre as classes da fila segundo os
+    seus pesos (escalonamento por passos: cada classe avança 1/peso a cada vaga recebida,
+    e a vaga vai para a que avançou menos). As transferências nunca ocupam as `reserva`
+    últimas vagas, para que um LIST ou DELETE não espere o fim de uma transferência longa,
+    e respeitam os limites de cada nó do cluster (limitar_transferencias): um pedido cujo nó
+    está cheio fica na fila, e os de outros nós passam à frente dele. Uma requisição que não
+    cabe na fila, ou que espera mais que `espera_maxima`, é recusada com ServidorOcupado.
+    """
+
+    def __init__(self, vagas=64, reserva=None, limite_fila=256, espera_maxima=10.0, pesos=PESOS):
+        self.vagas = vagas
+        if reserva is None:
+            reserva = max(1, vagas // 8)
+        self.limites = {LEVE: vagas, TRANSFERENCIA: max(1, vagas - reserva)}
+        self.limite_fila = limite_fila
+        self.espera_maxima = espera_maxima
+        self.pesos = pesos
+        self.condicao = threading.Condition()
+        self.em_uso = {classe: 0 for classe in pesos}
+        self.filas = {classe: deque() for classe in pesos}  # Pedidos em espera, por classe
+        self.passadas = {classe: 0.0 for classe in pesos}
+        self.virtual = 0.0  # Passada da última classe atendida: uma classe que volta à fila parte dela
+        self.duracao_media = {classe: 0.0 for classe in pesos}  # Média móvel do tempo de uso de uma vaga
+        self.limites_nos = {}  # Nó do cluster -> transferências simultâneas nele
+        self.em_uso_nos = {}
+
+    def limitar_transferencias(self, limite, limites_nos=None):
+        """
+        Limita as transferências simultâneas a `limite` (no mínimo 1) e as de cada nó do
+        cluster a `limites_nos` (nó -> limite), como as conexões que os pools deixam a elas:
+        as excedentes esperam na fila do escalonador, com os pesos e a espera máxima, em vez
+        de esperar uma conexão do pool.
+        """
+        with self.condicao:
+            self.limites[TRANSFERENCIA] = max(1, min(self.limites[TRANSFERENCIA], limite))
+            self.limites_nos = {no: max(1, limite_no) for no, limite_no in (limites_nos or {}).items()}
+            self.em_uso_nos = dict.fromkeys(self.limites_nos, 0)
+
+    def _cabe(self, classe):
+        return sum(self.em_uso.values()) < self.vagas and self.em_uso[classe] < self.limites[classe]
+
+    def _nos_livres(self, pedido):
+        """Nós que o pedido ocupa se for atendido agora, ou None se algum deles está no limite."""
+        limitados = [no for no in pedido.nos if no in self.limites_nos]
+        livres = [no for no in limitados if self.em_uso_nos[no] < self.limites_nos[no]]
+        if pedido.todos:
+            return tuple(limitados) if len(livres) == len(limitados) else None
+        if not limitados:
+            return ()
+        return (min(livres, key=self.em_uso_nos.get),) if livres else None
+
+    def _despachar(self):
+        """Entrega as vagas livres aos pedidos da fila, na ordem dada pelos pesos."""
+        atendidos = False
+        while True:
+            escolhido = None  # (classe, pedido, nós) da classe que avançou menos entre as que têm um pedido que cabe
+            for classe, fila in self.filas.items():
+                if not fila or not self._cabe(classe) or (
+                        escolhido is not None and self.passadas[classe] >= self.passadas[escolhido[0]]):
+                    continue
+                for pedido in fila:
+                    nos = self._nos_livres(pedido)
+                    if nos is not None:
+                        escolhido = classe, pedido, nos
+                        break
+            if escolhido is None:
+                break
+            classe, pedido, nos = escolhido
+            self.filas[classe].remove(pedido)
+            pedido.atendido = True
+            pedido.atribuidos = nos
+            self.em_uso[classe] += 1
+            for no in nos:
+                self.em_uso_nos[no] += 1
+            self.virtual = self.passadas[classe]
+            self.passadas[classe] += 1 / self.pesos[classe]
+            atendidos = True
+        if atendidos:
+            self.condicao.notify_all()
+
+    def _estimar_espera(self, classe):
+        """Espera sugerida a um pedido recusado: o tempo para a fila da sua classe andar."""
+        return self.duracao_media[classe] * (len(self.filas[classe]) + 1) / self.limites[classe]
+
+    def _adquirir(self, classe, nos, todos):
+        with self.condicao:
+            if not self.filas[classe]:
+                self.passadas[classe] = max(self.passadas[classe], self.virtual)
+            pedido = Pedido(nos, todos)
+            self.filas[classe].append(pedido)
+            self._despachar()
+            if pedido.atendido:
+                return pedido.atribuidos
+            if sum(len(fila) for fila in self.filas.values()) > self.limite_fila:
+                self.filas[classe].remove(pedido)
+                REJEICOES.inc(motivo="fila")
+                raise ServidorOcupado("Servidor ocupado: fila de requisições cheia", self._estimar_espera(classe))
+            prazo = time.monotonic() + self.espera_maxima
+            while not pedido.atendido:
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    self.filas[classe].remove(pedido)
+                    REJEICOES.inc(motivo="espera")
+                    raise ServidorOcupado("Servidor ocupado: espera máxima na fila esgotada",
+                                          self._estimar_espera(classe))
+                self.condicao.wait(restante)
+            return pedido.atribuidos
+
+    def _liberar(self, classe, duracao, nos):
+        with self.condicao:
+            self.em_uso[classe] -= 1
+            for no in nos:
+                self.em_uso_nos[no] -= 1
+            self.duracao_media[classe] += 0.1 * (duracao - self.duracao_media[classe])
+            self._despachar()
+
+    @contextmanager
+    def vaga(self, classe, nos=(), todos=True):
+        """
+        Ocupa uma vaga durante o bloco, esperando na fila se preciso. ServidorOcupado se recusada.
+        `nos` são os nós do cluster que a requisição ocupa (`todos`) ou entre os quais usa um; o
+        bloco recebe os nós ocupados (o escolhido, se não `todos`).
+        """
+        inicio = time.monotonic()
+        atribuidos = self._adquirir(classe, nos, todos)
+        inicio_uso = time.monotonic()
+        ESPERA_VAGA.observar(inicio_uso - inicio, classe=classe)
+        try:
+            yield atribuidos
+        finally:
+            self._liberar(classe, time.monotonic() - inicio_uso, atribuidos)
+
+    def ocupacao(self):
+        """Vagas em uso e pedidos na fila de cada classe."""
+        with self.condicao:
+            return {(classe, estado): valor for classe in self.pesos
+                    for estado, valor in (("em_uso", self.em_uso[classe]), ("fila", len(self.filas[classe])))}
+
+
+class Cliente:
+    """Conexões de um mesmo endereço, que compartilham os seus limites de taxa."""
+
+    def __init__(self, endereco, limite_requisicoes, limite_banda):
+        self.endereco = endereco
+        self.conexoes = 0
+        # Rajadas de até 1 s de requisições (no mínimo uma) e de transferência
+        self.requisicoes = BaldeFichas(limite_requisicoes, max(1, limite_requisicoes)) if limite_requisicoes else None
+        self.banda = BaldeFichas(limite_banda) if limite_banda else None
+
+
+class Admissao:
+    """
+    Controle de admissão do servidor: limita as conexões simultâneas (cada uma ocupa uma
+    thread), a taxa de requisições e a banda de cada cliente (por endereço IP), e passa as
+    requisições pelo Escalonador. Limites 0 (ou None) ficam desativados.
+    """
+
+    def __init__(self, max_clientes=1024, limite_requisicoes=0, limite_banda=0, escalonador=None):
+        self.max_clientes = max_clientes
+        self.limite_requisicoes = limite_requisicoes
+        self.limite_banda = limite_banda
+        self.escalonador = escalonador or Escalonador()
+        self.trava = threading.Lock()
+        self.conexoes = 0
+        self.clientes = {}  # Endereço -> Cliente, enquanto houver conexões dele
+
+    def conectar(self, endereco):
+        """Registra uma nova conexão do endereço. Retorna o seu Cliente; ServidorOcupado se não houver lugar."""
+        with self.trava:
+            if self.max_clientes and self.conexoes >= self.max_clientes:
+                REJEICOES.inc(motivo="conexoes")
+                raise ServidorOcupado(f"Servidor ocupado: limite de {self.max_clientes} conexões atingido", 1.0)
+            self.conexoes += 1
+            cliente = self.clientes.get(endereco)
+            if cliente is None:
+                cliente = self.clientes[endereco] = Cliente(endereco, self.limite_requisicoes, self.limite_banda)
+            cliente.conexoes += 1
+            return cliente
+
+    def desconectar(self, cliente):
+        with self.trava:
+            self.conexoes -= 1
+            cliente.conexoes -= 1
+            if not cliente.conexoes:
+                del self.clientes[cliente.endereco]
+
+    @contextmanager
+    def requisicao(self, cliente, opcode, nos=(), todos=True):
+        """
+        Admite uma requisição do cliente durante o bloco: confere a sua taxa de requisições e
+        ocupa uma vaga da classe do comando (e, numa transferência, dos nós do cluster que ela
+        usa; ver Escalonador.vaga, cujos nós ocupados o bloco recebe). ServidorOcupado se ela
+        for recusada.
+        """
+        if opcode in OPCODES_LIVRES:
+            yield ()
+            return
+        if cliente.requisicoes is not None:
+            espera = cliente.requisicoes.retirar()
+            if espera:
+                REJEICOES.inc(motivo="taxa")
+                raise ServidorOcupado(f"Limite de {self.limite_requisicoes:g} requisições/s excedido", espera)
+        if opcode not in OPCODES_TRANSFERENCIA:
+            with self.escalonador.vaga(LEVE):
+                yield ()
+            return
+        with self.escalonador.vaga(TRANSFERENCIA, nos, todos) as atribuidos:
+            yield atribuidos
@@ -0,0 +1,60 @@
+import bisect
+import hashlib
+
+def hash_chave(chave):
+    """Hash de 64 bits estável entre processos (o hash() do Python é aleatório por execução)."""
+    return int.from_bytes(hashlib.blake2b(chave.encode(), digest_size=8).digest(), "big")
+
+
+class AnelConsistente:
+    """
+    Anel de hash consistente com nós virtuais.
+
+    Cada nó físico ocupa `nos_virtuais` posições no anel; uma chave pertence aos
+    primeiros nós distintos encontrados a partir do seu hash, no sentido horário.
+    Ao adicionar ou remover um nó, apenas as chaves das faixas vizinhas às suas
+    posições mudam de dono (cerca de 1/N das imagens).
+    """
+
+    def __init__(self, nos=(), nos_virtuais=128):
+        self.nos_virtuais = nos_virtuais
+        self.posicoes = []  # Hashes ordenados das posições no anel
+        self.donos = []  # Nó físico de cada posição (mesma ordem de self.posicoes)
+        self.nos = []
+        for no in nos:
+            self.adicionar(no)
+
+    def adicionar(self, no):
+        """Adiciona um nó físico ao anel."""
+        if no in self.nos:
+            return
+        self.nos.append(no)
+        for i in range(self.nos_virtuais):
+            posicao = hash_chave(f"{no}#{i}")
+            indice = bisect.bisect(self.posicoes, posicao)
+            self.posicoes.insert(indice, posicao)
+            self.donos.insert(indice, no)
+
+    def remover(self, no):
+        """Remove um nó físico (e todas as suas posições) do anel."""
+        if no not in self.nos:
+            return
+        self.nos.remove(no)
+        manter = [i for i, dono in enumerate(self.donos) if dono != no]
+        self.posicoes = [self.posicoes[i] for i in manter]
+        self.donos = [self.donos[i] for i in manter]
+
+    def nos_para(self, chave, quantidade=1):
+        """Retorna até `quantidade` nós distintos responsáveis pela chave, em ordem de preferência."""
+        if not self.posicoes:
+            return []
+        quantidade = min(quantidade, len(self.nos))
+        escolhidos = []
+        inicio = bisect.bisect(self.posicoes, hash_chave(chave))
+        for passo in range(len(self.posicoes)):
+            dono = self.donos[(inicio + passo) % len(self.donos)]
+            if dono not in escolhidos:
+                escolhidos.append(dono)
+                if len(escolhidos) == quantidade:
+                    break
+        return escolhidos
@@ -0,0 +1,263 @@
+import hashlib
+import itertools
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import protocolo
+
+TAMANHO_MAXIMO_MEMORIA = 4 * 1024 * 1024  # Imagens até este tamanho ficam na camada em memória
+VALIDADE = 5.0  # Segundos em que uma imagem do cache é servida sem conferir a versão no cluster
+
+class LeituraCache:
+    """Acesso a uma imagem encontrada no cache, válido mesmo se ela for despejada durante o envio."""
+
+    def __init__(self, tamanho, dados=None, arquivo=None, versao=None, expirada=False):
+        self.tamanho = tamanho
+        self.dados = dados  # Camada em memória
+        self.arquivo = arquivo  # Camada em disco (arquivo já aberto)
+        self.versao = versao  # Versão da imagem no cluster quando foi copiada
+        self.expirada = expirada  # A versão não é conferida há mais que a validade do cache
+
+    def enviar(self, sock, deslocamento=0, comprimento=None):
+        """Envia um intervalo da imagem: da memória com sendall, do disco com sendfile."""
+        if comprimento is None:
+            comprimento = self.tamanho - deslocamento
+        if self.arquivo is not None:
+            protocolo.enviar_trecho(sock, self.arquivo, deslocamento, comprimento)
+        else:
+            sock.sendall(memoryview(self.dados)[deslocamento:deslocamento + comprimento])
+
+    def __enter__(self):
+        return self
+
+    def fechar(self):
+        if self.arquivo is not None:
+            self.arquivo.close()
+
+    def __exit__(self, *excecao):
+        self.fechar()
+
+
+class PreenchimentoCache:
+    """
+    Cópia de uma imagem sendo recebida do cluster para o cache. Os bytes são gravados em
+    `destino` (um bytearray ou um mmap de um arquivo do disco) enquanto são repassados ao
+    cliente; a entrada só passa a valer em concluir().
+    """
+
+    def __init__(self, cache, nome, tamanho, versao, caminho=None):
+        self.cache = cache
+        self.nome = nome
+        self.tamanho = tamanho
+        self.versao = versao
+        self.obsoleto = False  # Marcado por uma invalidação do nome durante a cópia
+        self.caminho = caminho
+        if caminho is None:
+            self.destino = bytearray(tamanho)
+        else:
+            with open(caminho, 'w+b') as f:
+                f.truncate(tamanho)
+                self.destino = mmap.mmap(f.fileno(), tamanho)
+
+    def concluir(self):
+        if self.caminho is not None:
+            self.destino.close()  # O conteúdo fica no arquivo; o mmap só servia para recebê-lo
+            self.destino = None
+        self.cache._inserir(self)
+
+    def cancelar(self):
+        with self.cache.trava:
+            self.cache._encerrar(self)
+        if self.caminho is not None:
+            self.destino.close()
+            os.remove(self.caminho)
+
+
+class CacheImagens:
+    """
+    Cache de imagens do servidor em duas camadas, ambas com despejo LRU e limites em bytes:
+    imagens pequenas ficam em memória e as grandes em arquivos de um diretório local,
+    servidos com sendfile. UPLOADs e DELETEs feitos por este servidor invalidam o nome.
+
+    Outros servidores podem alterar as imagens nos mesmos nós, então cada imagem guarda a
+    versão que tinha no cluster ao ser copiada. Passados `validade` segundos da última
+    conferência, obter() a entrega marcada como expirada, e quem a usa confere a versão no
+    cluster antes de servi-la (revalidar) ou a descarta (invalidar).
+    """
+
+    def __init__(self, limite_memoria=256 * 1024 * 1024, limite_disco=4 * 1024 * 1024 * 1024,
+                 diretorio=None, tamanho_maximo_memoria=TAMANHO_MAXIMO_MEMORIA, validade=VALIDADE):
+        self.limite_memoria = limite_memoria
+        self.limite_disco = limite_disco
+        self.tamanho_maximo_memoria = tamanho_maximo_memoria
+        self.validade = validade
+        if diretorio is None:
+            diretorio = tempfile.mkdtemp(prefix="mygeo-cache-")
+        else:
+            # Arquivos de uma execução anterior não têm como ser validados: começa vazio
+            shutil.rmtree(diretorio, ignore_errors=True)
+            os.makedirs(diretorio)
+        self.diretorio = diretorio
+
+        self.trava = threading.Lock()
+        self.memoria = OrderedDict()  # nome -> bytearray, do menos para o mais recente
+        self.disco = OrderedDict()  # nome -> (caminho, tamanho)
+        self.versoes = {}  # nome -> (versão, instante monotônico da última conferência)
+        self.uso_memoria = 0
+        self.uso_disco = 0
+        # Cópias em andamento por nome: uma invalidação as marca como obsoletas
+        self.preenchendo = {}
+        self.sequencia = itertools.count()  # Distingue os arquivos de preenchimentos simultâneos
+
+        self.acertos = 0
+        self.falhas = 0
+        self.bytes_economizados = 0
+        self.despejos = 0
+        self.invalidacoes = 0
+        self.revalidacoes = 0
+
+    def obter(self, nome, contabilizar=True):
+        """
+        Retorna uma LeituraCache da imagem, ou None se ela não estiver no cache. Com
+        `contabilizar`, a consulta entra nas contagens de acertos e falhas.
+        """
+        with self.trava:
+            versao, conferida = self.versoes.get(nome, (None, 0.0))
+            expirada = time.monotonic() - conferida > self.validade
+            if nome in self.memoria:
+                self.memoria.move_to_end(nome)
+                self.acertos += contabilizar
+                dados = self.memoria[nome]
+                return LeituraCache(len(dados), dados=dados, versao=versao, expirada=expirada)
+            if nome in self.disco:
+                self.disco.move_to_end(nome)
+                self.acertos += contabilizar
+                caminho, tamanho = self.disco[nome]
+                # Aberto sob a trava: um despejo posterior remove o nome, mas o arquivo aberto continua legível
+                return LeituraCache(tamanho, arquivo=open(caminho, 'rb'), versao=versao, expirada=expirada)
+            self.falhas += contabilizar
+            return None
+
+    def contem(self, nome):
+        """Se a imagem está no cache (válida ou não), sem reservá-la nem contar um acerto."""
+        with self.trava:
+            return nome in self.memoria or nome in self.disco
+
+    def revalidar(self, nome, versao):
+        """Renova a validade da imagem, cuja `versao` foi conferida no cluster."""
+        with self.trava:
+            if nome in self.versoes and self.versoes[nome][0] == versao:
+                self.versoes[nome] = (versao, time.monotonic())
+                self.revalidacoes += 1
+
+    def contabilizar_envio(self, quantidade):
+        """Registra bytes enviados ao cliente a partir do cache (sem passar pelo cluster)."""
+        with self.trava:
+            self.bytes_economizados += quantidade
+
+    def preencher(self, nome, tamanho, versao):
+        """
+        Prepara a cópia de uma imagem que será recebida do cluster, com a `versao` consultada
+        antes do envio. Retorna um PreenchimentoCache, ou None se a imagem não cabe em nenhuma
+        das camadas.
+        """
+        if tamanho <= self.tamanho_maximo_memoria and tamanho <= self.limite_memoria:
+            preenchimento = PreenchimentoCache(self, nome, tamanho, versao)
+        elif 0 < tamanho <= self.limite_disco:
+            resumo = hashlib.blake2b(nome.encode(), digest_size=16).hexdigest()
+            caminho = os.path.join(self.diretorio, f"{resumo}-{next(self.sequencia)}")
+            preenchimento = PreenchimentoCache(self, nome, tamanho, versao, caminho)
+        else:
+            return None
+        with self.trava:
+            self.preenchendo.setdefault(nome, []).append(preenchimento)
+        return preenchimento
+
+    def _encerrar(self, preenchimento):
+        """Retira uma cópia da lista de cópias em andamento (chamado com a trava)."""
+        pendentes = self.preenchendo[preenchimento.nome]
+        pendentes.remove(preenchimento)
+        if not pendentes:
+            del self.preenchendo[preenchimento.nome]
+
+    def _inserir(self, preenchimento):
+        nome = preenchimento.nome
+        with self.trava:
+            self._encerrar(preenchimento)
+            if preenchimento.obsoleto:
+                # A imagem mudou enquanto era copiada: a cópia está desatualizada
+                if preenchimento.caminho is not None:
+                    os.remove(preenchimento.caminho)
+                return
+            self._remover(nome)
+            if preenchimento.caminho is None:
+                self.memoria[nome] = preenchimento.destino
+                self.uso_memoria += preenchimento.tamanho
+            else:
+                self.disco[nome] = (preenchimento.caminho, preenchimento.tamanho)
+                self.uso_disco += preenchimento.tamanho
+            self.versoes[nome] = (preenchimento.versao, time.monotonic())
+            self._despejar()
+
+    def _remover(self, nome):
+        """Retira um nome das duas camadas (chamado com a trava)."""
+        self.versoes.pop(nome, None)
+        dados = self.memoria.pop(nome, None)
+        if dados is not None:
+            self.uso_memoria -= len(dados)
+        entrada = self.disco.pop(nome, None)
+        if entrada is not None:
+            os.remove(entrada[0])
+            self.uso_disco -= entrada[1]
+        return dados is not None or entrada is not None
+
+    def _despejar(self):
+        """Despeja as imagens menos usadas até que cada camada caiba no seu limite (chamado com a trava)."""
+        while self.uso_memoria > self.limite_memoria:
+            nome, dados = self.memoria.popitem(last=False)
+            del self.versoes[nome]
+            self.uso_memoria -= len(dados)
+            self.despejos += 1
+        while self.uso_disco > self.limite_disco:
+            nome, (caminho, tamanho) = self.disco.popitem(last=False)
+            del self.versoes[nome]
+            os.remove(caminho)
+            self.uso_disco -= tamanho
+            self.despejos += 1
+
+    def invalidar(self, nome):
+        """
+        Descarta a imagem do cache (e qualquer cópia ainda em andamento), após UPLOAD ou DELETE
+        ou quando a versão no cluster mudou.
+        """
+        with self.trava:
+            for preenchimento in self.preenchendo.get(nome, ()):
+                preenchimento.obsoleto = True
+            if self._remover(nome):
+                self.invalidacoes += 1
+
+    def estatisticas(self):
+        """Contadores do cache: acertos, falhas, taxa de acerto, bytes economizados, revalidações e ocupação."""
+        with self.trava:
+            consultas = self.acertos + self.falhas
+            return {
+                "acertos": self.acertos,
+                "falhas": self.falhas,
+                "taxa_acerto": self.acertos / consultas if consultas else 0.0,
+                "bytes_economizados": self.bytes_economizados,
+                "despejos": self.despejos,
+                "invalidacoes": self.invalidacoes,
+                "revalidacoes": self.revalidacoes,
+                "imagens_memoria": len(self.memoria),
+                "bytes_memoria": self.uso_memoria,
+                "imagens_disco": len(self.disco),
+                "bytes_disco": self.uso_disco,
+            }
@@ -0,0 +1,273 @@
+import itertools
+import logging
+import os
+import select
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import metricas, protocolo
+
+log = logging.getLogger("servidor.pool")
+
+CONEXOES_ABERTAS = metricas.REGISTRO.contador("mygeo_pool_conexoes_abertas_total",
+                                              "Conexões abertas com os nós do cluster", ["no"])
+FALHAS_CONEXAO = metricas.REGISTRO.contador("mygeo_pool_falhas_conexao_total",
+                                            "Tentativas de conexão com os nós que falharam", ["no"])
+RECONEXOES = metricas.REGISTRO.contador("mygeo_pool_reconexoes_total",
+                                        "Conexões com os nós restabelecidas depois de uma falha", ["no"])
+ESPERA_CANAL = metricas.REGISTRO.histograma("mygeo_pool_espera_segundos",
+                                            "Espera por uma conexão livre do pool", ["no"])
+
+ESPERA_ESGOTADO = 1.0  # Espera sugerida (s) a uma requisição que não conseguiu uma conexão livre
+
+
+class ClusterIndisponivel(Exception):
+    """O cluster não pode ser contactado agora (em espera de reconexão ou pool esgotado)."""
+
+
+class PoolEsgotado(ClusterIndisponivel):
+    """As conexões que a requisição pode usar estão ocupadas; `espera` é o tempo sugerido (s) para repeti-la."""
+
+    def __init__(self, mensagem, espera=ESPERA_ESGOTADO):
+        super().__init__(mensagem)
+        self.espera = espera
+
+
+class ConexaoCluster:
+    """Uma conexão TCP com o cluster, com o instante do último uso."""
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.ultimo_uso = time.monotonic()
+
+    def fechada_pelo_cluster(self):
+        """
+        Verificação barata de saúde: numa conexão ociosa não há resposta pendente,
+        então qualquer dado legível indica que o cluster a encerrou (EOF ou reset).
+        """
+        try:
+            legiveis, _, _ = select.select([self.socket], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(legiveis)
+
+    def ping(self):
+        """Verificação completa de saúde: envia PING e aguarda a resposta."""
+        try:
+            protocolo.enviar_quadro(self.socket, protocolo.PING)
+            resposta = protocolo.receber_cabecalho(self.socket)
+            if resposta is None:
+                return False
+            protocolo.descartar(self.socket, resposta.tamanho)
+            return resposta.opcode == protocolo.OK
+        except (OSError, protocolo.ErroProtocolo):
+            return False
+
+    def fechar(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+
+class Canal:
+    """
+    Acesso exclusivo a uma conexão do pool durante uma requisição.
+    Uso: enviar o quadro dentro de `envio()` e depois ler a resposta com `aguardar_resposta()`.
+    """
+
+    def __init__(self, conexao, id_requisicao, tempo_limite_resposta=None):
+        self.conexao = conexao
+        self.socket = conexao.socket
+        self.id_requisicao = id_requisicao
+        self.tempo_limite_resposta = tempo_limite_resposta
+        self.valido = True
+
+    @contextmanager
+    def envio(self):
+        yield self.socket
+
+    def invalidar(self):
+        """Marca a conexão como inutilizável (ficou no meio de um quadro); ela não voltará ao pool."""
+        self.valido = False
+
+    def aguardar_resposta(self):
+        """
+        Recebe o cabeçalho da resposta. Um cluster que não responde em `tempo_limite_resposta`
+        segundos levanta socket.timeout (a conexão, no meio de uma requisição, é descartada).
+        """
+        self.socket.settimeout(self.tempo_limite_resposta)
+        try:
+            resposta = protocolo.receber_cabecalho(self.socket)
+        finally:
+            self.socket.settimeout(None)
+        if resposta is None:
+            raise ConnectionResetError("Cluster encerrou a conexão durante a requisição")
+        return resposta
+
+
+class PoolCluster:
+    """
+    Pool de conexões do servidor com o cluster: cada requisição retira uma conexão do pool
+    (checkout), usa-a sozinha e a devolve ao final. Conexões ociosas passam por uma
+    verificação de saúde antes de serem reutilizadas. As transferências usam no máximo
+    `tamanho - reserva` conexões, e as `reserva` restantes ficam para os comandos leves,
+    como LIST e DELETE; quem não consegue uma conexão em `tempo_limite_checkout` segundos
+    recebe PoolEsgotado.
+
+    Falhas de conexão não bloqueiam o servidor: após uma falha, novas tentativas só
+    acontecem depois de uma espera com crescimento exponencial, e enquanto isso as
+    requisições recebem ClusterIndisponivel imediatamente.
+    """
+
+    def __init__(self, host='localhost', porta=7000, tamanho=8, reserva=None, intervalo_verificacao=30.0,
+                 tempo_limite_conexao=5.0, tempo_limite_checkout=30.0, tempo_limite_resposta=60.0,
+                 espera_inicial=0.5, espera_maxima=30.0):
+        self.host = host
+        self.porta = porta
+        self.no = f"{host}:{porta}"  # Rótulo das métricas
+        self.tamanho = tamanho
+        reserva = reserva if reserva is not None else max(1, tamanho // 4)
+        self.limite_transferencias = max(1, tamanho - reserva)
+        self.intervalo_verificacao = intervalo_verificacao  # Ociosidade a partir da qual se envia PING
+        self.tempo_limite_conexao = tempo_limite_conexao
+        self.tempo_limite_checkout = tempo_limite_checkout
+        self.tempo_limite_resposta = tempo_limite_resposta  # Espera máxima pelo cabeçalho de uma resposta
+        self.espera_inicial = espera_inicial
+        self.espera_maxima = espera_maxima
+
+        self.condicao = threading.Condition()
+        self.ociosas = []  # Conexões disponíveis
+        self.abertas = 0  # Conexões existentes, ociosas ou em uso
+        self.aguardando = 0  # Requisições à espera de uma conexão livre
+        self.transferencias = 0  # Conexões em uso por transferências
+        self.ids = itertools.count(1)
+
+        self.espera = 0.0  # Espera atual do backoff
+        self.proxima_tentativa = 0.0  # Instante (monotônico) da próxima tentativa de conexão
+
+    def _proximo_id(self):
+        return next(self.ids) % 0xFFFFFFFF or 1
+
+    def _abrir_socket(self):
+        """Abre uma nova conexão respeitando o backoff; falhas aumentam a espera."""
+        agora = time.monotonic()
+        if agora < self.proxima_tentativa:
+            raise ClusterIndisponivel(
+                f"Cluster indisponível; nova tentativa em {self.proxima_tentativa - agora:.1f} s")
+        try:
+            sock = socket.create_connection((self.host, self.porta), timeout=self.tempo_limite_conexao)
+            sock.settimeout(None)
+            protocolo.desativar_nagle(sock)
+        except OSError as e:
+            self.espera = min(self.espera * 2 or self.espera_inicial, self.espera_maxima)
+            self.proxima_tentativa = time.monotonic() + self.espera
+            FALHAS_CONEXAO.inc(no=self.no)
+            log.warning("Falha ao conectar ao cluster em %s (%s). Nova tentativa em %.1f s", self.no, e, self.espera)
+            raise ClusterIndisponivel(f"Cluster indisponível: {e}")
+        CONEXOES_ABERTAS.inc(no=self.no)
+        if self.espera:
+            RECONEXOES.inc(no=self.no)
+            log.info("Conexão com o cluster %s restabelecida", self.no)
+        self.espera = 0.0
+        self.proxima_tentativa = 0.0
+        return sock
+
+    @contextmanager
+    def canal(self, transferencia=False):
+        """
+        Fornece um canal para uma requisição ao cluster (uma transferência, se `transferencia`).
+        Se a requisição falhar no meio de um quadro, a conexão usada é descartada (não volta ao pool).
+        """
+        conexao = self.obter(transferencia)
+        canal = Canal(conexao, self._proximo_id(), self.tempo_limite_resposta)
+        try:
+            yield canal
+        except BaseException:
+            self.devolver(conexao, valida=False, transferencia=transferencia)
+            raise
+        self.devolver(conexao, valida=canal.valido, transferencia=transferencia)
+
+    def obter(self, transferencia=False):
+        """
+        Retira (checkout) uma conexão saudável do pool, abrindo uma nova se necessário. Uma
+        transferência espera também que haja menos de `limite_transferencias` em andamento.
+        """
+        inicio = time.monotonic()
+        limite = inicio + self.tempo_limite_checkout
+        with self.condicao:
+            while True:
+                if transferencia and self.transferencias >= self.limite_transferencias:
+                    self._aguardar(limite)
+                    continue
+                while self.ociosas:
+                    conexao = self.ociosas.pop()
+                    if self._saudavel(conexao):
+                        self.transferencias += transferencia
+                        ESPERA_CANAL.observar(time.monotonic() - inicio, no=self.no)
+                        return conexao
+                    conexao.fechar()
+                    self.abertas -= 1
+                if self.abertas < self.tamanho:
+                    self.abertas += 1  # Reserva a vaga; a conexão é aberta fora da trava
+                    self.transferencias += transferencia
+                    break
+                self._aguardar(limite)
+        ESPERA_CANAL.observar(time.monotonic() - inicio, no=self.no)
+        try:
+            return ConexaoCluster(self._abrir_socket())
+        except BaseException:
+            with self.condicao:
+                self.abertas -= 1
+                self.transferencias -= transferencia
+                self.condicao.notify_all()
+            raise
+
+    def _aguardar(self, limite):
+        """Espera (com a trava) a devolução de uma conexão até o instante `limite`; PoolEsgotado depois dele."""
+        restante = limite - time.monotonic()
+        self.aguardando += 1
+        try:
+            if restante <= 0 or not self.condicao.wait(restante):
+                raise PoolEsgotado("Todas as conexões com o cluster estão ocupadas")
+        finally:
+            self.aguardando -= 1
+
+    def _saudavel(self, conexao):
+        if conexao.fechada_pelo_cluster():
+            return False
+        if time.monotonic() - conexao.ultimo_uso > self.intervalo_verificacao:
+            return conexao.ping()
+        return True
+
+    def devolver(self, conexao, valida=True, transferencia=False):
+        """Devolve (checkin) uma conexão ao pool; conexões inválidas são fechadas."""
+        with self.condicao:
+            self.transferencias -= transferencia
+            if valida:
+                conexao.ultimo_uso = time.monotonic()
+                self.ociosas.append(conexao)
+            else:
+                conexao.fechar()
+                self.abertas -= 1
+            # Acorda todos: uma transferência acordada sozinha pode não poder usar a conexão devolvida
+            self.condicao.notify_all()
+
+    def ocupacao(self):
+        """Estado do pool para as métricas: conexões ociosas e em uso, e requisições à espera de uma livre."""
+        with self.condicao:
+            return {"ociosas": len(self.ociosas), "em_uso": self.abertas - len(self.ociosas),
+                    "transferencias": self.transferencias, "fila": self.aguardando}
+
+    def fechar(self):
+        """Fecha todas as conexões ociosas."""
+        with self.condicao:
+            for conexao in self.ociosas:
+                conexao.fechar()
+            self.abertas -= len(self.ociosas)
+            self.ociosas.clear()
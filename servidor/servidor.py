@@ -1,182 +1,1017 @@
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import os
+import queue
+import random
 import socket
+import struct
+import sys
 import threading
-import time  # Adiciona o time para permitir o sleep entre tentativas de reconexão
+import time
+from collections import namedtuple
+from contextlib import ExitStack
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import compressao, metricas, protocolo
+from comum.relay import Relay, formatar_vazao
+from admissao import OPCODES_TRANSFERENCIA, REJEICOES, Admissao, Escalonador, ServidorOcupado
+from anel_hash import AnelConsistente
+from cache_imagens import CacheImagens
+from pool_cluster import ClusterIndisponivel, PoolCluster, PoolEsgotado
+
+JANELA_LOTE = 4  # Leituras de um MDOWNLOAD abertas no cluster ao mesmo tempo, contando a que está sendo repassada
+
+# Escrita repassada às réplicas, com os canais ainda abertos à espera das confirmações
+EnvioEscrita = namedtuple("EnvioEscrita", "cab nos canais falhas estatistica pilha")
+
+log = logging.getLogger("servidor")
+
+REQUISICOES = metricas.REGISTRO.contador("mygeo_servidor_requisicoes_total",
+                                         "Requisições atendidas, por comando", ["comando"])
+FALHAS = metricas.REGISTRO.contador("mygeo_servidor_falhas_total",
+                                    "Requisições interrompidas por um erro (cluster indisponível, conexão perdida)",
+                                    ["comando"])
+LATENCIA = metricas.REGISTRO.histograma("mygeo_servidor_latencia_segundos",
+                                        "Duração das requisições, por comando", ["comando"])
+BYTES = metricas.REGISTRO.contador("mygeo_servidor_bytes_total",
+                                   "Bytes de imagens recebidos dos clientes (entrada) e enviados a eles (saida)",
+                                   ["direcao"])
+CONEXOES = metricas.REGISTRO.contador("mygeo_servidor_conexoes_total", "Conexões de clientes aceitas")
+CONEXOES_ATIVAS = metricas.REGISTRO.medidor("mygeo_servidor_conexoes_ativas", "Clientes conectados")
+
+# Parâmetros do LIST que consulta a versão de uma imagem: a primeira página, de um só registro, com o seu nome
+LISTAGEM_VERSAO = protocolo.empacotar_listagem(limite=1)
+
+
+def versao_imagem(no, nome, resposta, payload):
+    """
+    Versão de uma imagem num nó, a partir da resposta ao LIST do seu nome: (nó, tamanho,
+    checksum, data de envio), que muda a cada nova publicação; None se o nó não a tem.
+    """
+    if resposta.opcode != protocolo.OK:
+        return None
+    registros = protocolo.desempacotar_registros(payload)
+    if not registros or registros[0].nome != nome:
+        return None
+    return no, registros[0].tamanho, registros[0].checksum, registros[0].enviado_em
+
 
 class Servidor:
-    def __init__(self, host='localhost', porta=6000, cluster_host='localhost', cluster_porta=7000):
+    def __init__(self, host='localhost', porta=6000, cluster_host='localhost', cluster_porta=7000, backlog=5,
+                 conexoes_cluster=8, nos_cluster=None, replicas=1,
+                 cache_memoria=256 * 1024 * 1024, cache_disco=4 * 1024 * 1024 * 1024, diretorio_cache=None,
+                 validade_cache=5.0, admissao=None):
         # Inicializa o servidor com as informações do host e porta para comunicação com clientes e cluster
         self.host = host
         self.porta = porta
-        self.cluster_host = cluster_host
-        self.cluster_porta = cluster_porta
         self.servidor_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Permite reabrir a porta logo após um reinício, sem esperar o TIME_WAIT das conexões antigas
+        self.servidor_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # Associa o socket ao endereço e porta especificados
         self.servidor_socket.bind((self.host, self.porta))
-        # Coloca o servidor em modo de escuta para até 5 conexões pendentes
-        self.servidor_socket.listen(5)
-        print(f"[DEBUG] Servidor ouvindo em {self.host}:{self.porta}")
+        # Coloca o servidor em modo de escuta com a fila de conexões pendentes configurada
+        self.servidor_socket.listen(backlog)
+        log.info("Servidor ouvindo em %s:%d", self.host, self.porta)
+
+        # Nós de armazenamento: sem uma lista explícita, usa o cluster único de cluster_host:cluster_porta
+        if not nos_cluster:
+            nos_cluster = [(cluster_host, cluster_porta)]
+        # Um pool de conexões por nó: cada requisição usa um canal próprio, então clientes simultâneos
+        # não intercalam bytes nem esperam por uma transferência lenta de outro cliente
+        self.pools = {f"{h}:{p}": PoolCluster(h, p, tamanho=conexoes_cluster) for h, p in nos_cluster}
+        # Cada imagem é colocada nos `replicas` primeiros nós do anel de hash consistente a partir do seu nome
+        self.anel = AnelConsistente(self.pools)
+        self.replicas = max(1, min(replicas, len(self.pools)))
+        # Threads para consultar vários nós em paralelo (LIST e DELETE)
+        self.executor = metricas.ExecutorMedido(max_workers=max(4, 2 * len(self.pools)), thread_name_prefix="nos")
+        # Um MDOWNLOAD ocupa no máximo metade das conexões que o menor pool deixa às transferências
+        self.janela_lote = min(JANELA_LOTE,
+                               max(1, min(pool.limite_transferencias for pool in self.pools.values()) // 2))
+        # Threads dos comandos em lote (confirmações dos uploads de um MUPLOAD e remoções de um MDELETE)
+        self.executor_lotes = metricas.ExecutorMedido(max_workers=max(4, conexoes_cluster * len(self.pools)),
+                                                      thread_name_prefix="lotes")
+        # Cache das imagens baixadas com frequência (memória para as pequenas, disco para as grandes)
+        self.cache = None
+        if cache_memoria or cache_disco:
+            self.cache = CacheImagens(cache_memoria, cache_disco, diretorio_cache, validade=validade_cache)
+        # Limites de conexões, de taxa por cliente e vagas para as requisições em execução
+        self.admissao = admissao or Admissao()
+        # Transferências além das conexões que os pools lhes deixam (no total, e em cada nó) esperariam
+        # uma conexão sem os pesos do escalonador: ficam na fila dele. Cada escrita ocupa uma por réplica
+        self.admissao.escalonador.limitar_transferencias(
+            sum(pool.limite_transferencias for pool in self.pools.values()) // self.replicas,
+            {no: pool.limite_transferencias for no, pool in self.pools.items()})
+        self.registrar_medidores()
+        self.conectar_cluster()  # Tenta conectar aos nós no início, sem bloquear se algum estiver fora
 
-        self.cluster_socket = None  # Socket para conexão com o cluster
-        self.conectar_cluster()  # Tenta conectar ao cluster no início
+    def registrar_medidores(self):
+        """Medidores lidos na exportação das métricas: ocupação dos pools, filas e cache."""
+        metricas.REGISTRO.medidor(
+            "mygeo_pool_conexoes", "Conexões com cada nó, por estado (ociosas, em_uso), e requisições na fila",
+            ["no", "estado"], funcao=lambda: {(no, estado): valor for no, pool in self.pools.items()
+                                              for estado, valor in pool.ocupacao().items()})
+        # Tarefas submetidas que ainda esperam uma thread livre
+        metricas.REGISTRO.medidor(
+            "mygeo_servidor_fila_tarefas", "Tarefas à espera de uma thread, por executor", ["executor"],
+            funcao=lambda: {("nos",): self.executor.pendentes, ("lotes",): self.executor_lotes.pendentes})
+        metricas.REGISTRO.medidor("mygeo_servidor_vagas", "Vagas do escalonador em uso e pedidos na fila, por classe",
+                                  ["classe", "estado"], funcao=self.admissao.escalonador.ocupacao)
+        if self.cache is not None:
+            metricas.REGISTRO.medidor("mygeo_servidor_cache", "Contadores e ocupação do cache de imagens", ["campo"],
+                                      funcao=lambda: {(campo,): valor
+                                                      for campo, valor in self.cache.estatisticas().items()})
 
     def conectar_cluster(self):
-        """Tenta conectar ao cluster com reconexões automáticas."""
-        while self.cluster_socket is None:
+        """Abre a primeira conexão com cada nó; se falhar, o pool tentará de novo com backoff."""
+        for no, pool in self.pools.items():
+            log.info("Tentando conectar ao cluster em %s...", no)
             try:
-                print(f"[DEBUG] Tentando conectar ao cluster em {self.cluster_host}:{self.cluster_porta}...")
-                # Cria um socket e tenta conectar ao cluster
-                self.cluster_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.cluster_socket.connect((self.cluster_host, self.cluster_porta))
-                print(f"[DEBUG] Conexão com o cluster estabelecida")
-            except ConnectionRefusedError:
-                # Caso a conexão falhe, espera 5 segundos e tenta novamente
-                print(f"[DEBUG] Conexão recusada. Tentando novamente em 5 segundos...")
-                self.cluster_socket = None
-                time.sleep(5)
-
-    def reconectar_cluster(self):
-        """Tenta reconectar ao cluster caso a conexão caia."""
-        print("[DEBUG] Tentando reconectar ao cluster...")
-        self.desconectar_cluster()  # Desconecta o socket atual
-        self.conectar_cluster()  # Tenta se conectar novamente
-
-    def desconectar_cluster(self):
-        """Desconecta do cluster."""
-        if self.cluster_socket:
-            print("[DEBUG] Desconectando do cluster")
-            self.cluster_socket.close()  # Fecha a conexão
-            self.cluster_socket = None  # Define como None para tentar reconectar
-
-    def tratar_cliente(self, cliente_socket):
-        """Gerencia a comunicação com o cliente conectado."""
+                with pool.canal():
+                    log.info("Conexão com o cluster %s estabelecida", no)
+            except ClusterIndisponivel as e:
+                log.warning("%s", e)
+
+    def nos_da_imagem(self, nome_arquivo):
+        """Nós (em ordem de preferência no anel) que guardam as réplicas de uma imagem."""
+        return self.anel.nos_para(nome_arquivo, self.replicas)
+
+    def nos_da_transferencia(self, cab):
+        """
+        Nós cujas conexões uma transferência ocupa, para o escalonador: (nós, todos), com todas
+        as réplicas numa escrita e uma delas, à escolha dele, numa leitura. Nenhum para os lotes
+        (os nomes estão no payload, ainda não lido) e para as leituras de imagens do cache.
+        """
+        if cab.opcode not in OPCODES_TRANSFERENCIA or not cab.nome:
+            return (), True
+        if cab.opcode in protocolo.OPCODES_LEITURA:
+            if self.cache is not None and self.cache.contem(cab.nome):
+                return (), True
+            return self.nos_da_imagem(cab.nome), False
+        return self.nos_da_imagem(cab.nome), True
+
+    def consultar_no(self, no, opcode, nome="", parametros=b"", rastreio=0):
+        """Envia um comando com parâmetros pequenos a um nó e retorna (cabeçalho, payload) da resposta."""
+        with self.pools[no].canal() as canal:
+            with canal.envio() as cluster_socket:
+                protocolo.enviar_quadro(cluster_socket, opcode, nome, parametros, id_requisicao=canal.id_requisicao,
+                                        rastreio=rastreio)
+            resposta = canal.aguardar_resposta()
+            return resposta, protocolo.receber_payload(canal.socket, resposta)
+
+    def consultar_nos(self, nos, opcode, nome="", parametros=b"", rastreio=0):
+        """
+        Consulta vários nós em paralelo. Retorna uma lista de (nó, cabeçalho, payload);
+        nós que falharem aparecem com cabeçalho None e a mensagem de erro como payload.
+        """
+        futuros = {no: self.executor.submit(self.consultar_no, no, opcode, nome, parametros, rastreio) for no in nos}
+        resultados = []
+        for no, futuro in futuros.items():
+            try:
+                resposta, payload = futuro.result()
+                resultados.append((no, resposta, payload))
+            except (OSError, ClusterIndisponivel, protocolo.ErroProtocolo) as e:
+                log.warning("[%016x] Falha ao consultar o nó %s: %s", rastreio, no, e)
+                resultados.append((no, None, str(e).encode()))
+        return resultados
+
+    def listar_no(self, no):
+        """Nomes de todas as imagens de um nó, percorrendo as páginas do LIST."""
+        cursor = None
+        while True:
+            parametros = protocolo.empacotar_listagem(limite=protocolo.LIMITE_MAXIMO_LISTAGEM, cursor=cursor)
+            resposta, payload = self.consultar_no(no, protocolo.LIST, parametros=parametros)
+            if resposta.opcode != protocolo.OK:
+                raise protocolo.ErroProtocolo(payload.decode())
+            registros = protocolo.desempacotar_registros(payload)
+            if not registros:
+                return
+            yield from (registro.nome for registro in registros)
+            cursor = protocolo.cursor_registro(registros[-1], protocolo.ORDEM_NOME)
+
+    def copiar_imagem(self, nome_arquivo, origem, destino, relay):
+        """Copia uma imagem de um nó para outro, repassando o DOWNLOAD da origem como UPLOAD no destino."""
+        with self.pools[origem].canal(transferencia=True) as canal_origem, \
+                self.pools[destino].canal(transferencia=True) as canal_destino:
+            with canal_origem.envio() as s:
+                protocolo.enviar_quadro(s, protocolo.DOWNLOAD, nome_arquivo, id_requisicao=canal_origem.id_requisicao)
+            resposta = canal_origem.aguardar_resposta()
+            if resposta.opcode != protocolo.OK:
+                protocolo.descartar(canal_origem.socket, resposta.tamanho)
+                return False
+            with canal_destino.envio() as s:
+                # Reenvia o cabeçalho do UPLOAD com o tamanho anunciado pela origem e repassa os bytes
+                s.sendall(protocolo.montar_cabecalho(protocolo.UPLOAD, nome_arquivo, resposta.tamanho,
+                                                     canal_destino.id_requisicao))
+                relay.transferir(canal_origem.socket, s, resposta.tamanho)
+            resposta = canal_destino.aguardar_resposta()
+            protocolo.descartar(canal_destino.socket, resposta.tamanho)
+            return resposta.opcode == protocolo.OK
+
+    def rebalancear(self):
+        """
+        Move para os nós corretos as imagens que mudaram de dono no anel (por exemplo,
+        depois de adicionar um nó). Só as imagens afetadas, cerca de 1/N, são copiadas;
+        a cópia antiga é removida depois que todas as réplicas novas existirem.
+        """
+        relay = Relay()
+        movidas = 0
+        # Imagens presentes em cada nó
+        conteudo = {}
+        for no in self.pools:
+            try:
+                conteudo[no] = set(self.listar_no(no))
+            except (OSError, ClusterIndisponivel, protocolo.ErroProtocolo) as e:
+                log.warning("Falha ao listar o nó %s: %s", no, e)
+        try:
+            for no, imagens in conteudo.items():
+                for nome_arquivo in sorted(imagens):
+                    donos = self.nos_da_imagem(nome_arquivo)
+                    if no in donos:
+                        continue
+                    # Copia apenas para os donos que ainda não têm a imagem
+                    faltando = [dono for dono in donos if nome_arquivo not in conteudo.get(dono, ())]
+                    if all([self.copiar_imagem(nome_arquivo, no, dono, relay) for dono in faltando]):
+                        for dono in faltando:
+                            if dono in conteudo:
+                                conteudo[dono].add(nome_arquivo)
+                        self.consultar_no(no, protocolo.DELETE, nome_arquivo)
+                        movidas += 1
+        finally:
+            relay.fechar()
+        log.info("Rebalanceamento concluído: %d imagem(ns) movida(s)", movidas)
+        return movidas
+
+    def tratar_cliente(self, cliente_socket, cliente):
+        """Gerencia a comunicação com o cliente conectado (`cliente`, registrado na admissão)."""
+        # Motor de repasse da conexão (buffer e pipe do splice são reutilizados entre transferências),
+        # no ritmo do limite de banda do cliente
+        relay = Relay(limitador=cliente.banda)
+        CONEXOES.inc()
+        CONEXOES_ATIVAS.inc()
+        cab = None  # Requisição em andamento
         try:
             while True:
-                # Recebe dados do cliente (tamanho máximo 1024 bytes)
-                requisicao = cliente_socket.recv(1024)
-                if not requisicao:
-                    print("[DEBUG] Cliente desconectado")
+                # Recebe o cabeçalho do próximo quadro enviado pelo cliente
+                cab = protocolo.receber_cabecalho(cliente_socket)
+                if cab is None:
+                    log.debug("Cliente desconectado")
                     break
-                # Decodifica a requisição recebida e processa
-                requisicao = requisicao.decode()
-                print(f"[DEBUG] Requisição recebida: {requisicao}")
-                self.processar_comando(requisicao, cliente_socket)
+                # Cada requisição ganha um id de rastreio (se o cliente não enviou um), repassado ao cluster
+                if not cab.rastreio:
+                    cab = cab._replace(rastreio=metricas.novo_rastreio())
+                comando = protocolo.nome_opcode(cab.opcode)
+                log.debug("[%016x] Requisição recebida: %s %s", cab.rastreio, comando, cab.nome)
+                inicio = time.perf_counter()
+                try:
+                    with self.admissao.requisicao(cliente, cab.opcode, *self.nos_da_transferencia(cab)) as nos:
+                        self.processar_comando(cab, cliente_socket, relay, nos)
+                except ServidorOcupado as e:
+                    if not self.recusar_requisicao(cab, cliente_socket, e):
+                        break
+                    cab = None
+                    continue
+                LATENCIA.observar(time.perf_counter() - inicio, comando=comando)
+                REQUISICOES.inc(comando=comando)
+                cab = None
         except Exception as e:
-            print(f"[DEBUG] Erro ao tratar cliente: {e}")
+            if cab is not None:
+                FALHAS.inc(comando=protocolo.nome_opcode(cab.opcode))
+            log.warning("[%016x] Erro ao tratar cliente: %s", cab.rastreio if cab is not None else 0, e)
         finally:
             # Fecha a conexão com o cliente após a comunicação
+            CONEXOES_ATIVAS.dec()
+            self.admissao.desconectar(cliente)
+            relay.fechar()
             cliente_socket.close()
 
-    def processar_comando(self, requisicao, cliente_socket):
-        """Processa o comando enviado pelo cliente."""
-        comando, *args = requisicao.split()  # Separa o comando dos argumentos
+    def recusar_requisicao(self, cab, cliente_socket, ocupado):
+        """
+        Responde OCUPADO a uma requisição recusada pela admissão, antes de executá-la. Um payload
+        pequeno é descartado e a conexão continua; o de uma transferência não é lido (seria gastar
+        a banda que faltou), e a conexão é encerrada. Retorna se a conexão continua.
+        """
+        log.debug("[%016x] %s recusado: %s", cab.rastreio, protocolo.nome_opcode(cab.opcode), ocupado)
+        continua = cab.tamanho <= protocolo.TAMANHO_MAXIMO_PARAMETROS
+        if continua:
+            protocolo.descartar(cliente_socket, cab.tamanho)
+        protocolo.enviar_quadro(cliente_socket, protocolo.OCUPADO,
+                                payload=protocolo.empacotar_ocupado(ocupado.espera, str(ocupado)),
+                                id_requisicao=cab.id_requisicao)
+        return continua
 
+    def processar_comando(self, cab, cliente_socket, relay, nos=()):
+        """
+        Processa o comando enviado pelo cliente. `nos` são os nós do cluster em que o
+        escalonador reservou a transferência (numa leitura, a réplica a consultar primeiro).
+        """
         # Identifica o comando e chama o método correspondente
-        if comando == "UPLOAD":
-            self.processar_upload(args, cliente_socket)
-        elif comando == "LIST":
-            self.processar_list(cliente_socket)
-        elif comando == "DOWNLOAD":
-            self.processar_download(args, cliente_socket)
-        elif comando == "DELETE":
-            self.processar_delete(args, cliente_socket)
+        try:
+            if cab.opcode in protocolo.OPCODES_ESCRITA:
+                self.processar_upload(cab, cliente_socket, relay)
+                return
+            # Os demais comandos carregam no máximo alguns parâmetros, lidos inteiros em memória
+            if cab.tamanho > protocolo.TAMANHO_MAXIMO_PARAMETROS:
+                protocolo.descartar(cliente_socket, cab.tamanho)
+                protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, payload="Parâmetros muito grandes",
+                                        id_requisicao=cab.id_requisicao)
+                return
+            parametros = protocolo.receber_payload(cliente_socket, cab)
+            if cab.opcode == protocolo.LIST:
+                self.processar_list(cab, cliente_socket, parametros)
+            elif cab.opcode == protocolo.BUSCA:
+                self.processar_busca(cab, cliente_socket, parametros)
+            elif cab.opcode in protocolo.OPCODES_LEITURA:
+                self.processar_download(cab, cliente_socket, relay, parametros, nos[0] if nos else None)
+            elif cab.opcode == protocolo.DELETE:
+                self.processar_delete(cab, cliente_socket)
+            elif cab.opcode == protocolo.ESTATISTICAS:
+                self.processar_estatisticas(cab, cliente_socket)
+            elif cab.opcode == protocolo.CAPACIDADES:
+                self.processar_capacidades(cab, cliente_socket, parametros)
+            elif cab.opcode == protocolo.MUPLOAD:
+                self.processar_lote_upload(cab, cliente_socket, relay, parametros)
+            elif cab.opcode == protocolo.MDOWNLOAD:
+                self.processar_lote_download(cab, cliente_socket, relay, parametros)
+            elif cab.opcode == protocolo.MDELETE:
+                self.processar_lote_delete(cab, cliente_socket, parametros)
+            else:
+                protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, payload="Comando inválido",
+                                        id_requisicao=cab.id_requisicao)
+        except PoolEsgotado as e:
+            # Todas as conexões com o cluster estão ocupadas: o cliente repete depois da espera sugerida
+            REJEICOES.inc(motivo="cluster")
+            log.debug("[%016x] %s recusado: %s", cab.rastreio, protocolo.nome_opcode(cab.opcode), e)
+            protocolo.enviar_quadro(cliente_socket, protocolo.OCUPADO, id_requisicao=cab.id_requisicao,
+                                    payload=protocolo.empacotar_ocupado(e.espera, str(e)))
+        except ClusterIndisponivel as e:
+            # Responde imediatamente em vez de prender a thread esperando o cluster voltar
+            FALHAS.inc(comando=protocolo.nome_opcode(cab.opcode))
+            log.warning("[%016x] %s", cab.rastreio, e)
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, payload=f"Erro: {e}",
+                                    id_requisicao=cab.id_requisicao)
+
+    def encaminhar_resposta(self, canal, resposta, cab, cliente_socket, relay=None, preenchimento=None):
+        """
+        Repassa ao cliente um quadro de resposta recebido do cluster, transmitindo o
+        payload com contagem exata de bytes. Com um `preenchimento` de cache, o payload
+        é copiado para o cache enquanto é repassado. Retorna a estatística do repasse
+        (ou None para respostas repassadas sem relay).
+        """
+        protocolo.reenviar_cabecalho(cliente_socket, resposta, id_requisicao=cab.id_requisicao)
+        if preenchimento is not None:
+            try:
+                estatistica = relay.transferir_copiando(canal.socket, cliente_socket, preenchimento.destino)
+            except BaseException:
+                preenchimento.cancelar()
+                raise
+            preenchimento.concluir()
+            return estatistica
+        if relay is None:
+            protocolo.repassar(canal.socket, cliente_socket, resposta.tamanho)
+            return None
+        return relay.transferir(canal.socket, cliente_socket, resposta.tamanho)
+
+    def processar_upload(self, cab, cliente_socket, relay):
+        """
+        Gerencia o upload de uma imagem do cliente para as suas réplicas no cluster.
+        Serve também às etapas do upload em pedaços (início, pedaço e fim), que seguem
+        o mesmo caminho: o quadro é repassado a todas as réplicas.
+        """
+        envio = self.repassar_escrita(cab, cliente_socket, relay)
+        confirmacoes, mensagens = self.coletar_confirmacoes(envio)
+        if cab.opcode == protocolo.UPLOAD_RETOMAR and confirmacoes:
+            # Cada réplica tem a sua marca de progresso: o cliente retoma da menor delas
+            payload = min(confirmacoes, key=lambda p: protocolo.DESLOCAMENTO.unpack(p)[0])
+            protocolo.enviar_quadro(cliente_socket, protocolo.OK, payload=payload, id_requisicao=cab.id_requisicao)
+        elif cab.opcode == protocolo.BLOCOS_CONSULTAR and confirmacoes:
+            # Cada réplica informa os blocos que lhe faltam: o cliente envia a união deles
+            faltando = set()
+            for payload in confirmacoes:
+                faltando.update(protocolo.desempacotar_indices(payload))
+            protocolo.enviar_quadro(cliente_socket, protocolo.OK, payload=protocolo.empacotar_indices(sorted(faltando)),
+                                    id_requisicao=cab.id_requisicao)
+        elif cab.opcode == protocolo.UPLOAD_DELTA and len(confirmacoes) < len(envio.nos):
+            # Uma réplica sem o delta aplicado ficaria com a versão anterior: o cliente envia a imagem inteira
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, id_requisicao=cab.id_requisicao,
+                                    payload="; ".join(mensagens) or "Delta não aplicado em todas as réplicas")
         else:
-            cliente_socket.send("Comando inválido".encode())  # Responde com erro se o comando não for reconhecido
+            sucesso, texto = self.resumir_confirmacoes(envio, confirmacoes, mensagens)
+            protocolo.enviar_quadro(cliente_socket, protocolo.OK if sucesso else protocolo.ERRO, payload=texto,
+                                    id_requisicao=cab.id_requisicao)
+
+    def repassar_escrita(self, cab, cliente_socket, relay):
+        """
+        Repassa um quadro de escrita do cliente a todas as réplicas da imagem. Retorna o
+        EnvioEscrita com os canais ainda abertos, à espera das confirmações.
+        """
+        nos = self.nos_da_imagem(cab.nome)
+        if self.cache is not None:
+            # Invalida antes (descarta cópias em andamento) e depois (descarta as que leram a versão antiga)
+            self.cache.invalidar(cab.nome)
+        log.debug("[%016x] Recebendo %s %s (%d bytes) do cliente e enviando para %s...", cab.rastreio,
+                  protocolo.nome_opcode(cab.opcode), cab.nome, cab.tamanho, nos)
+
+        transferencia = cab.opcode in OPCODES_TRANSFERENCIA
+        with ExitStack() as pilha:
+            canais = []
+            erros = []
+            for no in nos:
+                try:
+                    canais.append((no, pilha.enter_context(self.pools[no].canal(transferencia))))
+                except ClusterIndisponivel as e:
+                    log.warning("[%016x] Réplica %s indisponível: %s", cab.rastreio, no, e)
+                    erros.append(e)
+            if not canais:
+                # O payload ainda não foi lido: descarta-o para manter a conexão do cliente sincronizada
+                protocolo.descartar(cliente_socket, cab.tamanho)
+                if all(isinstance(e, PoolEsgotado) for e in erros):
+                    raise erros[0]
+                raise ClusterIndisponivel("Nenhuma réplica disponível para a imagem")
+
+            with ExitStack() as envios:
+                sockets = [envios.enter_context(canal.envio()) for _, canal in canais]
+                falhas = set()
+                for i, (cluster_socket, (_, canal)) in enumerate(zip(sockets, canais)):
+                    try:
+                        protocolo.reenviar_cabecalho(cluster_socket, cab, id_requisicao=canal.id_requisicao)
+                    except OSError:
+                        falhas.add(i)
+                if len(canais) == 1 and not falhas:
+                    # Uma única réplica: repassa os bytes anunciados pelo relay (splice, se disponível)
+                    estatistica = relay.transferir(cliente_socket, sockets[0], cab.tamanho)
+                else:
+                    # Várias réplicas: lê o cliente uma vez e escreve em todos os nós
+                    destinos = [None if i in falhas else s for i, s in enumerate(sockets)]
+                    estatistica, falhas_envio = relay.transferir_para_varios(
+                        cliente_socket, [d for d in destinos if d is not None], cab.tamanho)
+                    ativos = [i for i, d in enumerate(destinos) if d is not None]
+                    falhas |= {ativos[j] for j in falhas_envio}
+            BYTES.inc(cab.tamanho, direcao="entrada")
+            # Os canais continuam abertos até a coleta das confirmações
+            return EnvioEscrita(cab, nos, canais, falhas, estatistica, pilha.pop_all())
+
+    def coletar_confirmacoes(self, envio):
+        """
+        Lê a confirmação (ou o erro) de cada réplica de um EnvioEscrita e devolve os canais
+        ao pool. Retorna (payloads das confirmações, mensagens de erro).
+        """
+        confirmacoes, mensagens = [], []
+        with envio.pilha:
+            for i, (no, canal) in enumerate(envio.canais):
+                if i in envio.falhas:
+                    canal.invalidar()
+                    mensagens.append(f"{no}: falha no envio")
+                    continue
+                try:
+                    resposta = canal.aguardar_resposta()
+                    payload = protocolo.receber_payload(canal.socket, resposta)
+                except (OSError, protocolo.ErroProtocolo) as e:
+                    canal.invalidar()
+                    mensagens.append(f"{no}: {e}")
+                    continue
+                if resposta.opcode == protocolo.OK:
+                    confirmacoes.append(payload)
+                else:
+                    mensagens.append(f"{no}: {payload.decode()}")
 
-    def verificar_conexao_cluster(self):
-        """Verifica se a conexão com o cluster está ativa."""
+        if self.cache is not None:
+            self.cache.invalidar(envio.cab.nome)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[%016x] Imagem %s enviada para %d réplica(s): %s", envio.cab.rastreio, envio.cab.nome,
+                      len(confirmacoes), formatar_vazao(envio.estatistica))
+        return confirmacoes, mensagens
+
+    @staticmethod
+    def resumir_confirmacoes(envio, confirmacoes, mensagens):
+        """Resultado de uma escrita para o cliente: (sucesso, mensagem da primeira réplica ou dos erros)."""
+        if not confirmacoes:
+            return False, "; ".join(mensagens)
+        texto = confirmacoes[0].decode()
+        if len(confirmacoes) < len(envio.nos):
+            texto += f" ({len(confirmacoes)} de {len(envio.nos)} réplicas)"
+        return True, texto
+
+    def processar_lote_upload(self, cab, cliente_socket, relay, parametros):
+        """
+        Atende um MUPLOAD: confirma o lote e recebe em sequência os quadros UPLOAD anunciados,
+        respondendo no fim com o resultado de cada arquivo. Cada arquivo é repassado às
+        réplicas assim que chega; as confirmações são coletadas em outras threads, então o
+        próximo arquivo não espera a ida e volta do anterior ao cluster.
+        """
         try:
-            # Tenta enviar uma mensagem "PING" para verificar a conexão com o cluster
-            self.cluster_socket.send(b"PING")
-        except (BrokenPipeError, ConnectionResetError):
-            print("[DEBUG] Conexão com o cluster perdida. Reconectando...")
-            self.reconectar_cluster()  # Se a conexão estiver quebrada, tenta reconectar
-
-    def processar_upload(self, args, cliente_socket):
-        """Gerencia o upload de uma imagem do cliente para o cluster."""
-        nome_arquivo = args[0]  # Nome do arquivo a ser enviado
-        print(f"[DEBUG] Recebendo imagem {nome_arquivo} do cliente e enviando para o cluster...")
-
-        self.verificar_conexao_cluster()  # Verifica se a conexão com o cluster está ativa
-        # Envia a requisição de upload para o cluster
-        self.cluster_socket.send(f"UPLOAD {nome_arquivo}".encode())
-
-        # Recebe os dados da imagem do cliente e envia para o cluster
-        while True:
-            dados = cliente_socket.recv(4096)  # Tamanho do buffer de recebimento
-            if not dados:
-                print("[DEBUG] Nenhum dado recebido, encerrando transmissão.")
+            quantidade, = protocolo.QUANTIDADE_LOTE.unpack(parametros)
+        except struct.error:
+            quantidade = None
+        if quantidade is None or quantidade > protocolo.LIMITE_LOTE:
+            # Recusado antes de o cliente enviar os arquivos: a conexão continua sincronizada
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, id_requisicao=cab.id_requisicao,
+                                    payload=f"Parâmetros de MUPLOAD inválidos (até {protocolo.LIMITE_LOTE} arquivos)")
+            return
+        protocolo.enviar_quadro(cliente_socket, protocolo.OK, id_requisicao=cab.id_requisicao)
+        log.debug("[%016x] Recebendo lote de %d arquivo(s)...", cab.rastreio, quantidade)
+        pendentes = []  # (nome, EnvioEscrita e futuro das confirmações, ou None e o resultado já conhecido)
+        for _ in range(quantidade):
+            item = protocolo.receber_cabecalho_resposta(cliente_socket)
+            item = item._replace(rastreio=item.rastreio or cab.rastreio)  # Os arquivos levam o rastreio do lote
+            if item.opcode != protocolo.UPLOAD:
+                protocolo.descartar(cliente_socket, item.tamanho)
+                pendentes.append((item.nome, None, (False, "Comando inválido no lote")))
+                continue
+            try:
+                envio = self.repassar_escrita(item, cliente_socket, relay)
+            except ClusterIndisponivel as e:
+                pendentes.append((item.nome, None, (False, f"Erro: {e}")))
+                continue
+            pendentes.append((item.nome, envio, self.executor_lotes.submit(self.coletar_confirmacoes, envio)))
+
+        resultados = []
+        for nome, envio, pendente in pendentes:
+            if envio is None:
+                sucesso, mensagem = pendente
+            else:
+                sucesso, mensagem = self.resumir_confirmacoes(envio, *pendente.result())
+            resultados.append(protocolo.ResultadoLote(nome, sucesso, mensagem))
+        self.responder_lote(cab, cliente_socket, resultados)
+
+    def processar_list(self, cab, cliente_socket, parametros=b""):
+        """
+        Solicita a mesma página da lista de imagens (prefixo, ordenação e cursor) a todos os
+        nós em paralelo e intercala as páginas, já ordenadas, numa só.
+        """
+        log.debug("[%016x] Solicitando lista de imagens ao cluster...", cab.rastreio)
+        try:
+            listagem = protocolo.desempacotar_listagem(parametros)
+        except (protocolo.ErroProtocolo, struct.error, UnicodeDecodeError) as e:
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, payload=f"Parâmetros de LIST inválidos: {e}",
+                                    id_requisicao=cab.id_requisicao)
+            return
+        paginas = []
+        for no, resposta, payload in self.consultar_nos(self.pools, protocolo.LIST, cab.nome, parametros,
+                                                        cab.rastreio):
+            if resposta is not None and resposta.opcode == protocolo.OK:
+                paginas.append(protocolo.desempacotar_registros(payload))
+        if not paginas:
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, payload="Erro: cluster indisponível",
+                                    id_requisicao=cab.id_requisicao)
+            return
+        # As réplicas de uma imagem aparecem em mais de um nó: cada nome entra uma só vez
+        registros, vistos = [], set()
+        for registro in heapq.merge(*paginas, key=lambda r: protocolo.cursor_registro(r, listagem.ordem),
+                                    reverse=listagem.decrescente):
+            if registro.nome in vistos:
+                continue
+            vistos.add(registro.nome)
+            registros.append(registro)
+            if len(registros) == listagem.limite:
                 break
-            if dados.endswith(b"FIM"):
-                # Se os dados terminarem com "FIM", indica o fim da transmissão
-                self.cluster_socket.send(dados[:-3])  # Envia todos os dados, exceto "FIM"
-                print(f"[DEBUG] Recebido marcador 'FIM'. Transmissão concluída.")
+        protocolo.enviar_quadro(cliente_socket, protocolo.OK, payload=protocolo.empacotar_registros(registros),
+                                id_requisicao=cab.id_requisicao)
+
+    def processar_busca(self, cab, cliente_socket, parametros=b""):
+        """
+        Repassa a BUSCA (caixa, datas, EPSG, limite e cursor) a todos os nós em paralelo e
+        intercala as páginas, ordenadas por nome, numa só.
+        """
+        log.debug("[%016x] Buscando cenas no cluster...", cab.rastreio)
+        try:
+            busca = protocolo.desempacotar_busca(parametros)
+        except (protocolo.ErroProtocolo, struct.error) as e:
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, payload=f"Parâmetros de BUSCA inválidos: {e}",
+                                    id_requisicao=cab.id_requisicao)
+            return
+        paginas = []
+        for no, resposta, payload in self.consultar_nos(self.pools, protocolo.BUSCA, cab.nome, parametros,
+                                                        cab.rastreio):
+            if resposta is not None and resposta.opcode == protocolo.OK:
+                paginas.append(protocolo.desempacotar_cenas(payload))
+        if not paginas:
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, payload="Erro: cluster indisponível",
+                                    id_requisicao=cab.id_requisicao)
+            return
+        # As réplicas de uma cena aparecem em mais de um nó: cada nome entra uma só vez
+        cenas, vistos = [], set()
+        for cena in heapq.merge(*paginas, key=lambda c: c.nome):
+            if cena.nome in vistos:
+                continue
+            vistos.add(cena.nome)
+            cenas.append(cena)
+            if len(cenas) == busca.limite:
                 break
-            self.cluster_socket.send(dados)
-
-        # Envia "FIM" ao cluster para indicar o término da transmissão
-        self.cluster_socket.send(b"FIM")
-        cliente_socket.send("Upload bem-sucedido".encode())  # Informa ao cliente que o upload foi bem-sucedido
-        print(f"[DEBUG] Imagem {nome_arquivo} enviada para o cluster")
-
-    def processar_list(self, cliente_socket):
-        """Solicita ao cluster a lista de imagens disponíveis."""
-        print("[DEBUG] Solicitando lista de imagens ao cluster...")
-        self.verificar_conexao_cluster()  # Verifica se a conexão com o cluster está ativa
-        self.cluster_socket.send("LIST".encode())  # Envia a solicitação de listagem ao cluster
-        imagens = self.cluster_socket.recv(1024).decode()  # Recebe a lista de imagens do cluster
-        print(f"[DEBUG] Imagens recebidas do cluster: {imagens}")
-        cliente_socket.send(imagens.encode())  # Envia a lista de imagens ao cliente
-
-    def processar_download(self, args, cliente_socket):
-        """Gerencia o download de uma imagem do cluster para o cliente."""
-        nome_arquivo = args[0]
+        protocolo.enviar_quadro(cliente_socket, protocolo.OK, payload=protocolo.empacotar_cenas(cenas),
+                                id_requisicao=cab.id_requisicao)
+
+    def processar_download(self, cab, cliente_socket, relay, parametros=b"", preferido=None):
+        """
+        Gerencia o download de uma imagem a partir de qualquer uma das suas réplicas (a
+        começar por `preferido`, se dado). Também atende aos downloads de intervalos, às
+        consultas de tamanho e às prévias (miniaturas e ladrilhos), cujos parâmetros são
+        repassados à réplica escolhida.
+        """
+        if cab.opcode == protocolo.DOWNLOAD_INTERVALO and len(parametros) != protocolo.INTERVALO.size:
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, id_requisicao=cab.id_requisicao,
+                                    payload="Parâmetros de DOWNLOAD_INTERVALO inválidos")
+            return
+        if self.servir_do_cache(cab, cliente_socket, relay, parametros):
+            return
+        leitura = self.abrir_leitura(cab, parametros, preferido)
+        self.entregar_leitura(cab, cliente_socket, relay, leitura)
+
+    def abrir_leitura(self, cab, parametros=b"", preferido=None):
+        """
+        Envia uma requisição de leitura às réplicas da imagem (a começar por `preferido`, se
+        dado, ou por uma aleatória), uma de cada vez, até que uma responda OK. Retorna
+        (pilha, canal, resposta, versão) com o canal ainda aberto para o repasse do payload
+        (fechado por `pilha`), ou (None, None, mensagem de erro, None). PoolEsgotado se
+        nenhuma réplica tinha uma conexão livre.
+
+        Um DOWNLOAD que pode preencher o cache é precedido, na mesma conexão e sem esperar a
+        resposta, de um LIST do próprio nome: a versão é a da imagem na réplica antes do envio.
+        """
+        consultar_versao = self.cache is not None and cab.opcode == protocolo.DOWNLOAD
+        # Começa pela réplica reservada pelo escalonador, ou por uma aleatória (distribui a carga entre os nós)
+        nos = self.nos_da_imagem(cab.nome)
+        inicio = nos.index(preferido) if preferido in nos else random.randrange(len(nos))
+        nos = nos[inicio:] + nos[:inicio]
+        erro = b"Arquivo nao encontrado"
+        esgotados = []  # Réplicas sem conexão livre
+        for no in nos:
+            log.debug("[%016x] Solicitando a imagem %s ao cluster %s...", cab.rastreio, cab.nome, no)
+            try:
+                with ExitStack() as pilha:
+                    canal = pilha.enter_context(self.pools[no].canal(cab.opcode in OPCODES_TRANSFERENCIA))
+                    with canal.envio() as cluster_socket:
+                        if consultar_versao:
+                            protocolo.enviar_quadro(cluster_socket, protocolo.LIST, cab.nome, LISTAGEM_VERSAO,
+                                                    id_requisicao=canal.id_requisicao, rastreio=cab.rastreio)
+                        protocolo.enviar_quadro(cluster_socket, cab.opcode, cab.nome, parametros,
+                                                id_requisicao=canal.id_requisicao, rastreio=cab.rastreio)
+                    versao = None
+                    if consultar_versao:
+                        resposta = canal.aguardar_resposta()
+                        versao = versao_imagem(no, cab.nome, resposta,
+                                               protocolo.receber_payload(canal.socket, resposta))
+                    resposta = canal.aguardar_resposta()
+                    if resposta.opcode != protocolo.OK:
+                        # Esta réplica não tem a imagem: tenta a próxima
+                        erro = protocolo.receber_payload(canal.socket, resposta)
+                        continue
+                    return pilha.pop_all(), canal, resposta, versao
+            except (ClusterIndisponivel, ConnectionError) as e:
+                # Falhas antes do repasse começar permitem tentar outra réplica
+                log.warning("[%016x] Réplica %s falhou: %s", cab.rastreio, no, e)
+                erro = str(e).encode()
+                if isinstance(e, PoolEsgotado):
+                    esgotados.append(e)
+        if len(esgotados) == len(nos):
+            raise esgotados[0]
+        return None, None, erro, None
+
+    def entregar_leitura(self, cab, cliente_socket, relay, leitura):
+        """
+        Repassa ao cliente a resposta de uma leitura aberta por abrir_leitura (ou o erro, se
+        nenhuma réplica a atendeu). Retorna (sucesso, mensagem).
+        """
+        pilha, canal, resposta, versao = leitura
+        if pilha is None:
+            log.debug("[%016x] Arquivo %s não encontrado no cluster", cab.rastreio, cab.nome)
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, cab.nome, resposta, id_requisicao=cab.id_requisicao)
+            return False, resposta.decode(errors="replace")
+        with pilha:
+            # O arquivo chega do cluster via sendfile e é emendado no socket do cliente pelo relay;
+            # um DOWNLOAD completo e sem compressão, de versão conhecida, também é copiado para o cache
+            preenchimento = None
+            if versao is not None and not resposta.flags & protocolo.FLAG_COMPRIMIDO:
+                preenchimento = self.cache.preencher(cab.nome, resposta.tamanho, versao)
+            # O cliente já recebe parte do arquivo: uma falha daqui em diante não permite trocar de réplica
+            estatistica = self.encaminhar_resposta(canal, resposta, cab, cliente_socket, relay, preenchimento)
+        BYTES.inc(resposta.tamanho, direcao="saida")
+        if cab.opcode == protocolo.DOWNLOAD and log.isEnabledFor(logging.DEBUG):
+            log.debug("[%016x] Imagem %s enviada com sucesso ao cliente: %s", cab.rastreio, cab.nome,
+                      formatar_vazao(estatistica))
+        return True, f"{resposta.tamanho} bytes"
+
+    def servir_do_cache(self, cab, cliente_socket, relay, parametros):
+        """
+        Atende um DOWNLOAD, DOWNLOAD_INTERVALO ou TAMANHO com a imagem do cache, sem
+        consultar o cluster. Retorna False se a imagem não estiver no cache.
+        """
+        if self.cache is None or cab.opcode not in (protocolo.DOWNLOAD, protocolo.DOWNLOAD_INTERVALO,
+                                                    protocolo.TAMANHO):
+            return False
+        # Consultas de tamanho não entram na taxa de acerto: só os downloads preenchem o cache
+        leitura = self.obter_do_cache(cab, contabilizar=cab.opcode != protocolo.TAMANHO)
+        if leitura is None:
+            return False
+        self.enviar_do_cache(cab, cliente_socket, relay, leitura, parametros)
+        return True
+
+    def obter_do_cache(self, cab, contabilizar=True):
+        """
+        LeituraCache da imagem, ou None se ela não estiver no cache. Uma imagem fora da
+        validade só é entregue depois de conferida a sua versão na réplica de onde veio (um
+        LIST do próprio nome); se mudou, ou a réplica não responde, sai do cache.
+        """
+        leitura = self.cache.obter(cab.nome, contabilizar)
+        if leitura is None or not leitura.expirada:
+            return leitura
+        no = leitura.versao[0]
         try:
-            self.verificar_conexao_cluster()  # Verifica a conexão com o cluster
-            self.cluster_socket.send(f"DOWNLOAD {nome_arquivo}".encode())  # Solicita o download ao cluster
-            print(f"[DEBUG] Solicitando a imagem {nome_arquivo} ao cluster...")
-
-            response = self.cluster_socket.recv(4096)  # Recebe a resposta inicial do cluster
-            if response == b"Arquivo nao encontrado":
-                # Se o arquivo não for encontrado, envia a resposta de erro ao cliente
-                print(f"[DEBUG] Arquivo {nome_arquivo} não encontrado no cluster.")
-                cliente_socket.send("Arquivo nao encontrado".encode())
+            versao = versao_imagem(no, cab.nome, *self.consultar_no(no, protocolo.LIST, cab.nome, LISTAGEM_VERSAO,
+                                                                    cab.rastreio))
+        except (OSError, ClusterIndisponivel, protocolo.ErroProtocolo) as e:
+            log.warning("[%016x] Falha ao conferir a versão de %s em %s: %s", cab.rastreio, cab.nome, no, e)
+            versao = None
+        if versao == leitura.versao:
+            self.cache.revalidar(cab.nome, versao)
+            return leitura
+        log.debug("[%016x] Imagem %s do cache desatualizada", cab.rastreio, cab.nome)
+        leitura.fechar()
+        self.cache.invalidar(cab.nome)
+        return None
+
+    def enviar_do_cache(self, cab, cliente_socket, relay, leitura, parametros=b""):
+        """
+        Envia ao cliente a imagem (ou o intervalo, ou o tamanho) de uma LeituraCache. O envio
+        não passa pelo relay, mas é descontado do seu limitador de banda.
+        """
+        with leitura:
+            if cab.opcode == protocolo.TAMANHO:
+                protocolo.enviar_quadro(cliente_socket, protocolo.OK, cab.nome,
+                                        protocolo.DESLOCAMENTO.pack(leitura.tamanho), id_requisicao=cab.id_requisicao)
+                return
+            if cab.opcode == protocolo.DOWNLOAD_INTERVALO:
+                deslocamento, comprimento = protocolo.INTERVALO.unpack(parametros)
+                comprimento = max(0, min(comprimento, leitura.tamanho - deslocamento))
             else:
-                # Se o arquivo for encontrado, começa a enviar os dados para o cliente
-                print(f"[DEBUG] Enviando imagem {nome_arquivo} para o cliente.")
-                while True:
-                    dados = self.cluster_socket.recv(4096)  # Recebe dados do cluster
-                    if not dados:
-                        print("[DEBUG] Nenhum dado recebido, encerrando transmissão.")
-                        break
-                    if dados.endswith(b"FIM"):
-                        # Envia os dados até o marcador "FIM"
-                        cliente_socket.send(dados[:-3])
-                        print(f"[DEBUG] Recebido marcador 'FIM'. Transmissão concluída.")
-                        break
-                    cliente_socket.send(dados)
-                cliente_socket.send(b"FIM")  # Envia "FIM" ao cliente para finalizar
-                print(f"Imagem {nome_arquivo} enviada com sucesso ao cliente.")
-        except FileNotFoundError:
-            cliente_socket.send("Arquivo não encontrado".encode())  # Envia erro se o arquivo não for encontrado
-
-    def processar_delete(self, args, cliente_socket):
-        """Gerencia a remoção de uma imagem no cluster."""
-        nome_arquivo = args[0]
-        self.verificar_conexao_cluster()  # Verifica a conexão com o cluster
-        # Solicita ao cluster a remoção do arquivo
-        self.cluster_socket.send(f"DELETE {nome_arquivo}".encode())
-        resposta = self.cluster_socket.recv(1024).decode()  # Recebe a resposta do cluster
-        cliente_socket.send(resposta.encode())  # Envia a resposta ao cliente
+                deslocamento, comprimento = 0, leitura.tamanho
+            cliente_socket.sendall(protocolo.montar_cabecalho(protocolo.OK, cab.nome, comprimento,
+                                                              cab.id_requisicao))
+            leitura.enviar(cliente_socket, deslocamento, comprimento)
+        relay.ritmar(comprimento)
+        self.cache.contabilizar_envio(comprimento)
+        BYTES.inc(comprimento, direcao="saida")
+        if cab.opcode == protocolo.DOWNLOAD:
+            log.debug("[%016x] Imagem %s enviada ao cliente a partir do cache (%d bytes)", cab.rastreio, cab.nome,
+                      comprimento)
+
+    def processar_lote_download(self, cab, cliente_socket, relay, parametros):
+        """
+        Atende um MDOWNLOAD: envia as imagens na ordem pedida, um quadro por imagem (OK com o
+        arquivo ou ERRO com a mensagem, ambos com o nome da imagem), e no fim o resultado de
+        cada uma. Enquanto uma imagem é repassada, uma thread já pede as próximas às
+        réplicas, então a ida e volta de cada requisição ao cluster fica escondida atrás das
+        transferências. O lote mantém no máximo `janela_lote` leituras abertas (e conexões
+        com o cluster presas), contando a que está sendo repassada.
+        """
+        try:
+            codecs, nomes = protocolo.desempacotar_lote_download(parametros)
+        except (protocolo.ErroProtocolo, struct.error, UnicodeDecodeError) as e:
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, payload=f"Parâmetros de MDOWNLOAD inválidos: {e}",
+                                    id_requisicao=cab.id_requisicao)
+            return
+        log.debug("[%016x] Enviando lote de %d imagem(ns)...", cab.rastreio, len(nomes))
+        itens = [cab._replace(opcode=protocolo.DOWNLOAD, flags=0, nome=nome, tamanho=len(codecs), checksum=0)
+                 for nome in nomes]
+        abertas = queue.Queue()
+        vagas = threading.Semaphore(self.janela_lote)  # Liberada a cada imagem repassada
+        cancelado = threading.Event()
+        threading.Thread(target=self.abrir_leituras, args=(itens, codecs, abertas, vagas, cancelado),
+                         daemon=True).start()
+        resultados = []
+        terminou = False
+        try:
+            for item in itens:
+                aberta = abertas.get()
+                if aberta is None:
+                    terminou = True
+                    raise ConnectionError("Leituras do lote interrompidas")
+                em_cache, leitura = aberta
+                if em_cache is not None:
+                    self.enviar_do_cache(item, cliente_socket, relay, em_cache)
+                    sucesso, mensagem = True, f"{em_cache.tamanho} bytes"
+                else:
+                    sucesso, mensagem = self.entregar_leitura(item, cliente_socket, relay, leitura)
+                vagas.release()
+                resultados.append(protocolo.ResultadoLote(item.nome, sucesso, mensagem))
+        finally:
+            # Interrompe a thread de leituras (acordando-a, se espera uma vaga) e fecha as que não serão
+            # repassadas (conexão perdida no meio do lote)
+            cancelado.set()
+            vagas.release()
+            while not terminou:
+                aberta = abertas.get()
+                if aberta is None:
+                    break
+                em_cache, leitura = aberta
+                if em_cache is not None:
+                    em_cache.fechar()
+                elif leitura[0] is not None:
+                    pilha, canal, _, _ = leitura
+                    canal.invalidar()  # O payload da resposta não foi lido: a conexão não volta ao pool
+                    pilha.close()
+        self.responder_lote(cab, cliente_socket, resultados)
+
+    def abrir_leituras(self, itens, codecs, abertas, vagas, cancelado):
+        """
+        Thread de um MDOWNLOAD: abre as leituras das imagens, uma de cada vez e na ordem do
+        lote, e as entrega em `abertas`. Cada leitura ocupa uma das `vagas` até ser repassada.
+        Na ordem, os canais do pool nunca ficam todos com imagens posteriores à que o repasse espera.
+        """
+        try:
+            for item in itens:
+                vagas.acquire()
+                if cancelado.is_set():
+                    break
+                # Imagens do cache são reservadas agora (continuam legíveis mesmo se despejadas depois)
+                em_cache = self.obter_do_cache(item) if self.cache is not None else None
+                if em_cache is not None:
+                    abertas.put((em_cache, None))
+                    continue
+                try:
+                    leitura = self.abrir_leitura(item, codecs)
+                except PoolEsgotado as e:
+                    leitura = None, None, str(e).encode(), None  # Só esta imagem falha, não o lote
+                abertas.put((None, leitura))
+        finally:
+            abertas.put(None)
+
+    def processar_lote_delete(self, cab, cliente_socket, parametros):
+        """Atende um MDELETE: remove as imagens em paralelo e responde com o resultado de cada uma."""
+        try:
+            nomes = protocolo.desempacotar_nomes(parametros)
+        except (protocolo.ErroProtocolo, struct.error, UnicodeDecodeError) as e:
+            protocolo.enviar_quadro(cliente_socket, protocolo.ERRO, payload=f"Parâmetros de MDELETE inválidos: {e}",
+                                    id_requisicao=cab.id_requisicao)
+            return
+        log.debug("[%016x] Removendo lote de %d imagem(ns)...", cab.rastreio, len(nomes))
+        futuros = [self.executor_lotes.submit(self.remover_imagem, nome, cab.rastreio) for nome in nomes]
+        resultados = [protocolo.ResultadoLote(nome, *futuro.result()) for nome, futuro in zip(nomes, futuros)]
+        self.responder_lote(cab, cliente_socket, resultados)
+
+    def responder_lote(self, cab, cliente_socket, resultados):
+        """Envia o resultado de cada arquivo de um comando em lote."""
+        sucessos = sum(resultado.sucesso for resultado in resultados)
+        log.debug("[%016x] Lote %s concluído: %d de %d arquivo(s) com sucesso", cab.rastreio,
+                  protocolo.nome_opcode(cab.opcode), sucessos, len(resultados))
+        protocolo.enviar_quadro(cliente_socket, protocolo.OK, payload=protocolo.empacotar_resultados(resultados),
+                                id_requisicao=cab.id_requisicao)
+
+    def processar_capacidades(self, cab, cliente_socket, parametros):
+        """
+        Negocia a compressão com o cliente: responde com os codecs oferecidos que todos os nós
+        do cluster sabem descomprimir. O servidor repassa os quadros comprimidos como chegam,
+        sem descomprimir nem comprimir de novo; quem trata a compressão são as pontas.
+        """
+        aceitos = compressao.escolher(parametros, compressao.NOMES_CODECS)
+        for no, resposta, payload in self.consultar_nos(list(self.pools), protocolo.CAPACIDADES,
+                                                        parametros=bytes(aceitos), rastreio=cab.rastreio):
+            if resposta is None:
+                continue  # Nó fora do ar: a negociação segue com os demais
+            # Um nó que não conhece CAPACIDADES (ERRO) não aceita compressão
+            aceitos = compressao.escolher(aceitos, payload if resposta.opcode == protocolo.OK else ())
+        log.debug("[%016x] Compressão negociada: %s", cab.rastreio,
+                  [compressao.nome_codec(codec) for codec in aceitos])
+        protocolo.enviar_quadro(cliente_socket, protocolo.OK, payload=bytes(aceitos), id_requisicao=cab.id_requisicao)
+
+    def processar_estatisticas(self, cab, cliente_socket):
+        """
+        Responde com as estatísticas (JSON): o cache, as métricas do servidor e as de cada nó
+        do cluster (ou o erro ao consultá-lo).
+        """
+        nos = {}
+        for no, resposta, payload in self.consultar_nos(list(self.pools), protocolo.ESTATISTICAS,
+                                                        rastreio=cab.rastreio):
+            if resposta is not None and resposta.opcode == protocolo.OK:
+                nos[no] = json.loads(payload)
+            else:
+                nos[no] = {"erro": payload.decode(errors="replace")}
+        estatisticas = {"cache": self.cache.estatisticas() if self.cache is not None else None,
+                        "metricas": metricas.REGISTRO.json(), "nos": nos}
+        protocolo.enviar_quadro(cliente_socket, protocolo.OK, payload=json.dumps(estatisticas),
+                                id_requisicao=cab.id_requisicao)
+
+    def processar_delete(self, cab, cliente_socket):
+        """Gerencia a remoção de uma imagem em todas as suas réplicas."""
+        sucesso, mensagem = self.remover_imagem(cab.nome, cab.rastreio)
+        protocolo.enviar_quadro(cliente_socket, protocolo.OK if sucesso else protocolo.ERRO, payload=mensagem,
+                                id_requisicao=cab.id_requisicao)
+
+    def remover_imagem(self, nome_arquivo, rastreio=0):
+        """Remove uma imagem de todas as suas réplicas. Retorna (sucesso, mensagem)."""
+        if self.cache is not None:
+            self.cache.invalidar(nome_arquivo)
+        resultados = self.consultar_nos(self.nos_da_imagem(nome_arquivo), protocolo.DELETE, nome_arquivo,
+                                        rastreio=rastreio)
+        for _, resposta, payload in resultados:
+            if resposta is not None and resposta.opcode == protocolo.OK:
+                return True, payload.decode()
+        # Nenhuma réplica removeu a imagem: repassa a primeira mensagem de erro
+        return False, resultados[0][2].decode()
 
     def iniciar(self):
         """Inicia o servidor e aceita conexões de clientes."""
         while True:
             cliente_socket, endereco = self.servidor_socket.accept()  # Aguarda novas conexões de clientes
-            print(f"[DEBUG] Conexão de {endereco}")
+            log.debug("Conexão de %s", endereco)
+            protocolo.desativar_nagle(cliente_socket)
+            try:
+                cliente = self.admissao.conectar(endereco[0])
+            except ServidorOcupado as e:
+                # Recusa sem criar uma thread: a resposta cabe no buffer do socket recém-aberto, e o
+                # cliente a lê como resposta à sua primeira requisição
+                log.warning("Conexão de %s recusada: %s", endereco, e)
+                try:
+                    protocolo.enviar_quadro(cliente_socket, protocolo.OCUPADO,
+                                            payload=protocolo.empacotar_ocupado(e.espera, str(e)))
+                except OSError:
+                    pass
+                cliente_socket.close()
+                continue
             # Cria uma nova thread para lidar com o cliente
-            tratador_cliente = threading.Thread(target=self.tratar_cliente, args=(cliente_socket,))
+            tratador_cliente = threading.Thread(target=self.tratar_cliente, args=(cliente_socket, cliente))
             tratador_cliente.start()  # Inicia a thread para tratar o cliente
 
-if __name__ == "__main__":  
-    servidor = Servidor()  # Cria uma instância do servidor
-    servidor.iniciar()  # Inicia o servidor, esperando por conexões de clientes
\ No newline at end of file
+# Opções de linha de comando que só o Servidor com threads implementa (destino -> opção)
+OPCOES_SO_THREADS = {"nos": "--cluster", "replicas": "--replicas", "rebalancear": "--rebalancear",
+                     "cache_memoria": "--cache-memoria", "cache_disco": "--cache-disco",
+                     "diretorio_cache": "--diretorio-cache", "validade_cache": "--validade-cache",
+                     "max_clientes": "--max-clientes", "max_requisicoes": "--max-requisicoes", "fila": "--fila",
+                     "espera_maxima": "--espera-maxima", "limite_requisicoes": "--limite-requisicoes",
+                     "limite_banda": "--limite-banda"}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor do MyGeo Eye")
+    parser.add_argument("--modo", choices=["threads", "async"], default="threads",
+                        help="threads: uma thread por cliente; async: front end asyncio, com um só nó do cluster "
+                             "e sem cache nem controle de admissão")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--porta", type=int, default=6000)
+    parser.add_argument("--cluster-host", default="localhost")
+    parser.add_argument("--cluster-porta", type=int, default=7000)
+    parser.add_argument("--cluster", action="append", metavar="HOST:PORTA", dest="nos",
+                        help="Nó de armazenamento (repita para vários nós); substitui --cluster-host/--cluster-porta")
+    parser.add_argument("--replicas", type=int, default=1, help="Número de nós que guardam cada imagem")
+    parser.add_argument("--rebalancear", action="store_true",
+                        help="Ao iniciar, move para os nós corretos as imagens que mudaram de dono no anel")
+    parser.add_argument("--backlog", type=int, help="Tamanho da fila de conexões pendentes")
+    parser.add_argument("--conexoes-cluster", type=int, default=8,
+                        help="Tamanho do pool de conexões com cada nó do cluster (1/4 delas, no mínimo uma, "
+                             "fica reservada para os comandos leves, como LIST e DELETE)")
+    parser.add_argument("--cache-memoria", type=int, default=256,
+                        help="Limite (MB) da camada em memória do cache de imagens (0 desativa)")
+    parser.add_argument("--cache-disco", type=int, default=4096,
+                        help="Limite (MB) da camada em disco do cache de imagens (0 desativa)")
+    parser.add_argument("--diretorio-cache", help="Diretório da camada em disco do cache (padrão: temporário)")
+    parser.add_argument("--validade-cache", type=float, default=5.0,
+                        help="Segundos em que uma imagem do cache é servida sem conferir a sua versão no cluster")
+    parser.add_argument("--max-clientes", type=int, default=1024,
+                        help="Conexões de clientes simultâneas (uma thread cada); as demais recebem OCUPADO "
+                             "(0 desativa)")
+    parser.add_argument("--max-requisicoes", type=int, default=64,
+                        help="Requisições em execução simultânea; as demais esperam numa fila")
+    parser.add_argument("--fila", type=int, default=256, help="Requisições à espera de uma vaga (além: OCUPADO)")
+    parser.add_argument("--espera-maxima", type=float, default=10.0,
+                        help="Segundos que uma requisição pode esperar na fila antes de receber OCUPADO")
+    parser.add_argument("--limite-requisicoes", type=float, default=0,
+                        help="Requisições por segundo de cada cliente (endereço IP); 0 desativa")
+    parser.add_argument("--limite-banda", type=float, default=0,
+                        help="Banda (MB/s) de cada cliente nas transferências; 0 desativa")
+    parser.add_argument("--log", choices=metricas.NIVEIS_LOG, default="info",
+                        help="Nível do log (debug mostra cada requisição, com o seu id de rastreio)")
+    parser.add_argument("--metricas-porta", type=int,
+                        help="Porta do endpoint HTTP /metrics, no formato do Prometheus (desativado se omitida)")
+    args = parser.parse_args()
+    metricas.configurar_log(args.log)
+    if args.metricas_porta is not None:
+        metricas.servir_http(args.host, args.metricas_porta)
+    opcoes = {"backlog": args.backlog} if args.backlog else {}
+    nos = [(no.rsplit(":", 1)[0], int(no.rsplit(":", 1)[1])) for no in args.nos or []]
+
+    if args.modo == "async":
+        # O front end asyncio fala com um só nó e não tem cache nem controle de admissão
+        ignoradas = [opcao for destino, opcao in OPCOES_SO_THREADS.items()
+                     if getattr(args, destino) != parser.get_default(destino)]
+        if ignoradas:
+            parser.error(f"opções não suportadas com --modo async: {', '.join(ignoradas)}")
+        from servidor_async import ServidorAsync
+        asyncio.run(ServidorAsync(args.host, args.porta, args.cluster_host, args.cluster_porta,
+                                 conexoes_cluster=args.conexoes_cluster, **opcoes).iniciar())
+    else:
+        # Cria uma instância do servidor
+        servidor = Servidor(args.host, args.porta, args.cluster_host, args.cluster_porta,
+                            conexoes_cluster=args.conexoes_cluster, nos_cluster=nos, replicas=args.replicas,
+                            cache_memoria=args.cache_memoria * 1024 * 1024,
+                            cache_disco=args.cache_disco * 1024 * 1024,
+                            diretorio_cache=args.diretorio_cache, validade_cache=args.validade_cache,
+                            admissao=Admissao(args.max_clientes, args.limite_requisicoes,
+                                              args.limite_banda * 1024 * 1024,
+                                              Escalonador(args.max_requisicoes, limite_fila=args.fila,
+                                                          espera_maxima=args.espera_maxima)),
+                            **opcoes)
+        if args.rebalancear:
+            threading.Thread(target=servidor.rebalancear, daemon=True).start()
+        servidor.iniciar()  # Inicia o servidor, esperando por conexões de clientes
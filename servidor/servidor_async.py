@@ -0,0 +1,352 @@
+import asyncio
+import json
+import logging
+import struct
+import os
+import sys
+from contextlib import asynccontextmanager
+
+# Permite importar o pacote "comum", compartilhado entre cliente, servidor e cluster
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from comum import metricas, protocolo
+from comum import protocolo_async
+from admissao import OPCODES_TRANSFERENCIA
+from pool_cluster import ClusterIndisponivel, PoolEsgotado
+
+log = logging.getLogger("servidor.async")
+
+# Comandos cuja resposta do cluster é repassada ao cliente como chega
+COMANDOS_REPASSADOS = protocolo.OPCODES_LEITURA | {protocolo.LIST, protocolo.BUSCA, protocolo.DELETE,
+                                                   protocolo.CAPACIDADES}
+
+
+class PoolStreams:
+    """
+    Conexões (pares de streams asyncio) do front end com o cluster. Cada requisição retira
+    uma conexão só para ela e a devolve no fim, então uma transferência lenta ocupa apenas
+    a sua conexão. Até `tamanho` conexões ficam abertas; as requisições além disso esperam
+    uma livre por até `tempo_limite_checkout` segundos e então recebem PoolEsgotado.
+    As transferências (admissao.OPCODES_TRANSFERENCIA) usam no máximo `tamanho - reserva`
+    delas, e as `reserva` restantes ficam para os comandos leves, como LIST e DELETE.
+
+    Uma conexão ociosa não tem resposta pendente: se o cluster a encerrou, o EOF já chegou
+    ao stream, e ela é descartada sem uma ida e volta ao cluster antes de cada requisição.
+    """
+
+    def __init__(self, host, porta, tamanho=8, limite_buffer=protocolo.TAMANHO_BUFFER_RECEPCAO,
+                 reserva=None, tempo_limite_conexao=5.0, tempo_limite_checkout=30.0):
+        self.host = host
+        self.porta = porta
+        self.limite_buffer = limite_buffer
+        self.tempo_limite_conexao = tempo_limite_conexao
+        self.tempo_limite_checkout = tempo_limite_checkout
+        self.vagas = asyncio.Semaphore(tamanho)
+        reserva = reserva if reserva is not None else max(1, tamanho // 4)
+        self.vagas_transferencia = asyncio.Semaphore(max(1, tamanho - reserva))
+        self.ociosas = []  # (reader, writer) disponíveis
+
+    async def _abrir(self):
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(self.host, self.porta, limit=self.limite_buffer),
+                                          self.tempo_limite_conexao)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.warning("Falha ao conectar ao cluster em %s:%d: %s", self.host, self.porta, e)
+            raise ClusterIndisponivel(f"Cluster indisponível: {str(e) or 'tempo esgotado'}")
+
+    async def _reservar(self, semaforo):
+        try:
+            await asyncio.wait_for(semaforo.acquire(), self.tempo_limite_checkout)
+        except asyncio.TimeoutError:
+            raise PoolEsgotado("Todas as conexões com o cluster estão ocupadas")
+
+    @asynccontextmanager
+    async def conexao(self, transferencia=False):
+        """
+        Fornece (reader, writer) de uma conexão exclusiva durante o bloco. Se o bloco terminar
+        com uma exceção, a conexão pode ter ficado no meio de um quadro e é fechada.
+        """
+        if transferencia:
+            await self._reservar(self.vagas_transferencia)
+        try:
+            await self._reservar(self.vagas)
+        except ClusterIndisponivel:
+            if transferencia:
+                self.vagas_transferencia.release()
+            raise
+        try:
+            streams = None
+            while self.ociosas:
+                reader, writer = self.ociosas.pop()
+                if not reader.at_eof() and not writer.is_closing():
+                    streams = reader, writer
+                    break
+                writer.close()
+            if streams is None:
+                streams = await self._abrir()
+            try:
+                yield streams
+            except BaseException:
+                streams[1].close()
+                raise
+            self.ociosas.append(streams)
+        finally:
+            self.vagas.release()
+            if transferencia:
+                self.vagas_transferencia.release()
+
+    def fechar(self):
+        for _, writer in self.ociosas:
+            writer.close()
+        self.ociosas.clear()
+
+
+class ServidorAsync:
+    """
+    Front end do servidor baseado em asyncio: uma única thread atende milhares de
+    clientes com os mesmos comandos do Servidor com threads, diante de um só nó do
+    cluster e sem cache nem controle de admissão. Cada requisição usa uma conexão
+    própria do PoolStreams, e uma transferência parada por mais de `tempo_limite`
+    segundos (um cliente que não envia nem lê) é interrompida.
+    """
+
+    def __init__(self, host='localhost', porta=6000, cluster_host='localhost', cluster_porta=7000,
+                 backlog=1024, limite_buffer=protocolo.TAMANHO_BUFFER_RECEPCAO, conexoes_cluster=8,
+                 tempo_limite=60.0):
+        # Inicializa o servidor com as informações do host e porta para comunicação com clientes e cluster
+        self.host = host
+        self.porta = porta
+        self.backlog = backlog  # Tamanho da fila de conexões pendentes do listen
+        # Limite do buffer de leitura de cada stream: acima dele a leitura do socket é pausada
+        self.limite_buffer = limite_buffer
+        self.tempo_limite = tempo_limite
+        self.pool = PoolStreams(cluster_host, cluster_porta, conexoes_cluster, limite_buffer)
+
+    async def tratar_cliente(self, reader, writer):
+        """Gerencia a comunicação com o cliente conectado."""
+        try:
+            while True:
+                cab = await protocolo_async.receber_cabecalho(reader)
+                if cab is None:
+                    break
+                await self.processar_comando(cab, reader, writer)
+        except Exception as e:
+            log.warning("Erro ao tratar cliente: %s", str(e) or type(e).__name__)
+        finally:
+            writer.close()
+
+    async def processar_comando(self, cab, reader, writer):
+        """Processa o comando enviado pelo cliente."""
+        if cab.opcode in protocolo.OPCODES_ESCRITA:
+            await self.processar_upload(cab, reader, writer)
+            return
+        # Os demais comandos carregam no máximo alguns parâmetros, lidos inteiros em memória
+        if cab.tamanho > protocolo.TAMANHO_MAXIMO_PARAMETROS:
+            await protocolo_async.descartar(reader, cab.tamanho)
+            await protocolo_async.enviar_quadro(writer, protocolo.ERRO, payload="Parâmetros muito grandes",
+                                                id_requisicao=cab.id_requisicao)
+            return
+        parametros = await protocolo_async.receber_payload(reader, cab)
+        if cab.opcode in COMANDOS_REPASSADOS:
+            # Com um só nó, a resposta do cluster é a própria resposta ao cliente
+            await self.encaminhar_requisicao(cab, writer, parametros)
+        elif cab.opcode == protocolo.ESTATISTICAS:
+            await self.processar_estatisticas(cab, writer)
+        elif cab.opcode == protocolo.MUPLOAD:
+            await self.processar_lote_upload(cab, reader, writer, parametros)
+        elif cab.opcode == protocolo.MDOWNLOAD:
+            await self.processar_lote_download(cab, writer, parametros)
+        elif cab.opcode == protocolo.MDELETE:
+            await self.processar_lote_delete(cab, writer, parametros)
+        else:
+            await protocolo_async.enviar_quadro(writer, protocolo.ERRO, payload="Comando inválido",
+                                                id_requisicao=cab.id_requisicao)
+
+    async def aguardar_resposta(self, cluster_reader):
+        """Cabeçalho da resposta do cluster, esperado por até `tempo_limite` segundos."""
+        resposta = await asyncio.wait_for(protocolo_async.receber_cabecalho(cluster_reader), self.tempo_limite)
+        if resposta is None:
+            raise ConnectionResetError("Cluster encerrou a conexão durante a requisição")
+        return resposta
+
+    async def encaminhar_resposta(self, cab, cluster_reader, writer):
+        """Repassa ao cliente o quadro de resposta do cluster. Retorna o cabeçalho da resposta."""
+        resposta = await self.aguardar_resposta(cluster_reader)
+        await protocolo_async.reenviar_cabecalho(writer, resposta, id_requisicao=cab.id_requisicao)
+        await protocolo_async.repassar(cluster_reader, writer, resposta.tamanho, tempo_limite=self.tempo_limite)
+        return resposta
+
+    async def consultar(self, cluster_reader, cluster_writer, opcode, nome="", parametros=b""):
+        """Envia um comando ao cluster e recebe a resposta inteira. Retorna (cabeçalho, payload)."""
+        await protocolo_async.enviar_quadro(cluster_writer, opcode, nome, parametros)
+        resposta = await self.aguardar_resposta(cluster_reader)
+        payload = await asyncio.wait_for(protocolo_async.receber_payload(cluster_reader, resposta), self.tempo_limite)
+        return resposta, payload
+
+    async def responder_lote(self, cab, writer, resultados):
+        """Envia o resultado de cada arquivo de um comando em lote."""
+        await protocolo_async.enviar_quadro(writer, protocolo.OK, payload=protocolo.empacotar_resultados(resultados),
+                                            id_requisicao=cab.id_requisicao)
+
+    async def responder_indisponivel(self, cab, writer, erro):
+        """Responde a uma requisição sem conexão com o cluster: OCUPADO se o pool está esgotado, ERRO se não."""
+        log.warning("%s %s: %s", protocolo.nome_opcode(cab.opcode), cab.nome, erro)
+        if isinstance(erro, PoolEsgotado):
+            await protocolo_async.enviar_quadro(writer, protocolo.OCUPADO, id_requisicao=cab.id_requisicao,
+                                                payload=protocolo.empacotar_ocupado(erro.espera, str(erro)))
+            return
+        await protocolo_async.enviar_quadro(writer, protocolo.ERRO, payload=f"Erro: {erro}",
+                                            id_requisicao=cab.id_requisicao)
+
+    async def encaminhar_requisicao(self, cab, writer, parametros=b""):
+        """Envia ao cluster um comando sem payload grande (LIST, DOWNLOAD, DELETE...) e repassa a resposta."""
+        try:
+            async with self.pool.conexao(cab.opcode in OPCODES_TRANSFERENCIA) as (cluster_reader, cluster_writer):
+                await protocolo_async.enviar_quadro(cluster_writer, cab.opcode, cab.nome, parametros)
+                resposta = await self.encaminhar_resposta(cab, cluster_reader, writer)
+        except ClusterIndisponivel as e:
+            await self.responder_indisponivel(cab, writer, e)
+            return
+        if cab.opcode == protocolo.DOWNLOAD and resposta.opcode == protocolo.OK:
+            log.debug("Imagem %s enviada com sucesso ao cliente (%d bytes)", cab.nome, resposta.tamanho)
+
+    async def processar_upload(self, cab, reader, writer):
+        """Gerencia o upload de uma imagem do cliente para o cluster."""
+        try:
+            async with self.pool.conexao(cab.opcode in OPCODES_TRANSFERENCIA) as (cluster_reader, cluster_writer):
+                # Repassa o cabeçalho e os bytes anunciados com contrapressão entre os streams
+                await protocolo_async.reenviar_cabecalho(cluster_writer, cab)
+                await protocolo_async.repassar(reader, cluster_writer, cab.tamanho, tempo_limite=self.tempo_limite)
+                await self.encaminhar_resposta(cab, cluster_reader, writer)
+        except ClusterIndisponivel as e:
+            # O payload ainda não foi lido: descarta-o para manter a conexão do cliente sincronizada
+            await protocolo_async.descartar(reader, cab.tamanho)
+            await self.responder_indisponivel(cab, writer, e)
+            return
+        log.debug("Imagem %s enviada para o cluster (%d bytes)", cab.nome, cab.tamanho)
+
+    async def processar_lote_upload(self, cab, reader, writer, parametros):
+        """
+        Atende um MUPLOAD: confirma o lote, repassa ao cluster os quadros UPLOAD anunciados,
+        um de cada vez pela mesma conexão, e responde no fim com o resultado de cada arquivo.
+        """
+        try:
+            quantidade, = protocolo.QUANTIDADE_LOTE.unpack(parametros)
+        except struct.error:
+            quantidade = None
+        if quantidade is None or quantidade > protocolo.LIMITE_LOTE:
+            # Recusado antes de o cliente enviar os arquivos: a conexão continua sincronizada
+            await protocolo_async.enviar_quadro(
+                writer, protocolo.ERRO, id_requisicao=cab.id_requisicao,
+                payload=f"Parâmetros de MUPLOAD inválidos (até {protocolo.LIMITE_LOTE} arquivos)")
+            return
+        try:
+            async with self.pool.conexao(transferencia=True) as (cluster_reader, cluster_writer):
+                await protocolo_async.enviar_quadro(writer, protocolo.OK, id_requisicao=cab.id_requisicao)
+                resultados = []
+                for _ in range(quantidade):
+                    item = await protocolo_async.receber_cabecalho(reader)
+                    if item is None:
+                        raise ConnectionError("Conexão encerrada no meio do lote")
+                    if item.opcode != protocolo.UPLOAD:
+                        await protocolo_async.descartar(reader, item.tamanho)
+                        resultados.append(protocolo.ResultadoLote(item.nome, False, "Comando inválido no lote"))
+                        continue
+                    await protocolo_async.reenviar_cabecalho(cluster_writer, item)
+                    await protocolo_async.repassar(reader, cluster_writer, item.tamanho, tempo_limite=self.tempo_limite)
+                    resposta = await self.aguardar_resposta(cluster_reader)
+                    mensagem = await asyncio.wait_for(protocolo_async.receber_payload(cluster_reader, resposta),
+                                                      self.tempo_limite)
+                    resultados.append(protocolo.ResultadoLote(item.nome, resposta.opcode == protocolo.OK,
+                                                              mensagem.decode(errors="replace")))
+        except ClusterIndisponivel as e:
+            # O OK não foi enviado: o cliente não manda os arquivos
+            await self.responder_indisponivel(cab, writer, e)
+            return
+        await self.responder_lote(cab, writer, resultados)
+
+    async def processar_lote_download(self, cab, writer, parametros):
+        """
+        Atende um MDOWNLOAD: envia as imagens na ordem pedida, um quadro por imagem (OK com o
+        arquivo ou ERRO com a mensagem, ambos com o nome da imagem), e no fim o resultado de
+        cada uma.
+        """
+        try:
+            codecs, nomes = protocolo.desempacotar_lote_download(parametros)
+        except (protocolo.ErroProtocolo, struct.error, UnicodeDecodeError) as e:
+            await protocolo_async.enviar_quadro(writer, protocolo.ERRO, id_requisicao=cab.id_requisicao,
+                                                payload=f"Parâmetros de MDOWNLOAD inválidos: {e}")
+            return
+        try:
+            async with self.pool.conexao(transferencia=True) as (cluster_reader, cluster_writer):
+                resultados = []
+                for nome in nomes:
+                    await protocolo_async.enviar_quadro(cluster_writer, protocolo.DOWNLOAD, nome, bytes(codecs))
+                    resposta = await self.aguardar_resposta(cluster_reader)
+                    if resposta.opcode == protocolo.OK:
+                        await protocolo_async.reenviar_cabecalho(writer, resposta._replace(nome=nome),
+                                                                 id_requisicao=cab.id_requisicao)
+                        await protocolo_async.repassar(cluster_reader, writer, resposta.tamanho,
+                                                       tempo_limite=self.tempo_limite)
+                        resultados.append(protocolo.ResultadoLote(nome, True, f"{resposta.tamanho} bytes"))
+                        continue
+                    mensagem = await asyncio.wait_for(protocolo_async.receber_payload(cluster_reader, resposta),
+                                                      self.tempo_limite)
+                    await protocolo_async.enviar_quadro(writer, protocolo.ERRO, nome, mensagem,
+                                                        id_requisicao=cab.id_requisicao)
+                    resultados.append(protocolo.ResultadoLote(nome, False, mensagem.decode(errors="replace")))
+        except ClusterIndisponivel as e:
+            # Nenhuma imagem foi enviada: o lote é recusado com um só quadro de erro
+            await self.responder_indisponivel(cab, writer, e)
+            return
+        await self.responder_lote(cab, writer, resultados)
+
+    async def processar_lote_delete(self, cab, writer, parametros):
+        """Atende um MDELETE: remove as imagens, uma de cada vez, e responde com o resultado de cada uma."""
+        try:
+            nomes = protocolo.desempacotar_nomes(parametros)
+        except (protocolo.ErroProtocolo, struct.error, UnicodeDecodeError) as e:
+            await protocolo_async.enviar_quadro(writer, protocolo.ERRO, id_requisicao=cab.id_requisicao,
+                                                payload=f"Parâmetros de MDELETE inválidos: {e}")
+            return
+        try:
+            async with self.pool.conexao() as (cluster_reader, cluster_writer):
+                resultados = []
+                for nome in nomes:
+                    resposta, mensagem = await self.consultar(cluster_reader, cluster_writer, protocolo.DELETE, nome)
+                    resultados.append(protocolo.ResultadoLote(nome, resposta.opcode == protocolo.OK,
+                                                              mensagem.decode(errors="replace")))
+        except ClusterIndisponivel as e:
+            await self.responder_indisponivel(cab, writer, e)
+            return
+        await self.responder_lote(cab, writer, resultados)
+
+    async def processar_estatisticas(self, cab, writer):
+        """
+        Responde com as estatísticas (JSON) no formato do Servidor com threads: as métricas do
+        servidor e as do cluster (ou o erro ao consultá-lo). O modo async não tem cache.
+        """
+        no = f"{self.pool.host}:{self.pool.porta}"
+        try:
+            async with self.pool.conexao() as (cluster_reader, cluster_writer):
+                resposta, payload = await self.consultar(cluster_reader, cluster_writer, protocolo.ESTATISTICAS)
+            nos = {no: json.loads(payload) if resposta.opcode == protocolo.OK
+                   else {"erro": payload.decode(errors="replace")}}
+        except ClusterIndisponivel as e:
+            nos = {no: {"erro": str(e)}}
+        estatisticas = {"cache": None, "metricas": metricas.REGISTRO.json(), "nos": nos}
+        await protocolo_async.enviar_quadro(writer, protocolo.OK, payload=json.dumps(estatisticas),
+                                            id_requisicao=cab.id_requisicao)
+
+    async def iniciar(self):
+        """Inicia o servidor asyncio e aceita conexões de clientes."""
+        servidor = await asyncio.start_server(self.tratar_cliente, self.host, self.porta,
+                                              backlog=self.backlog, limit=self.limite_buffer)
+        log.info("Servidor (asyncio) ouvindo em %s:%d (backlog %d)", self.host, self.porta, self.backlog)
+        try:
+            async with servidor:
+                await servidor.serve_forever()
+        finally:
+            self.pool.fechar()
+
+if __name__ == "__main__":
+    asyncio.run(ServidorAsync().iniciar())